@@ -10,13 +10,16 @@ directory. Maintaining these files by hand is too unwieldy.
 import argparse
 import ast
 import collections
+import concurrent.futures
 import copy
 import difflib
 import functools
 import glob
+import hashlib
 import itertools
 import json
 import os
+import pickle
 import string
 import sys
 
@@ -37,12 +40,233 @@ BROWSER_CONFIG_TO_TARGET_SUFFIX_MAP = {
   'android-webview': '_android_webview',
 }
 
+# Query parameters that are matched against a test's swarming dimensions.
+QUERY_DIMENSION_PARAMS = (
+  'device_os',
+  'device_type',
+  'os',
+  'kvm',
+  'pool',
+  'integrity',
+)
+
+# Query parameters that are matched against a test's swarming settings.
+QUERY_SWARMING_PARAMS = (
+  'shards',
+  'hard_timeout',
+  'idempotent',
+  'can_use_on_swarming_builders',
+)
+
+# Query parameters that are matched against a builder's configuration in
+# waterfalls.pyl rather than against its tests.
+QUERY_BUILDER_PARAMS = ('os_type',)
+
 
 class BBGenErr(Exception):
   def __init__(self, message):
     super(BBGenErr, self).__init__(message)
 
 
+def fingerprint(value):
+  """Returns a stable digest of a value parsed from a .pyl or .json file."""
+  return hashlib.sha256(
+    json.dumps(value, sort_keys=True, default=repr).encode('utf-8')
+  ).hexdigest()
+
+
+# Represents a value that is missing from one side of a diff_json_values
+# comparison.
+_MISSING = object()
+
+
+def _is_step_list(value):
+  names = [s.get('name') if isinstance(s, dict) else None for s in value]
+  return bool(names) and None not in names and len(set(names)) == len(names)
+
+
+def diff_json_values(expected, current, path=()):
+  """Yields the differences between two values parsed from JSON.
+
+  Dictionaries are compared key by key and lists of steps (dictionaries with
+  unique names) are compared by step name, so that each difference is reported
+  at the most specific location possible. Other values are compared as a whole.
+
+  Yields:
+    (path, expected, current) tuples, where path is a tuple of the keys and step
+    names leading to the difference. A value that is missing on one side is
+    represented by _MISSING.
+  """
+  if isinstance(expected, dict) and isinstance(current, dict):
+    for key in sorted(expected.keys() | current.keys()):
+      yield from diff_json_values(
+        expected.get(key, _MISSING), current.get(key, _MISSING), path + (key,)
+      )
+  elif (
+    isinstance(expected, list)
+    and isinstance(current, list)
+    and _is_step_list(expected)
+    and _is_step_list(current)
+  ):
+    yield from diff_json_values(
+      {step['name']: step for step in expected},
+      {step['name']: step for step in current},
+      path,
+    )
+  elif expected != current:
+    yield path, expected, current
+
+
+def _source_fingerprint():
+  digest = hashlib.sha256()
+  for path in (__file__, magic_substitutions.__file__):
+    with open(path, 'rb') as fp:
+      digest.update(fp.read())
+  return digest.hexdigest()
+
+
+# Changes to the generator itself invalidate any incremental cache.
+SOURCE_FINGERPRINT = _source_fingerprint()
+
+
+class IncrementalCache(object):  # pylint: disable=useless-object-inheritance
+  """Cache of generated outputs keyed on the inputs used to generate them.
+
+  The entry for each builder records a fingerprint of the builder's resolved
+  configuration (which includes its test suites and any variants they expand
+  to) along with a fingerprint of every mixin, test suite exception and isolate
+  map entry that was consulted while generating its tests. A builder's cached
+  tests are only reused if all of those fingerprints still match. A waterfall's
+  jsonified contents are only reused if none of its builders or autoshard
+  exceptions changed.
+  """
+
+  VERSION = 1
+
+  def __init__(self, bb_gen, path):
+    self._bb_gen = bb_gen
+    self._path = path
+    self._key = fingerprint([
+      self.VERSION,
+      SOURCE_FINGERPRINT,
+      sorted(bb_gen.exclude_test_id_prefix),
+    ])
+    self._waterfalls = {}
+    self._new_waterfalls = {}
+    self._dependency_fingerprints = {}
+    self._suite_fingerprints = {}
+
+    if os.path.exists(path):
+      try:
+        cache = json.loads(bb_gen.read_file(path))
+      except ValueError:
+        cache = {}
+      if cache.get('key') == self._key:
+        self._waterfalls = cache['waterfalls']
+
+  def _dependency_fingerprint(self, kind, name):
+    key = (kind, name)
+    if key not in self._dependency_fingerprints:
+      self._dependency_fingerprints[key] = fingerprint(
+        self._bb_gen.get_dependency_value(kind, name)
+      )
+    return self._dependency_fingerprints[key]
+
+  def _config_fingerprint(self, waterfall, config):
+    # Resolved test suites are shared between builders, so only fingerprint
+    # each one once.
+    suites = {}
+    for test_type, suite in config.get('test_suites', {}).items():
+      if id(suite) not in self._suite_fingerprints:
+        self._suite_fingerprints[id(suite)] = fingerprint(suite)
+      suites[test_type] = self._suite_fingerprints[id(suite)]
+    return fingerprint({
+      'waterfall': {k: v for k, v in waterfall.items() if k != 'machines'},
+      'builder': {k: v for k, v in config.items() if k != 'test_suites'},
+      'test_suites': suites,
+    })
+
+  def get_tests_for_config(self, waterfall, name, config):
+    """Returns the tests for a builder, regenerating them only if needed."""
+    config_fingerprint = self._config_fingerprint(waterfall, config)
+    entry = self._waterfalls.get(waterfall['name'], {}).get('builders', {}).get(
+      name
+    )
+    if (
+      entry is None
+      or entry['config'] != config_fingerprint
+      or any(
+        self._dependency_fingerprint(kind, dep_name) != dep_fingerprint
+        for kind, dep_name, dep_fingerprint in entry['deps']
+      )
+    ):
+      tests, dependencies = self._bb_gen.get_tests_and_dependencies_for_config(
+        waterfall, name, config
+      )
+      entry = {
+        'config': config_fingerprint,
+        'deps': [
+          [kind, dep_name, self._dependency_fingerprint(kind, dep_name)]
+          for kind, dep_name in sorted(dependencies)
+        ],
+        'tests': tests,
+      }
+    new_waterfall = self._new_waterfalls.setdefault(
+      waterfall['name'], {'builders': {}}
+    )
+    new_waterfall['builders'][name] = entry
+    # The tests are modified after generation (e.g. by autoshard exceptions),
+    # so the cached copy must not be handed out.
+    return copy.deepcopy(entry['tests'])
+
+  def finish_waterfall(self, waterfall_name, autoshards):
+    """Records the fingerprint of a waterfall once all builders are done."""
+    new_waterfall = self._new_waterfalls.setdefault(
+      waterfall_name, {'builders': {}}
+    )
+    new_waterfall['fingerprint'] = fingerprint([
+      sorted(
+        (name, entry['config'], entry['deps'])
+        for name, entry in new_waterfall['builders'].items()
+      ),
+      autoshards,
+    ])
+
+  def jsonify(self, waterfall_name, contents):
+    """Returns the jsonified contents of a waterfall."""
+    new_waterfall = self._new_waterfalls[waterfall_name]
+    old_waterfall = self._waterfalls.get(waterfall_name, {})
+    if 'text' in old_waterfall and (
+      old_waterfall.get('fingerprint') == new_waterfall['fingerprint']
+    ):
+      new_waterfall['text'] = old_waterfall['text']
+    else:
+      new_waterfall['text'] = self._bb_gen.jsonify(contents)
+    return new_waterfall['text']
+
+  def get_waterfall_entry(self, waterfall_name):
+    return self._new_waterfalls[waterfall_name]
+
+  def set_waterfall_entry(self, waterfall_name, entry):
+    self._new_waterfalls[waterfall_name] = entry
+
+  def save(self):
+    waterfalls = {}
+    for waterfall in self._bb_gen.waterfalls:
+      name = waterfall['name']
+      # Waterfalls that were filtered out of this run keep their old entries.
+      entry = self._new_waterfalls.get(name, self._waterfalls.get(name))
+      if entry is not None:
+        waterfalls[name] = entry
+    parent = os.path.dirname(self._path)
+    if not os.path.exists(parent):
+      os.makedirs(parent)
+    self._bb_gen.write_file(
+      self._path,
+      json.dumps({'key': self._key, 'waterfalls': waterfalls}, sort_keys=True),
+    )
+
+
 class BaseGenerator(object):  # pylint: disable=useless-object-inheritance
   def __init__(self, bb_gen):
     self.bb_gen = bb_gen
@@ -281,6 +505,200 @@ def check_matrix_identifier(
       )
 
 
+class PylParseCache(object):  # pylint: disable=useless-object-inheritance
+  """On-disk cache of parsed .pyl files.
+
+  Each .pyl file has a cache entry containing its literal value and/or its AST
+  (used by the formatting checks), keyed by a hash of the file's contents. The
+  parsed data is stored pickled, so loading an unchanged file only requires
+  unpickling, which is much cheaper than parsing it again. Every lookup returns
+  a new copy of the parsed data, so callers are free to modify it.
+  """
+
+  VERSION = 1
+
+  def __init__(self, cache_dir):
+    self._cache_dir = cache_dir
+    # Pickled ASTs are specific to a python version.
+    self._key = fingerprint([self.VERSION, list(sys.version_info[:2])])
+    self._entries = {}
+
+  def _entry_path(self, pyl_file_path):
+    return os.path.join(
+      self._cache_dir,
+      hashlib.sha256(os.path.abspath(pyl_file_path).encode('utf-8')).hexdigest()
+      + '.pickle',
+    )
+
+  def _read_entry(self, entry_path):
+    if not os.path.exists(entry_path):
+      return None
+    # Unpickling corrupt data can raise nearly any exception, e.g. if it
+    # refers to a module or attribute that doesn't exist.
+    try:
+      with open(entry_path, 'rb') as fp:
+        entry = pickle.load(fp)
+    except Exception:  # pylint: disable=broad-except
+      return None
+    if not isinstance(entry, dict) or entry.get('key') != self._key:
+      return None
+    return entry
+
+  def _write_entry(self, entry_path, entry):
+    if not os.path.exists(self._cache_dir):
+      os.makedirs(self._cache_dir)
+    with open(entry_path, 'wb') as fp:
+      pickle.dump(entry, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+  def get(self, pyl_file_path, contents, kind, parse):
+    """Returns parsed data for a .pyl file, parsing it only if necessary.
+
+    Args:
+      pyl_file_path: The path to the .pyl file.
+      contents: The current contents of the .pyl file.
+      kind: The kind of parsed data to return, either 'value' or 'ast'.
+      parse: A function taking the contents of the .pyl file and returning the
+        parsed data of the given kind, used if the data isn't cached.
+    """
+    entry_path = self._entry_path(pyl_file_path)
+    content_hash = hashlib.sha256(contents.encode('utf-8')).hexdigest()
+    entry = self._entries.get(entry_path)
+    if entry is None:
+      entry = self._read_entry(entry_path)
+    if entry is None or entry['hash'] != content_hash:
+      entry = {'key': self._key, 'hash': content_hash}
+    self._entries[entry_path] = entry
+
+    if kind not in entry:
+      entry[kind] = pickle.dumps(
+        parse(contents), protocol=pickle.HIGHEST_PROTOCOL
+      )
+      self._write_entry(entry_path, entry)
+    return pickle.loads(entry[kind])
+
+
+class QueryIndex(object):  # pylint: disable=useless-object-inheritance
+  """Index of generated tests used to answer --query requests.
+
+  The index is built once per run from the generated test specs of every
+  builder. It maps test names to the builders that run them, builders to their
+  tests, and swarming dimensions, swarming settings, flags and other test fields
+  to the tests with those values, so that queries don't need to scan every
+  builder's tests.
+  """
+
+  VERSION = 1
+
+  def __init__(self, bots, tests_by_bot, tests, os_types):
+    """
+    Args:
+      bots: A dict mapping builder names to their generated test specs.
+      tests_by_bot: A dict mapping builder names to a flat list of their tests.
+      tests: A dict mapping test names to their definitions in the test suites.
+      os_types: A dict mapping builder names to their os_type.
+    """
+    self.bots = bots
+    self.tests_by_bot = tests_by_bot
+    self.tests = tests
+    self.os_types = os_types
+    self._bots_by_test = {}
+    self._postings = collections.defaultdict(set)
+    for bot, bot_tests in tests_by_bot.items():
+      for i, test_info in enumerate(bot_tests):
+        self._bots_by_test.setdefault(test_info['name'], []).append(bot)
+        for key in self._keys_for_test(test_info):
+          self._postings[key].add((bot, i))
+
+  @staticmethod
+  def _is_hashable(value):
+    return isinstance(value, (str, int, float, bool, type(None)))
+
+  def _keys_for_test(self, test_info):
+    keys = set()
+    swarming = test_info.get('swarming', {})
+    for dimension, value in swarming.get('dimensions', {}).items():
+      if self._is_hashable(value):
+        keys.add(('dimension', dimension, value))
+    for param in QUERY_SWARMING_PARAMS:
+      if param in swarming:
+        keys.add(('swarming', param, str(swarming[param])))
+    for arg in test_info.get('args', []):
+      keys.add(('flag', arg))
+    for field, value in test_info.items():
+      if self._is_hashable(value):
+        keys.add(('field', field, value))
+    return keys
+
+  @staticmethod
+  def _key_for_param(param, value):
+    # This mirrors the matching done by BBJSONGenerator.does_test_match.
+    if param in QUERY_DIMENSION_PARAMS:
+      return ('dimension', param, value)
+    if param in QUERY_SWARMING_PARAMS:
+      return ('swarming', param, value)
+    if param.startswith('--'):
+      return ('flag', param)
+    return ('field', param, value)
+
+  def bots_for_test(self, test_name):
+    """Returns the builders that run a test, once for each matching test."""
+    return list(self._bots_by_test.get(test_name, []))
+
+  def find_bots(self, params_dict):
+    """Returns the builders matching all of the given parameters.
+
+    os_type parameters are matched against the builder's configuration, all
+    other parameters must be matched by the same test on the builder.
+    """
+    matching_bots = set(self.bots)
+    matching_tests = None
+    for param, value in params_dict.items():
+      if param in QUERY_BUILDER_PARAMS:
+        matching_bots.intersection_update(
+          bot for bot in self.bots if self.os_types.get(bot) == value
+        )
+        continue
+      postings = self._postings.get(self._key_for_param(param, value), set())
+      if matching_tests is None:
+        matching_tests = set(postings)
+      else:
+        matching_tests.intersection_update(postings)
+    if matching_tests is not None:
+      matching_bots.intersection_update(bot for bot, _ in matching_tests)
+    return [bot for bot in self.bots if bot in matching_bots]
+
+  def to_json(self):
+    return {
+      'bots': self.bots,
+      'tests': self.tests,
+      'os_types': self.os_types,
+    }
+
+
+# The generator used by a worker process when generating waterfalls in parallel,
+# see BBJSONGenerator.generate_waterfall_outputs_in_parallel.
+_worker_bb_gen = None
+
+
+def _initialize_worker(bb_gen):  # pragma: no cover
+  # Runs in the worker processes, so coverage can't be measured.
+  global _worker_bb_gen  # pylint: disable=global-statement
+  _worker_bb_gen = bb_gen
+
+
+def _generate_waterfall_output_in_worker(index, autoshards):  # pragma: no cover
+  # Runs in the worker processes, so coverage can't be measured.
+  waterfall = _worker_bb_gen.waterfalls[index]
+  all_tests = _worker_bb_gen.generate_waterfall_output(waterfall, autoshards)
+  text = _worker_bb_gen.jsonify_output(waterfall['name'], all_tests)
+  cache_entry = None
+  if _worker_bb_gen.incremental_cache is not None:
+    cache_entry = _worker_bb_gen.incremental_cache.get_waterfall_entry(
+      waterfall['name']
+    )
+  return all_tests, text, cache_entry
+
+
 class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
   def __init__(self, args):
     self.args = args
@@ -291,6 +709,12 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
     self.gn_isolate_map = None
     self.variants = None
     self.exclude_test_id_prefix = set()
+    self.incremental_cache = None
+    self.recorded_dependencies = None
+    self.jsonified_outputs = {}
+    self.pyl_cache = None
+    if args.pyl_cache_dir:
+      self.pyl_cache = PylParseCache(args.pyl_cache_dir)
 
   class _ArgsNamespace(argparse.Namespace):
     def _pyl_dir_path(self, filename):
@@ -391,6 +815,9 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
         '    --query tests/"device_os:Android&device_type:hammerhead"\n\n'
         '  List all tests that run with a specific flag:\n'
         '    --query bots/"--test-launcher-print-test-studio=always"\n\n'
+        '  List all bots running "test1" on android with a specific\n'
+        '  dimension (separation of parameters by "&" symbol):\n'
+        '    --query bots/"name:test1&os_type:android&device_type:foo"\n\n'
         '  List specific test (make sure you have quotes):\n'
         '    --query test/"test1"\n\n'
         '  List all bots running "test1" '
@@ -403,6 +830,16 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
       type=os.path.abspath,
       help='Outputs results into a json file. Only works with query function.',
     )
+    parser.add_argument(
+      '--query-index',
+      metavar='PATH',
+      type=os.path.abspath,
+      help=(
+        'Path to a file used to store the index built for queries. Later'
+        ' queries reuse the stored index until any of the input files change.'
+        ' Only works with query function.'
+      ),
+    )
     parser.add_argument(
       '-n',
       '--new-files',
@@ -463,6 +900,37 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
       action='append',
       dest='isolate_map_files',
     )
+    parser.add_argument(
+      '-j',
+      '--jobs',
+      type=int,
+      default=1,
+      help=(
+        'Number of processes to use when generating waterfalls. Waterfalls'
+        ' are generated in parallel once the input files have been resolved.'
+      ),
+    )
+    parser.add_argument(
+      '--pyl-cache-dir',
+      metavar='PATH',
+      type=os.path.abspath,
+      help=(
+        'Path to a directory used to cache the parsed contents of the input'
+        ' .pyl files between runs. Files that have not changed since they were'
+        ' cached will not be parsed again.'
+      ),
+    )
+    parser.add_argument(
+      '--incremental-cache',
+      metavar='PATH',
+      type=os.path.abspath,
+      help=(
+        'Path to a file used to cache generated outputs between runs. When'
+        ' provided, only builders whose configuration, test suites, mixins,'
+        ' variants or test suite exceptions changed since the previous run'
+        ' will be regenerated.'
+      ),
+    )
     # TODO(crbug.com/465167917): Remove this field and usage after 90 days,
     # which is approximately around March 20, 2026.
     parser.add_argument(
@@ -491,6 +959,10 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
       parser.error(
         'The --json flag can only be used with --query.'
       )  # pragma: no cover
+    if args.query_index and not args.query:
+      parser.error(
+        'The --query-index flag can only be used with --query.'
+      )  # pragma: no cover
 
     # pylint: disable=attribute-defined-outside-init
     args.pyl_files_dir = args.pyl_files_dir or THIS_DIR
@@ -511,15 +983,26 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
     with open(file_path, 'w', newline='') as fp:
       fp.write(contents)
 
-  # pylint: disable=inconsistent-return-statements
   def load_pyl_file(self, pyl_file_path):
-    try:
-      return ast.literal_eval(self.read_file(pyl_file_path))
-    except (SyntaxError, ValueError) as e:  # pragma: no cover
-      raise BBGenErr(
-        'Failed to parse pyl file "%s": %s' % (pyl_file_path, e)
-      ) from e
-    # pylint: enable=inconsistent-return-statements
+    def parse(contents):
+      try:
+        return ast.literal_eval(contents)
+      except (SyntaxError, ValueError) as e:  # pragma: no cover
+        raise BBGenErr(
+          'Failed to parse pyl file "%s": %s' % (pyl_file_path, e)
+        ) from e
+
+    contents = self.read_file(pyl_file_path)
+    if self.pyl_cache is not None:
+      return self.pyl_cache.get(pyl_file_path, contents, 'value', parse)
+    return parse(contents)
+
+  def parse_pyl_file(self, pyl_file_path):
+    """Returns the AST for a .pyl file."""
+    contents = self.read_file(pyl_file_path)
+    if self.pyl_cache is not None:
+      return self.pyl_cache.get(pyl_file_path, contents, 'ast', ast.parse)
+    return ast.parse(contents)
 
   # TOOD(kbr): require that os_type be specified for all bots in waterfalls.pyl.
   # Currently it is only mandatory for bots which run GPU tests. Change these to
@@ -551,7 +1034,26 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
       and tester_config.get('browser_config') == 'release_x64'
     )
 
+  def record_dependency(self, kind, name):
+    """Records an input consulted while generating the current builder.
+
+    Args:
+      kind: One of 'mixin', 'exception' or 'isolate'.
+      name: The key of the input within mixins.pyl, test_suite_exceptions.pyl
+          or gn_isolate_map.pyl respectively.
+    """
+    if self.recorded_dependencies is not None:
+      self.recorded_dependencies.add((kind, name))
+
+  def get_dependency_value(self, kind, name):
+    return {
+      'exception': self.exceptions,
+      'isolate': self.gn_isolate_map,
+      'mixin': self.mixins,
+    }[kind].get(name)
+
   def get_exception_for_test(self, test_config):
+    self.record_dependency('exception', test_config['name'])
     return self.exceptions.get(test_config['name'])
 
   def should_run_on_tester(self, waterfall, tester_name, test_config):
@@ -1112,6 +1614,7 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
     )
 
     # Populate test_id_prefix.
+    self.record_dependency('isolate', result['test'])
     gn_entry = self.gn_isolate_map[result['test']]
     if result['test'] not in self.exclude_test_id_prefix:
       result['test_id_prefix'] = 'ninja:%s/' % gn_entry['label']
@@ -1581,9 +2084,16 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
   def apply_mixins(self, test, mixins, mixins_to_ignore, builder=None):
     for mixin in mixins:
       if mixin not in mixins_to_ignore:
+        self.record_dependency('mixin', mixin)
         test = self.apply_mixin(self.mixins[mixin], test, builder)
     return test
 
+  _MIXIN_ARGS_FIELDS = ('args', 'precommit_args', 'non_precommit_args')
+
+  _MIXIN_MERGED_FIELDS = frozenset(
+    _MIXIN_ARGS_FIELDS + ('description', 'resultdb', 'skylab', 'swarming')
+  )
+
   def apply_mixin(self, mixin, test, builder=None):
     """Applies a mixin to a test.
 
@@ -1598,53 +2108,58 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
         value.
       * For the dimensions sub-key, the tests's existing value (an empty
         dict if not present) will be updated with the mixin's value.
-    """
 
-    new_test = copy.deepcopy(test)
-    mixin = copy.deepcopy(mixin)
+    The test is updated in place and returned, so callers must own it (the
+    generators make a copy of the test config before any mixins are applied).
+    The mixin is never modified. Values that are merged (args, swarming,
+    dimensions, named caches, resultdb and skylab) are merged into containers
+    owned by the test, while other values are shared with the mixin and so must
+    not be modified in place.
+    """
 
     if 'description' in mixin:
       description = []
-      if 'description' in new_test:
-        description.append(new_test['description'])
-      description.append(mixin.pop('description'))
-      new_test['description'] = '\n'.join(description)
+      if 'description' in test:
+        description.append(test['description'])
+      description.append(mixin['description'])
+      test['description'] = '\n'.join(description)
 
     if 'swarming' in mixin:
-      self.merge_swarming(
-        new_test.setdefault('swarming', {}), mixin.pop('swarming')
-      )
+      self.merge_swarming(test.setdefault('swarming', {}), mixin['swarming'])
 
     if 'skylab' in mixin:
-      new_test.setdefault('skylab', {}).update(mixin.pop('skylab'))
+      test.setdefault('skylab', {}).update(mixin['skylab'])
 
-    for a in ('args', 'precommit_args', 'non_precommit_args'):
-      if (value := mixin.pop(a, None)) is None:
+    for a in self._MIXIN_ARGS_FIELDS:
+      if (value := mixin.get(a)) is None:
         continue
       if not isinstance(value, list):
         raise BBGenErr(f'"{a}" must be a list')
-      new_test.setdefault(a, []).extend(value)
+      test.setdefault(a, []).extend(value)
 
     if 'resultdb' in mixin:
-      new_test.setdefault('resultdb', {})
-      if 'base_variant' in mixin['resultdb']:
-        new_test['resultdb'].setdefault('base_variant', {}).update(
-          mixin['resultdb'].pop('base_variant')
+      resultdb = test.setdefault('resultdb', {})
+      mixin_resultdb = dict(mixin['resultdb'])
+      if 'base_variant' in mixin_resultdb:
+        resultdb.setdefault('base_variant', {}).update(
+          mixin_resultdb.pop('base_variant')
         )
-      new_test['resultdb'].update(mixin.pop('resultdb'))
+      resultdb.update(mixin_resultdb)
     # At this point, all keys that require merging are taken care of, so the
     # remaining entries can be copied over. The os-conditional entries will be
     # resolved immediately after and they are resolved before any mixins are
     # applied, so there's are no concerns about overwriting the corresponding
     # entry in the test.
-    new_test.update(mixin)
+    for key, value in mixin.items():
+      if key not in self._MIXIN_MERGED_FIELDS:
+        test[key] = value
     if builder:
-      self.resolve_os_conditional_values(new_test, builder)
+      self.resolve_os_conditional_values(test, builder)
 
-    if 'args' in new_test:
-      new_test['args'] = self.maybe_fixup_args_array(new_test['args'])
+    if 'args' in test:
+      test['args'] = self.maybe_fixup_args_array(test['args'])
 
-    return new_test
+    return test
 
   def generate_output_tests(self, waterfall):
     """Generates the tests for a waterfall.
@@ -1654,11 +2169,29 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
     Returns:
       A dictionary mapping builders to test specs
     """
+    get_tests_for_config = self.get_tests_for_config
+    if self.incremental_cache is not None:
+      get_tests_for_config = self.incremental_cache.get_tests_for_config
     return {
-      name: self.get_tests_for_config(waterfall, name, config)
+      name: get_tests_for_config(waterfall, name, config)
       for name, config in waterfall['machines'].items()
     }
 
+  def get_tests_and_dependencies_for_config(self, waterfall, name, config):
+    """Generates the tests for a builder, tracking the inputs used.
+
+    Returns:
+      A tuple of the builder's test specs and a set of (kind, name) tuples
+      identifying the mixins, exceptions and isolate map entries that were
+      consulted while generating them.
+    """
+    self.recorded_dependencies = set()
+    try:
+      tests = self.get_tests_for_config(waterfall, name, config)
+      return tests, self.recorded_dependencies
+    finally:
+      self.recorded_dependencies = None
+
   def get_tests_for_config(self, waterfall, name, config):
     generator_map = self.get_test_generator_map()
     test_type_remapper = self.get_test_type_remapper()
@@ -1694,11 +2227,24 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
       + '\n'
     )
 
+  def jsonify_output(self, filename, contents):
+    if filename in self.jsonified_outputs:
+      return self.jsonified_outputs[filename]
+    if self.incremental_cache is not None:
+      return self.incremental_cache.jsonify(filename, contents)
+    return self.jsonify(contents)
+
   def generate_outputs(self):  # pragma: no cover
     self.load_configuration_files()
     self.resolve_configuration_files()
     filters = self.args.waterfall_filters
     result = collections.defaultdict(dict)
+    self.jsonified_outputs = {}
+
+    if self.args.incremental_cache:
+      self.incremental_cache = IncrementalCache(
+        self, self.args.incremental_cache
+      )
 
     if os.path.exists(self.args.autoshard_exceptions_json_path):
       autoshards = json.loads(
@@ -1708,6 +2254,7 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
       autoshards = {}
 
     required_fields = ('name',)
+    waterfalls = []
     for waterfall in self.waterfalls:
       for field in required_fields:
         # Verify required fields
@@ -1717,13 +2264,37 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
       # Handle filter flag, if specified
       if filters and waterfall['name'] not in filters:
         continue
+      waterfalls.append(waterfall)
 
-      # Join config files and hardcoded values together
-      all_tests = self.generate_output_tests(waterfall)
-      result[waterfall['name']] = all_tests
+    if self.args.jobs > 1:
+      result.update(
+        self.generate_waterfall_outputs_in_parallel(waterfalls, autoshards)
+      )
+    else:
+      for waterfall in waterfalls:
+        result[waterfall['name']] = self.generate_waterfall_output(
+          waterfall, autoshards.get(waterfall['name'], {})
+        )
 
-      if not autoshards:
-        continue
+    return result
+
+  def generate_waterfall_output(self, waterfall, autoshards):
+    """Generates the contents of the output file for a waterfall.
+
+    Args:
+      waterfall: a dictionary parsed from a master pyl file
+      autoshards: a dictionary mapping the waterfall's builders to the
+        autoshard exceptions for their tests
+    Returns:
+      A dictionary mapping builders to test specs, including the do not edit
+      warning entries
+    """
+    # Join config files and hardcoded values together
+    all_tests = self.generate_output_tests(waterfall)
+    if self.incremental_cache is not None:
+      self.incremental_cache.finish_waterfall(waterfall['name'], autoshards)
+
+    if autoshards:
       for builder, test_spec in all_tests.items():
         for target_type, test_list in test_spec.items():
           if target_type == 'additional_compile_targets':
@@ -1736,22 +2307,59 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
             # test = content_browsertests and
             # test_id_prefix = "ninja://content/test:content_browsertests/"
             test_name = test_dict['name']
-            shard_info = (
-              autoshards.get(waterfall['name'], {})
-              .get(builder, {})
-              .get(test_name)
-            )
+            shard_info = autoshards.get(builder, {}).get(test_name)
             if shard_info:
               test_dict['swarming'].update(
                 {'shards': int(shard_info['shards'])}
               )
 
     # Add do not edit warning
-    for tests in result.values():
-      tests['AAAAA1 AUTOGENERATED FILE DO NOT EDIT'] = {}
-      tests['AAAAA2 See generate_buildbot_json.py to make changes'] = {}
+    all_tests['AAAAA1 AUTOGENERATED FILE DO NOT EDIT'] = {}
+    all_tests['AAAAA2 See generate_buildbot_json.py to make changes'] = {}
 
-    return result
+    return all_tests
+
+  def generate_waterfall_outputs_in_parallel(self, waterfalls, autoshards):
+    """Generates the outputs for waterfalls using a pool of processes.
+
+    Each worker process generates and jsonifies whole waterfalls; the jsonified
+    text is kept so that it doesn't need to be regenerated when the outputs are
+    written or checked.
+
+    Args:
+      waterfalls: a list of the waterfalls to generate
+      autoshards: a dictionary mapping waterfall names to autoshard exceptions
+    Returns:
+      A dictionary mapping waterfall names to the contents of their output
+      file, in the same order as |waterfalls|
+    """
+    indices = {id(w): i for i, w in enumerate(self.waterfalls)}
+    with concurrent.futures.ProcessPoolExecutor(
+      max_workers=self.args.jobs,
+      initializer=_initialize_worker,
+      initargs=(self,),
+    ) as executor:
+      # Start the largest waterfalls first so that they don't end up being the
+      # only ones left running at the end.
+      futures = {}
+      for waterfall in sorted(
+        waterfalls, key=lambda w: len(w['machines']), reverse=True
+      ):
+        futures[waterfall['name']] = executor.submit(
+          _generate_waterfall_output_in_worker,
+          indices[id(waterfall)],
+          autoshards.get(waterfall['name'], {}),
+        )
+
+      result = {}
+      for waterfall in waterfalls:
+        name = waterfall['name']
+        all_tests, text, cache_entry = futures[name].result()
+        result[name] = all_tests
+        self.jsonified_outputs[name] = text
+        if self.incremental_cache is not None:
+          self.incremental_cache.set_waterfall_entry(name, cache_entry)
+      return result
 
   def write_json_result(self, result):  # pragma: no cover
     suffix = '.json'
@@ -1759,10 +2367,13 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
       suffix = '.new' + suffix
 
     for filename, contents in result.items():
-      jsonstr = self.jsonify(contents)
+      jsonstr = self.jsonify_output(filename, contents)
       file_path = os.path.join(self.args.output_dir, filename + suffix)
       self.write_file(file_path, jsonstr)
 
+    if self.incremental_cache is not None:
+      self.incremental_cache.save()
+
   def get_valid_bot_names(self):
     # Extract bot names from infra/config/generated/luci/luci-milo.cfg.
     # NOTE: This reference can cause issues; if a file changes there, the
@@ -2142,7 +2753,7 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
       """Parses and validates a .pyl file.
 
       Returns an AST node representing the value in the pyl file."""
-      parsed = ast.parse(self.read_file(file_path))
+      parsed = self.parse_pyl_file(file_path)
 
       # Must be a module.
       self.type_assert(parsed, ast.Module, file_path, verbose)
@@ -2255,23 +2866,24 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
     ungenerated_files = set()
     outputs = self.generate_outputs()
     for filename, expected_contents in outputs.items():
-      expected = self.jsonify(expected_contents)
+      expected = self.jsonify_output(filename, expected_contents)
       file_path = os.path.join(self.args.output_dir, filename + '.json')
       current = self.read_file(file_path)
       if expected != current:
         ungenerated_files.add(filename)
-        if verbose:  # pragma: no cover
-          self.print_line(
-            'File ' + filename + '.json did not have the following expected '
-            'contents:'
-          )
-          for line in difflib.unified_diff(
-            expected.splitlines(),
-            current.splitlines(),
-            fromfile='expected',
-            tofile='current',
-          ):
-            self.print_line(line)
+        if not verbose:
+          # Only the names of the out of date files are reported, so skip
+          # describing the differences.
+          continue
+        self.print_line(
+          'File ' + filename + '.json did not have the following expected '
+          'contents:'
+        )
+        for line in self.describe_output_differences(expected, current):
+          self.print_line(line)
+
+    if self.incremental_cache is not None:
+      self.incremental_cache.save()
 
     if ungenerated_files:
       raise BBGenErr(
@@ -2289,6 +2901,54 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
               builder_group, builder, step_name, step_data
             )
 
+  def describe_output_differences(self, expected, current):
+    """Yields lines describing how an output file differs from what's expected.
+
+    The contents are compared as parsed JSON so that differences can be reported
+    per builder and per step, rather than rendering a diff of the whole file.
+
+    Args:
+      expected: The expected contents of the output file.
+      current: The current contents of the output file.
+    """
+    try:
+      current_value = json.loads(current)
+    except ValueError as e:
+      yield '  The current contents are not valid JSON: %s' % e
+      return
+
+    def render(value):
+      if value is _MISSING:
+        return 'nothing'
+      return json.dumps(value, sort_keys=True)
+
+    found_difference = False
+    for path, expected_value, current_value in diff_json_values(
+      json.loads(expected), current_value
+    ):
+      found_difference = True
+      yield '  %s: expected %s, found %s' % (
+        ' / '.join(path),
+        render(expected_value),
+        render(current_value),
+      )
+
+    if not found_difference:
+      expected_lines = expected.splitlines()
+      current_lines = current.splitlines()
+      line = next(
+        (
+          i
+          for i, (e, c) in enumerate(zip(expected_lines, current_lines))
+          if e != c
+        ),
+        min(len(expected_lines), len(current_lines)),
+      )
+      yield (
+        '  The contents match but are not formatted or ordered as generated,'
+        ' starting at line %d' % (line + 1)
+      )
+
   def _check_swarming_config(self, filename, builder, step_name, step_data):
     # TODO(crbug.com/40179524): Ensure all swarming tests specify cpu, not
     # just mac tests.
@@ -2334,20 +2994,8 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
         }
 
     """
-    DIMENSION_PARAMS = [
-      'device_os',
-      'device_type',
-      'os',
-      'kvm',
-      'pool',
-      'integrity',
-    ]  # dimension parameters
-    SWARMING_PARAMS = [
-      'shards',
-      'hard_timeout',
-      'idempotent',
-      'can_use_on_swarming_builders',
-    ]
+    DIMENSION_PARAMS = QUERY_DIMENSION_PARAMS
+    SWARMING_PARAMS = QUERY_SWARMING_PARAMS
     for param in params_dict:
       # if dimension parameter
       if param in DIMENSION_PARAMS or param in SWARMING_PARAMS:
@@ -2399,18 +3047,6 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
     )
     sys.exit(1)
 
-  def find_bots_that_run_test(self, test, bots):
-    matching_bots = []
-    for bot in bots:
-      bot_info = bots[bot]
-      tests = self.flatten_tests_for_bot(bot_info)
-      for test_info in tests:
-        test_name = test_info['name']
-        if not test_name == test:
-          continue
-        matching_bots.append(bot)
-    return matching_bots
-
   def find_tests_with_params(self, tests, params_dict):
     matching_tests = []
     for test_name in tests:
@@ -2441,8 +3077,7 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
     for test_cat in TEST_CATS:
       if not test_cat in bot_info:
         continue
-      test_cat_tests = bot_info[test_cat]
-      tests = tests + test_cat_tests
+      tests.extend(bot_info[test_cat])
     return tests
 
   def flatten_tests_for_query(self, test_suites):
@@ -2483,17 +3118,66 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
           params_dict[pair[0]] = pair[1]
     return params_dict
 
-  def get_test_suites_dict(self, bots):
-    """Returns a dictionary of bots and their tests.
+  def build_query_index(self, bots, tests, os_types):
+    tests_by_bot = {
+      bot: self.flatten_tests_for_bot(bot_info)
+      for bot, bot_info in bots.items()
+    }
+    return QueryIndex(bots, tests_by_bot, tests, os_types)
 
-    Returns a dictionary of bots and a list of their associated tests.
+  def get_query_index_key(self):
+    """Returns a fingerprint of all of the inputs used to build the index."""
+    input_files = [
+      self.args.waterfalls_pyl_path,
+      self.args.test_suites_pyl.actual_path,
+      self.args.test_suite_exceptions_pyl_path,
+      self.args.mixins_pyl.actual_path,
+      self.args.gn_isolate_map_pyl.actual_path,
+      self.args.variants_pyl.actual_path,
+    ]
+    input_files.extend(self.args.isolate_map_files)
+    input_files.extend(self.args.prefix_exclude_map_files)
+    return fingerprint(
+      [QueryIndex.VERSION, SOURCE_FINGERPRINT]
+      + [[path, self.read_file(path)] for path in input_files]
+    )
+
+  def get_query_index(self):
+    """Returns the index used to answer queries.
+
+    If --query-index was specified and the index stored there was built from
+    the current inputs, it is used without loading or generating anything.
+    Otherwise the index is built and stored there for later queries.
     """
-    test_suite_dict = dict()
-    for bot in bots:
-      bot_info = bots[bot]
-      tests = self.flatten_tests_for_bot(bot_info)
-      test_suite_dict[bot] = tests
-    return test_suite_dict
+    index_path = self.args.query_index
+    if index_path:
+      key = self.get_query_index_key()
+      stored = {}
+      if os.path.exists(index_path):
+        try:
+          stored = json.loads(self.read_file(index_path))
+        except ValueError:
+          pass
+      if stored.get('key') == key:
+        return self.build_query_index(**stored['index'])
+
+    self.load_configuration_files()
+    self.resolve_configuration_files()
+    os_types = {}
+    for waterfall in self.waterfalls:
+      for bot, config in waterfall['machines'].items():
+        os_types[bot] = config.get('os_type')
+    index = self.build_query_index(
+      self.flatten_waterfalls_for_query(self.waterfalls),
+      self.flatten_tests_for_query(self.test_suites),
+      os_types,
+    )
+
+    if index_path:
+      self.write_file(
+        index_path, json.dumps({'key': key, 'index': index.to_json()})
+      )
+    return index
 
   def output_query_result(self, result, json_file=None):
     """Outputs the result of the query.
@@ -2517,12 +3201,8 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
     """
     # split up query statement
     query = args.query.split('/')
-    self.load_configuration_files()
-    self.resolve_configuration_files()
-
-    # flatten bots json
-    tests = self.test_suites
-    bots = self.flatten_waterfalls_for_query(self.waterfalls)
+    index = self.get_query_index()
+    bots = index.bots
 
     cmd_class = query[0]
 
@@ -2533,9 +3213,17 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
       # query with specific parameters
       if len(query) == 2:
         if query[1] == 'tests':
-          test_suites_dict = self.get_test_suites_dict(bots)
-          return self.output_query_result(test_suites_dict, args.json)
-        self.error_msg('This query should be in the format: bots/tests.')
+          return self.output_query_result(index.tests_by_bot, args.json)
+        params = query[1].split('&')
+        if not all(':' in p or p.startswith('--') for p in params):
+          self.error_msg(
+            'This query should be in the format: bots/tests or '
+            'bots/<parameters>.'
+          )
+        params_dict = self.parse_query_filter_params(params)
+        return self.output_query_result(
+          index.find_bots(params_dict), args.json
+        )
 
       else:
         self.error_msg(
@@ -2561,8 +3249,7 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
           'The query should be in the format:bot/<bot-name>/tests.'
         )
 
-      bot_tests = self.flatten_tests_for_bot(bot_info)
-      return self.output_query_result(bot_tests, args.json)
+      return self.output_query_result(index.tests_by_bot[bot_id], args.json)
 
     # For queries starting with 'tests'
     elif cmd_class == 'tests':
@@ -2571,7 +3258,7 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
           'The query should have 0 or 1 "/", found %s instead.'
           % str(len(query) - 1)
         )
-      flattened_tests = self.flatten_tests_for_query(tests)
+      flattened_tests = index.tests
       if len(query) == 1:
         return self.output_query_result(flattened_tests, args.json)
 
@@ -2590,17 +3277,14 @@ class BBJSONGenerator(object):  # pylint: disable=useless-object-inheritance
         )
       test_id = query[1]
       if len(query) == 2:
-        flattened_tests = self.flatten_tests_for_query(tests)
-        for test in flattened_tests:
-          if test == test_id:
-            return self.output_query_result(flattened_tests[test], args.json)
+        if test_id in index.tests:
+          return self.output_query_result(index.tests[test_id], args.json)
         self.error_msg('There is no test named %s.' % test_id)
       if not query[2] == 'bots':
         self.error_msg(
           'The query should be in the format: test/<test-name>/bots'
         )
-      bots_for_test = self.find_bots_that_run_test(test_id, bots)
-      return self.output_query_result(bots_for_test)
+      return self.output_query_result(index.bots_for_test(test_id))
 
     else:
       self.error_msg(
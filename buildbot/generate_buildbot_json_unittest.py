@@ -5,11 +5,15 @@
 
 """Tests for generate_buildbot_json.py."""
 
+import ast
 import contextlib
+import itertools
 import json
 import os
+import pickle
 import re
 import unittest
+from unittest import mock
 
 # vpython-provided modules.
 from pyfakefs import fake_filesystem_unittest  # pylint: disable=import-error
@@ -1338,6 +1342,18 @@ AUTOSHARD_EXCEPTIONS = json.dumps(
   }
 )
 
+ANDROID_AUTOSHARD_EXCEPTIONS = json.dumps(
+  {
+    'chromium.test': {
+      'Fake Android K Tester': {
+        'foo_test': {
+          'shards': 3,
+        },
+      }
+    },
+  }
+)
+
 NO_BAR_TEST_EXCEPTIONS = """\
 {
   'bar_test': {
@@ -2441,11 +2457,127 @@ class UnitTest(TestCase):
       joined_lines,
       'File chromium.test.json did not have the following expected contents:.*',
     )
-    self.assertRegex(joined_lines, r'.*--- expected.*')
-    self.assertRegex(joined_lines, r'.*\+\+\+ current.*')
+    self.assertRegex(
+      joined_lines,
+      r'Fake Tester / gtest_tests: expected \[.*"name": "foo_test".*\],'
+      r' found \[{"test": "foo_test"}\]',
+    )
     fbb.printed_lines = []
     self.assertFalse(fbb.printed_lines)
 
+  def test_ungenerated_output_files_are_caught_without_verbose(self):
+    fbb = FakeBBGen(
+      self.args,
+      COMPOSITION_GTEST_SUITE_WATERFALL,
+      GOOD_COMPOSITION_TEST_SUITES,
+      LUCI_MILO_CFG,
+      exceptions=NO_BAR_TEST_EXCEPTIONS,
+    )
+    with self.assertRaisesRegex(
+      generate_buildbot_json.BBGenErr, 'chromium.test.json'
+    ):
+      fbb.check_output_file_consistency(verbose=False, dump=False)
+    self.assertFalse(fbb.printed_lines)
+
+  def test_all_ungenerated_output_files_are_reported(self):
+    waterfalls = COMPOSITION_GTEST_SUITE_WATERFALL.replace(
+      ']\n',
+      """\
+  {
+    'project': 'chromium',
+    'bucket': 'ci',
+    'name': 'chromium.test2',
+    'machines': {
+      'Fake Tester': {
+        'test_suites': {
+          'gtest_tests': 'composition_tests',
+        },
+      },
+    },
+  },
+]
+""",
+    )
+    fbb = FakeBBGen(
+      self.args,
+      waterfalls,
+      GOOD_COMPOSITION_TEST_SUITES,
+      LUCI_MILO_CFG,
+      exceptions=NO_BAR_TEST_EXCEPTIONS,
+    )
+    with self.assertRaises(generate_buildbot_json.BBGenErr) as e:
+      fbb.check_output_file_consistency(verbose=False, dump=False)
+    self.assertIn('chromium.test.json', str(e.exception))
+    self.assertIn('chromium.test2.json', str(e.exception))
+    self.assertFalse(fbb.printed_lines)
+
+  def test_output_step_differences_are_reported(self):
+    fbb = FakeBBGen(
+      self.args,
+      COMPOSITION_GTEST_SUITE_WATERFALL,
+      GOOD_COMPOSITION_TEST_SUITES,
+      LUCI_MILO_CFG,
+      exceptions=NO_BAR_TEST_EXCEPTIONS,
+    )
+    with self.assertRaises(generate_buildbot_json.BBGenErr):
+      fbb.check_output_file_consistency(verbose=True, dump=False)
+    self.assertEqual(
+      fbb.printed_lines[1:],
+      [
+        '  Fake Tester / gtest_tests / bar_test: expected nothing, found'
+        ' {"name": "bar_test", "test": "bar_test"}',
+        '  Fake Tester / gtest_tests / foo_test / merge: expected'
+        ' {"script": "//testing/merge_scripts/standard_gtest_merge.py"},'
+        ' found nothing',
+        '  Fake Tester / gtest_tests / foo_test / swarming / dimensions / os:'
+        ' expected "Linux", found "Mac"',
+      ],
+    )
+
+  def test_output_formatting_differences_are_reported(self):
+    fbb = FakeBBGen(
+      self.args,
+      COMPOSITION_GTEST_SUITE_WATERFALL,
+      GOOD_COMPOSITION_TEST_SUITES,
+      LUCI_MILO_CFG,
+      exceptions=NO_BAR_TEST_EXCEPTIONS,
+    )
+    with self.assertRaises(generate_buildbot_json.BBGenErr):
+      fbb.check_output_file_consistency(verbose=True, dump=False)
+    self.assertEqual(
+      fbb.printed_lines[1:],
+      [
+        '  The contents match but are not formatted or ordered as generated,'
+        ' starting at line 2',
+      ],
+    )
+
+  def test_invalid_output_files_are_reported(self):
+    fbb = FakeBBGen(
+      self.args,
+      COMPOSITION_GTEST_SUITE_WATERFALL,
+      GOOD_COMPOSITION_TEST_SUITES,
+      LUCI_MILO_CFG,
+      exceptions=NO_BAR_TEST_EXCEPTIONS,
+    )
+    with self.assertRaises(generate_buildbot_json.BBGenErr):
+      fbb.check_output_file_consistency(verbose=True, dump=False)
+    self.assertEqual(len(fbb.printed_lines), 2)
+    self.assertRegex(
+      fbb.printed_lines[1], 'The current contents are not valid JSON: .*'
+    )
+
+  def test_autoshard_exceptions_with_additional_compile_targets(self):
+    fbb = FakeBBGen(
+      self.args,
+      ANDROID_WATERFALL,
+      FOO_TEST_SUITE,
+      LUCI_MILO_CFG,
+      autoshard_exceptions=ANDROID_AUTOSHARD_EXCEPTIONS,
+    )
+    fbb.check_output_file_consistency(verbose=True)
+    self.assertFalse(fbb.printed_lines)
+
   def test_android_output_options(self):
     fbb = FakeBBGen(self.args, ANDROID_WATERFALL, FOO_TEST_SUITE, LUCI_MILO_CFG)
     fbb.check_output_file_consistency(verbose=True)
@@ -3444,6 +3576,24 @@ class MixinTests(TestCase):
     fbb.check_consistency(verbose=True)
     self.assertFalse(fbb.printed_lines)
 
+  def test_mixins_are_not_modified(self):
+    fbb = FakeBBGen(
+      self.args,
+      FOO_GTESTS_WATERFALL_MIXIN_WATERFALL,
+      FOO_TEST_SUITE_WITH_MIXIN,
+      LUCI_MILO_CFG,
+      mixins=SWARMING_MIXINS,
+    )
+    outputs = fbb.generate_outputs()
+    self.assertEqual(fbb.mixins, ast.literal_eval(SWARMING_MIXINS))
+
+    # Generating the same test for another builder must not be affected by
+    # modifications made to the first builder's output
+    test = outputs['chromium.test']['Fake Tester']['gtest_tests'][0]
+    test['swarming']['dimensions']['os'] = 'Modified'
+    test['resultdb']['base_variant']['variant_key'] = 'modified'
+    self.assertEqual(fbb.mixins, ast.literal_eval(SWARMING_MIXINS))
+
 
 TEST_SUITE_WITH_PARAMS = """\
 {
@@ -3729,6 +3879,105 @@ class QueryTests(TestCase):
     fbb.query(fbb.args)
     self.assertFalse(fbb.printed_lines)
 
+  def test_query_bots_params(self):
+    self.set_args('--query=bots/os_type:android&device_type:hammerhead')
+    fbb = FakeBBGen(
+      self.args,
+      ANDROID_WATERFALL,
+      GOOD_COMPOSITION_TEST_SUITES,
+      LUCI_MILO_CFG,
+      mixins=SWARMING_MIXINS_SORTED,
+    )
+    fbb.query(fbb.args)
+    query_json = json.loads(''.join(fbb.printed_lines))
+    self.assertEqual(
+      query_json, ['Fake Android K Tester', 'Fake Android L Tester']
+    )
+
+  def test_query_bots_params_matched_by_same_test(self):
+    self.set_args(
+      '--query=bots/name:foo_test&device_os:LMY41U&--recover-devices'
+    )
+    fbb = FakeBBGen(
+      self.args,
+      ANDROID_WATERFALL,
+      GOOD_COMPOSITION_TEST_SUITES,
+      LUCI_MILO_CFG,
+      mixins=SWARMING_MIXINS_SORTED,
+    )
+    fbb.query(fbb.args)
+    query_json = json.loads(''.join(fbb.printed_lines))
+    self.assertEqual(query_json, ['Fake Android L Tester'])
+
+  def test_query_bots_params_no_bots(self):
+    self.set_args('--query=bots/os_type:android&device_type:bullhead&shards:2')
+    fbb = FakeBBGen(
+      self.args,
+      ANDROID_WATERFALL,
+      GOOD_COMPOSITION_TEST_SUITES,
+      LUCI_MILO_CFG,
+      mixins=SWARMING_MIXINS_SORTED,
+    )
+    fbb.query(fbb.args)
+    query_json = json.loads(''.join(fbb.printed_lines))
+    self.assertEqual(query_json, [])
+
+  def test_query_index_is_reused(self):
+    index_path = os.path.join(THIS_DIR, 'query_index.json')
+    self.set_args('--query=bots/tests', '--query-index', index_path)
+    fbb = FakeBBGen(
+      self.args,
+      ANDROID_WATERFALL,
+      GOOD_COMPOSITION_TEST_SUITES,
+      LUCI_MILO_CFG,
+      mixins=SWARMING_MIXINS_SORTED,
+    )
+    fbb.query(fbb.args)
+    self.assertTrue(os.path.exists(index_path))
+
+    self.set_args('--query=test/foo_test/bots', '--query-index', index_path)
+    fbb = FakeBBGen(
+      self.args,
+      ANDROID_WATERFALL,
+      GOOD_COMPOSITION_TEST_SUITES,
+      LUCI_MILO_CFG,
+      mixins=SWARMING_MIXINS_SORTED,
+    )
+    with mock.patch.object(
+      fbb, 'load_configuration_files'
+    ) as load_configuration_files:
+      fbb.query(fbb.args)
+    load_configuration_files.assert_not_called()
+    query_json = json.loads(''.join(fbb.printed_lines))
+    self.assertEqual(query_json, TEST_QUERY_TEST_BOTS_OUTPUT)
+
+  def test_query_index_is_rebuilt_when_inputs_change(self):
+    index_path = os.path.join(THIS_DIR, 'query_index.json')
+    with open(index_path, 'w') as f:
+      f.write('not json')
+    self.set_args('--query=bots/tests', '--query-index', index_path)
+    fbb = FakeBBGen(
+      self.args,
+      ANDROID_WATERFALL,
+      GOOD_COMPOSITION_TEST_SUITES,
+      LUCI_MILO_CFG,
+      mixins=SWARMING_MIXINS_SORTED,
+    )
+    fbb.query(fbb.args)
+
+    fbb = FakeBBGen(
+      self.args,
+      ANDROID_WATERFALL,
+      GOOD_COMPOSITION_TEST_SUITES,
+      LUCI_MILO_CFG,
+      mixins=SWARMING_MIXINS,
+    )
+    with mock.patch.object(
+      fbb, 'load_configuration_files', wraps=fbb.load_configuration_files
+    ) as load_configuration_files:
+      fbb.query(fbb.args)
+    load_configuration_files.assert_called_once_with()
+
   def test_query_bots_tests(self):
     self.set_args('--query=bots/tests')
     fbb = FakeBBGen(
@@ -5504,5 +5753,290 @@ class SwarmingTests(TestCase):
     self.assertFalse(fbb.printed_lines)
 
 
+INCREMENTAL_WATERFALL = """\
+[
+  {
+    'project': 'chromium',
+    'bucket': 'ci',
+    'name': 'chromium.test',
+    'machines': {
+      'Fake Other Tester': {
+        'swarming': {
+          'dimensions': {
+            'os': 'Linux',
+          },
+        },
+        'test_suites': {
+          'gtest_tests': 'foo_tests',
+        },
+      },
+      'Fake Tester': {
+        'mixins': ['builder_mixin'],
+        'swarming': {
+          'dimensions': {
+            'os': 'Linux',
+          },
+        },
+        'test_suites': {
+          'gtest_tests': 'foo_tests',
+        },
+      },
+    },
+  },
+]
+"""
+
+INCREMENTAL_MIXINS = """\
+{
+  'builder_mixin': {
+    'swarming': {
+      'value': 'builder',
+    },
+  },
+}
+"""
+
+INCREMENTAL_MODIFIED_MIXINS = """\
+{
+  'builder_mixin': {
+    'swarming': {
+      'value': 'modified builder',
+    },
+  },
+}
+"""
+
+INCREMENTAL_LUCI_MILO_CFG = """\
+consoles {
+  builders {
+    name: "buildbucket/luci.chromium.ci/Fake Tester"
+    name: "buildbucket/luci.chromium.ci/Fake Other Tester"
+  }
+}
+"""
+
+
+class IncrementalWaterfallTestCase(TestCase):
+  """Base class for tests using the INCREMENTAL_* inputs."""
+
+  def create_fbb(self, mixins=INCREMENTAL_MIXINS):
+    return FakeBBGen(
+      self.args,
+      INCREMENTAL_WATERFALL,
+      FOO_TEST_SUITE,
+      INCREMENTAL_LUCI_MILO_CFG,
+      mixins=mixins,
+    )
+
+
+class IncrementalCacheTests(IncrementalWaterfallTestCase):
+  def setUp(self):
+    super(IncrementalCacheTests, self).setUp()
+    self.cache_path = os.path.join(THIS_DIR, 'cache', 'incremental.json')
+    self.set_args('--incremental-cache', self.cache_path)
+
+  def generate(self, fbb):
+    outputs = fbb.generate_outputs()
+    texts = {
+      filename: fbb.jsonify_output(filename, contents)
+      for filename, contents in outputs.items()
+    }
+    fbb.incremental_cache.save()
+    return outputs, texts
+
+  def generated_builders(self, fbb):
+    with mock.patch.object(
+      fbb, 'get_tests_for_config', wraps=fbb.get_tests_for_config
+    ) as get_tests_for_config:
+      outputs, texts = self.generate(fbb)
+    builders = sorted(c.args[1] for c in get_tests_for_config.call_args_list)
+    return builders, outputs, texts
+
+  def test_incremental_check_output_file_consistency(self):
+    fbb = self.create_fbb()
+    fbb.check_output_file_consistency(verbose=True)
+    self.assertFalse(fbb.printed_lines)
+    self.assertTrue(os.path.exists(self.cache_path))
+
+    fbb = self.create_fbb()
+    fbb.check_output_file_consistency(verbose=True)
+    self.assertFalse(fbb.printed_lines)
+
+  def test_unchanged_inputs_are_not_regenerated(self):
+    builders, outputs, texts = self.generated_builders(self.create_fbb())
+    self.assertEqual(builders, ['Fake Other Tester', 'Fake Tester'])
+
+    fbb = self.create_fbb()
+    with mock.patch.object(fbb, 'jsonify') as jsonify:
+      builders, cached_outputs, cached_texts = self.generated_builders(fbb)
+    self.assertEqual(builders, [])
+    jsonify.assert_not_called()
+    self.assertEqual(
+      fbb.incremental_cache.get_waterfall_entry('chromium.test')['text'],
+      texts['chromium.test'],
+    )
+    self.assertEqual(cached_outputs, outputs)
+    self.assertEqual(cached_texts, texts)
+
+  def test_changed_mixin_regenerates_dependent_builders(self):
+    self.generated_builders(self.create_fbb())
+
+    fbb = self.create_fbb(mixins=INCREMENTAL_MODIFIED_MIXINS)
+    builders, outputs, texts = self.generated_builders(fbb)
+    self.assertEqual(builders, ['Fake Tester'])
+
+    self.set_args()
+    fbb = self.create_fbb(mixins=INCREMENTAL_MODIFIED_MIXINS)
+    expected_outputs = fbb.generate_outputs()
+    self.assertEqual(outputs, expected_outputs)
+    self.assertEqual(
+      texts['chromium.test'], fbb.jsonify(expected_outputs['chromium.test'])
+    )
+
+  def test_invalid_cache_is_ignored(self):
+    os.makedirs(os.path.dirname(self.cache_path))
+    with open(self.cache_path, 'w') as f:
+      f.write('not json')
+
+    builders, _, _ = self.generated_builders(self.create_fbb())
+    self.assertEqual(builders, ['Fake Other Tester', 'Fake Tester'])
+    builders, _, _ = self.generated_builders(self.create_fbb())
+    self.assertEqual(builders, [])
+
+
+class ParallelGenerationTests(IncrementalWaterfallTestCase):
+  def setUp(self):
+    super(ParallelGenerationTests, self).setUp()
+    bb_gen_class = generate_buildbot_json.BBJSONGenerator
+    generate_in_parallel = bb_gen_class.generate_waterfall_outputs_in_parallel
+
+    def generate_in_parallel_with_real_fs(fbb, *args):
+      # Worker processes can't be started while the filesystem is faked, but
+      # they don't need access to any files.
+      with fake_filesystem_unittest.Pause(self.fs):
+        return generate_in_parallel(fbb, *args)
+
+    patcher = mock.patch.object(
+      FakeBBGen,
+      'generate_waterfall_outputs_in_parallel',
+      generate_in_parallel_with_real_fs,
+    )
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def test_parallel_output_matches_serial_output(self):
+    fbb = self.create_fbb()
+    expected_outputs = fbb.generate_outputs()
+
+    self.set_args('--jobs', '2')
+    fbb = self.create_fbb()
+    outputs = fbb.generate_outputs()
+    self.assertEqual(outputs, expected_outputs)
+    self.assertEqual(list(outputs), list(expected_outputs))
+    self.assertEqual(
+      fbb.jsonify_output('chromium.test', outputs['chromium.test']),
+      fbb.jsonify(expected_outputs['chromium.test']),
+    )
+
+  def test_parallel_output_updates_incremental_cache(self):
+    cache_path = os.path.join(THIS_DIR, 'cache', 'incremental.json')
+    self.set_args('--jobs', '2', '--incremental-cache', cache_path)
+    fbb = self.create_fbb()
+    outputs = fbb.generate_outputs()
+    text = fbb.jsonify_output('chromium.test', outputs['chromium.test'])
+    fbb.incremental_cache.save()
+
+    self.set_args('--incremental-cache', cache_path)
+    fbb = self.create_fbb()
+    with mock.patch.object(fbb, 'get_tests_for_config') as get_tests_for_config:
+      cached_outputs = fbb.generate_outputs()
+    get_tests_for_config.assert_not_called()
+    self.assertEqual(cached_outputs, outputs)
+    self.assertEqual(
+      fbb.jsonify_output('chromium.test', cached_outputs['chromium.test']), text
+    )
+
+
+class PylParseCacheTests(IncrementalWaterfallTestCase):
+  def setUp(self):
+    super(PylParseCacheTests, self).setUp()
+    self.cache_dir = os.path.join(THIS_DIR, 'pyl_cache')
+    self.set_args('--pyl-cache-dir', self.cache_dir)
+
+  def test_cached_pyl_files_are_not_parsed_again(self):
+    fbb = self.create_fbb()
+    fbb.check_input_files_sorting(verbose=True)
+    expected_outputs = fbb.generate_outputs()
+    self.assertTrue(os.listdir(self.cache_dir))
+
+    fbb = self.create_fbb()
+    with mock.patch.object(
+      ast, 'literal_eval', wraps=ast.literal_eval
+    ) as literal_eval:
+      with mock.patch.object(ast, 'parse', wraps=ast.parse) as parse:
+        fbb.check_input_files_sorting(verbose=True)
+        outputs = fbb.generate_outputs()
+    literal_eval.assert_not_called()
+    parse.assert_not_called()
+    self.assertEqual(outputs, expected_outputs)
+
+  def test_modified_pyl_files_are_parsed_again(self):
+    self.create_fbb().generate_outputs()
+
+    fbb = self.create_fbb(mixins=INCREMENTAL_MODIFIED_MIXINS)
+    with mock.patch.object(
+      ast, 'literal_eval', wraps=ast.literal_eval
+    ) as literal_eval:
+      outputs = fbb.generate_outputs()
+    literal_eval.assert_called_once_with(INCREMENTAL_MODIFIED_MIXINS)
+
+    self.set_args()
+    self.assertEqual(
+      outputs,
+      self.create_fbb(mixins=INCREMENTAL_MODIFIED_MIXINS).generate_outputs(),
+    )
+
+  def test_invalid_cache_entries_are_ignored(self):
+    self.create_fbb().generate_outputs()
+    invalid_entries = itertools.cycle([
+      b'not a pickle',
+      pickle.dumps({'key': 'stale', 'hash': 'stale'}),
+    ])
+    for filename, entry in zip(os.listdir(self.cache_dir), invalid_entries):
+      with open(os.path.join(self.cache_dir, filename), 'wb') as f:
+        f.write(entry)
+
+    fbb = self.create_fbb()
+    with mock.patch.object(
+      ast, 'literal_eval', wraps=ast.literal_eval
+    ) as literal_eval:
+      fbb.generate_outputs()
+    self.assertTrue(literal_eval.called)
+
+  def test_corrupt_cache_files_are_ignored(self):
+    self.create_fbb().generate_outputs()
+    corrupt_entries = [
+      # Unsupported protocol, raises ValueError.
+      b'\x80\x09.',
+      # Missing module, raises ImportError.
+      b'cnonexistent_module\nfoo\n.',
+      # Missing attribute, raises AttributeError.
+      b'cos\nnonexistent_attribute\n.',
+      # Invalid constructor arguments, raises TypeError.
+      b'c__builtin__\nint\n(S"x"\nI1\nI2\ntR.',
+    ]
+    for entry in corrupt_entries:
+      for filename in os.listdir(self.cache_dir):
+        with open(os.path.join(self.cache_dir, filename), 'wb') as f:
+          f.write(entry)
+
+      fbb = self.create_fbb()
+      with mock.patch.object(
+        ast, 'literal_eval', wraps=ast.literal_eval
+      ) as literal_eval:
+        fbb.generate_outputs()
+      self.assertTrue(literal_eval.called)
+
+
 if __name__ == '__main__':
   unittest.main()
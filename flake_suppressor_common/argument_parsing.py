@@ -89,6 +89,40 @@ def ParseArgs():
       'not specified, will use a temporary file.'
     ),
   )
+  parser.add_argument(
+    '--query-cache-dir',
+    help=(
+      'A directory to cache BigQuery results in. If specified, results '
+      'cached by a previous run are used instead of running the same query '
+      'again, e.g. when re-running with different thresholds.'
+    ),
+  )
+  parser.add_argument(
+    '--query-cache-max-age-hours',
+    type=float,
+    default=24,
+    help=(
+      'How old, in hours, results cached in --query-cache-dir can be and '
+      'still be used.'
+    ),
+  )
+  parser.add_argument(
+    '--use-bigquery-client',
+    action='store_true',
+    default=False,
+    help=(
+      'Run queries using the BigQuery client library instead of the bq tool. '
+      'Results are fetched and processed one page at a time, which keeps '
+      'memory usage low for long sample periods.'
+    ),
+  )
+  parser.add_argument(
+    '--gitiles-cache-dir',
+    help=(
+      'A directory to cache expectation files fetched from gitiles in. If '
+      'specified, files are only downloaded again once they change on origin.'
+    ),
+  )
   parser.add_argument(
     '--bypass-up-to-date-check',
     action='store_true',
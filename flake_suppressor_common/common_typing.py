@@ -5,7 +5,7 @@
 
 import datetime
 from enum import Enum
-from typing import Any, Dict, List, Tuple, NamedTuple
+from typing import Any, Dict, Iterable, List, Tuple, NamedTuple
 
 TagTupleType = Tuple[str, ...]
 # TODO(crbug.com/40237087): Remove this and update both GPU and Web test
@@ -56,6 +56,8 @@ ResultCountType = Dict[TagTupleType, TestToResultCountType]
 
 SingleQueryResultType = Dict[str, Any]
 QueryJsonType = List[SingleQueryResultType]
+# Rows may be streamed instead of being loaded into a list up front.
+QueryJsonIterableType = Iterable[SingleQueryResultType]
 
 
 class ResultStatus(str, Enum):
@@ -3,12 +3,15 @@
 # found in the LICENSE file.
 """Module for custom data types."""
 
+import collections
 import datetime
-from typing import Any, List, Optional
+import itertools
+from typing import Any, Iterable, List, Optional
 
 # //testing imports.
 from flake_suppressor_common import common_typing as ct
 from unexpected_passes_common import data_types as unexpected_dt
+from unexpected_passes_common import registry
 
 
 class Expectation(unexpected_dt.Expectation):
@@ -86,3 +89,51 @@ class Result:
         tuple(self.typ_expectations),
       )
     )
+
+
+class ExpectationIndex:
+  """Index for quickly checking whether any expectation applies to a result.
+
+  Only the tags of each expectation are kept. NON_WILDCARD expectations are
+  looked up by test name, SIMPLE_WILDCARD expectations are stored in a prefix
+  trie and FULL_WILDCARD expectations are found with a FullWildcardMatcher.
+  Tags are compared as bitmasks.
+  """
+
+  def __init__(self, expectations: Iterable[Expectation]):
+    """
+    Args:
+      expectations: An iterable of Expectations to index.
+    """
+    self._non_wildcard = collections.defaultdict(list)
+    self._simple_wildcard = unexpected_dt.PrefixTrie()
+    self._full_wildcard = unexpected_dt.FullWildcardMatcher()
+    for e in expectations:
+      if e.wildcard_type == unexpected_dt.WildcardType.NON_WILDCARD:
+        self._non_wildcard[e.test].append(e.tags_mask)
+      elif e.wildcard_type == unexpected_dt.WildcardType.SIMPLE_WILDCARD:
+        self._simple_wildcard.Add(e.test[:-1], e.tags_mask)
+      else:
+        self._full_wildcard.Add(e, e.tags_mask)
+
+  def AppliesToResult(self, result: Result) -> bool:
+    """Checks whether any indexed expectation applies to |result|.
+
+    Args:
+      result: A Result instance to check against.
+
+    Returns:
+      True if at least one indexed expectation would apply to |result|,
+      otherwise False. This is the same as calling
+      Expectation.AppliesToResult() for every indexed expectation.
+    """
+    candidate_masks = itertools.chain(
+      self._non_wildcard.get(result.test, ()),
+      self._simple_wildcard.IterPrefixValues(result.test),
+      self._full_wildcard.IterMatches(result.test),
+    )
+    result_mask = registry.TagsToMask(result.tags)
+    for tags_mask in candidate_masks:
+      if registry.IsTagMaskSubset(tags_mask, result_mask):
+        return True
+    return False
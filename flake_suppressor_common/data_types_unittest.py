@@ -101,6 +101,41 @@ class ExpectationUnittest(unittest.TestCase):
     self.assertFalse(e.AppliesToResult(r))
 
 
+class ExpectationIndexUnittest(unittest.TestCase):
+  def testMatchesExpectationAppliesToResult(self) -> None:
+    """Tests that the index agrees with checking every expectation."""
+    expectations = [
+      data_types.Expectation('foo', ['win'], ['Failure'], NON_WILDCARD),
+      data_types.Expectation(
+        'bar', ['win', 'nvidia'], ['Failure'], NON_WILDCARD
+      ),
+      data_types.Expectation('ba*', ['mac'], ['Failure'], SIMPLE_WILDCARD),
+      data_types.Expectation('*', ['android'], ['Failure'], SIMPLE_WILDCARD),
+      data_types.Expectation('q*x', ['linux'], ['Failure'], FULL_WILDCARD),
+      data_types.Expectation('*oo', ['amd'], ['Failure'], FULL_WILDCARD),
+    ]
+    index = data_types.ExpectationIndex(expectations)
+    for test in ('foo', 'bar', 'baz', 'qux', 'quux', 'qu', 'boo', 'other'):
+      for tags in (
+        ('win',),
+        ('nvidia', 'win'),
+        ('mac',),
+        ('android', 'release'),
+        ('linux',),
+        ('amd', 'linux'),
+        (),
+      ):
+        r = data_types.Result('suite', test, tags, 'id')
+        expected = any(e.AppliesToResult(r) for e in expectations)
+        self.assertEqual(index.AppliesToResult(r), expected, (test, tags))
+
+  def testEmpty(self) -> None:
+    """Tests that an empty index applies to nothing."""
+    index = data_types.ExpectationIndex([])
+    r = data_types.Result('suite', 'test', ('win',), 'id')
+    self.assertFalse(index.AppliesToResult(r))
+
+
 class ResultUnittest(unittest.TestCase):
   def testTupleEnforced(self) -> None:
     """Tests that tags must be in a tuple."""
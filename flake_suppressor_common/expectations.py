@@ -5,12 +5,28 @@
 
 import base64
 import collections
+import concurrent.futures
+import contextlib
 from datetime import timedelta, date
+import hashlib
 import itertools
+import logging
 import os
 import posixpath
 import re
-from typing import Dict, List, Set, Tuple, Union
+import threading
+from typing import (
+  Any,
+  Callable,
+  Dict,
+  Generator,
+  Iterable,
+  List,
+  Optional,
+  Set,
+  Tuple,
+  Union,
+)
 import urllib.request
 
 # //testing imports.
@@ -27,6 +43,7 @@ CHROMIUM_SRC_DIR = os.path.realpath(
 )
 GITILES_URL = 'https://chromium.googlesource.com/chromium/src/+/refs/heads/main'
 TEXT_FORMAT_ARG = '?format=TEXT'
+MAX_GITILES_WORKERS = 8
 
 TAG_GROUP_REGEX = re.compile(r'# tags: \[([^\]]*)\]', re.MULTILINE | re.DOTALL)
 
@@ -123,6 +140,41 @@ def FailedBuildWithinRecentDayThreshold(
 
 
 class ExpectationProcessor:
+  # Expectation file path -> _BatchedExpectationFile while edits are being
+  # batched, otherwise None.
+  _batched_files: Optional[Dict[str, '_BatchedExpectationFile']] = None
+
+  def __init__(self, gitiles_cache_dir: Optional[str] = None):
+    """
+    Args:
+      gitiles_cache_dir: An optional directory to cache expectation file
+          contents fetched from gitiles in. If set, files are only downloaded
+          again once they have changed on origin.
+    """
+    self._gitiles_cache = None
+    if gitiles_cache_dir:
+      self._gitiles_cache = GitilesBlobCache(gitiles_cache_dir)
+
+  @contextlib.contextmanager
+  def BatchExpectationFileEdits(self) -> Generator[None, None, None]:
+    """Batches edits made by ModifyFileForResult() within the context.
+
+    Each expectation file is read and parsed once when it is first modified
+    and written once when the context exits. The resulting files are the same
+    as if every edit had been written immediately.
+    """
+    if self._batched_files is not None:
+      yield
+      return
+    self._batched_files = {}
+    try:
+      yield
+    finally:
+      batched_files = self._batched_files
+      self._batched_files = None
+      for batched_file in batched_files.values():
+        batched_file.Write()
+
   # pylint: disable=too-many-locals
   def IterateThroughResultsForUser(
     self,
@@ -147,7 +199,7 @@ class ExpectationProcessor:
       include_all_tags: A boolean denoting whether all tags should be used for
           expectations or only the most specific ones.
     """
-    typ_tag_ordered_result_map = self._ReorderMapByTypTags(result_map)
+    failure_counts = FailureCountIndex(result_map)
     for suite, test_map in result_map.items():
       if self.IsSuiteUnsupported(suite):
         continue
@@ -159,16 +211,16 @@ class ExpectationProcessor:
           print('Configuration:\n    %s' % '\n    '.join(typ_tags))
           print('Failed builds:\n    %s' % '\n    '.join(build_url_list))
 
-          other_failures_for_test = self.FindFailuresInSameTest(
-            result_map, suite, test, typ_tags
+          other_failures_for_test = failure_counts.GetOtherFailuresForTest(
+            suite, test, typ_tags
           )
           if other_failures_for_test:
             print('Other failures in same test found on other configurations')
             for tags, failure_count in other_failures_for_test:
               print('    %d failures on %s' % (failure_count, ' '.join(tags)))
 
-          other_failures_for_config = self.FindFailuresInSameConfig(
-            typ_tag_ordered_result_map, suite, test, typ_tags
+          other_failures_for_config = (
+            failure_counts.GetOtherFailuresForConfig(suite, test, typ_tags)
           )
           if other_failures_for_config:
             print('Other failures on same configuration found in other tests')
@@ -222,27 +274,28 @@ class ExpectationProcessor:
     """
     assert isinstance(ignore_threshold, float)
     assert isinstance(flaky_threshold, float)
-    for suite, test_map in result_map.items():
-      if self.IsSuiteUnsupported(suite):
-        continue
-      for test, tag_map in test_map.items():
-        for typ_tags, build_url_list in tag_map.items():
-          failure_count = len(build_url_list)
-          total_count = result_counts[typ_tags][test]
-          fraction = failure_count / total_count
-          if fraction < ignore_threshold:
-            continue
-          expected_result = self.GetExpectedResult(fraction, flaky_threshold)
-          if expected_result:
-            self.ModifyFileForResult(
-              suite,
-              test,
-              typ_tags,
-              '',
-              expected_result,
-              group_by_tags,
-              include_all_tags,
-            )
+    with self.BatchExpectationFileEdits():
+      for suite, test_map in result_map.items():
+        if self.IsSuiteUnsupported(suite):
+          continue
+        for test, tag_map in test_map.items():
+          for typ_tags, build_url_list in tag_map.items():
+            failure_count = len(build_url_list)
+            total_count = result_counts[typ_tags][test]
+            fraction = failure_count / total_count
+            if fraction < ignore_threshold:
+              continue
+            expected_result = self.GetExpectedResult(fraction, flaky_threshold)
+            if expected_result:
+              self.ModifyFileForResult(
+                suite,
+                test,
+                typ_tags,
+                '',
+                expected_result,
+                group_by_tags,
+                include_all_tags,
+              )
 
   def CreateExpectationsForAllResults(
     self,
@@ -282,47 +335,48 @@ class ExpectationProcessor:
           build-fail*-thresholds must be hit in order for a test to actually
           be suppressed.
     """
-    for suite, test_map in result_map.items():
-      if self.IsSuiteUnsupported(suite):
-        continue
-      for test, tag_map in test_map.items():
-        # Same test in all builders that caused build fail must be over all
-        # threshold requirement.
-        all_results = list(itertools.chain(*tag_map.values()))
-        if not OverFailedBuildThreshold(
-          all_results, build_fail_total_number_threshold
-        ) or not OverFailedBuildByConsecutiveDayThreshold(
-          all_results, build_fail_consecutive_day_threshold
-        ):
+    with self.BatchExpectationFileEdits():
+      for suite, test_map in result_map.items():
+        if self.IsSuiteUnsupported(suite):
           continue
-        for typ_tags, result_tuple_list in tag_map.items():
-          if not FailedBuildWithinRecentDayThreshold(
-            result_tuple_list, build_fail_recent_day_threshold
+        for test, tag_map in test_map.items():
+          # Same test in all builders that caused build fail must be over all
+          # threshold requirement.
+          all_results = list(itertools.chain(*tag_map.values()))
+          if not OverFailedBuildThreshold(
+            all_results, build_fail_total_number_threshold
+          ) or not OverFailedBuildByConsecutiveDayThreshold(
+            all_results, build_fail_consecutive_day_threshold
           ):
             continue
-          status = set()
-          for test_result in result_tuple_list:
-            # Should always add a pass to all flaky web tests in
-            # TestsExpectation that have passed runs.
-            status.add('Pass')
-            if test_result.status == ct.ResultStatus.CRASH:
-              status.add('Crash')
-            elif test_result.status == ct.ResultStatus.FAIL:
-              status.add('Failure')
-            elif test_result.status == ct.ResultStatus.ABORT:
-              status.add('Timeout')
-          if status:
-            status_list = list(status)
-            status_list.sort()
-            self.ModifyFileForResult(
-              suite,
-              test,
-              typ_tags,
-              '',
-              ' '.join(status_list),
-              group_by_tags,
-              include_all_tags,
-            )
+          for typ_tags, result_tuple_list in tag_map.items():
+            if not FailedBuildWithinRecentDayThreshold(
+              result_tuple_list, build_fail_recent_day_threshold
+            ):
+              continue
+            status = set()
+            for test_result in result_tuple_list:
+              # Should always add a pass to all flaky web tests in
+              # TestsExpectation that have passed runs.
+              status.add('Pass')
+              if test_result.status == ct.ResultStatus.CRASH:
+                status.add('Crash')
+              elif test_result.status == ct.ResultStatus.FAIL:
+                status.add('Failure')
+              elif test_result.status == ct.ResultStatus.ABORT:
+                status.add('Timeout')
+            if status:
+              status_list = list(status)
+              status_list.sort()
+              self.ModifyFileForResult(
+                suite,
+                test,
+                typ_tags,
+                '',
+                ' '.join(status_list),
+                group_by_tags,
+                include_all_tags,
+              )
 
   # pylint: enable=too-many-locals,too-many-arguments
 
@@ -371,8 +425,9 @@ class ExpectationProcessor:
 
     Args:
       typ_tag_ordered_result_map: Aggregated query results from
-          results.AggregateResults that have been reordered using
-          _ReorderMapByTypTags.
+          results.AggregateResults that have been reordered to use typ tags as
+          the top level keys, i.e. mapping typ tags to suites to tests to
+          build URL lists.
       target_suite: A string containing the test suite the original failure was
           found in.
       target_test: A string containing the test case the original failure was
@@ -396,34 +451,6 @@ class ExpectationProcessor:
         other_failures.append((full_name, len(build_url_list)))
     return other_failures
 
-  def _ReorderMapByTypTags(
-    self, result_map: ct.AggregatedResultsType
-  ) -> TagOrderedAggregateResultType:
-    """Rearranges|result_map| to use typ tags as the top level keys.
-
-    Args:
-      result_map: Aggregated query results from results.AggregateResults
-
-    Returns:
-      A dict containing the same contents as |result_map|, but in the following
-      format:
-      {
-        typ_tags (tuple of str): {
-          suite (str): {
-            test (str): build_url_list (list of str),
-          },
-        },
-      }
-    """
-    reordered_map = {}
-    for suite, test_map in result_map.items():
-      for test, tag_map in test_map.items():
-        for typ_tags, build_url_list in tag_map.items():
-          reordered_map.setdefault(typ_tags, {}).setdefault(suite, {})[test] = (
-            build_url_list
-          )
-    return reordered_map
-
   def PromptUserForExpectationAction(
     self,
   ) -> Union[Tuple[str, str], Tuple[None, None]]:
@@ -485,8 +512,25 @@ class ExpectationProcessor:
           expectations or only the most specific ones.
     """
     expectation_file = self.GetExpectationFileForSuite(suite, typ_tags)
+    batched_file = None
+    if self._batched_files is not None:
+      batched_file = self._batched_files.get(expectation_file)
+      if batched_file is None:
+        batched_file = _BatchedExpectationFile(expectation_file)
+        self._batched_files[expectation_file] = batched_file
     if not include_all_tags:
-      typ_tags = self.FilterToMostSpecificTypTags(typ_tags, expectation_file)
+      if batched_file and not self._IsOverridden('FilterToMostSpecificTypTags'):
+        if batched_file.tag_groups is None:
+          batched_file.tag_groups = self.GetTagGroups(batched_file.contents)
+        typ_tags = self._FilterToMostSpecificTypTagsInGroups(
+          typ_tags, batched_file.tag_groups
+        )
+      else:
+        typ_tags = self.FilterToMostSpecificTypTags(
+          typ_tags,
+          expectation_file,
+          batched_file.GetContents() if batched_file else None,
+        )
     bug = '%s ' % bug if bug else bug
 
     def AppendExpectationToEnd():
@@ -496,13 +540,27 @@ class ExpectationProcessor:
         test,
         expected_result,
       )
+      if batched_file:
+        batched_file.AppendLine(expectation_line)
+        return
       with open(expectation_file, 'a') as outfile:
         outfile.write(expectation_line)
 
     if group_by_tags:
-      insertion_line, best_matching_tags = (
-        self.FindBestInsertionLineForExpectation(typ_tags, expectation_file)
-      )
+      if batched_file and not self._IsOverridden(
+        'FindBestInsertionLineForExpectation'
+      ):
+        insertion_line, best_matching_tags = _FindBestInsertionLine(
+          typ_tags, batched_file.expectations
+        )
+      else:
+        insertion_line, best_matching_tags = (
+          self.FindBestInsertionLineForExpectation(
+            typ_tags,
+            expectation_file,
+            batched_file.GetContents() if batched_file else None,
+          )
+        )
       if insertion_line == -1:
         AppendExpectationToEnd()
       else:
@@ -521,6 +579,9 @@ class ExpectationProcessor:
           test,
           expected_result,
         )
+        if batched_file:
+          batched_file.InsertLine(insertion_line, expectation_line)
+          return
         with open(expectation_file) as infile:
           input_contents = infile.read()
         output_contents = ''
@@ -535,9 +596,22 @@ class ExpectationProcessor:
 
   # pylint: enable=too-many-locals,too-many-arguments
 
-  # pylint: disable=too-many-locals
+  def _IsOverridden(self, method_name: str) -> bool:
+    """Checks whether a subclass overrides the given public method.
+
+    Batched edits use cached data instead of the public methods unless they
+    are overridden, in which case the overrides are used so that batching does
+    not change behavior.
+    """
+    return getattr(type(self), method_name) is not getattr(
+      ExpectationProcessor, method_name
+    )
+
   def FilterToMostSpecificTypTags(
-    self, typ_tags: ct.TagTupleType, expectation_file: str
+    self,
+    typ_tags: ct.TagTupleType,
+    expectation_file: str,
+    contents: Optional[str] = None,
   ) -> ct.TagTupleType:
     """Filters |typ_tags| to the most specific set.
 
@@ -548,15 +622,34 @@ class ExpectationProcessor:
       typ_tags: A tuple of strings containing the typ tags the test produced.
       expectation_file: A string containing a filepath pointing to the
           expectation file to filter tags with.
+      contents: The current contents of |expectation_file|. If None, the file
+          is read. Set while edits to the file are being batched.
 
     Returns:
       A tuple containing the contents of |typ_tags| with only the most specific
       tag from each tag group remaining.
     """
-    with open(expectation_file) as infile:
-      contents = infile.read()
+    if contents is None:
+      with open(expectation_file) as infile:
+        contents = infile.read()
+    return self._FilterToMostSpecificTypTagsInGroups(
+      typ_tags, self.GetTagGroups(contents)
+    )
 
-    tag_groups = self.GetTagGroups(contents)
+  # pylint: disable=too-many-locals
+  def _FilterToMostSpecificTypTagsInGroups(
+    self, typ_tags: ct.TagTupleType, tag_groups: List[List[str]]
+  ) -> ct.TagTupleType:
+    """Filters |typ_tags| to the most specific set using |tag_groups|.
+
+    Args:
+      typ_tags: A tuple of strings containing the typ tags the test produced.
+      tag_groups: A list of tag groups as returned by GetTagGroups().
+
+    Returns:
+      A tuple containing the contents of |typ_tags| with only the most specific
+      tag from each tag group remaining.
+    """
     num_matches = 0
     tags_in_same_group = collections.defaultdict(list)
     for tag in typ_tags:
@@ -594,7 +687,10 @@ class ExpectationProcessor:
   # pylint: enable=too-many-locals
 
   def FindBestInsertionLineForExpectation(
-    self, typ_tags: ct.TagTupleType, expectation_file: str
+    self,
+    typ_tags: ct.TagTupleType,
+    expectation_file: str,
+    contents: Optional[str] = None,
   ) -> Tuple[int, Set[str]]:
     """Finds the best place to insert an expectation when grouping by tags.
 
@@ -603,6 +699,8 @@ class ExpectationProcessor:
           failing test.
       expectation_file: A string containing a filepath to the expectation file
       to use.
+      contents: The current contents of |expectation_file|. If None, the file
+          is read. Set while edits to the file are being batched.
 
     Returns:
       A tuple (insertion_line, best_matching_tags). |insertion_line| is an int
@@ -611,46 +709,93 @@ class ExpectationProcessor:
       expectation that was found to be the closest match. If no appropriate
       line is found, |insertion_line| is -1 and |best_matching_tags| is empty.
     """
-    best_matching_tags = set()
-    best_insertion_line = -1
-    with open(expectation_file) as f:
-      content = f.read()
-    list_parser = expectations_parser.TaggedTestListParser(content)
-    for e in list_parser.expectations:
-      expectation_tags = e.tags
-      if not expectation_tags.issubset(typ_tags):
-        continue
-      if len(expectation_tags) > len(best_matching_tags):
-        best_matching_tags = expectation_tags
-        best_insertion_line = e.lineno
-      elif len(expectation_tags) == len(best_matching_tags):
-        if best_insertion_line < e.lineno:
-          best_insertion_line = e.lineno
-    return best_insertion_line, best_matching_tags
+    if contents is None:
+      with open(expectation_file) as f:
+        contents = f.read()
+    list_parser = expectations_parser.TaggedTestListParser(contents)
+    return _FindBestInsertionLine(
+      typ_tags, ((e.lineno, e.tags) for e in list_parser.expectations)
+    )
 
   def GetOriginExpectationFileContents(self) -> Dict[str, str]:
     """Gets expectation file contents from origin/main.
 
+    Files are fetched in parallel. If a gitiles cache is in use, only files
+    whose blob IDs are not already cached are downloaded.
+
     Returns:
       A dict of expectation file name (str) -> expectation file contents (str)
       that are available on origin/main. File paths are relative to the
       Chromium src dir and are OS paths.
     """
-    # Get the path to the expectation file directory in gitiles, i.e. the POSIX
-    # path relative to the Chromium src directory.
-    origin_file_contents = {}
     expectation_files = self.ListOriginExpectationFiles()
-    for f in expectation_files:
+    blob_ids = {}
+    if self._gitiles_cache:
+      blob_ids = self._GetOriginBlobIds(expectation_files)
+
+    def GetContents(f: str) -> str:
+      blob_id = blob_ids.get(f)
+      if blob_id:
+        cached_contents = self._gitiles_cache.Get(blob_id)
+        if cached_contents is not None:
+          return cached_contents
+      # Get the path to the expectation file in gitiles, i.e. the POSIX path
+      # relative to the Chromium src directory.
       filepath_posix = f.replace(os.sep, '/')
       origin_filepath_url = (
         posixpath.join(GITILES_URL, filepath_posix) + TEXT_FORMAT_ARG
       )
       response = urllib.request.urlopen(origin_filepath_url).read()
-      decoded_text = base64.b64decode(response).decode('utf-8')
-      # After the URL access maintain all the paths as os paths.
-      origin_file_contents[f] = decoded_text
+      decoded_bytes = base64.b64decode(response)
+      if blob_id:
+        self._gitiles_cache.Set(blob_id, decoded_bytes)
+      return decoded_bytes.decode('utf-8')
+
+    # After the URL access maintain all the paths as os paths.
+    return dict(
+      zip(expectation_files, _MapConcurrently(GetContents, expectation_files))
+    )
+
+  def GetOriginExpectationFileBlobIds(self) -> Dict[str, Optional[str]]:
+    """Gets the git blob IDs of expectation files on origin/main.
+
+    This only requires listing the directories containing expectation files,
+    not downloading the files themselves.
+
+    Returns:
+      A dict of expectation file name (str) -> git blob ID (str) for each file
+      returned by ListOriginExpectationFiles(). The blob ID is None if the file
+      was not found in its directory listing.
+    """
+    return self._GetOriginBlobIds(self.ListOriginExpectationFiles())
 
-    return origin_file_contents
+  def _GetOriginBlobIds(
+    self, expectation_files: List[str]
+  ) -> Dict[str, Optional[str]]:
+    """Gets the git blob IDs of |expectation_files| on origin/main.
+
+    Args:
+      expectation_files: A list of expectation file paths as returned by
+          ListOriginExpectationFiles().
+
+    Returns:
+      A dict in the format described by GetOriginExpectationFileBlobIds().
+    """
+    directories = sorted(
+      {posixpath.dirname(f.replace(os.sep, '/')) for f in expectation_files}
+    )
+    directory_entries = dict(
+      zip(
+        directories,
+        _MapConcurrently(self._ListGitilesDirectoryEntries, directories),
+      )
+    )
+    blob_ids = {}
+    for f in expectation_files:
+      filepath_posix = f.replace(os.sep, '/')
+      entries = directory_entries[posixpath.dirname(filepath_posix)]
+      blob_ids[f] = entries.get(posixpath.basename(filepath_posix))
+    return blob_ids
 
   def GetLocalCheckoutExpectationFileContents(self) -> Dict[str, str]:
     """Gets expectation file contents from the local checkout.
@@ -670,8 +815,17 @@ class ExpectationProcessor:
 
   def AssertCheckoutIsUpToDate(self) -> None:
     """Confirms that the local checkout's expectations are up to date."""
-    origin_file_contents = self.GetOriginExpectationFileContents()
     local_file_contents = self.GetLocalCheckoutExpectationFileContents()
+    # Comparing blob IDs does not require downloading any files, so try that
+    # first. Differing IDs can still be caused by things such as line ending
+    # conversion, so fall back to comparing contents in that case.
+    local_blob_ids = {
+      f: GetGitBlobId(contents.encode('utf-8'))
+      for f, contents in local_file_contents.items()
+    }
+    if local_blob_ids == self.GetOriginExpectationFileBlobIds():
+      return
+    origin_file_contents = self.GetOriginExpectationFileContents()
     if origin_file_contents != local_file_contents:
       raise RuntimeError(
         'Local Chromium checkout expectations are out of date. Please '
@@ -704,15 +858,28 @@ class ExpectationProcessor:
     Returns:
       A list of filename strings under origin_dir.
     """
+    return list(self._ListGitilesDirectoryEntries(origin_dir))
+
+  def _ListGitilesDirectoryEntries(self, origin_dir: str) -> Dict[str, str]:
+    """Gets all files from origin/main under origin_dir with their blob IDs.
+
+    Args:
+      origin_dir: A string containing the POSIX path to a directory relative
+          to the Chromium src dir.
+
+    Returns:
+      A dict of filename (str) -> git blob ID (str), in listing order.
+    """
     origin_dir_url = posixpath.join(GITILES_URL, origin_dir) + TEXT_FORMAT_ARG
     response = urllib.request.urlopen(origin_dir_url).read()
     # Response is a base64 encoded, newline-separated list of files in the
     # directory in the format: `mode file_type hash name`
-    files = []
+    entries = {}
     decoded_text = base64.b64decode(response).decode('utf-8')
     for line in decoded_text.splitlines():
-      files.append(line.split()[-1])
-    return files
+      split_line = line.split()
+      entries[split_line[-1]] = split_line[2]
+    return entries
 
   def IsSuiteUnsupported(self, suite: str) -> bool:
     raise NotImplementedError
@@ -748,3 +915,238 @@ class ExpectationProcessor:
     self, typ_tags: ct.TagTupleType
   ) -> ct.TagTupleType:
     return typ_tags
+
+
+class FailureCountIndex:
+  """Failure counts from an aggregated result map, indexed by test and config.
+
+  Built with a single pass over the map. The failures for each test and for
+  each configuration are stored as lists along with the position of every
+  result in them, so finding the other failures for a result does not require
+  walking or reordering the map.
+  """
+
+  def __init__(self, result_map: ct.AggregatedResultsType):
+    """
+    Args:
+      result_map: Aggregated query results from results.AggregateResults.
+    """
+    # (suite, test) -> [(typ_tags, count)]
+    self._failures_per_test = {}
+    # typ_tags -> [(full_name, count)]
+    self._failures_per_config = {}
+    # (suite, test, typ_tags) -> (index into the per-test list, index into the
+    # per-config list)
+    self._positions = {}
+    for suite, test_map in result_map.items():
+      for test, tag_map in test_map.items():
+        full_name = '%s.%s' % (suite, test)
+        test_failures = self._failures_per_test.setdefault((suite, test), [])
+        for typ_tags, build_url_list in tag_map.items():
+          config_failures = self._failures_per_config.setdefault(typ_tags, [])
+          self._positions[(suite, test, typ_tags)] = (
+            len(test_failures),
+            len(config_failures),
+          )
+          test_failures.append((typ_tags, len(build_url_list)))
+          config_failures.append((full_name, len(build_url_list)))
+
+  def GetOtherFailuresForTest(
+    self, suite: str, test: str, typ_tags: ct.TagTupleType
+  ) -> List[Tuple[ct.TagTupleType, int]]:
+    """Finds all other failures that occurred in the given test.
+
+    Same as ExpectationProcessor.FindFailuresInSameTest().
+    """
+    assert isinstance(typ_tags, tuple)
+    failures = self._failures_per_test.get((suite, test), [])
+    position = self._positions.get((suite, test, typ_tags))
+    if position is None:
+      return list(failures)
+    return failures[: position[0]] + failures[position[0] + 1 :]
+
+  def GetOtherFailuresForConfig(
+    self, suite: str, test: str, typ_tags: ct.TagTupleType
+  ) -> List[Tuple[str, int]]:
+    """Finds all other failures that occurred on the given configuration.
+
+    Same as ExpectationProcessor.FindFailuresInSameConfig().
+    """
+    assert isinstance(typ_tags, tuple)
+    failures = self._failures_per_config.get(typ_tags, [])
+    position = self._positions.get((suite, test, typ_tags))
+    if position is None:
+      return list(failures)
+    return failures[: position[1]] + failures[position[1] + 1 :]
+
+
+def GetGitBlobId(data: bytes) -> str:
+  """Computes the ID git would assign to a blob containing |data|."""
+  header = b'blob %d\0' % len(data)
+  return hashlib.sha1(header + data).hexdigest()
+
+
+def _MapConcurrently(func: Callable[[Any], Any], items: List[Any]) -> List[Any]:
+  """Applies |func| to each of |items| using a thread pool.
+
+  Returns:
+    A list containing the return value of |func| for each of |items|, in the
+    same order.
+  """
+  if len(items) <= 1:
+    return [func(i) for i in items]
+  with concurrent.futures.ThreadPoolExecutor(
+    max_workers=min(MAX_GITILES_WORKERS, len(items))
+  ) as pool:
+    return list(pool.map(func, items))
+
+
+class GitilesBlobCache:
+  """Caches file contents fetched from gitiles by their git blob IDs.
+
+  Since blob IDs are derived from file contents, cached entries never become
+  stale and are only used again if the file on origin is unchanged.
+  """
+
+  def __init__(self, cache_dir: str):
+    self._cache_dir = cache_dir
+
+  def Get(self, blob_id: str) -> Optional[str]:
+    """Gets the cached contents for |blob_id|, or None if not cached."""
+    try:
+      with open(os.path.join(self._cache_dir, blob_id), 'rb') as infile:
+        data = infile.read()
+    except OSError:
+      return None
+    if GetGitBlobId(data) != blob_id:
+      logging.debug('Ignoring corrupted gitiles cache entry %s', blob_id)
+      return None
+    return data.decode('utf-8')
+
+  def Set(self, blob_id: str, data: bytes) -> None:
+    """Caches |data| if it matches |blob_id|."""
+    if GetGitBlobId(data) != blob_id:
+      return
+    os.makedirs(self._cache_dir, exist_ok=True)
+    cache_file = os.path.join(self._cache_dir, blob_id)
+    temp_file = '%s.%d.tmp' % (cache_file, threading.get_ident())
+    with open(temp_file, 'wb') as outfile:
+      outfile.write(data)
+    os.replace(temp_file, cache_file)
+
+
+def _FindBestInsertionLine(
+  typ_tags: ct.TagTupleType, expectations: Iterable[Tuple[int, Set[str]]]
+) -> Tuple[int, Set[str]]:
+  """Finds the best place to insert an expectation when grouping by tags.
+
+  Args:
+    typ_tags: A tuple of strings containing typ tags that were produced by the
+        failing test.
+    expectations: An iterable of (lineno, tags) tuples, one for each
+        expectation in the expectation file.
+
+  Returns:
+    The same as ExpectationProcessor.FindBestInsertionLineForExpectation().
+  """
+  best_matching_tags = set()
+  best_insertion_line = -1
+  for lineno, expectation_tags in expectations:
+    if not expectation_tags.issubset(typ_tags):
+      continue
+    if len(expectation_tags) > len(best_matching_tags):
+      best_matching_tags = expectation_tags
+      best_insertion_line = lineno
+    elif len(expectation_tags) == len(best_matching_tags):
+      if best_insertion_line < lineno:
+        best_insertion_line = lineno
+  return best_insertion_line, best_matching_tags
+
+
+class _BatchedExpectationFile:
+  """In-memory copy of an expectation file that is being added to.
+
+  The file is parsed once. Lines that are added afterwards are parsed on their
+  own using the file's header so that later insertions see them the same way
+  they would if the file was re-read from disk after every addition.
+  """
+
+  def __init__(self, expectation_file: str):
+    self.path = expectation_file
+    with open(expectation_file) as infile:
+      self.contents = infile.read()
+    self.tag_groups: Optional[List[List[str]]] = None
+    self.lines = self.contents.splitlines(True)
+    list_parser = expectations_parser.TaggedTestListParser(self.contents)
+    # A list of [lineno, tags] lists, one for each expectation in the file.
+    self.expectations = [[e.lineno, e.tags] for e in list_parser.expectations]
+    header_length = len(self.lines)
+    if self.expectations:
+      header_length = min(e[0] for e in self.expectations) - 1
+    self._header = ''.join(self.lines[:header_length])
+    if self._header and not self._header.endswith('\n'):
+      self._header += '\n'
+    self._modified = False
+
+  def _ParseTags(self, expectation_line: str) -> Optional[Set[str]]:
+    list_parser = expectations_parser.TaggedTestListParser(
+      self._header + expectation_line
+    )
+    if not list_parser.expectations:
+      return None
+    return list_parser.expectations[0].tags
+
+  def AppendLine(self, expectation_line: str) -> None:
+    """Appends |expectation_line| to the end of the file.
+
+    Args:
+      expectation_line: A string containing a newline-terminated expectation.
+    """
+    self._modified = True
+    if self.lines and not self.lines[-1].endswith('\n'):
+      # Appending merges the new line into the unterminated last line, which
+      # is not something that later insertions can sensibly use.
+      self.lines[-1] += expectation_line
+      return
+    self.lines.append(expectation_line)
+    tags = self._ParseTags(expectation_line)
+    if tags is not None:
+      self.expectations.append([len(self.lines), tags])
+
+  def InsertLine(self, after_lineno: int, expectation_line: str) -> None:
+    """Inserts |expectation_line| after the given line.
+
+    Args:
+      after_lineno: A 0-indexed int specifying which line to insert after.
+      expectation_line: A string containing a newline-terminated expectation.
+    """
+    if after_lineno >= len(self.lines):
+      return
+    self._modified = True
+    if not self.lines[after_lineno].endswith('\n'):
+      self.lines[after_lineno] += expectation_line
+      return
+    self.lines.insert(after_lineno + 1, expectation_line)
+    # Line numbers reported by the parser start at 1.
+    new_lineno = after_lineno + 2
+    # Keep expectations in file order since ties are broken based on which
+    # expectation was seen first.
+    insertion_index = len(self.expectations)
+    for i, e in enumerate(self.expectations):
+      if e[0] >= new_lineno:
+        e[0] += 1
+        insertion_index = min(insertion_index, i)
+    tags = self._ParseTags(expectation_line)
+    if tags is not None:
+      self.expectations.insert(insertion_index, [new_lineno, tags])
+
+  def GetContents(self) -> str:
+    """Gets the current contents of the file, including added lines."""
+    return ''.join(self.lines)
+
+  def Write(self) -> None:
+    """Writes the file back to disk if it was modified."""
+    if not self._modified:
+      return
+    with open(self.path, 'w') as outfile:
+      outfile.write(self.GetContents())
@@ -5,12 +5,19 @@
 
 # pylint: disable=protected-access
 
+import base64
 import datetime
+import http.server
 import os
+import shutil
 import sys
 import tempfile
+import threading
 import unittest
 import unittest.mock as mock
+import urllib.error
+import urllib.parse
+import urllib.request
 
 # vpython-provided modules.
 from pyfakefs import fake_filesystem_unittest  # pylint:disable=import-error
@@ -775,9 +782,23 @@ class FindFailuresInSameConditionUnittest(unittest.TestCase):
     self.assertEqual(other_failures, [(tuple(['mac']), 2)])
 
   def testFindFailuresInSameConfig(self) -> None:
-    typ_tag_ordered_result_map = self._expectations._ReorderMapByTypTags(
-      self.result_map
-    )
+    typ_tag_ordered_result_map = {
+      tuple(['win']): {
+        'pixel_integration_test': {
+          'foo_test': ['a'],
+          'bar_test': ['a', 'b', 'c'],
+        },
+        'webgl_conformance_integration_test': {
+          'foo_test': ['a', 'b', 'c', 'd', 'e'],
+          'bar_test': ['a', 'b', 'c', 'd', 'e', 'f', 'g'],
+        },
+      },
+      tuple(['mac']): {
+        'pixel_integration_test': {
+          'foo_test': ['a', 'b'],
+        },
+      },
+    }
     other_failures = self._expectations.FindFailuresInSameConfig(
       typ_tag_ordered_result_map,
       'pixel_integration_test',
@@ -792,6 +813,64 @@ class FindFailuresInSameConditionUnittest(unittest.TestCase):
     self.assertEqual(len(other_failures), len(expected_other_failures))
     self.assertEqual(set(other_failures), set(expected_other_failures))
 
+  def testFailureCountIndexSameTest(self) -> None:
+    """Tests that the index finds the same failures as walking the map."""
+    failure_counts = expectations.FailureCountIndex(self.result_map)
+    for suite, test_map in self.result_map.items():
+      for test, tag_map in test_map.items():
+        for typ_tags in list(tag_map) + [('linux',)]:
+          self.assertEqual(
+            failure_counts.GetOtherFailuresForTest(suite, test, typ_tags),
+            self._expectations.FindFailuresInSameTest(
+              self.result_map, suite, test, typ_tags
+            ),
+          )
+    self.assertEqual(
+      failure_counts.GetOtherFailuresForTest('suite', 'test', ('win',)), []
+    )
+
+  def testFailureCountIndexSameConfig(self) -> None:
+    """Tests that the index finds other failures on the same configuration."""
+    failure_counts = expectations.FailureCountIndex(self.result_map)
+    self.assertEqual(
+      failure_counts.GetOtherFailuresForConfig(
+        'pixel_integration_test', 'foo_test', tuple(['win'])
+      ),
+      [
+        ('pixel_integration_test.bar_test', 3),
+        ('webgl_conformance_integration_test.foo_test', 5),
+        ('webgl_conformance_integration_test.bar_test', 7),
+      ],
+    )
+    self.assertEqual(
+      failure_counts.GetOtherFailuresForConfig(
+        'webgl_conformance_integration_test', 'bar_test', tuple(['mac'])
+      ),
+      [
+        ('pixel_integration_test.foo_test', 2),
+        ('pixel_integration_test.bar_test', 4),
+        ('webgl_conformance_integration_test.foo_test', 6),
+      ],
+    )
+    # Tests without a failure on the configuration get every failure on it.
+    self.assertEqual(
+      failure_counts.GetOtherFailuresForConfig(
+        'pixel_integration_test', 'baz_test', tuple(['mac'])
+      ),
+      [
+        ('pixel_integration_test.foo_test', 2),
+        ('pixel_integration_test.bar_test', 4),
+        ('webgl_conformance_integration_test.foo_test', 6),
+        ('webgl_conformance_integration_test.bar_test', 8),
+      ],
+    )
+    self.assertEqual(
+      failure_counts.GetOtherFailuresForConfig(
+        'pixel_integration_test', 'foo_test', tuple(['linux'])
+      ),
+      [],
+    )
+
 
 @unittest.skipIf(sys.version_info[0] != 3, 'Python 3-only')
 class ModifyFileForResultUnittest(fake_filesystem_unittest.TestCase):
@@ -888,6 +967,124 @@ class ModifyFileForResultUnittest(fake_filesystem_unittest.TestCase):
 
 
 @unittest.skipIf(sys.version_info[0] != 3, 'Python 3-only')
+class BatchExpectationFileEditsUnittest(fake_filesystem_unittest.TestCase):
+  def setUp(self) -> None:
+    self.setUpPyfakefs()
+    self._expectations = uu.UnitTestExpectationProcessor()
+    self.expectation_file = os.path.join(
+      uu.ABSOLUTE_EXPECTATION_FILE_DIRECTORY, 'expectation.txt'
+    )
+    uu.CreateFile(self, self.expectation_file)
+    self._expectation_file_patcher = mock.patch.object(
+      uu.UnitTestExpectationProcessor, 'GetExpectationFileForSuite'
+    )
+    self._expectation_file_mock = self._expectation_file_patcher.start()
+    self.addCleanup(self._expectation_file_patcher.stop)
+    self._expectation_file_mock.return_value = self.expectation_file
+    self.expectation_file_contents = (
+      uu.TAG_HEADER
+      + """\
+[ win ] some_test [ Failure ]
+
+[ mac ] some_test [ Failure ]
+[ android ] some_test [ Failure ]
+"""
+    )
+    self.modifications = [
+      ('foo_test', ('win', 'win10'), True, True),
+      ('bar_test', ('mac', 'release'), True, False),
+      ('baz_test', ('win', 'win10', 'release'), True, True),
+      ('qux_test', ('linux', 'release'), True, True),
+      ('foo_test', ('linux', 'ubuntu', 'release'), True, False),
+      ('bar_test', ('win', 'win8'), False, True),
+      ('baz_test', ('mac', 'mojave'), True, True),
+    ]
+
+  def _ResetExpectationFile(self) -> None:
+    with open(self.expectation_file, 'w') as outfile:
+      outfile.write(self.expectation_file_contents)
+
+  def _ApplyModifications(self) -> None:
+    for test, typ_tags, group_by_tags, include_all_tags in self.modifications:
+      self._expectations.ModifyFileForResult(
+        'some_file',
+        test,
+        typ_tags,
+        'crbug.com/1234',
+        'Failure',
+        group_by_tags,
+        include_all_tags,
+      )
+
+  def testMatchesSequentialOutput(self) -> None:
+    """Tests that batched edits produce the same file as sequential edits."""
+    self._ResetExpectationFile()
+    self._ApplyModifications()
+    with open(self.expectation_file) as infile:
+      sequential_contents = infile.read()
+
+    self._ResetExpectationFile()
+    with self._expectations.BatchExpectationFileEdits():
+      self._ApplyModifications()
+      # Nothing should be written until the batch is finished.
+      with open(self.expectation_file) as infile:
+        self.assertEqual(infile.read(), self.expectation_file_contents)
+    with open(self.expectation_file) as infile:
+      self.assertEqual(infile.read(), sequential_contents)
+
+  def testWritesOnError(self) -> None:
+    """Tests that edits made before an error are still written."""
+    self._ResetExpectationFile()
+    self._ApplyModifications()
+    with open(self.expectation_file) as infile:
+      sequential_contents = infile.read()
+
+    self._ResetExpectationFile()
+    with self.assertRaises(RuntimeError):
+      with self._expectations.BatchExpectationFileEdits():
+        self._ApplyModifications()
+        raise RuntimeError()
+    with open(self.expectation_file) as infile:
+      self.assertEqual(infile.read(), sequential_contents)
+
+  def testOverridesUsed(self) -> None:
+    """Tests that overridden tag filtering and line finding are used."""
+    self._ResetExpectationFile()
+    with mock.patch.object(
+      uu.UnitTestExpectationProcessor,
+      'FilterToMostSpecificTypTags',
+      return_value=('linux',),
+    ) as filter_mock, mock.patch.object(
+      uu.UnitTestExpectationProcessor,
+      'FindBestInsertionLineForExpectation',
+      return_value=(-1, set()),
+    ) as insertion_mock:
+      with self._expectations.BatchExpectationFileEdits():
+        for test in ('foo_test', 'bar_test'):
+          self._expectations.ModifyFileForResult(
+            'some_file',
+            test,
+            ('win', 'win10'),
+            '',
+            'Failure',
+            True,
+            False,
+          )
+    first_line = '[ linux ] foo_test [ Failure ]\n'
+    expected_contents = self.expectation_file_contents + first_line
+    with open(self.expectation_file) as infile:
+      self.assertEqual(
+        infile.read(), expected_contents + '[ linux ] bar_test [ Failure ]\n'
+      )
+    # The overrides should see edits that have not been written yet.
+    filter_mock.assert_called_with(
+      ('win', 'win10'), self.expectation_file, expected_contents
+    )
+    insertion_mock.assert_called_with(
+      ('linux',), self.expectation_file, expected_contents
+    )
+
+
 class FilterToMostSpecificTagTypeUnittest(fake_filesystem_unittest.TestCase):
   def setUp(self) -> None:
     self._expectations = uu.UnitTestExpectationProcessor()
@@ -1074,6 +1271,16 @@ class AssertCheckoutIsUpToDateUnittest(unittest.TestCase):
     )
     self._local_mock = self._local_patcher.start()
     self.addCleanup(self._local_patcher.stop)
+    self._origin_blob_patcher = mock.patch(
+      'flake_suppressor_common.expectations.ExpectationProcessor.'
+      'GetOriginExpectationFileBlobIds'
+    )
+    self._origin_blob_mock = self._origin_blob_patcher.start()
+    self.addCleanup(self._origin_blob_patcher.stop)
+    self._origin_blob_mock.side_effect = lambda: {
+      f: expectations.GetGitBlobId(contents.encode('utf-8'))
+      for f, contents in self._origin_mock.return_value.items()
+    }
 
   def testContentsMatch(self) -> None:
     """Tests the happy path where the contents match."""
@@ -1109,6 +1316,254 @@ class AssertCheckoutIsUpToDateUnittest(unittest.TestCase):
     with self.assertRaises(RuntimeError):
       self._expectations.AssertCheckoutIsUpToDate()
 
+  def testMatchingBlobIdsSkipContents(self) -> None:
+    """Tests that contents are not fetched if blob IDs match."""
+    self._origin_mock.return_value = {
+      'foo.txt': 'foo_content',
+    }
+    self._local_mock.return_value = {
+      'foo.txt': 'foo_content',
+    }
+    self._expectations.AssertCheckoutIsUpToDate()
+    self._origin_blob_mock.assert_called_once()
+    self._origin_mock.assert_not_called()
+
+  def testMismatchedBlobIdsCompareContents(self) -> None:
+    """Tests that contents are compared if blob IDs do not match."""
+    self._origin_mock.return_value = {
+      'foo.txt': 'foo_content',
+    }
+    self._local_mock.return_value = {
+      'foo.txt': 'foo_content',
+    }
+    self._origin_blob_mock.side_effect = None
+    self._origin_blob_mock.return_value = {'foo.txt': None}
+    self._expectations.AssertCheckoutIsUpToDate()
+    self._origin_mock.assert_called_once()
+
+
+class _FakeGitilesHandler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self) -> None:  # pylint: disable=invalid-name
+    server = self.server
+    with server.lock:
+      server.requests.append(self.path)
+    # Requests sent through a proxy use absolute URLs.
+    split_path = urllib.parse.urlsplit(self.path)
+    path = split_path.path
+    if split_path.query:
+      path += '?' + split_path.query
+    redirect = server.redirects.get(path)
+    if redirect is not None:
+      self.send_response(302)
+      self.send_header('Location', redirect)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    contents = server.files.get(path)
+    if contents is None:
+      self.send_response(404)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    body = base64.b64encode(contents.encode('utf-8'))
+    self.send_response(200)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args) -> None:  # pylint: disable=arguments-differ
+    pass
+
+
+class GitilesFetchUnittest(unittest.TestCase):
+  def setUp(self) -> None:
+    self._server = http.server.ThreadingHTTPServer(
+      ('127.0.0.1', 0), _FakeGitilesHandler
+    )
+    self._server.daemon_threads = True
+    self._server.lock = threading.Lock()
+    self._server.requests = []
+    self._server.redirects = {}
+    self._server.files = {}
+    server_thread = threading.Thread(
+      target=self._server.serve_forever, kwargs={'poll_interval': 0.01}
+    )
+    server_thread.daemon = True
+    server_thread.start()
+    self.addCleanup(self._server.server_close)
+    self.addCleanup(self._server.shutdown)
+
+    gitiles_url = 'http://127.0.0.1:%d/+/refs/heads/main' % (
+      self._server.server_address[1]
+    )
+    gitiles_patcher = mock.patch.object(
+      expectations, 'GITILES_URL', gitiles_url
+    )
+    gitiles_patcher.start()
+    self.addCleanup(gitiles_patcher.stop)
+
+    # urlopen() reads proxies from the environment when it first builds its
+    # opener, so make sure each test's environment is picked up.
+    urllib.request.install_opener(None)
+    self.addCleanup(urllib.request.install_opener, None)
+    environ_patcher = mock.patch.dict(os.environ)
+    environ_patcher.start()
+    self.addCleanup(environ_patcher.stop)
+    for variable in list(os.environ):
+      if variable.lower().endswith('_proxy'):
+        del os.environ[variable]
+
+    self._expectation_dir = 'content/test/gpu/gpu_tests/test_expectations'
+    self._expectation_files = [
+      os.path.join(*self._expectation_dir.split('/'), 'foo_expectations.txt'),
+      os.path.join(*self._expectation_dir.split('/'), 'bar_expectations.txt'),
+    ]
+    list_patcher = mock.patch.object(
+      uu.UnitTestExpectationProcessor,
+      'ListOriginExpectationFiles',
+      return_value=self._expectation_files,
+    )
+    list_patcher.start()
+    self.addCleanup(list_patcher.stop)
+
+    self._cache_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self._cache_dir)
+
+    self._SetOriginContents({
+      'foo_expectations.txt': 'foo_content\n',
+      'bar_expectations.txt': 'bar_content\n',
+    })
+
+  def _SetOriginContents(self, contents: dict) -> None:
+    listing = ''
+    for filename, file_contents in contents.items():
+      blob_id = expectations.GetGitBlobId(file_contents.encode('utf-8'))
+      listing += '100644 blob %s %s\n' % (blob_id, filename)
+      self._server.files[
+        '/+/refs/heads/main/%s/%s?format=TEXT'
+        % (self._expectation_dir, filename)
+      ] = file_contents
+    self._server.files[
+      '/+/refs/heads/main/%s?format=TEXT' % self._expectation_dir
+    ] = listing
+
+  def _GetFileRequests(self) -> list:
+    return sorted(r for r in self._server.requests if '.txt' in r)
+
+  def testListGitilesDirectory(self) -> None:
+    """Tests that directory listings are parsed."""
+    processor = uu.UnitTestExpectationProcessor()
+    self.assertEqual(
+      processor.ListGitilesDirectory(self._expectation_dir),
+      ['foo_expectations.txt', 'bar_expectations.txt'],
+    )
+    self.assertEqual(len(self._server.requests), 1)
+
+  def testProxyFromEnvironmentUsed(self) -> None:
+    """Tests that proxies set in the environment are used."""
+    os.environ['http_proxy'] = 'http://127.0.0.1:%d' % (
+      self._server.server_address[1]
+    )
+    gitiles_url = 'http://gitiles.invalid/+/refs/heads/main'
+    with mock.patch.object(expectations, 'GITILES_URL', gitiles_url):
+      processor = uu.UnitTestExpectationProcessor()
+      self.assertEqual(
+        processor.GetOriginExpectationFileContents(),
+        {
+          self._expectation_files[0]: 'foo_content\n',
+          self._expectation_files[1]: 'bar_content\n',
+        },
+      )
+    self.assertTrue(self._server.requests)
+    for r in self._server.requests:
+      self.assertTrue(r.startswith(gitiles_url))
+
+  def testRedirectsFollowed(self) -> None:
+    """Tests that redirects are followed."""
+    listing_path = '/+/refs/heads/main/%s?format=TEXT' % self._expectation_dir
+    self._server.redirects[listing_path] = '/moved' + listing_path
+    self._server.files['/moved' + listing_path] = self._server.files[
+      listing_path
+    ]
+    processor = uu.UnitTestExpectationProcessor()
+    self.assertEqual(
+      processor.ListGitilesDirectory(self._expectation_dir),
+      ['foo_expectations.txt', 'bar_expectations.txt'],
+    )
+    self.assertEqual(
+      self._server.requests, [listing_path, '/moved' + listing_path]
+    )
+
+  def testGetContentsNoCache(self) -> None:
+    """Tests that contents are fetched for every call without a cache."""
+    processor = uu.UnitTestExpectationProcessor()
+    expected_contents = {
+      self._expectation_files[0]: 'foo_content\n',
+      self._expectation_files[1]: 'bar_content\n',
+    }
+    self.assertEqual(
+      processor.GetOriginExpectationFileContents(), expected_contents
+    )
+    self.assertEqual(
+      processor.GetOriginExpectationFileContents(), expected_contents
+    )
+    self.assertEqual(len(self._GetFileRequests()), 4)
+
+  def testGetContentsWithCache(self) -> None:
+    """Tests that files are only downloaded again once they change."""
+    processor = uu.UnitTestExpectationProcessor(self._cache_dir)
+    expected_contents = {
+      self._expectation_files[0]: 'foo_content\n',
+      self._expectation_files[1]: 'bar_content\n',
+    }
+    self.assertEqual(
+      processor.GetOriginExpectationFileContents(), expected_contents
+    )
+    self.assertEqual(len(self._GetFileRequests()), 2)
+
+    # A new processor should be able to use the cache from the old one.
+    processor = uu.UnitTestExpectationProcessor(self._cache_dir)
+    self.assertEqual(
+      processor.GetOriginExpectationFileContents(), expected_contents
+    )
+    self.assertEqual(len(self._GetFileRequests()), 2)
+
+    self._SetOriginContents({
+      'foo_expectations.txt': 'new_foo_content\n',
+      'bar_expectations.txt': 'bar_content\n',
+    })
+    expected_contents[self._expectation_files[0]] = 'new_foo_content\n'
+    self.assertEqual(
+      processor.GetOriginExpectationFileContents(), expected_contents
+    )
+    file_requests = self._GetFileRequests()
+    self.assertEqual(len(file_requests), 3)
+    self.assertEqual(len([r for r in file_requests if 'foo' in r]), 2)
+
+  def testGetBlobIds(self) -> None:
+    """Tests that blob IDs are retrieved without downloading files."""
+    processor = uu.UnitTestExpectationProcessor()
+    self.assertEqual(
+      processor.GetOriginExpectationFileBlobIds(),
+      {
+        self._expectation_files[0]: expectations.GetGitBlobId(
+          b'foo_content\n'
+        ),
+        self._expectation_files[1]: expectations.GetGitBlobId(
+          b'bar_content\n'
+        ),
+      },
+    )
+    self.assertEqual(self._GetFileRequests(), [])
+
+  def testHttpError(self) -> None:
+    """Tests that HTTP errors are surfaced."""
+    processor = uu.UnitTestExpectationProcessor()
+    with self.assertRaises(urllib.error.HTTPError):
+      processor.ListGitilesDirectory('does/not/exist')
+
 
 class OverFailedBuildThresholdUnittest(unittest.TestCase):
   def setUp(self) -> None:
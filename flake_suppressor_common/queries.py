@@ -4,10 +4,24 @@
 """Module for querying BigQuery."""
 
 import collections
+import contextlib
+import datetime
+import hashlib
 import json
 import os
+import sqlite3
 import subprocess
-from typing import Any, Dict, List
+import time
+from typing import (
+  Any,
+  Callable,
+  Dict,
+  Generator,
+  Iterable,
+  List,
+  Mapping,
+  Optional,
+)
 
 # //testing imports.
 from flake_suppressor_common import common_typing as ct
@@ -15,6 +29,10 @@ from flake_suppressor_common import results as results_module
 from flake_suppressor_common import tag_utils
 
 MAX_ROWS = (2**31) - 1
+# Number of rows to request at a time when using the BigQuery client library.
+QUERY_PAGE_SIZE = 10000
+
+QUERY_CACHE_FILENAME = 'query_results.sqlite'
 
 # A note about the try version of the queries: The submitted builds subquery is
 # included in each query instead of running it once by itself and including the
@@ -62,6 +80,9 @@ class BigQueryQuerier:
     sample_period: int,
     billing_project: str,
     result_processor: results_module.ResultProcessor,
+    query_cache_dir: Optional[str] = None,
+    query_cache_max_age_hours: float = 24,
+    use_bigquery_client: bool = False,
   ):
     """Class for making calls to BigQuery.
 
@@ -70,12 +91,28 @@ class BigQueryQuerier:
           queried over.
       billing_project: A string containing the billing project to use for
           BigQuery queries.
+      query_cache_dir: An optional directory to cache query results in. If
+          set, results cached by previous runs are used instead of running the
+          same query again.
+      query_cache_max_age_hours: How old, in hours, cached results can be and
+          still be used.
+      use_bigquery_client: Whether to run queries using the BigQuery client
+          library instead of the bq tool. If set, results are fetched one page
+          at a time and methods returning query results return generators
+          instead of lists, so results are never held in memory all at once.
     """
     self._sample_period = sample_period
     self._billing_project = billing_project
     self._result_processor = result_processor
+    self._use_bigquery_client = use_bigquery_client
+    self._query_cache = None
+    if query_cache_dir:
+      self._query_cache = QueryResultCache(
+        os.path.join(query_cache_dir, QUERY_CACHE_FILENAME),
+        query_cache_max_age_hours * 60 * 60,
+      )
 
-  def GetFlakyOrFailingCiTests(self) -> ct.QueryJsonType:
+  def GetFlakyOrFailingCiTests(self) -> ct.QueryJsonIterableType:
     """Gets all flaky or failing tests from CI.
 
     Returns:
@@ -84,7 +121,7 @@ class BigQueryQuerier:
     """
     return self._GetJsonResultsFromBigQuery(self.GetFlakyOrFailingCiQuery())
 
-  def GetFailingCiBuildCulpritTests(self) -> ct.QueryJsonType:
+  def GetFailingCiBuildCulpritTests(self) -> ct.QueryJsonIterableType:
     """Gets all failing build culprit tests from CI builders.
 
     Returns:
@@ -97,7 +134,7 @@ class BigQueryQuerier:
 
   def GetFlakyOrFailingTestsFromCiBuilders(
     self, builder_names: List[str]
-  ) -> ct.QueryJsonType:
+  ) -> ct.QueryJsonIterableType:
     """Gets all flaky or failing tests from input CI builders.
 
     Returns:
@@ -110,7 +147,7 @@ class BigQueryQuerier:
 
   def GetFailingBuildCulpritFromCiBuilders(
     self, builder_names: List[str]
-  ) -> ct.QueryJsonType:
+  ) -> ct.QueryJsonIterableType:
     """Gets all failing build culprit tests from input CI builders.
 
     Returns:
@@ -121,7 +158,7 @@ class BigQueryQuerier:
       self.GetFailingBuildCulpritFromCIBuildersQuery(builder_names)
     )
 
-  def GetFlakyOrFailingTryTests(self) -> ct.QueryJsonType:
+  def GetFlakyOrFailingTryTests(self) -> ct.QueryJsonIterableType:
     """Gets all flaky or failing tests from the trybots.
 
     Limits results to those that came from builds used for CL submission.
@@ -238,7 +275,9 @@ class BigQueryQuerier:
     """
     raise NotImplementedError
 
-  def _GetJsonResultsFromBigQuery(self, query: str) -> ct.QueryJsonType:
+  def _GetJsonResultsFromBigQuery(
+    self, query: str
+  ) -> ct.QueryJsonIterableType:
     """Gets the JSON results from a BigQuery query.
 
     Automatically passes in the "@sample_period" parameterized argument to
@@ -248,12 +287,23 @@ class BigQueryQuerier:
       query: A string containing the SQL query to run in BigQuery.
 
     Returns:
-      The loaded JSON results from running |query|.
+      The loaded JSON results from running |query|. If the BigQuery client
+      library is in use, this is a generator that runs the query or reads the
+      cached results once it is first iterated over, otherwise it is a list.
     """
+    parameters = {'INT64': {'sample_period': self._sample_period}}
+    if self._query_cache:
+      cached_results = self._query_cache.Get(query, parameters)
+      if cached_results is not None:
+        if self._use_bigquery_client:
+          return cached_results
+        return list(cached_results)
+
+    if self._use_bigquery_client:
+      return self._IterJsonResultsFromBigQueryClient(query, parameters)
+
     cmd = GenerateBigQueryCommand(
-      self._billing_project,
-      {'INT64': {'sample_period': self._sample_period}},
-      batch=False,
+      self._billing_project, parameters, batch=False
     )
 
     with open(os.devnull, 'w') as devnull:
@@ -266,7 +316,74 @@ class BigQueryQuerier:
         text=True,
       )
 
-    return json.loads(completed_process.stdout)
+    results = json.loads(completed_process.stdout)
+    if self._query_cache:
+      with self._query_cache.OpenWriter(query, parameters) as write_rows:
+        write_rows(results)
+    return results
+
+  def _IterJsonResultsFromBigQueryClient(
+    self, query: str, parameters: QueryParameters
+  ) -> Generator[ct.SingleQueryResultType, None, None]:
+    """Generates results for |query| using the BigQuery client library.
+
+    Args:
+      query: A string containing the SQL query to run in BigQuery.
+      parameters: The parameters to run |query| with, in the same format as
+          for GenerateBigQueryCommand().
+
+    Yields:
+      Each row returned by |query|, in the same format that the bq tool
+      outputs. If the query cache is in use, each page is cached as it is
+      fetched, but the results are only reused once all of them have been
+      generated.
+    """
+    with contextlib.ExitStack() as stack:
+      write_rows = None
+      if self._query_cache:
+        write_rows = stack.enter_context(
+          self._query_cache.OpenWriter(query, parameters)
+        )
+      for page in self._GetPagesFromBigQueryClient(query, parameters):
+        rows = [
+          {k: _ConvertBigQueryValue(v) for k, v in row.items()} for row in page
+        ]
+        if write_rows:
+          write_rows(rows)
+        yield from rows
+
+  def _GetPagesFromBigQueryClient(
+    self, query: str, parameters: QueryParameters
+  ) -> Iterable[Iterable[Mapping[str, Any]]]:
+    """Runs |query| using the BigQuery client library.
+
+    Args:
+      query: A string containing the SQL query to run in BigQuery.
+      parameters: The parameters to run |query| with, in the same format as
+          for GenerateBigQueryCommand().
+
+    Returns:
+      An iterable of pages, each of which is an iterable of rows. Pages are
+      only fetched once they are iterated over.
+    """
+    # Only needed when the client library is used, so avoid requiring it
+    # otherwise.
+    from google.cloud import bigquery  # pylint: disable=import-outside-toplevel
+
+    query_parameters = []
+    for parameter_type, parameter_pairs in parameters.items():
+      for k, v in parameter_pairs.items():
+        query_parameters.append(
+          bigquery.ScalarQueryParameter(k, parameter_type, v)
+        )
+    client = bigquery.Client(project=self._billing_project)
+    job = client.query(
+      query,
+      job_config=bigquery.QueryJobConfig(
+        query_parameters=query_parameters, use_legacy_sql=False
+      ),
+    )
+    return job.result(page_size=QUERY_PAGE_SIZE).pages
 
   def _GetResultCountWithQuery(
     self, query: str, result_counts: ct.ResultCountType
@@ -290,6 +407,180 @@ class BigQueryQuerier:
       result_counts[typ_tags][test_name] += count
 
 
+class QueryResultCache:
+  """Persistent cache of BigQuery results stored in a SQLite database.
+
+  Results are stored one row per record, per query and set of parameters, and
+  reused until they are older than the maximum age. Rows are both written and
+  read a page at a time, so results never need to be held in memory all at
+  once.
+  """
+
+  def __init__(self, cache_file: str, max_age_seconds: float):
+    """
+    Args:
+      cache_file: A path to the SQLite database to use. Does not need to exist
+          yet.
+      max_age_seconds: How old cached results can be and still be used.
+    """
+    self._cache_file = cache_file
+    self._max_age_seconds = max_age_seconds
+    cache_dir = os.path.dirname(cache_file)
+    if cache_dir:
+      os.makedirs(cache_dir, exist_ok=True)
+    # Rows are tagged with the time their write started so that rows from
+    # writes which never finished are not mixed in with complete results.
+    # A query is only added to the queries table once all of its rows have
+    # been written.
+    with self._Connect() as connection:
+      connection.execute(
+        'CREATE TABLE IF NOT EXISTS queries (key TEXT PRIMARY KEY, '
+        'timestamp REAL)'
+      )
+      connection.execute(
+        'CREATE TABLE IF NOT EXISTS query_rows (key TEXT, timestamp REAL, '
+        'row TEXT)'
+      )
+      connection.execute(
+        'CREATE INDEX IF NOT EXISTS query_rows_by_key ON query_rows '
+        '(key, timestamp)'
+      )
+      expiration_time = time.time() - self._max_age_seconds
+      connection.execute(
+        'DELETE FROM queries WHERE timestamp < ?', (expiration_time,)
+      )
+      connection.execute(
+        'DELETE FROM query_rows WHERE timestamp < ?', (expiration_time,)
+      )
+
+  @contextlib.contextmanager
+  def _Connect(self) -> Generator[sqlite3.Connection, None, None]:
+    """Connects to the database, committing any changes on success."""
+    connection = sqlite3.connect(self._cache_file)
+    try:
+      with connection:
+        yield connection
+    finally:
+      connection.close()
+
+  # pylint: disable=no-self-use
+  def _GetKey(self, query: str, parameters: QueryParameters) -> str:
+    key = json.dumps([query, parameters], sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+  # pylint: enable=no-self-use
+
+  def Get(
+    self, query: str, parameters: QueryParameters
+  ) -> Optional[Generator[ct.SingleQueryResultType, None, None]]:
+    """Gets the cached results for |query|.
+
+    Args:
+      query: A string containing the SQL query that was run.
+      parameters: The parameters |query| was run with, in the same format as
+          for GenerateBigQueryCommand().
+
+    Returns:
+      None if there are no unexpired results for |query| and |parameters|.
+      Otherwise, a generator of the cached rows.
+    """
+    key = self._GetKey(query, parameters)
+    with self._Connect() as connection:
+      row = connection.execute(
+        'SELECT timestamp FROM queries WHERE key = ? AND timestamp >= ?',
+        (key, time.time() - self._max_age_seconds),
+      ).fetchone()
+    if not row:
+      return None
+    return self._IterRows(key, row[0])
+
+  def _IterRows(
+    self, key: str, timestamp: float
+  ) -> Generator[ct.SingleQueryResultType, None, None]:
+    # Each page is read with its own connection so that no lock is held on
+    # the database while rows are being consumed.
+    last_rowid = 0
+    while True:
+      with self._Connect() as connection:
+        rows = connection.execute(
+          'SELECT rowid, row FROM query_rows WHERE key = ? AND timestamp = ? '
+          'AND rowid > ? ORDER BY rowid LIMIT ?',
+          (key, timestamp, last_rowid, QUERY_PAGE_SIZE),
+        ).fetchall()
+      if not rows:
+        return
+      for _, row in rows:
+        yield json.loads(row)
+      last_rowid = rows[-1][0]
+
+  @contextlib.contextmanager
+  def OpenWriter(
+    self, query: str, parameters: QueryParameters
+  ) -> Generator[
+    Callable[[Iterable[ct.SingleQueryResultType]], None], None, None
+  ]:
+    """Opens a writer to cache results for |query|.
+
+    The cached results are only used if the context exits normally, so
+    partially read results are never reused.
+
+    Args:
+      query: A string containing the SQL query that was run.
+      parameters: The parameters |query| was run with, in the same format as
+          for GenerateBigQueryCommand().
+
+    Yields:
+      A function taking an iterable of rows to add to the cached results.
+      Rows are committed on every call.
+    """
+    key = self._GetKey(query, parameters)
+    timestamp = time.time()
+
+    def WriteRows(rows: Iterable[ct.SingleQueryResultType]) -> None:
+      with self._Connect() as connection:
+        connection.executemany(
+          'INSERT INTO query_rows VALUES (?, ?, ?)',
+          ((key, timestamp, json.dumps(r)) for r in rows),
+        )
+
+    try:
+      yield WriteRows
+    except BaseException:
+      with self._Connect() as connection:
+        connection.execute(
+          'DELETE FROM query_rows WHERE key = ? AND timestamp = ?',
+          (key, timestamp),
+        )
+      raise
+    with self._Connect() as connection:
+      connection.execute(
+        'INSERT OR REPLACE INTO queries VALUES (?, ?)', (key, timestamp)
+      )
+      connection.execute(
+        'DELETE FROM query_rows WHERE key = ? AND timestamp != ?',
+        (key, timestamp),
+      )
+
+
+def _ConvertBigQueryValue(value: Any) -> Any:
+  """Converts a value from the BigQuery client library to bq tool format.
+
+  The bq tool outputs all scalar values as strings, so the rest of the code
+  expects that format regardless of how the query was run.
+  """
+  if value is None or isinstance(value, str):
+    return value
+  if isinstance(value, bool):
+    return 'true' if value else 'false'
+  if isinstance(value, (datetime.date, datetime.datetime)):
+    return value.isoformat()
+  if isinstance(value, (list, tuple)):
+    return [_ConvertBigQueryValue(v) for v in value]
+  if isinstance(value, Mapping):
+    return {k: _ConvertBigQueryValue(v) for k, v in value.items()}
+  return str(value)
+
+
 # TODO(crbug.com/343248818): Switch off this and use the bigquery module
 # directly.
 def GenerateBigQueryCommand(
@@ -5,7 +5,13 @@
 
 # pylint: disable=protected-access
 
+import datetime
 import json
+import os
+import sqlite3
+import tempfile
+import time
+import typing
 import unittest
 import unittest.mock as mock
 
@@ -81,6 +87,76 @@ class GetResultCountsUnittest(unittest.TestCase):
     self.assertEqual(self._subprocess_mock.call_count, 2)
 
 
+class QueryResultCacheUnittest(unittest.TestCase):
+  def setUp(self) -> None:
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    self._cache_dir = temp_dir.name
+    self._subprocess_patcher = mock.patch(
+      'flake_suppressor_common.queries.subprocess.run'
+    )
+    self._subprocess_mock = self._subprocess_patcher.start()
+    self.addCleanup(self._subprocess_patcher.stop)
+    self._subprocess_mock.return_value = uu.FakeProcess(
+      stdout=json.dumps([{'test_name': 'foo'}])
+    )
+
+  def _CreateQuerier(self, sample_period: int = 1) -> queries.BigQueryQuerier:
+    expectations_processor = uu.UnitTestExpectationProcessor()
+    results_processor = uu.UnitTestResultProcessor(expectations_processor)
+    return uu.UnitTest_BigQueryQuerier(
+      sample_period,
+      'project',
+      results_processor,
+      query_cache_dir=self._cache_dir,
+    )
+
+  def testResultsReused(self) -> None:
+    """Tests that cached results are used by later runs."""
+    self.assertEqual(
+      self._CreateQuerier().GetFlakyOrFailingCiTests(), [{'test_name': 'foo'}]
+    )
+    cache_file = os.path.join(self._cache_dir, queries.QUERY_CACHE_FILENAME)
+    self.assertTrue(os.path.exists(cache_file))
+    self.assertEqual(
+      self._CreateQuerier().GetFlakyOrFailingCiTests(), [{'test_name': 'foo'}]
+    )
+    self.assertEqual(self._subprocess_mock.call_count, 1)
+
+  def testDifferentQueriesNotReused(self) -> None:
+    """Tests that results are cached per query and parameters."""
+    querier = self._CreateQuerier()
+    querier.GetFlakyOrFailingCiTests()
+    querier.GetFlakyOrFailingTryTests()
+    self._CreateQuerier(sample_period=2).GetFlakyOrFailingCiTests()
+    self.assertEqual(self._subprocess_mock.call_count, 3)
+
+  def testExpiredResultsNotUsed(self) -> None:
+    """Tests that results older than the maximum age are not used."""
+    self._CreateQuerier().GetFlakyOrFailingCiTests()
+    with mock.patch.object(
+      queries.time, 'time', return_value=time.time() + 25 * 60 * 60
+    ):
+      self._CreateQuerier().GetFlakyOrFailingCiTests()
+    self.assertEqual(self._subprocess_mock.call_count, 2)
+
+  def testRowsStoredIndividually(self) -> None:
+    """Tests that each row is stored as its own record."""
+    self._subprocess_mock.return_value = uu.FakeProcess(
+      stdout=json.dumps([{'test_name': 'foo'}, {'test_name': 'bar'}])
+    )
+    self._CreateQuerier().GetFlakyOrFailingCiTests()
+    connection = sqlite3.connect(
+      os.path.join(self._cache_dir, queries.QUERY_CACHE_FILENAME)
+    )
+    self.addCleanup(connection.close)
+    rows = connection.execute('SELECT row FROM query_rows ORDER BY rowid')
+    self.assertEqual(
+      rows.fetchall(),
+      [('{"test_name": "foo"}',), ('{"test_name": "bar"}',)],
+    )
+
+
 class GenerateBigQueryCommandUnittest(unittest.TestCase):
   def testNoParametersSpecified(self) -> None:
     """Tests that no parameters are added if none are specified."""
@@ -102,5 +178,154 @@ class GenerateBigQueryCommandUnittest(unittest.TestCase):
     self.assertIn('--batch', cmd)
 
 
+class BigQueryClientUnittest(unittest.TestCase):
+  def setUp(self) -> None:
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    self._cache_dir = temp_dir.name
+    self._pages_patcher = mock.patch.object(
+      queries.BigQueryQuerier, '_GetPagesFromBigQueryClient'
+    )
+    self._pages_mock = self._pages_patcher.start()
+    self.addCleanup(self._pages_patcher.stop)
+    self._subprocess_patcher = mock.patch(
+      'flake_suppressor_common.queries.subprocess.run'
+    )
+    self._subprocess_mock = self._subprocess_patcher.start()
+    self.addCleanup(self._subprocess_patcher.stop)
+    self._fetched_pages = 0
+
+  def _SetPages(self, pages: list) -> None:
+    def SideEffect(*_) -> typing.Generator[list, None, None]:
+      for page in pages:
+        self._fetched_pages += 1
+        yield page
+
+    self._pages_mock.side_effect = SideEffect
+
+  def _CreateQuerier(
+    self, query_cache_dir: typing.Optional[str] = None
+  ) -> queries.BigQueryQuerier:
+    expectations_processor = uu.UnitTestExpectationProcessor()
+    results_processor = uu.UnitTestResultProcessor(expectations_processor)
+    return uu.UnitTest_BigQueryQuerier(
+      1,
+      'project',
+      results_processor,
+      query_cache_dir=query_cache_dir,
+      use_bigquery_client=True,
+    )
+
+  def testRowsConvertedToBqFormat(self) -> None:
+    """Tests that rows match the format output by the bq tool."""
+    self._SetPages([
+      [
+        {
+          'name': 'foo',
+          'count': 5,
+          'is_slow': False,
+          'date': datetime.date(2023, 3, 8),
+          'typ_tags': ['win', 'nvidia'],
+          'missing': None,
+        },
+      ],
+    ])
+    self.assertEqual(
+      list(self._CreateQuerier().GetFlakyOrFailingCiTests()),
+      [
+        {
+          'name': 'foo',
+          'count': '5',
+          'is_slow': 'false',
+          'date': '2023-03-08',
+          'typ_tags': ['win', 'nvidia'],
+          'missing': None,
+        },
+      ],
+    )
+    self._pages_mock.assert_called_once_with(
+      'SELECT * FROM foo', {'INT64': {'sample_period': 1}}
+    )
+    self._subprocess_mock.assert_not_called()
+
+  def testPagesFetchedLazily(self) -> None:
+    """Tests that pages are only fetched as rows are consumed."""
+    self._SetPages([[{'name': 'foo'}], [{'name': 'bar'}]])
+    results = self._CreateQuerier().GetFlakyOrFailingCiTests()
+    self.assertEqual(self._fetched_pages, 0)
+    self.assertEqual(next(results), {'name': 'foo'})
+    self.assertEqual(self._fetched_pages, 1)
+    self.assertEqual(list(results), [{'name': 'bar'}])
+    self.assertEqual(self._fetched_pages, 2)
+
+  def testResultCounts(self) -> None:
+    """Tests that result counts are tallied from streamed rows."""
+    self._SetPages([
+      [
+        {
+          'typ_tags': ['a', 'b', 'c'],
+          'test_name': 'garbage.suite.garbage.alphabet',
+          'result_count': 100,
+        },
+      ],
+      [
+        {
+          'typ_tags': ['a', 'b', 'c'],
+          'test_name': 'garbage.suite.garbage.alphabet',
+          'result_count': 50,
+        },
+      ],
+    ])
+    # Both the CI and try queries return the same rows.
+    self.assertEqual(
+      self._CreateQuerier().GetResultCounts(),
+      {('a', 'b', 'c'): {'alphabet': 300}},
+    )
+
+  def testResultsCached(self) -> None:
+    """Tests that streamed results are cached once fully consumed."""
+    self._SetPages([[{'name': 'foo'}], [{'name': 'bar', 'count': 1}]])
+    expected_results = [{'name': 'foo'}, {'name': 'bar', 'count': '1'}]
+    self.assertEqual(
+      list(self._CreateQuerier(self._cache_dir).GetFlakyOrFailingCiTests()),
+      expected_results,
+    )
+    self.assertEqual(
+      list(self._CreateQuerier(self._cache_dir).GetFlakyOrFailingCiTests()),
+      expected_results,
+    )
+    self._pages_mock.assert_called_once()
+
+  def testCachedResultsStreamed(self) -> None:
+    """Tests that cached results are read a page at a time."""
+    self._SetPages([[{'name': 'foo'}, {'name': 'bar'}], [{'name': 'baz'}]])
+    list(self._CreateQuerier(self._cache_dir).GetFlakyOrFailingCiTests())
+    with mock.patch.object(queries, 'QUERY_PAGE_SIZE', 1):
+      results = self._CreateQuerier(self._cache_dir).GetFlakyOrFailingCiTests()
+      self.assertIsInstance(results, typing.Generator)
+      self.assertEqual(next(results), {'name': 'foo'})
+      self.assertEqual(list(results), [{'name': 'bar'}, {'name': 'baz'}])
+    self._pages_mock.assert_called_once()
+
+  def testPartialResultsNotCached(self) -> None:
+    """Tests that results are not cached if they were not fully consumed."""
+    self._SetPages([[{'name': 'foo'}], [{'name': 'bar'}]])
+    results = self._CreateQuerier(self._cache_dir).GetFlakyOrFailingCiTests()
+    next(results)
+    results.close()
+    self.assertEqual(
+      list(self._CreateQuerier(self._cache_dir).GetFlakyOrFailingCiTests()),
+      [{'name': 'foo'}, {'name': 'bar'}],
+    )
+    self.assertEqual(self._pages_mock.call_count, 2)
+    connection = sqlite3.connect(
+      os.path.join(self._cache_dir, queries.QUERY_CACHE_FILENAME)
+    )
+    self.addCleanup(connection.close)
+    self.assertEqual(
+      connection.execute('SELECT COUNT(*) FROM query_rows').fetchone(), (2,)
+    )
+
+
 if __name__ == '__main__':
   unittest.main(verbosity=2)
@@ -3,11 +3,10 @@
 # found in the LICENSE file.
 """Module for working with BigQuery results."""
 
-import collections
 import datetime
 import os
 from collections import defaultdict
-from typing import List, Tuple
+from typing import Dict, Generator, Iterable, List, Tuple
 
 # //testing imports.
 from flake_suppressor_common import common_typing as ct
@@ -23,16 +22,21 @@ from typ import expectations_parser
 class ResultProcessor:
   def __init__(self, expectations_processor: expectations.ExpectationProcessor):
     self._expectations_processor = expectations_processor
+    # Expectation file name -> (contents, data_types.ExpectationIndex). Kept
+    # between calls so that each unchanged file is only parsed once.
+    self._expectation_indices = {}
 
   def AggregateResults(
-    self, results: ct.QueryJsonType
+    self, results: ct.QueryJsonIterableType
   ) -> ct.AggregatedResultsType:
     """Aggregates BigQuery results.
 
     Also filters out any results that have already been suppressed.
 
     Args:
-      results: Parsed JSON results from a BigQuery query.
+      results: Parsed JSON results from a BigQuery query. Can be a generator,
+          in which case results are converted and filtered as they are
+          generated.
 
     Returns:
       A map in the following format:
@@ -44,8 +48,9 @@ class ResultProcessor:
         },
       }
     """
-    results = self._ConvertJsonResultsToResultObjects(results)
-    results = self._FilterOutSuppressedResults(results)
+    results = self._FilterOutSuppressedResults(
+      self._IterResultObjectsFromJsonResults(results)
+    )
     aggregated_results = {}
     for r in results:
       build_url = 'http://ci.chromium.org/b/%s' % r.build_id
@@ -59,14 +64,16 @@ class ResultProcessor:
     return aggregated_results
 
   def AggregateTestStatusResults(
-    self, results: ct.QueryJsonType
+    self, results: ct.QueryJsonIterableType
   ) -> ct.AggregatedStatusResultsType:
     """Aggregates BigQuery results.
 
     Also filters out any results that have already been suppressed.
 
     Args:
-      results: Parsed JSON results from a BigQuery query.
+      results: Parsed JSON results from a BigQuery query. Can be a generator,
+          in which case results are converted and filtered as they are
+          generated.
 
     Returns:
       A map in the following format:
@@ -80,8 +87,9 @@ class ResultProcessor:
         },
       }
     """
-    results = self._ConvertJsonResultsToResultObjects(results)
-    results = self._FilterOutSuppressedResults(results)
+    results = self._FilterOutSuppressedResults(
+      self._IterResultObjectsFromJsonResults(results)
+    )
     aggregated_results = defaultdict(
       lambda: defaultdict(lambda: defaultdict(list))
     )
@@ -94,18 +102,17 @@ class ResultProcessor:
       )
     return aggregated_results
 
-  def _ConvertJsonResultsToResultObjects(
-    self, results: ct.QueryJsonType
-  ) -> List[data_types.Result]:
-    """Converts JSON BigQuery results to data_types.Result objects.
+  def _IterResultObjectsFromJsonResults(
+    self, results: ct.QueryJsonIterableType
+  ) -> Generator[data_types.Result, None, None]:
+    """Lazily converts JSON BigQuery results to data_types.Result objects.
 
     Args:
       results: Parsed JSON results from a BigQuery query
 
-    Returns:
-      The contents of |results| as a list of data_types.Result objects.
+    Yields:
+      A data_types.Result object for each of |results|.
     """
-    object_results = []
     for r in results:
       suite, test_name = self.GetTestSuiteAndNameFromResultDbName(r['name'])
       build_id = r['id'].split('-')[-1]
@@ -122,64 +129,95 @@ class ResultProcessor:
         is_slow = r['is_slow']
       if 'typ_expectations' in r:
         typ_expectations = r['typ_expectations']
-      object_results.append(
-        data_types.Result(
-          suite,
-          test_name,
-          typ_tags,
-          build_id,
-          status,
-          date,
-          is_slow,
-          typ_expectations,
-        )
+      yield data_types.Result(
+        suite,
+        test_name,
+        typ_tags,
+        build_id,
+        status,
+        date,
+        is_slow,
+        typ_expectations,
       )
-    return object_results
 
   def _FilterOutSuppressedResults(
-    self, results: List[data_types.Result]
+    self, results: Iterable[data_types.Result]
   ) -> List[data_types.Result]:
     """Filters out results that have already been suppressed in the repo.
 
     Args:
-      results: A list of data_types.Result objects.
+      results: An iterable of data_types.Result objects.
 
     Returns:
       |results| with any already-suppressed failures removed.
     """
-    # Get all the expectations.
-    origin_expectation_contents = (
-      self._expectations_processor.GetLocalCheckoutExpectationFileContents()
-    )
-    origin_expectations = collections.defaultdict(list)
-    for filename, contents in origin_expectation_contents.items():
-      list_parser = expectations_parser.TaggedTestListParser(contents)
-      for e in list_parser.expectations:
-        wildcard_type = unexpected_expectations.WildcardTypeFromTypExpectation(
-          e
-        )
-        expectation = data_types.Expectation(
-          e.test, e.tags, e.raw_results, wildcard_type, e.reason
-        )
-        origin_expectations[filename].append(expectation)
+    expectation_indices = self._GetExpectationIndices()
 
     # Discard any results that already have a matching expectation.
+    expectation_filenames = {}
     kept_results = []
     for r in results:
-      expectation_filename = (
-        self._expectations_processor.GetExpectationFileForSuite(r.suite, r.tags)
-      )
-      expectation_filename = os.path.basename(expectation_filename)
-      should_keep = True
-      for e in origin_expectations[expectation_filename]:
-        if e.AppliesToResult(r):
-          should_keep = False
-          break
-      if should_keep:
+      # Results with the same suite and tags always use the same file.
+      expectation_filename = expectation_filenames.get((r.suite, r.tags))
+      if expectation_filename is None:
+        expectation_filename = os.path.basename(
+          self._expectations_processor.GetExpectationFileForSuite(
+            r.suite, r.tags
+          )
+        )
+        expectation_filenames[(r.suite, r.tags)] = expectation_filename
+      expectation_index = expectation_indices.get(expectation_filename)
+      if expectation_index is None or not expectation_index.AppliesToResult(r):
         kept_results.append(r)
 
     return kept_results
 
+  def _GetExpectationIndices(self) -> Dict[str, data_types.ExpectationIndex]:
+    """Gets an index of the expectations in each local expectation file.
+
+    Returns:
+      A dict of expectation file name (str) -> data_types.ExpectationIndex.
+      Indices for files whose contents have not changed since the last call
+      are re-used.
+    """
+    expectation_contents = (
+      self._expectations_processor.GetLocalCheckoutExpectationFileContents()
+    )
+    expectation_indices = {}
+    for filename, contents in expectation_contents.items():
+      cached_contents, expectation_index = self._expectation_indices.get(
+        filename, (None, None)
+      )
+      if cached_contents != contents:
+        expectation_index = self._CreateExpectationIndex(contents)
+        self._expectation_indices[filename] = (contents, expectation_index)
+      expectation_indices[filename] = expectation_index
+    return expectation_indices
+
+  def _CreateExpectationIndex(
+    self, contents: str
+  ) -> data_types.ExpectationIndex:
+    """Parses expectation file contents into a data_types.ExpectationIndex.
+
+    Args:
+      contents: A string containing the contents of an expectation file.
+
+    Returns:
+      A data_types.ExpectationIndex containing all expectations in |contents|.
+    """
+    list_parser = expectations_parser.TaggedTestListParser(contents)
+    parsed_expectations = []
+    for e in list_parser.expectations:
+      wildcard_type = unexpected_expectations.WildcardTypeFromTypExpectation(
+        e
+      )
+      parsed_expectations.append(
+        data_types.Expectation(
+          e.test, e.tags, e.raw_results, wildcard_type, e.reason
+        )
+      )
+    return data_types.ExpectationIndex(parsed_expectations)
+
   def GetTestSuiteAndNameFromResultDbName(
     self, result_db_name: str
   ) -> Tuple[str, str]:
@@ -124,6 +124,11 @@ class AggregateResultsUnittest(BaseResultsUnittest):
     self.assertEqual(
       self._results.AggregateResults(query_results), expected_output
     )
+    # Streamed results should be handled the same way.
+    self.assertEqual(
+      self._results.AggregateResults(r for r in query_results),
+      expected_output,
+    )
 
 
 class AggregateTestStatusResultsUnittest(BaseResultsUnittest):
@@ -257,7 +262,7 @@ class AggregateTestStatusResultsUnittest(BaseResultsUnittest):
     )
 
 
-class ConvertJsonResultsToResultObjectsUnittest(BaseResultsUnittest):
+class IterResultObjectsFromJsonResultsUnittest(BaseResultsUnittest):
   def testBasic(self) -> None:
     """Basic functionality test."""
     r = [
@@ -297,7 +302,8 @@ class ConvertJsonResultsToResultObjectsUnittest(BaseResultsUnittest):
       ),
     ]
     self.assertEqual(
-      self._results._ConvertJsonResultsToResultObjects(r), expected_results
+      list(self._results._IterResultObjectsFromJsonResults(r)),
+      expected_results,
     )
 
   def testOnQueryResultWithOptionalAttributes(self) -> None:
@@ -355,7 +361,8 @@ class ConvertJsonResultsToResultObjectsUnittest(BaseResultsUnittest):
       ),
     ]
     self.assertEqual(
-      self._results._ConvertJsonResultsToResultObjects(r), expected_results
+      list(self._results._IterResultObjectsFromJsonResults(r)),
+      expected_results,
     )
 
 
@@ -410,6 +417,40 @@ class FilterOutSuppressedResultsUnittest(BaseResultsUnittest):
       self._results._FilterOutSuppressedResults(r), expected_filtered_results
     )
 
+  def testExpectationFilesParsedOnce(self) -> None:
+    """Tests that unchanged expectation files are only parsed once."""
+    self._local_mock.return_value = {
+      'foo_expectations.txt': GENERIC_EXPECTATION_FILE_CONTENTS,
+    }
+    self._expectation_file_mock.return_value = os.path.join(
+      uu.ABSOLUTE_EXPECTATION_FILE_DIRECTORY, 'foo_expectations.txt'
+    )
+    r = [
+      data_types.Result(
+        'foo_integration_test', 'foo_test', tuple(['win']), 'id'
+      ),
+      data_types.Result(
+        'foo_integration_test', 'bar_test', tuple(['win']), 'id'
+      ),
+    ]
+    with mock.patch.object(
+      self._results,
+      '_CreateExpectationIndex',
+      wraps=self._results._CreateExpectationIndex,
+    ) as index_mock:
+      self.assertEqual(self._results._FilterOutSuppressedResults(r), r[1:])
+      self.assertEqual(self._results._FilterOutSuppressedResults(r), r[1:])
+      index_mock.assert_called_once_with(GENERIC_EXPECTATION_FILE_CONTENTS)
+
+      # Changed contents should be parsed again.
+      self._local_mock.return_value = {
+        'foo_expectations.txt': GENERIC_EXPECTATION_FILE_CONTENTS.replace(
+          'foo_test', 'bar_test'
+        ),
+      }
+      self.assertEqual(self._results._FilterOutSuppressedResults(r), r[:1])
+      self.assertEqual(index_mock.call_count, 2)
+
 
 if __name__ == '__main__':
   unittest.main(verbosity=2)
@@ -30,14 +30,62 @@ def AddCommonArguments(parser: argparse.ArgumentParser) -> None:
     default=100,
     help='The number of recent builds to query.',
   )
+  parser.add_argument(
+    '--columnar-ingestion',
+    action='store_true',
+    default=False,
+    help='Read BigQuery results as Arrow record batches instead of '
+    'converting each row to a pandas Series. Uses less memory and CPU '
+    'on large queries.',
+  )
+  parser.add_argument(
+    '--jobs',
+    '-j',
+    type=int,
+    default=1,
+    help='The number of processes to use when matching query results against '
+    'expectations and when splitting expectations by staleness. Values '
+    'greater than 1 also fetch results while matching.',
+  )
+  cache_group = parser.add_mutually_exclusive_group()
+  cache_group.add_argument(
+    '--cache-dir',
+    default=constants.DEFAULT_CACHE_DIR,
+    help=(
+      'The directory to store data that is reused between runs in, e.g. the '
+      'ages of expectation file lines.'
+    ),
+  )
+  cache_group.add_argument(
+    '--no-cache',
+    action='store_const',
+    const=None,
+    dest='cache_dir',
+    help='Do not read or write any data that is reused between runs.',
+  )
+  parser.add_argument(
+    '--query-cache-max-age-hours',
+    type=float,
+    default=0,
+    help=(
+      'Reuse BigQuery results stored in --cache-dir by a previous run if they '
+      'are less than this many hours old instead of running the same query '
+      'again. Useful when re-running with different settings. Set to 0 to '
+      'always run queries.'
+    ),
+  )
   parser.add_argument(
     '--output-format',
     choices=[
       'html',
+      'jsonl',
       'print',
     ],
     default='html',
-    help='How to output script results.',
+    help=(
+      'How to output script results. "jsonl" outputs one JSON object per '
+      'line for consumption by other tools.'
+    ),
   )
   parser.add_argument(
     '--remove-stale-expectations',
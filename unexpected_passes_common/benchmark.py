@@ -0,0 +1,140 @@
+#!/usr/bin/env vpython3
+# Copyright 2026 The Chromium Authors
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Benchmarks for performance-sensitive unexpected pass finder code.
+
+Example usage:
+  testing/unexpected_passes_common/benchmark.py split_by_staleness --jobs 8
+  testing/unexpected_passes_common/benchmark.py full_wildcard_matching
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from typing import Callable
+
+if __name__ == '__main__':
+  sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+# //testing imports.
+from unexpected_passes_common import data_types
+from unexpected_passes_common import unittest_utils as uu
+
+
+def _TimeFunction(name: str, func: Callable[[], None], iterations: int) -> None:
+  """Runs |func| |iterations| times and prints the best and mean times."""
+  times = []
+  for _ in range(iterations):
+    start = time.perf_counter()
+    func()
+    times.append(time.perf_counter() - start)
+  print(
+    '%s: best %.3fs, mean %.3fs over %d iterations'
+    % (name, min(times), sum(times) / len(times), iterations)
+  )
+
+
+def BenchmarkSplitByStaleness(args: argparse.Namespace) -> None:
+  print('Creating synthetic expectation map...')
+  expectation_map = uu.CreateSyntheticExpectationMap(
+    args.num_expectation_files,
+    args.num_expectations,
+    args.num_builders,
+    args.builders_per_expectation,
+  )
+  _TimeFunction(
+    'SplitByStaleness (serial)',
+    expectation_map.SplitByStaleness,
+    args.iterations,
+  )
+  if args.jobs > 1:
+    _TimeFunction(
+      'SplitByStaleness (%d jobs)' % args.jobs,
+      lambda: expectation_map.SplitByStaleness(jobs=args.jobs),
+      args.iterations,
+    )
+
+
+def BenchmarkFullWildcardMatching(args: argparse.Namespace) -> None:
+  print('Creating synthetic expectations and test names...')
+  rng = random.Random(0)
+
+  def RandomPath() -> str:
+    return 'suite_%d/dir_%d' % (
+      rng.randrange(args.num_suites),
+      rng.randrange(100),
+    )
+
+  expectations = [
+    data_types.Expectation(
+      '%s/*/test_%d*' % (RandomPath(), rng.randrange(100)),
+      [],
+      'Failure',
+      data_types.WildcardType.FULL_WILDCARD,
+    )
+    for _ in range(args.num_expectations)
+  ]
+  test_names = [
+    '%s/subdir_%d/test_%d' % (RandomPath(), i, rng.randrange(100))
+    for i in range(args.num_test_names)
+  ]
+  matcher = data_types.FullWildcardMatcher()
+  for e in expectations:
+    matcher.Add(e, e)
+
+  def PerExpectationLoop() -> None:
+    for test_name in test_names:
+      for e in expectations:
+        e.MaybeAppliesToTest(test_name)
+
+  def Matcher() -> None:
+    for test_name in test_names:
+      for _ in matcher.IterMatches(test_name):
+        pass
+
+  _TimeFunction('Per-expectation loop', PerExpectationLoop, args.iterations)
+  _TimeFunction('FullWildcardMatcher', Matcher, args.iterations)
+
+
+def ParseArgs() -> argparse.Namespace:
+  parser = argparse.ArgumentParser(
+    description='Benchmarks unexpected pass finder code using synthetic data.'
+  )
+  subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+  split_parser = subparsers.add_parser(
+    'split_by_staleness',
+    help='Benchmark TestExpectationMap.SplitByStaleness().',
+  )
+  split_parser.set_defaults(func=BenchmarkSplitByStaleness)
+  split_parser.add_argument('--num-expectation-files', type=int, default=10)
+  split_parser.add_argument('--num-expectations', type=int, default=50000)
+  split_parser.add_argument('--num-builders', type=int, default=300)
+  split_parser.add_argument('--builders-per-expectation', type=int, default=10)
+  split_parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count())
+
+  wildcard_parser = subparsers.add_parser(
+    'full_wildcard_matching',
+    help='Benchmark FullWildcardMatcher against checking every expectation.',
+  )
+  wildcard_parser.set_defaults(func=BenchmarkFullWildcardMatching)
+  wildcard_parser.add_argument('--num-expectations', type=int, default=2000)
+  wildcard_parser.add_argument('--num-test-names', type=int, default=5000)
+  wildcard_parser.add_argument('--num-suites', type=int, default=10)
+
+  for subparser in subparsers.choices.values():
+    subparser.add_argument('--iterations', type=int, default=3)
+  return parser.parse_args()
+
+
+def main() -> int:
+  args = ParseArgs()
+  args.func(args)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -8,11 +8,14 @@ import json
 import logging
 import os
 import subprocess
-from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
 
 # //testing imports.
 from unexpected_passes_common import constants
 from unexpected_passes_common import data_types
+from unexpected_passes_common import json_cache
 
 TESTING_BUILDBOT_DIR = os.path.realpath(
   os.path.join(constants.CHROMIUM_SRC_DIR, 'testing', 'buildbot')
@@ -42,6 +45,14 @@ PUBLIC_INTERNAL_JSON_FILES = {
 
 AUTOGENERATED_JSON_KEY = 'AAAAA1 AUTOGENERATED FILE DO NOT EDIT'
 
+BUILDER_INDEX_CACHE_FILENAME = 'builder_index_cache.json'
+MIRROR_CACHE_FILENAME = 'builder_mirror_cache.json'
+# Mirrors change rarely, so results are reused for a day.
+MIRROR_CACHE_TTL_SECONDS = 24 * 60 * 60
+# Mirror lookups are spent waiting on Buildbucket rather than on the CPU, so
+# use more workers than there are cores.
+MAX_BUILDBUCKET_WORKERS = 16
+
 FakeBuildersDict = Dict[data_types.BuilderEntry, Set[data_types.BuilderEntry]]
 
 # TODO(crbug.com/358591565): Refactor this to remove the need for global
@@ -66,17 +77,36 @@ def ClearInstance() -> None:
 
 
 class Builders:
-  def __init__(self, suite: Optional[str], include_internal_builders: bool):
+  def __init__(
+    self,
+    suite: Optional[str],
+    include_internal_builders: bool,
+    cache_dir: Optional[str] = None,
+  ):
     """
     Args:
       suite: A string containing particular suite of interest if applicable,
           such as for Telemetry-based tests. Can be None if not applicable.
       include_internal_builders: A boolean indicating whether data from
           internal builders should be used in addition to external ones.
+      cache_dir: An optional directory to store persistent caches in, e.g. the
+          value of the --cache-dir argument. If not set, nothing is cached
+          between runs.
     """
     self._authenticated = False
+    self._authentication_lock = threading.Lock()
     self._suite = suite
     self._include_internal_builders = include_internal_builders
+    self._builder_index = None
+    if cache_dir:
+      self._builder_index = BuilderIndexCache(
+        os.path.join(cache_dir, BUILDER_INDEX_CACHE_FILENAME)
+      )
+    self._mirror_cache = None
+    if cache_dir:
+      self._mirror_cache = BuilderMirrorCache(
+        os.path.join(cache_dir, MIRROR_CACHE_FILENAME)
+      )
 
   def _ProcessTestingBuildbotJsonFiles(
     self, files: List[str], are_internal_files: bool, builder_type: str
@@ -91,24 +121,72 @@ class Builders:
       elif builder_type == constants.BuilderTypes.TRY:
         if 'tryserver' not in filepath:
           continue
-      with open(filepath, encoding='utf-8') as f:
-        buildbot_json = json.load(f)
-      # Skip any JSON files that don't contain builder information.
-      if AUTOGENERATED_JSON_KEY not in buildbot_json:
-        continue
-
-      for builder, test_map in buildbot_json.items():
-        # Remove the auto-generated comments.
-        if 'AAAA' in builder:
-          continue
-        # Filter out any builders that don't run the suite in question.
-        if not self._BuilderRunsTestOfInterest(test_map):
-          continue
+      for builder in self._GetBuildersOfInterestInFile(filepath, False):
         builders.add(
           data_types.BuilderEntry(builder, builder_type, are_internal_files)
         )
     return builders
 
+  def _GetBuildersOfInterestInFile(
+    self, filepath: str, is_infra_config_file: bool
+  ) -> List[str]:
+    """Gets the builders in a JSON file that run a test of interest.
+
+    Results are served from the builder index cache if one is in use and
+    |filepath| has not changed since it was last indexed.
+
+    Args:
+      filepath: A string containing a path to either a //testing/buildbot JSON
+          file or an //infra/config generated targets JSON file.
+      is_infra_config_file: A boolean denoting whether |filepath| is an
+          //infra/config file.
+
+    Returns:
+      A list of builder names from the top level of |filepath|'s JSON whose
+      test specs contain a test of interest.
+    """
+
+    def _ParseFile() -> List[str]:
+      with open(filepath, encoding='utf-8') as f:
+        builder_json = json.load(f)
+      if not is_infra_config_file:
+        # Skip any JSON files that don't contain builder information.
+        if AUTOGENERATED_JSON_KEY not in builder_json:
+          return []
+      builders = []
+      for builder, test_map in builder_json.items():
+        # Remove the auto-generated comments.
+        if not is_infra_config_file and 'AAAA' in builder:
+          continue
+        # Filter out any builders that don't run the suite in question.
+        if self._BuilderRunsTestOfInterest(test_map):
+          builders.append(builder)
+      return builders
+
+    if not self._builder_index:
+      return _ParseFile()
+    return self._builder_index.GetBuilders(
+      filepath, self._GetBuilderIndexKey(), _ParseFile
+    )
+
+  def _GetBuilderIndexKey(self) -> str:
+    """Gets a key identifying what _BuilderRunsTestOfInterest() looks for.
+
+    Cached builder index results are only reused for the same key, so
+    implementations whose _BuilderRunsTestOfInterest() depends on more than
+    the suite and isolate names should override this.
+
+    Returns:
+      A string uniquely identifying the tests of interest.
+    """
+    return json.dumps(
+      [
+        '%s.%s' % (type(self).__module__, type(self).__qualname__),
+        self._suite,
+        sorted(self.GetIsolateNames()),
+      ]
+    )
+
   def _ProcessInfraConfigJsonFiles(
     self,
     files: List[Tuple[str, str]],
@@ -119,9 +197,6 @@ class Builders:
     for builder_name, filepath in files:
       if not filepath.endswith('.json'):
         raise RuntimeError(f'Given path {filepath} was not a JSON file')
-      with open(filepath, encoding='utf-8') as f:
-        targets_json = json.load(f)
-
       # For CI builders, we can directly use the builder name from the JSON
       # file, as this will always be a valid CI builder name. Additionally, this
       # properly handles cases of a parent builder triggering a child tester -
@@ -129,9 +204,7 @@ class Builders:
       # For trybots, we want to instead use the builder name from the filepath.
       # This is because trybots that mirror CI builders contain the CI builder
       # names in the JSON, but we want the trybot name.
-      for ci_builder_name, test_map in targets_json.items():
-        if not self._BuilderRunsTestOfInterest(test_map):
-          continue
+      for ci_builder_name in self._GetBuildersOfInterestInFile(filepath, True):
         if builder_type == constants.BuilderTypes.CI:
           builders.add(
             data_types.BuilderEntry(
@@ -169,6 +242,8 @@ class Builders:
       ci_builders |= self._ProcessInfraConfigJsonFiles(
         _GetInternalInfraConfigCiJsonFiles(), True, constants.BuilderTypes.CI
       )
+    if self._builder_index:
+      self._builder_index.Save()
 
     logging.debug(
       'Got %d CI builders after trimming: %s',
@@ -231,11 +306,17 @@ class Builders:
       dedicated_try_builders |= self._ProcessInfraConfigJsonFiles(
         _GetInternalInfraConfigTryJsonFiles(), True, constants.BuilderTypes.TRY
       )
+    if self._builder_index:
+      self._builder_index.Save()
     mirrored_builders = set()
     no_output_builders = set()
 
+    # Each uncached builder still needs its own `bb ls | bb get` pair, since
+    # the most recent ended build has to be found per builder. Instead of
+    # combining them into a single bb invocation, the lookups are run
+    # concurrently.
     with concurrent.futures.ThreadPoolExecutor(
-      max_workers=os.cpu_count()
+      max_workers=MAX_BUILDBUCKET_WORKERS
     ) as pool:
       results_iter = pool.map(
         self._GetMirroredBuildersForCiBuilder, ci_builders
@@ -245,6 +326,8 @@ class Builders:
           mirrored_builders |= builders
         else:
           no_output_builders |= builders
+    if self._mirror_cache:
+      self._mirror_cache.Save()
 
     if no_output_builders:
       raise RuntimeError(
@@ -289,20 +372,26 @@ class Builders:
       )
       return mirrored_builders, True
 
-    bb_output = self._GetBuildbucketOutputForCiBuilder(ci_builder)
-    if not bb_output:
-      mirrored_builders.add(ci_builder)
-      logging.debug(
-        'Did not get Buildbucket output for builder %s', ci_builder.name
-      )
-      return mirrored_builders, False
+    mirrored = None
+    if self._mirror_cache:
+      mirrored = self._mirror_cache.GetMirrors(ci_builder)
+    if mirrored is None:
+      bb_output = self._GetBuildbucketOutputForCiBuilder(ci_builder)
+      if not bb_output:
+        mirrored_builders.add(ci_builder)
+        logging.debug(
+          'Did not get Buildbucket output for builder %s', ci_builder.name
+        )
+        return mirrored_builders, False
 
-    bb_json = json.loads(bb_output)
-    mirrored = (
-      bb_json.get('output', {})
-      .get('properties', {})
-      .get('mirrored_builders', [])
-    )
+      bb_json = json.loads(bb_output)
+      mirrored = (
+        bb_json.get('output', {})
+        .get('properties', {})
+        .get('mirrored_builders', [])
+      )
+      if self._mirror_cache:
+        self._mirror_cache.SetMirrors(ci_builder, mirrored)
     # The mirror names from Buildbucket include the group separated by :, e.g.
     # tryserver.chromium.android:gpu-fyi-try-android-m-nexus-5x-64, so only grab
     # the builder name.
@@ -322,18 +411,20 @@ class Builders:
   def _GetBuildbucketOutputForCiBuilder(
     self, ci_builder: data_types.BuilderEntry
   ) -> str:
-    # Ensure the user is logged in to bb.
-    if not self._authenticated:
-      try:
-        with open(os.devnull, 'w', newline='', encoding='utf-8') as devnull:
-          subprocess.check_call(
-            ['bb', 'auth-info'], stdout=devnull, stderr=devnull
-          )
-      except subprocess.CalledProcessError as e:
-        raise RuntimeError(
-          'You are not logged into bb - run `bb auth-login`.'
-        ) from e
-      self._authenticated = True
+    # Ensure the user is logged in to bb. This is called from multiple threads,
+    # so make sure only one of them checks.
+    with self._authentication_lock:
+      if not self._authenticated:
+        try:
+          with open(os.devnull, 'w', newline='', encoding='utf-8') as devnull:
+            subprocess.check_call(
+              ['bb', 'auth-info'], stdout=devnull, stderr=devnull
+            )
+        except subprocess.CalledProcessError as e:
+          raise RuntimeError(
+            'You are not logged into bb - run `bb auth-login`.'
+          ) from e
+        self._authenticated = True
     # Split out for ease of testing.
     # Get the Buildbucket ID for the most recent completed build for a builder.
     p = subprocess.Popen(
@@ -393,6 +484,125 @@ class Builders:
     raise NotImplementedError()
 
 
+class BuilderIndexCache(json_cache.JsonFileCache):
+  """Persistent index of which builders in each JSON file run tests of interest.
+
+  Each file's entry is keyed by the file's modification time and size, so
+  unchanged files do not need to be loaded and parsed again. Within an entry,
+  results are stored per index key (see Builders._GetBuilderIndexKey()) since
+  different suites are interested in different builders.
+  """
+
+  ENTRIES_KEY = 'files'
+
+  def GetBuilders(
+    self,
+    filepath: str,
+    index_key: str,
+    parse_func: Callable[[], List[str]],
+  ) -> List[str]:
+    """Gets the builders of interest in |filepath|.
+
+    Args:
+      filepath: A string containing a path to a builder JSON file.
+      index_key: A string identifying the tests of interest.
+      parse_func: A function taking no arguments which parses |filepath| and
+          returns the builders of interest. Only called on a cache miss.
+
+    Returns:
+      A list of builder names, as returned by |parse_func|.
+    """
+    stat = os.stat(filepath)
+    key = os.path.abspath(filepath)
+    entry = self._entries.get(key)
+    if (
+      not entry
+      or entry['mtime_ns'] != stat.st_mtime_ns
+      or entry['size'] != stat.st_size
+    ):
+      entry = {
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'builders': {},
+      }
+      self._entries[key] = entry
+
+    builders = entry['builders'].get(index_key)
+    if builders is None:
+      builders = parse_func()
+      entry['builders'][index_key] = builders
+      self._modified = True
+    return builders
+
+
+class BuilderMirrorCache(json_cache.JsonFileCache):
+  """Persistent cache of the try builders mirroring each CI builder.
+
+  Entries expire after a fixed amount of time so that changes to mirroring
+  configurations are eventually picked up. Lookups may happen from multiple
+  threads at once.
+  """
+
+  ENTRIES_KEY = 'builders'
+
+  def __init__(
+    self, cache_file: str, ttl_seconds: int = MIRROR_CACHE_TTL_SECONDS
+  ):
+    """
+    Args:
+      cache_file: A filepath to a JSON file to load the cache from and save it
+          to. Does not need to exist yet.
+      ttl_seconds: How long cached mirrors remain valid for, in seconds.
+    """
+    super().__init__(cache_file)
+    self._ttl_seconds = ttl_seconds
+    self._lock = threading.Lock()
+
+  def GetMirrors(
+    self, ci_builder: data_types.BuilderEntry
+  ) -> Optional[List[str]]:
+    """Gets the cached mirrors for |ci_builder|.
+
+    Args:
+      ci_builder: A data_types.BuilderEntry for a CI builder.
+
+    Returns:
+      None if there is no unexpired entry for |ci_builder|. Otherwise, a list
+      of mirrored builders as reported by Buildbucket, i.e. in the
+      "group:builder" format.
+    """
+    with self._lock:
+      entry = self._entries.get(_GetMirrorCacheKey(ci_builder))
+    if not entry or time.time() - entry['timestamp'] > self._ttl_seconds:
+      return None
+    return entry['mirrors']
+
+  def SetMirrors(
+    self, ci_builder: data_types.BuilderEntry, mirrors: List[str]
+  ) -> None:
+    """Caches the mirrors for |ci_builder|.
+
+    Args:
+      ci_builder: A data_types.BuilderEntry for a CI builder.
+      mirrors: A list of mirrored builders as reported by Buildbucket.
+    """
+    with self._lock:
+      self._entries[_GetMirrorCacheKey(ci_builder)] = {
+        'timestamp': time.time(),
+        'mirrors': list(mirrors),
+      }
+      self._modified = True
+
+  def Save(self) -> None:
+    """Writes the cache to disk if it was modified."""
+    with self._lock:
+      super().Save()
+
+
+def _GetMirrorCacheKey(ci_builder: data_types.BuilderEntry) -> str:
+  return '%s/%s' % (ci_builder.project, ci_builder.name)
+
+
 def _GetPublicTestingBuildbotJsonFiles() -> List[str]:
   return [
     os.path.join(TESTING_BUILDBOT_DIR, f)
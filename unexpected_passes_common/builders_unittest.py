@@ -5,6 +5,9 @@
 
 import json
 import os
+import sys
+import tempfile
+import time
 from typing import Any, Dict, Set, Tuple
 import unittest
 from unittest import mock
@@ -993,5 +996,212 @@ class GetTryBuildersUnittest(FakeFilesystemTestCaseWithFileCreation):
     )
 
 
+class BuilderIndexCacheUnittest(FakeFilesystemTestCaseWithFileCreation):
+  def setUp(self) -> None:
+    self.setUpPyfakefs()
+    self._cache_dir = '/cache'
+    self._json_file = os.path.join(
+      builders.TESTING_BUILDBOT_DIR, 'chromium.gpu.json'
+    )
+    self.CreateFile(
+      self._json_file,
+      contents=json.dumps(
+        {
+          'AAAAA1 AUTOGENERATED FILE DO NOT EDIT': {},
+          'Builder': {},
+        }
+      ),
+    )
+    self.fs.create_dir(os.path.join(builders.INFRA_CONFIG_BUILDERS_DIR, 'ci'))
+
+  def _CreateInstance(self) -> unittest_utils.GenericBuilders:
+    return unittest_utils.GenericBuilders(cache_dir=self._cache_dir)
+
+  def testCachedBetweenRuns(self) -> None:
+    """Tests that unchanged files are not re-parsed by later runs."""
+    expected_builders = {
+      data_types.BuilderEntry('Builder', constants.BuilderTypes.CI, False)
+    }
+    instance = self._CreateInstance()
+    with mock.patch.object(
+      instance, '_BuilderRunsTestOfInterest', return_value=True
+    ) as interest_mock:
+      self.assertEqual(instance.GetCiBuilders(), expected_builders)
+      interest_mock.assert_called_once()
+    self.assertTrue(
+      os.path.exists(
+        os.path.join(self._cache_dir, builders.BUILDER_INDEX_CACHE_FILENAME)
+      )
+    )
+
+    instance = self._CreateInstance()
+    with mock.patch.object(instance, '_BuilderRunsTestOfInterest') as m:
+      self.assertEqual(instance.GetCiBuilders(), expected_builders)
+      m.assert_not_called()
+
+  def testModifiedFileReparsed(self) -> None:
+    """Tests that a changed file is parsed again."""
+    self._CreateInstance().GetCiBuilders()
+    with open(self._json_file, 'w', encoding='utf-8') as f:
+      json.dump(
+        {
+          'AAAAA1 AUTOGENERATED FILE DO NOT EDIT': {},
+          'Builder': {},
+          'Other Builder': {},
+        },
+        f,
+      )
+    self.assertEqual(
+      self._CreateInstance().GetCiBuilders(),
+      {
+        data_types.BuilderEntry('Builder', constants.BuilderTypes.CI, False),
+        data_types.BuilderEntry(
+          'Other Builder', constants.BuilderTypes.CI, False
+        ),
+      },
+    )
+
+  def testDifferentIndexKeys(self) -> None:
+    """Tests that results are cached separately per index key."""
+    self._CreateInstance().GetCiBuilders()
+    instance = unittest_utils.GenericBuilders(
+      suite='other_suite', cache_dir=self._cache_dir
+    )
+    with mock.patch.object(
+      instance, '_BuilderRunsTestOfInterest', return_value=False
+    ) as interest_mock:
+      self.assertEqual(instance.GetCiBuilders(), set())
+      interest_mock.assert_called_once()
+
+  def testCorruptCacheIgnored(self) -> None:
+    """Tests that an unreadable cache file is ignored."""
+    self.CreateFile(
+      os.path.join(self._cache_dir, builders.BUILDER_INDEX_CACHE_FILENAME),
+      contents='not json',
+    )
+    self.assertEqual(
+      self._CreateInstance().GetCiBuilders(),
+      {data_types.BuilderEntry('Builder', constants.BuilderTypes.CI, False)},
+    )
+
+
+# Stands in for the real bb binary. `bb ls` outputs the builder name as the
+# build ID, and `bb get` reports a single mirror named after that ID. Each
+# `bb get` call is logged so that tests can tell when Buildbucket was queried.
+FAKE_BB_SCRIPT = """#!%s
+import json
+import os
+import sys
+
+if sys.argv[1] == 'ls':
+  print(sys.argv[-1].split('/')[-1])
+elif sys.argv[1] == 'get':
+  build_id = sys.stdin.read().strip()
+  with open(os.environ['FAKE_BB_LOG'], 'a') as f:
+    f.write(build_id + '\\n')
+  print(json.dumps({
+    'output': {
+      'properties': {
+        'mirrored_builders': ['try:%%s_try' %% build_id],
+      },
+    },
+  }))
+""" % sys.executable
+
+
+@unittest.skipIf(sys.platform == 'win32', 'Fake bb script requires POSIX')
+class FakeBuildbucketMirrorUnittest(unittest.TestCase):
+  def setUp(self) -> None:
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    self._temp_dir = temp_dir.name
+    self._cache_dir = os.path.join(self._temp_dir, 'cache')
+    self._bb_log = os.path.join(self._temp_dir, 'bb.log')
+
+    bin_dir = os.path.join(self._temp_dir, 'bin')
+    os.mkdir(bin_dir)
+    bb_path = os.path.join(bin_dir, 'bb')
+    with open(bb_path, 'w', encoding='utf-8') as f:
+      f.write(FAKE_BB_SCRIPT)
+    os.chmod(bb_path, 0o755)
+    env_patcher = mock.patch.dict(
+      os.environ,
+      {
+        'PATH': bin_dir + os.pathsep + os.environ.get('PATH', ''),
+        'FAKE_BB_LOG': self._bb_log,
+      },
+    )
+    env_patcher.start()
+    self.addCleanup(env_patcher.stop)
+
+    # No dedicated try builders.
+    buildbot_dir = os.path.join(self._temp_dir, 'buildbot')
+    os.mkdir(buildbot_dir)
+    for patcher in (
+      mock.patch.object(builders, 'TESTING_BUILDBOT_DIR', buildbot_dir),
+      mock.patch.object(
+        builders, '_GetPublicInfraConfigTryJsonFiles', return_value=[]
+      ),
+    ):
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+    self._ci_builders = {
+      data_types.BuilderEntry(
+        'ci_builder_%d' % i, constants.BuilderTypes.CI, False
+      )
+      for i in range(5)
+    }
+    self._expected_try_builders = {
+      data_types.BuilderEntry(
+        'ci_builder_%d_try' % i, constants.BuilderTypes.TRY, False
+      )
+      for i in range(5)
+    }
+
+  def _GetQueriedBuilders(self) -> list:
+    if not os.path.exists(self._bb_log):
+      return []
+    with open(self._bb_log, encoding='utf-8') as f:
+      return f.read().splitlines()
+
+  def testMirrorsResolved(self) -> None:
+    """Tests that mirrors are resolved via bb for every CI builder."""
+    instance = unittest_utils.GenericBuilders()
+    self.assertEqual(
+      instance.GetTryBuilders(self._ci_builders), self._expected_try_builders
+    )
+    self.assertEqual(
+      sorted(self._GetQueriedBuilders()),
+      sorted(b.name for b in self._ci_builders),
+    )
+
+  def testMirrorsCachedBetweenRuns(self) -> None:
+    """Tests that cached mirrors are used instead of querying bb."""
+    instance = unittest_utils.GenericBuilders(cache_dir=self._cache_dir)
+    instance.GetTryBuilders(self._ci_builders)
+    self.assertEqual(len(self._GetQueriedBuilders()), 5)
+
+    instance = unittest_utils.GenericBuilders(cache_dir=self._cache_dir)
+    self.assertEqual(
+      instance.GetTryBuilders(self._ci_builders), self._expected_try_builders
+    )
+    self.assertEqual(len(self._GetQueriedBuilders()), 5)
+
+  def testExpiredMirrorsRequeried(self) -> None:
+    """Tests that cached mirrors older than the TTL are not used."""
+    instance = unittest_utils.GenericBuilders(cache_dir=self._cache_dir)
+    instance.GetTryBuilders(self._ci_builders)
+
+    expired_time = time.time() + builders.MIRROR_CACHE_TTL_SECONDS + 1
+    with mock.patch.object(builders.time, 'time', return_value=expired_time):
+      instance = unittest_utils.GenericBuilders(cache_dir=self._cache_dir)
+      self.assertEqual(
+        instance.GetTryBuilders(self._ci_builders),
+        self._expected_try_builders,
+      )
+    self.assertEqual(len(self._GetQueriedBuilders()), 10)
+
+
 if __name__ == '__main__':
   unittest.main(verbosity=2)
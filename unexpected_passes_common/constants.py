@@ -9,6 +9,9 @@ CHROMIUM_SRC_DIR = os.path.realpath(
   os.path.join(os.path.dirname(__file__), '..', '..')
 )
 SRC_INTERNAL_DIR = os.path.realpath(os.path.join(CHROMIUM_SRC_DIR, 'internal'))
+DEFAULT_CACHE_DIR = os.path.join(
+  CHROMIUM_SRC_DIR, 'out', '.unexpected_pass_finder_cache'
+)
 
 
 # pylint: disable=useless-object-inheritance
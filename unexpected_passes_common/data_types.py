@@ -3,10 +3,10 @@
 # found in the LICENSE file.
 """Various custom data types for use throughout the unexpected pass finder."""
 
+import array
 import collections
-import copy
+import concurrent.futures
 import enum
-import functools
 import logging
 from typing import (
   Any,
@@ -33,6 +33,20 @@ FULL_PASS = 1
 NEVER_PASS = 2
 PARTIAL_PASS = 3
 
+# Staleness classifications used by SplitByStaleness().
+_STALE = 1
+_SEMI_STALE = 2
+_ACTIVE = 3
+_SEMI_STALE_ACTIVE = 4
+# The pass types whose steps are kept for each staleness classification, in
+# the order they are added to the split map.
+_STALENESS_PASS_TYPES = {
+  _STALE: [FULL_PASS],
+  _SEMI_STALE: [FULL_PASS, PARTIAL_PASS, NEVER_PASS],
+  _ACTIVE: [NEVER_PASS, PARTIAL_PASS],
+  _SEMI_STALE_ACTIVE: [FULL_PASS, PARTIAL_PASS, NEVER_PASS],
+}
+
 # Allow different unexpected pass finder implementations to register custom
 # data types if necessary. These are set to the base versions at the end of the
 # file.
@@ -74,6 +88,24 @@ def SetTestExpectationMapImplementation(
   TestExpectationMap = impl
 
 
+def GetImplementations() -> Tuple[type, type, type, type]:
+  """Gets the currently registered data type implementations.
+
+  Custom implementations are not carried over to spawned processes, so worker
+  processes should pass this to SetImplementations().
+  """
+  return (Expectation, Result, BuildStats, TestExpectationMap)
+
+
+def SetImplementations(implementations: Tuple[type, type, type, type]) -> None:
+  """Sets all data type implementations from GetImplementations() output."""
+  expectation_impl, result_impl, build_stats_impl, map_impl = implementations
+  SetExpectationImplementation(expectation_impl)
+  SetResultImplementation(result_impl)
+  SetBuildStatsImplementation(build_stats_impl)
+  SetTestExpectationMapImplementation(map_impl)
+
+
 class WildcardType(enum.Enum):
   # Exact string match.
   NON_WILDCARD = 1
@@ -113,7 +145,9 @@ class BaseExpectation:
     self._expected_results_id = registry.RegisterExpectedResults(
       expected_results
     )
+    self._SetComparison()
 
+  def _SetComparison(self) -> None:
     # We're going to be making a lot of comparisons, so only use slower wildcard
     # comparisons as necessary.
     if self.wildcard_type == WildcardType.NON_WILDCARD:
@@ -126,6 +160,29 @@ class BaseExpectation:
     else:
       raise ValueError(f'Unsupported wildcard type {self.wildcard_type.name}')
 
+  # Registry IDs are only meaningful within a single process, so pickle the
+  # registered values instead for use with multiprocessing.
+  def __getstate__(self) -> dict:
+    state = self.__dict__.copy()
+    del state['_comp']
+    del state['_reduced_glob']
+    state['_test_id'] = self.test
+    state['_tags_id'] = self.tags
+    state['_bug_id'] = self.bug
+    state['_expected_results_id'] = self.expected_results
+    return state
+
+  def __setstate__(self, state: dict) -> None:
+    self.__dict__.update(state)
+    self._test_id = registry.RegisterTestName(state['_test_id'])
+    self._tags_id = registry.RegisterTagSet(state['_tags_id'])
+    self._bug_id = registry.RegisterBug(state['_bug_id'])
+    self._expected_results_id = registry.RegisterExpectedResults(
+      state['_expected_results_id']
+    )
+    self._reduced_glob = None
+    self._SetComparison()
+
   def __eq__(self, other: Any) -> bool:
     return (
       isinstance(other, BaseExpectation)
@@ -162,6 +219,10 @@ class BaseExpectation:
   def tags(self, new_tags: FrozenSet[str]):
     self._tags_id = registry.RegisterTagSet(new_tags)
 
+  @property
+  def tags_mask(self) -> int:
+    return registry.RetrieveTagMask(self._tags_id)
+
   @property
   def bug(self) -> str:
     return registry.RetrieveBug(self._bug_id)
@@ -193,7 +254,9 @@ class BaseExpectation:
       True if |self| applies to |result|, otherwise False.
     """
     assert isinstance(result, BaseResult)
-    return self._comp(result.test) and self.tags <= result.tags
+    return self._comp(result.test) and registry.IsTagMaskSubset(
+      self.tags_mask, result.tags_mask
+    )
 
   def MaybeAppliesToTest(self, test_name: str) -> bool:
     """Similar to AppliesToResult, but used to do initial filtering.
@@ -292,6 +355,24 @@ class BaseResult:
     # TODO(crbug.com/388307196): Switch to using ints instead of strings.
     self.build_id = build_id
 
+  # See BaseExpectation.__getstate__.
+  def __getstate__(self) -> dict:
+    state = self.__dict__.copy()
+    state['_test_id'] = self.test
+    state['_tags_id'] = self.tags
+    state['_actual_result_id'] = self.actual_result
+    state['_step_id'] = self.step
+    return state
+
+  def __setstate__(self, state: dict) -> None:
+    self.__dict__.update(state)
+    self._test_id = registry.RegisterTestName(state['_test_id'])
+    self._tags_id = registry.RegisterTagSet(state['_tags_id'])
+    self._actual_result_id = registry.RegisterActualResult(
+      state['_actual_result_id']
+    )
+    self._step_id = registry.RegisterStep(state['_step_id'])
+
   def __eq__(self, other: Any) -> bool:
     return (
       isinstance(other, BaseResult)
@@ -324,6 +405,10 @@ class BaseResult:
   def tags(self) -> FrozenSet[str]:
     return registry.RetrieveTagSet(self._tags_id)
 
+  @property
+  def tags_mask(self) -> int:
+    return registry.RetrieveTagMask(self._tags_id)
+
   @property
   def actual_result(self) -> str:
     return registry.RetrieveActualResult(self._actual_result_id)
@@ -333,6 +418,161 @@ class BaseResult:
     return registry.RetrieveStep(self._step_id)
 
 
+class ResultTable:
+  """Compact, column-based container for a builder's results.
+
+  Stores the registry IDs for each result in parallel arrays instead of
+  creating a Result object per row, which uses a fraction of the memory for
+  builders with millions of results. Result objects are only created on demand,
+  e.g. for results that did not match any expectation.
+  """
+
+  def __init__(self):
+    self.test_ids = array.array('I')
+    self.tag_ids = array.array('I')
+    self.result_ids = array.array('I')
+    self.step_ids = array.array('I')
+    self.build_ids = array.array('I')
+
+  # Tuples of (column, retrieve function, register function).
+  _COLUMNS = (
+    ('test_ids', registry.RetrieveTestName, registry.RegisterTestName),
+    ('tag_ids', registry.RetrieveTagSet, registry.RegisterTagSet),
+    (
+      'result_ids',
+      registry.RetrieveActualResult,
+      registry.RegisterActualResult,
+    ),
+    ('step_ids', registry.RetrieveStep, registry.RegisterStep),
+    ('build_ids', registry.RetrieveBuildId, registry.RegisterBuildId),
+  )
+
+  def __len__(self) -> int:
+    return len(self.test_ids)
+
+  # Registry IDs are only meaningful within a single process, so each column is
+  # pickled as its distinct values plus indices into them.
+  def __getstate__(self) -> dict:
+    state = {}
+    for column, retrieve, _ in self._COLUMNS:
+      ids = getattr(self, column)
+      unique_ids = sorted(set(ids))
+      positions = {identifier: i for i, identifier in enumerate(unique_ids)}
+      state[column] = (
+        [retrieve(identifier) for identifier in unique_ids],
+        array.array('I', (positions[identifier] for identifier in ids)),
+      )
+    return state
+
+  def __setstate__(self, state: dict) -> None:
+    for column, _, register in self._COLUMNS:
+      values, positions = state[column]
+      ids = [register(v) for v in values]
+      setattr(self, column, array.array('I', (ids[p] for p in positions)))
+
+  def __iter__(self) -> Generator[BaseResult, None, None]:
+    for i in range(len(self)):
+      yield self.GetResult(i)
+
+  def Append(
+    self,
+    test: str,
+    tags: Iterable[str],
+    actual_result: str,
+    step: str,
+    build_id: str,
+  ) -> None:
+    """Adds a single result to the table.
+
+    Args are the same as for BaseResult.
+    """
+    self.test_ids.append(registry.RegisterTestName(test))
+    self.tag_ids.append(registry.RegisterTagSet(frozenset(tags)))
+    self.result_ids.append(registry.RegisterActualResult(actual_result))
+    self.step_ids.append(registry.RegisterStep(step))
+    self.build_ids.append(registry.RegisterBuildId(build_id))
+
+  def Extend(
+    self,
+    test_ids: Iterable[int],
+    tag_ids: Iterable[int],
+    result_ids: Iterable[int],
+    step_ids: Iterable[int],
+    build_ids: Iterable[int],
+  ) -> None:
+    """Adds already registered results to the table, one column at a time.
+
+    All arguments must contain the same number of registry IDs.
+    """
+    self.test_ids.extend(test_ids)
+    self.tag_ids.extend(tag_ids)
+    self.result_ids.extend(result_ids)
+    self.step_ids.extend(step_ids)
+    self.build_ids.extend(build_ids)
+    assert (
+      len(self.test_ids)
+      == len(self.tag_ids)
+      == len(self.result_ids)
+      == len(self.step_ids)
+      == len(self.build_ids)
+    )
+
+  def GetResult(self, index: int) -> BaseResult:
+    """Creates a Result object for the row at |index|."""
+    return Result(
+      registry.RetrieveTestName(self.test_ids[index]),
+      registry.RetrieveTagSet(self.tag_ids[index]),
+      registry.RetrieveActualResult(self.result_ids[index]),
+      registry.RetrieveStep(self.step_ids[index]),
+      registry.RetrieveBuildId(self.build_ids[index]),
+    )
+
+  def GetDeduplicatedRows(self) -> array.array:
+    """Gets the rows that should be counted, with retries removed.
+
+    Identical results are only counted once, and a passing result is dropped if
+    there is a failing result for the same test, tags, step and build, i.e. the
+    pass was a retry of a flaky failure. This is done by sorting row indices
+    rather than building sets of Result objects.
+
+    Returns:
+      An array of row indices sorted by test ID, such that all rows for a test
+      are adjacent.
+    """
+    pass_id = registry.RegisterActualResult('Pass')
+    test_ids = self.test_ids
+    tag_ids = self.tag_ids
+    step_ids = self.step_ids
+    build_ids = self.build_ids
+    result_ids = self.result_ids
+    order = sorted(
+      range(len(self)),
+      key=lambda i: (
+        test_ids[i],
+        tag_ids[i],
+        step_ids[i],
+        build_ids[i],
+        result_ids[i] == pass_id,
+        result_ids[i],
+      ),
+    )
+
+    rows = array.array('I')
+    previous_key = None
+    previous_result = None
+    for i in order:
+      key = (test_ids[i], tag_ids[i], step_ids[i], build_ids[i])
+      if key != previous_key:
+        # Failures sort before passes, so the first row for a key is a pass
+        # only if the key has no failures.
+        rows.append(i)
+      elif result_ids[i] != previous_result and result_ids[i] != pass_id:
+        rows.append(i)
+      previous_key = key
+      previous_result = result_ids[i]
+    return rows
+
+
 class BaseBuildStats:
   """Container for keeping track of a builder's pass/fail stats."""
 
@@ -364,6 +604,16 @@ class BaseBuildStats:
     self.failure_links.add(BuildLinkFromBuildId(build_id))
     self.tag_sets.add(tags)
 
+  def AddStats(self, other: 'BaseBuildStats') -> None:
+    """Adds the builds tallied in |other| to |self|.
+
+    Implementations that store additional data should extend this.
+    """
+    self.passed_builds += other.passed_builds
+    self.total_builds += other.total_builds
+    self.failure_links |= other.failure_links
+    self.tag_sets |= other.tag_sets
+
   def GetStatsAsString(self) -> str:
     return '(%d/%d passed)' % (self.passed_builds, self.total_builds)
 
@@ -425,7 +675,8 @@ class BaseTypedMap(dict):
   """
 
   def __init__(self, *args, **kwargs):  # pylint:disable=super-init-not-called
-    self.update(*args, **kwargs)
+    if args or kwargs:
+      self.update(*args, **kwargs)
 
   def update(self, *args, **kwargs) -> None:
     if args:
@@ -473,39 +724,304 @@ class BaseTypedMap(dict):
           yield (k,) + nested_value
 
   def Merge(
-    self, other_map: 'BaseTypedMap', reference_map: Optional[dict] = None
+    self,
+    other_map: 'BaseTypedMap',
+    reference_map: Optional[dict] = None,
+    additive: bool = False,
   ) -> None:
     """Merges |other_map| into self.
 
+    Runs in time linear in the size of |other_map|.
+
     Args:
       other_map: A BaseTypedMap whose contents will be merged into self.
-      reference_map: A dict containing the information that was originally in
-          self. Used for ensuring that a single expectation/builder/step
-          combination is only ever updated once. If None, a copy of self will be
-          used.
+      reference_map: An optional dict containing the information that was
+          originally in self. If provided, used for ensuring that a single
+          expectation/builder/step combination is only ever updated once across
+          multiple merges.
+      additive: If True, BuildStats that exist in both maps are combined
+          instead of the BuildStats from |other_map| replacing the existing one.
+          Used for merging results for the same builder from disjoint shards.
     """
+    self._Merge(other_map, reference_map, additive, set())
+
+  def _Merge(
+    self,
+    other_map: 'BaseTypedMap',
+    reference_map: Optional[dict],
+    additive: bool,
+    updated_stats: Set[int],
+  ) -> None:
     assert isinstance(other_map, self.__class__)
-    # We should only ever encounter a single updated BuildStats for an
-    # expectation/builder/step combination. Use the reference map to determine
-    # if a particular BuildStats has already been updated or not.
-    reference_map = reference_map or copy.deepcopy(self)
     for key, value in other_map.items():
       if key not in self:
         self[key] = value
+      elif isinstance(value, dict):
+        self[key]._Merge(
+          value,
+          None if reference_map is None else reference_map.get(key, {}),
+          additive,
+          updated_stats,
+        )
       else:
-        if isinstance(value, dict):
-          self[key].Merge(value, reference_map.get(key, {}))
-        else:
-          assert isinstance(value, BuildStats)
-          # Ensure we haven't updated this BuildStats already. If the reference
-          # map doesn't have a corresponding BuildStats, then base_map shouldn't
-          # have initially either, and thus it would have been added before
-          # reaching this point. Otherwise, the two values must match, meaning
-          # that base_map's BuildStats hasn't been updated yet.
+        assert isinstance(value, BuildStats)
+        existing_stats = self[key]
+        # We should only ever encounter a single updated BuildStats for an
+        # expectation/builder/step combination. Track the identities of the
+        # BuildStats updated by this merge instead of keeping a copy of the
+        # original contents.
+        assert id(existing_stats) not in updated_stats
+        if reference_map is not None:
+          # If the reference map doesn't have a corresponding BuildStats, then
+          # self shouldn't have initially either, and thus it would have been
+          # added before reaching this point. Otherwise, the two values must
+          # match, meaning that self's BuildStats hasn't been updated yet.
           reference_stats = reference_map.get(key, None)
           assert reference_stats is not None
-          assert reference_stats == self[key]
+          assert reference_stats == existing_stats
+        if additive:
+          existing_stats.AddStats(value)
+          updated_stats.add(id(existing_stats))
+        else:
           self[key] = value
+          updated_stats.add(id(value))
+
+
+# Key used to store the entries ending at a prefix trie node. Real keys are
+# single characters, so this cannot collide with them.
+_TRIE_ENTRIES_KEY = ''
+
+# Characters with special meaning in FULL_WILDCARD test names. Everything
+# before the first of these has to match literally.
+_GLOB_SPECIAL_CHARACTERS = frozenset('*?[\\')
+
+
+class PrefixTrie:
+  """Stores values under string prefixes.
+
+  All values stored under any prefix of a name can be found with a single walk
+  over the name.
+  """
+
+  def __init__(self):
+    self._root = {}
+
+  def Add(self, prefix: str, value: Any) -> None:
+    """Stores |value| under |prefix|."""
+    node = self._root
+    for character in prefix:
+      node = node.setdefault(character, {})
+    node.setdefault(_TRIE_ENTRIES_KEY, []).append(value)
+
+  def IterPrefixValues(self, name: str) -> Generator[Any, None, None]:
+    """Iterates over the values stored under any prefix of |name|."""
+    node = self._root
+    yield from node.get(_TRIE_ENTRIES_KEY, ())
+    for character in name:
+      node = node.get(character)
+      if node is None:
+        return
+      yield from node.get(_TRIE_ENTRIES_KEY, ())
+
+
+def _GetLiteralPrefix(glob: str) -> str:
+  """Gets the part of |glob| before any special characters."""
+  for i, character in enumerate(glob):
+    if character in _GLOB_SPECIAL_CHARACTERS:
+      return glob[:i]
+  return glob
+
+
+class FullWildcardMatcher:
+  """Finds the FULL_WILDCARD expectations that match a test name.
+
+  Expectations are stored in a prefix trie keyed by the literal part of their
+  test name before the first wildcard. A single walk over a test name finds
+  the only expectations that can possibly match it, so the comparatively slow
+  glob comparison is done for those instead of for every expectation.
+  """
+
+  def __init__(self):
+    self._trie = PrefixTrie()
+
+  def Add(self, expectation: BaseExpectation, value: Any) -> None:
+    """Adds a FULL_WILDCARD expectation to the matcher.
+
+    Args:
+      expectation: The Expectation to add.
+      value: The value to return from IterMatches() when |expectation|
+          matches.
+    """
+    assert expectation.wildcard_type == WildcardType.FULL_WILDCARD
+    self._trie.Add(_GetLiteralPrefix(expectation.test), (expectation, value))
+
+  def IterMatches(self, test_name: str) -> Generator[Any, None, None]:
+    """Iterates over the values of all expectations matching |test_name|.
+
+    Args:
+      test_name: A string containing the name of a test.
+
+    Returns:
+      A generator yielding the value passed to Add() for every expectation
+      whose test name matches |test_name|. Tags are not considered.
+    """
+    for expectation, value in self._trie.IterPrefixValues(test_name):
+      if expectation.MaybeAppliesToTest(test_name):
+        yield value
+
+
+def _HasCustomTestNameMatching(expectation: BaseExpectation) -> bool:
+  """Checks whether |expectation| changes how test names are matched.
+
+  This is the case if its implementation overrides MaybeAppliesToTest() or
+  the comparison used by it.
+  """
+  if (
+    type(expectation).MaybeAppliesToTest
+    is not BaseExpectation.MaybeAppliesToTest
+  ):
+    return True
+  # pylint: disable=protected-access
+  comparison = getattr(expectation._comp, '__func__', None)
+  return comparison not in (
+    BaseExpectation._CompareNonWildcard,
+    BaseExpectation._CompareSimpleWildcard,
+    BaseExpectation._CompareFullWildcard,
+  )
+  # pylint: enable=protected-access
+
+
+class ExpectationIndex:
+  """Index for quickly finding the expectations that apply to results.
+
+  Rather than comparing every result against every expectation, expectations
+  are split up by wildcard type: NON_WILDCARD expectations are looked up by
+  test name, SIMPLE_WILDCARD expectations are stored in a prefix trie that is
+  walked once per test name, and FULL_WILDCARD expectations are found with a
+  FullWildcardMatcher. Tag subset checks are done on the registry's tag
+  bitmasks. Expectations whose implementations change how test names are
+  matched can't be looked up by name, so they are checked against every test
+  instead.
+  """
+
+  def __init__(
+    self,
+    expectation_map: 'BaseTestExpectationMap',
+    expectation_files: Optional[Iterable[str]] = None,
+  ):
+    """
+    Args:
+      expectation_map: A TestExpectationMap whose expectations will be indexed.
+      expectation_files: An iterable of expectation file names to limit the
+          index to. If None, expectations from all files will be indexed.
+    """
+    self._non_wildcard = collections.defaultdict(list)
+    self._simple_wildcard_trie = PrefixTrie()
+    self._full_wildcard = FullWildcardMatcher()
+    self._custom_name_matching = []
+
+    for expectation_file, expectation_builder_map in expectation_map.items():
+      if (
+        expectation_files is not None
+        and expectation_file not in expectation_files
+      ):
+        continue
+      for expectation in expectation_builder_map:
+        self._AddExpectation(expectation_file, expectation)
+
+  def _AddExpectation(
+    self, expectation_file: str, expectation: BaseExpectation
+  ) -> None:
+    # Subclasses are free to change how an expectation applies to a result, in
+    # which case the bitmask check cannot be used on its own.
+    custom_check = (
+      type(expectation).AppliesToResult is not BaseExpectation.AppliesToResult
+    )
+    entry = (
+      expectation_file,
+      expectation,
+      expectation.tags_mask,
+      custom_check,
+    )
+    if _HasCustomTestNameMatching(expectation):
+      self._custom_name_matching.append(
+        (expectation_file, expectation, expectation.tags_mask, True)
+      )
+    elif expectation.wildcard_type == WildcardType.NON_WILDCARD:
+      self._non_wildcard[expectation.test].append(entry)
+    elif expectation.wildcard_type == WildcardType.SIMPLE_WILDCARD:
+      self._simple_wildcard_trie.Add(expectation.test[:-1], entry)
+    else:
+      self._full_wildcard.Add(expectation, entry)
+
+  def _GetCandidates(self, test_name: str) -> List[tuple]:
+    """Gets the index entries whose test names could apply to |test_name|."""
+    candidates = list(self._non_wildcard.get(test_name, ()))
+    candidates.extend(self._simple_wildcard_trie.IterPrefixValues(test_name))
+    candidates.extend(self._full_wildcard.IterMatches(test_name))
+    candidates.extend(
+      entry
+      for entry in self._custom_name_matching
+      if entry[1].MaybeAppliesToTest(test_name)
+    )
+    return candidates
+
+  def IterTableMatches(
+    self, test_name: str, table: ResultTable, rows: Iterable[int]
+  ) -> Generator[Tuple[str, BaseExpectation, int], None, None]:
+    """Iterates over the expectations that apply to rows of a ResultTable.
+
+    Args:
+      test_name: A string containing the test name shared by all of |rows|.
+      table: The ResultTable containing |rows|.
+      rows: An iterable of row indices into |table|.
+
+    Returns:
+      A generator yielding tuples in the form (expectation_file (str),
+      expectation (Expectation), row (int)) for every expectation that applies
+      to a row.
+    """
+    candidates = self._GetCandidates(test_name)
+    if not candidates:
+      return
+    for row in rows:
+      result_mask = registry.RetrieveTagMask(table.tag_ids[row])
+      result = None
+      for expectation_file, expectation, tag_mask, custom_check in candidates:
+        if custom_check:
+          result = result or table.GetResult(row)
+          if not expectation.AppliesToResult(result):
+            continue
+        elif not registry.IsTagMaskSubset(tag_mask, result_mask):
+          continue
+        yield expectation_file, expectation, row
+
+  def IterMatches(
+    self, test_name: str, results: Iterable[BaseResult]
+  ) -> Generator[Tuple[str, BaseExpectation, BaseResult], None, None]:
+    """Iterates over the expectations that apply to each of |results|.
+
+    Args:
+      test_name: A string containing the test name shared by all of |results|.
+      results: An iterable of data_types.Result objects for |test_name|.
+
+    Returns:
+      A generator yielding tuples in the form (expectation_file (str),
+      expectation (Expectation), result (Result)) for every expectation that
+      applies to a result.
+    """
+    candidates = self._GetCandidates(test_name)
+    if not candidates:
+      return
+    for r in results:
+      result_mask = r.tags_mask
+      for expectation_file, expectation, tag_mask, custom_check in candidates:
+        if custom_check:
+          if not expectation.AppliesToResult(r):
+            continue
+        elif not registry.IsTagMaskSubset(tag_mask, result_mask):
+          continue
+        yield expectation_file, expectation, r
 
 
 class BaseTestExpectationMap(BaseTypedMap):
@@ -605,6 +1121,69 @@ class BaseTestExpectationMap(BaseTypedMap):
 
     return unmatched_results
 
+  def AddResultTable(
+    self,
+    builder: str,
+    table: ResultTable,
+    expectation_files: Optional[Iterable[str]] = None,
+  ) -> ResultListType:
+    """Adds the results in |table| to |self|.
+
+    Equivalent to AddResultList(), but works directly on the table's columns
+    so that Result objects only need to be created for unmatched results.
+
+    Args:
+      builder: A string containing the builder |table| came from. Should be
+          prefixed with something to distinguish between identically named CI
+          and try builders.
+      table: A data_types.ResultTable containing the ResultDB data queried for
+          |builder|.
+      expectation_files: An iterable of expectation file names that these
+          results could possibly apply to. If None, then expectations from all
+          known expectation files will be used.
+
+    Returns:
+      A list of data_types.Result objects who did not have a matching
+      expectation in |self|.
+    """
+    rows = table.GetDeduplicatedRows()
+    index = ExpectationIndex(self, expectation_files)
+    # Subclasses may need the full Result to tally stats.
+    custom_add = (
+      getattr(self._AddSingleResult, '__func__', None)
+      is not BaseTestExpectationMap._AddSingleResult
+    )
+    pass_id = registry.RegisterActualResult('Pass')
+    matched_rows = set()
+    start = 0
+    while start < len(rows):
+      test_id = table.test_ids[rows[start]]
+      end = start + 1
+      while end < len(rows) and table.test_ids[rows[end]] == test_id:
+        end += 1
+      test_name = registry.RetrieveTestName(test_id)
+      for ef, expectation, row in index.IterTableMatches(
+        test_name, table, rows[start:end]
+      ):
+        matched_rows.add(row)
+        builder_map = self[ef][expectation]
+        step_map = builder_map.setdefault(builder, StepBuildStatsMap())
+        stats = step_map.setdefault(
+          registry.RetrieveStep(table.step_ids[row]), BuildStats()
+        )
+        if custom_add:
+          self._AddSingleResult(table.GetResult(row), stats)
+        elif table.result_ids[row] == pass_id:
+          stats.AddPassedBuild(registry.RetrieveTagSet(table.tag_ids[row]))
+        else:
+          stats.AddFailedBuild(
+            registry.RetrieveBuildId(table.build_ids[row]),
+            registry.RetrieveTagSet(table.tag_ids[row]),
+          )
+      start = end
+
+    return [table.GetResult(row) for row in rows if row not in matched_rows]
+
   def _AddGroupedResults(
     self,
     grouped_results: Dict[str, ResultListType],
@@ -626,20 +1205,17 @@ class BaseTestExpectationMap(BaseTypedMap):
       A set of data_types.Result objects that had at least one matching
       expectation.
     """
+    # Building the index is linear in the number of expectations, which is
+    # far cheaper than comparing every test against every expectation.
+    index = ExpectationIndex(self, expectation_files)
     matched_results = set()
     for test_name, result_list in grouped_results.items():
-      for ef, expectation_map in self.items():
-        if expectation_files is not None and ef not in expectation_files:
-          continue
-        for expectation, builder_map in expectation_map.items():
-          if not expectation.MaybeAppliesToTest(test_name):
-            continue
-          for r in result_list:
-            if expectation.AppliesToResult(r):
-              matched_results.add(r)
-              step_map = builder_map.setdefault(builder, StepBuildStatsMap())
-              stats = step_map.setdefault(r.step, BuildStats())
-              self._AddSingleResult(r, stats)
+      for ef, expectation, r in index.IterMatches(test_name, result_list):
+        matched_results.add(r)
+        builder_map = self[ef][expectation]
+        step_map = builder_map.setdefault(builder, StepBuildStatsMap())
+        stats = step_map.setdefault(r.step, BuildStats())
+        self._AddSingleResult(r, stats)
     return matched_results
 
   # Overridden by subclasses.
@@ -659,12 +1235,17 @@ class BaseTestExpectationMap(BaseTypedMap):
   # pylint: enable=no-self-use
 
   def SplitByStaleness(
-    self,
+    self, jobs: int = 1
   ) -> Tuple[
     'BaseTestExpectationMap', 'BaseTestExpectationMap', 'BaseTestExpectationMap'
   ]:
     """Separates stored data based on expectation staleness.
 
+    Args:
+      jobs: The number of processes to classify expectations with. Work is
+          split by expectation file, so values greater than the number of
+          expectation files do not add any additional parallelism.
+
     Returns:
       Three TestExpectationMaps (stale_dict, semi_stale_dict, active_dict). All
       three combined contain the information of |self|. |stale_dict| contains
@@ -678,75 +1259,100 @@ class BaseTestExpectationMap(BaseTypedMap):
     semi_stale_dict = TestExpectationMap()
     active_dict = TestExpectationMap()
 
-    def _CopyPassesIntoBuilderMapUncurried(tmp_map, builder_map, pass_types):
-      for pt in pass_types:
-        for builder, steps in tmp_map[pt].items():
-          builder_map.setdefault(builder, StepBuildStatsMap()).update(steps)
+    if jobs > 1 and len(self) > 1:
+      # Each worker is only sent the expectation file it classifies and only
+      # sends back the classification. The output maps are built here, since
+      # sending them back would mean pickling every BuildStats again.
+      with concurrent.futures.ProcessPoolExecutor(
+        max_workers=min(jobs, len(self)),
+        initializer=_InitializeStalenessWorker,
+        initargs=(type(self), GetImplementations()),
+      ) as pool:
+        classifications = list(
+          pool.map(_ClassifyByStalenessInWorker, self.values())
+        )
+    else:
+      classifications = [
+        self._ClassifyExpectationFileByStaleness(expectation_map)
+        for expectation_map in self.values()
+      ]
+
+    output_dicts = {
+      _STALE: stale_dict,
+      _SEMI_STALE: semi_stale_dict,
+      _ACTIVE: active_dict,
+      _SEMI_STALE_ACTIVE: active_dict,
+    }
+    for (expectation_file, expectation_map), file_classifications in zip(
+      self.items(), classifications
+    ):
+      for (expectation, builder_map), (staleness, step_pass_types) in zip(
+        expectation_map.items(), file_classifications
+      ):
+        output_dicts[staleness].setdefault(
+          expectation_file, ExpectationBuilderMap()
+        )[expectation] = _CombinePassTypes(
+          builder_map, step_pass_types, _STALENESS_PASS_TYPES[staleness]
+        )
+    return stale_dict, semi_stale_dict, active_dict
 
-    # This initially looks like a good target for using
-    # TestExpectationMap's iterators since there are many nested loops.
-    # However, we need to reset state in different loops, and the alternative of
-    # keeping all the state outside the loop and resetting under certain
-    # conditions ends up being less readable than just using nested loops.
-    for expectation_file, expectation_map in self.items():
-      for expectation, builder_map in expectation_map.items():
-        # A temporary map to hold data so we can later determine whether an
-        # expectation is stale, semi-stale, or active.
-        tmp_map = {
-          FULL_PASS: BuilderStepMap(),
-          NEVER_PASS: BuilderStepMap(),
-          PARTIAL_PASS: BuilderStepMap(),
-        }
+  def _ClassifyExpectationFileByStaleness(
+    self, expectation_map: 'ExpectationBuilderMap'
+  ) -> List[Tuple[int, List[int]]]:
+    """Classifies a single expectation file's expectations by staleness.
 
-        split_stats_map = builder_map.SplitBuildStatsByPass(expectation)
-        for builder_name, (
-          fully_passed,
-          never_passed,
-          partially_passed,
-        ) in split_stats_map.items():
-          if fully_passed:
-            tmp_map[FULL_PASS][builder_name] = fully_passed
-          if never_passed:
-            tmp_map[NEVER_PASS][builder_name] = never_passed
-          if partially_passed:
-            tmp_map[PARTIAL_PASS][builder_name] = partially_passed
-
-        _CopyPassesIntoBuilderMap = functools.partial(
-          _CopyPassesIntoBuilderMapUncurried, tmp_map
-        )
+    Args:
+      expectation_map: The ExpectationBuilderMap stored in |self| for an
+          expectation file.
 
-        # Handle the case of a stale expectation.
-        if not (tmp_map[NEVER_PASS] or tmp_map[PARTIAL_PASS]):
-          builder_map = stale_dict.setdefault(
-            expectation_file, ExpectationBuilderMap()
-          ).setdefault(expectation, BuilderStepMap())
-          _CopyPassesIntoBuilderMap(builder_map, [FULL_PASS])
-        # Handle the case of an active expectation.
-        elif not tmp_map[FULL_PASS]:
-          builder_map = active_dict.setdefault(
-            expectation_file, ExpectationBuilderMap()
-          ).setdefault(expectation, BuilderStepMap())
-          _CopyPassesIntoBuilderMap(builder_map, [NEVER_PASS, PARTIAL_PASS])
-        # Handle the case of a semi-stale expectation that should be considered
-        # active.
-        elif self._ShouldTreatSemiStaleAsActive(tmp_map):
-          builder_map = active_dict.setdefault(
-            expectation_file, ExpectationBuilderMap()
-          ).setdefault(expectation, BuilderStepMap())
-          _CopyPassesIntoBuilderMap(
-            builder_map, [FULL_PASS, PARTIAL_PASS, NEVER_PASS]
-          )
-        # Handle the case of a semi-stale expectation.
-        else:
-          # TODO(crbug.com/40642384): Sort by pass percentage so it's easier to
-          # find problematic builders without highlighting.
-          builder_map = semi_stale_dict.setdefault(
-            expectation_file, ExpectationBuilderMap()
-          ).setdefault(expectation, BuilderStepMap())
-          _CopyPassesIntoBuilderMap(
-            builder_map, [FULL_PASS, PARTIAL_PASS, NEVER_PASS]
-          )
-    return stale_dict, semi_stale_dict, active_dict
+    Returns:
+      A list containing a (staleness, step_pass_types) tuple for each
+      expectation in |expectation_map|, in order. |staleness| is one of the
+      _STALE/_SEMI_STALE/_ACTIVE/_SEMI_STALE_ACTIVE constants.
+      |step_pass_types| is a list containing the FULL/NEVER/PARTIAL_PASS
+      constant for each step of the expectation's BuilderStepMap, in order.
+    """
+    # Building the maps passed to _ShouldTreatSemiStaleAsActive() is only
+    # worthwhile if a subclass actually looks at them.
+    treat_semi_stale_as_active = (
+      getattr(self._ShouldTreatSemiStaleAsActive, '__func__', None)
+      is not BaseTestExpectationMap._ShouldTreatSemiStaleAsActive
+    )
+    classifications = []
+    for expectation, builder_map in expectation_map.items():
+      step_pass_types = []
+      for step_map in builder_map.values():
+        for stats in step_map.values():
+          if stats.NeverNeededExpectation(expectation):
+            step_pass_types.append(FULL_PASS)
+          elif stats.AlwaysNeededExpectation(expectation):
+            step_pass_types.append(NEVER_PASS)
+          else:
+            step_pass_types.append(PARTIAL_PASS)
+      found_pass_types = set(step_pass_types)
+
+      # Handle the case of a stale expectation.
+      if not found_pass_types & {NEVER_PASS, PARTIAL_PASS}:
+        staleness = _STALE
+      # Handle the case of an active expectation.
+      elif FULL_PASS not in found_pass_types:
+        staleness = _ACTIVE
+      # Handle the case of a semi-stale expectation that should be considered
+      # active.
+      elif treat_semi_stale_as_active and self._ShouldTreatSemiStaleAsActive(
+        {
+          pt: _CombinePassTypes(builder_map, step_pass_types, [pt])
+          for pt in (FULL_PASS, NEVER_PASS, PARTIAL_PASS)
+        }
+      ):
+        staleness = _SEMI_STALE_ACTIVE
+      # Handle the case of a semi-stale expectation.
+      else:
+        # TODO(crbug.com/40642384): Sort by pass percentage so it's easier to
+        # find problematic builders without highlighting.
+        staleness = _SEMI_STALE
+      classifications.append((staleness, step_pass_types))
+    return classifications
 
   # Overridden by subclasses.
   # pylint: disable=no-self-use
@@ -808,6 +1414,69 @@ class BaseTestExpectationMap(BaseTypedMap):
     return unused
 
 
+def _CombinePassTypes(
+  builder_map: 'BuilderStepMap',
+  step_pass_types: List[int],
+  pass_types: List[int],
+) -> 'BuilderStepMap':
+  """Copies the steps of |builder_map| that have one of |pass_types|.
+
+  Args:
+    builder_map: The BuilderStepMap to copy steps from.
+    step_pass_types: A list containing the FULL/NEVER/PARTIAL_PASS constant
+        for each step in |builder_map|, in order.
+    pass_types: A list of FULL/NEVER/PARTIAL_PASS constants to copy steps for.
+        Steps are grouped by pass type in this order.
+
+  Returns:
+    A new BuilderStepMap containing the selected steps.
+  """
+  steps_by_pass_type = {pt: [] for pt in pass_types}
+  step_index = 0
+  for builder, step_map in builder_map.items():
+    for step, stats in step_map.items():
+      steps = steps_by_pass_type.get(step_pass_types[step_index])
+      if steps is not None:
+        steps.append((builder, step, stats))
+      step_index += 1
+
+  # Everything being copied already passed the type checks when it was added
+  # to |builder_map|, so skip them to keep copying large maps cheap.
+  combined_steps = {}
+  for pt in pass_types:
+    for builder, step, stats in steps_by_pass_type[pt]:
+      combined_steps.setdefault(builder, {})[step] = stats
+  combined_map = BuilderStepMap()
+  for builder, steps in combined_steps.items():
+    step_map = StepBuildStatsMap()
+    dict.update(step_map, steps)
+    dict.__setitem__(combined_map, builder, step_map)
+  return combined_map
+
+
+# An empty map of the type being split, used by worker processes to classify
+# expectation files. Set by _InitializeStalenessWorker().
+_staleness_worker_map = None
+
+
+def _InitializeStalenessWorker(map_type: type, implementations: tuple) -> None:
+  global _staleness_worker_map  # pylint: disable=global-statement
+  # Custom implementations are not carried over to spawned processes.
+  SetImplementations(implementations)
+  _staleness_worker_map = map_type()
+
+
+def _ClassifyByStalenessInWorker(
+  expectation_map: 'ExpectationBuilderMap',
+) -> List[Tuple[int, List[int]]]:
+  """Classifies a single expectation file in a worker process."""
+  # pylint: disable=protected-access
+  return _staleness_worker_map._ClassifyExpectationFileByStaleness(
+    expectation_map
+  )
+  # pylint: enable=protected-access
+
+
 class ExpectationBuilderMap(BaseTypedMap):
   """Typed map for Expectation -> BuilderStepMap."""
 
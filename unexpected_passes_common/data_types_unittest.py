@@ -4,6 +4,7 @@
 # found in the LICENSE file.
 
 import copy
+import pickle
 import typing
 from typing import Dict, List
 import unittest
@@ -33,6 +34,14 @@ GENERIC_RESULT = data_types.Result(
 
 
 class CustomImplementationUnittest(unittest.TestCase):
+  def tearDown(self) -> None:
+    data_types.SetExpectationImplementation(data_types.BaseExpectation)
+    data_types.SetResultImplementation(data_types.BaseResult)
+    data_types.SetBuildStatsImplementation(data_types.BaseBuildStats)
+    data_types.SetTestExpectationMapImplementation(
+      data_types.BaseTestExpectationMap
+    )
+
   def testCustomExpectation(self) -> None:
     class CustomExpectation(data_types.BaseExpectation):
       pass
@@ -104,6 +113,18 @@ class ExpectationUnittest(unittest.TestCase):
     e = GENERIC_EXPECTATION
     _ = {e}
 
+  def testTagsMask(self) -> None:
+    """Tests that tag masks are shared with results and follow tag changes."""
+    e = data_types.Expectation('test', ['tag1'], 'Pass', NON_WILDCARD)
+    r = data_types.Result('test', ['tag1'], 'Pass', 'pixel_tests', 'build_id')
+    self.assertNotEqual(e.tags_mask, 0)
+    self.assertEqual(e.tags_mask, r.tags_mask)
+    self.assertEqual(e.tags_mask & GENERIC_RESULT.tags_mask, e.tags_mask)
+    e.tags = frozenset(['tag3'])
+    self.assertNotEqual(e.tags_mask & GENERIC_RESULT.tags_mask, e.tags_mask)
+    e.tags = frozenset()
+    self.assertEqual(e.tags_mask, 0)
+
   def testAppliesToResultNonResult(self) -> None:
     e = GENERIC_EXPECTATION
     with self.assertRaises(AssertionError):
@@ -342,6 +363,20 @@ class BuildStatsUnittest(unittest.TestCase):
     self.assertEqual(s.failure_links, {'http://ci.chromium.org/b/build_id'})
     self.assertEqual(s.tag_sets, {frozenset(['tag']), frozenset(['other_tag'])})
 
+  def testAddStats(self) -> None:
+    s = data_types.BuildStats()
+    s.AddPassedBuild(frozenset(['win']))
+    other = data_types.BuildStats()
+    other.AddPassedBuild(frozenset(['mac']))
+    other.AddFailedBuild('build_id', frozenset(['win']))
+    s.AddStats(other)
+    self.assertEqual(s.passed_builds, 2)
+    self.assertEqual(s.total_builds, 3)
+    self.assertEqual(
+      s.failure_links, {data_types.BuildLinkFromBuildId('build_id')}
+    )
+    self.assertEqual(s.tag_sets, {frozenset(['win']), frozenset(['mac'])})
+
   def testGetStatsAsString(self) -> None:
     s = self.CreateGenericBuildStats()
     expected_str = '(1/2 passed)'
@@ -773,6 +808,55 @@ class TypedMapMergeUnittest(unittest.TestCase):
     with self.assertRaises(AssertionError):
       base_map.Merge(merge_map, original_base_map)
 
+  def _CreateMapWithStats(
+    self, stats: data_types.BuildStats
+  ) -> data_types.TestExpectationMap:
+    return data_types.TestExpectationMap(
+      {
+        'foo': data_types.ExpectationBuilderMap(
+          {
+            data_types.Expectation(
+              'foo', ['win'], 'Failure', NON_WILDCARD
+            ): data_types.BuilderStepMap(
+              {
+                'builder': data_types.StepBuildStatsMap(
+                  {
+                    'step': stats,
+                  }
+                ),
+              }
+            ),
+          }
+        ),
+      }
+    )
+
+  def testMergeDoesNotCopy(self) -> None:
+    """Tests that merging does not copy the base map."""
+    base_map = self._CreateMapWithStats(data_types.BuildStats())
+    merge_stats = data_types.BuildStats()
+    merge_stats.AddPassedBuild(frozenset())
+    merge_map = self._CreateMapWithStats(merge_stats)
+    with mock.patch('copy.deepcopy') as deepcopy_mock:
+      base_map.Merge(merge_map)
+    deepcopy_mock.assert_not_called()
+    self.assertEqual(base_map, merge_map)
+
+  def testMergeAdditive(self) -> None:
+    """Tests that additive merges combine BuildStats."""
+    base_stats = data_types.BuildStats()
+    base_stats.AddPassedBuild(frozenset(['win']))
+    base_map = self._CreateMapWithStats(base_stats)
+    merge_stats = data_types.BuildStats()
+    merge_stats.AddFailedBuild('1', frozenset(['win', 'amd']))
+    merge_map = self._CreateMapWithStats(merge_stats)
+    base_map.Merge(merge_map, additive=True)
+
+    expected_stats = data_types.BuildStats()
+    expected_stats.AddPassedBuild(frozenset(['win']))
+    expected_stats.AddFailedBuild('1', frozenset(['win', 'amd']))
+    self.assertEqual(base_map, self._CreateMapWithStats(expected_stats))
+
 
 class TestExpectationMapAddResultListUnittest(unittest.TestCase):
   def GetGenericRetryExpectation(self) -> data_types.Expectation:
@@ -949,6 +1033,148 @@ class TestExpectationMapAddResultListUnittest(unittest.TestCase):
     self.assertEqual(expectation_map, expected_expectation_map)
 
 
+class PickleUnittest(unittest.TestCase):
+  def testExpectation(self) -> None:
+    """Tests that expectations can be pickled."""
+    for e in (
+      GENERIC_EXPECTATION,
+      data_types.Expectation('foo*', ['win'], 'Failure', SIMPLE_WILDCARD),
+      data_types.Expectation('f*o', ['win'], 'Failure', FULL_WILDCARD, 'bug'),
+    ):
+      copied = pickle.loads(pickle.dumps(e))
+      self.assertEqual(copied, e)
+      self.assertEqual(hash(copied), hash(e))
+      for test_name in ('test', 'foo', 'fooo'):
+        self.assertEqual(
+          copied.MaybeAppliesToTest(test_name), e.MaybeAppliesToTest(test_name)
+        )
+
+  def testResult(self) -> None:
+    """Tests that results can be pickled."""
+    copied = pickle.loads(pickle.dumps(GENERIC_RESULT))
+    self.assertEqual(copied, GENERIC_RESULT)
+    self.assertEqual(hash(copied), hash(GENERIC_RESULT))
+
+  def testResultTable(self) -> None:
+    """Tests that result tables are pickled by value."""
+    table = data_types.ResultTable()
+    table.Append('foo', ['win'], 'Pass', 'step', '1')
+    table.Append('bar', ['mac'], 'Failure', 'step', '2')
+    table.Append('foo', ['win'], 'Failure', 'step', '1')
+    state = table.__getstate__()
+    self.assertEqual(sorted(state['test_ids'][0]), ['bar', 'foo'])
+    copied = pickle.loads(pickle.dumps(table))
+    self.assertEqual(list(copied), list(table))
+
+
+class ResultTableUnittest(unittest.TestCase):
+  def _CreateTable(
+    self, results: List[data_types.BaseResult]
+  ) -> data_types.ResultTable:
+    table = data_types.ResultTable()
+    for r in results:
+      table.Append(r.test, r.tags, r.actual_result, r.step, r.build_id)
+    return table
+
+  def testAppendAndGetResult(self) -> None:
+    """Tests that results round trip through the table."""
+    table = self._CreateTable([GENERIC_RESULT])
+    self.assertEqual(len(table), 1)
+    self.assertEqual(table.GetResult(0), GENERIC_RESULT)
+    self.assertEqual(list(table), [GENERIC_RESULT])
+
+  def testExtendMismatchedColumns(self) -> None:
+    """Tests that columns must be extended by the same amount."""
+    table = data_types.ResultTable()
+    with self.assertRaises(AssertionError):
+      table.Extend([0], [0], [0], [0], [])
+
+  def testGetDeduplicatedRows(self) -> None:
+    """Tests that duplicates and passing retries of failures are removed."""
+    fail = data_types.Result('foo', ['win'], 'Failure', 'step', '1')
+    crash = data_types.Result('foo', ['win'], 'Crash', 'step', '1')
+    retry_pass = data_types.Result('foo', ['win'], 'Pass', 'step', '1')
+    other_build_pass = data_types.Result('foo', ['win'], 'Pass', 'step', '2')
+    other_test_pass = data_types.Result('bar', ['win'], 'Pass', 'step', '1')
+    results = [
+      retry_pass,
+      fail,
+      other_build_pass,
+      crash,
+      fail,
+      other_test_pass,
+      other_build_pass,
+    ]
+    table = self._CreateTable(results)
+    rows = table.GetDeduplicatedRows()
+    self.assertCountEqual(
+      [table.GetResult(r) for r in rows],
+      [fail, crash, other_build_pass, other_test_pass],
+    )
+    # Rows for the same test must be adjacent.
+    tests = [table.test_ids[r] for r in rows]
+    self.assertEqual(tests, sorted(tests))
+
+
+class TestExpectationMapAddResultTableUnittest(unittest.TestCase):
+  def testMatchesAddResultList(self) -> None:
+    """Tests that adding a table is equivalent to adding a result list."""
+    results = [
+      data_types.Result('foo/test', ['win10'], 'Failure', 'pixel_tests', '1'),
+      data_types.Result('foo/test', ['win10'], 'Pass', 'pixel_tests', '1'),
+      data_types.Result('foo/test', ['win10'], 'Pass', 'pixel_tests', '2'),
+      data_types.Result('foo/test', ['win7'], 'Pass', 'pixel_tests', '3'),
+      data_types.Result('bar/test', ['win10'], 'Pass', 'pixel_tests', '4'),
+    ]
+    table = data_types.ResultTable()
+    for r in results:
+      table.Append(r.test, r.tags, r.actual_result, r.step, r.build_id)
+
+    def CreateMap() -> data_types.TestExpectationMap:
+      return data_types.TestExpectationMap(
+        {
+          'expectation_file': data_types.ExpectationBuilderMap(
+            {
+              data_types.Expectation(
+                'foo/*', ['win10'], 'RetryOnFailure', SIMPLE_WILDCARD
+              ): data_types.BuilderStepMap(),
+            }
+          ),
+        }
+      )
+
+    list_map = CreateMap()
+    list_unmatched = list_map.AddResultList('builder', results)
+    table_map = CreateMap()
+    table_unmatched = table_map.AddResultTable('builder', table)
+    self.assertEqual(table_map, list_map)
+    self.assertCountEqual(table_unmatched, list_unmatched)
+    self.assertCountEqual(table_unmatched, [results[3], results[4]])
+
+  def testCustomAddSingleResult(self) -> None:
+    """Tests that overridden _AddSingleResult implementations are used."""
+    expectation = data_types.Expectation('foo', [], 'Failure', NON_WILDCARD)
+    expectation_map = data_types.TestExpectationMap(
+      {
+        'expectation_file': data_types.ExpectationBuilderMap(
+          {
+            expectation: data_types.BuilderStepMap(),
+          }
+        ),
+      }
+    )
+    table = data_types.ResultTable()
+    table.Append('foo', [], 'Pass', 'step', 'build_id')
+    with mock.patch.object(
+      expectation_map, '_AddSingleResult'
+    ) as add_single_mock:
+      expectation_map.AddResultTable('builder', table)
+    add_single_mock.assert_called_once_with(
+      data_types.Result('foo', [], 'Pass', 'step', 'build_id'),
+      data_types.BuildStats(),
+    )
+
+
 class TestExpectationMapAddGroupedResultsUnittest(unittest.TestCase):
   def testResultMatchPassingNew(self) -> None:
     """Test adding a passing result when no results for a builder exist."""
@@ -1304,6 +1530,180 @@ class TestExpectationMapAddGroupedResultsUnittest(unittest.TestCase):
     self.assertEqual(expectation_map, expected_expectation_map)
 
 
+class FullWildcardMatcherUnittest(unittest.TestCase):
+  def testMatchesSameAsPerExpectationLoop(self) -> None:
+    """Tests that the matcher finds the same matches as checking each one."""
+    expectations = [
+      data_types.Expectation(t, [], 'Failure', FULL_WILDCARD)
+      for t in (
+        '*',
+        '*/test',
+        'foo/*',
+        'foo/*/test',
+        'foo/b*r/*',
+        'foo/bar/test*',
+        'bar/*/test',
+        'foo/ba?/test',
+      )
+    ]
+    matcher = data_types.FullWildcardMatcher()
+    for i, e in enumerate(expectations):
+      matcher.Add(e, i)
+    for test_name in (
+      'foo/bar/test',
+      'foo/baz/test',
+      'foo/test',
+      'bar/foo/test',
+      'baz',
+      '',
+    ):
+      self.assertEqual(
+        sorted(matcher.IterMatches(test_name)),
+        [
+          i
+          for i, e in enumerate(expectations)
+          if e.MaybeAppliesToTest(test_name)
+        ],
+      )
+
+  def testLiteralPrefix(self) -> None:
+    """Tests that literal prefixes stop at any special character."""
+    self.assertEqual(data_types._GetLiteralPrefix('foo/*/bar'), 'foo/')
+    self.assertEqual(data_types._GetLiteralPrefix('foo/b?r'), 'foo/b')
+    self.assertEqual(data_types._GetLiteralPrefix('foo/[ab]'), 'foo/')
+    self.assertEqual(data_types._GetLiteralPrefix('foo\\*bar*'), 'foo')
+    self.assertEqual(data_types._GetLiteralPrefix('foo'), 'foo')
+
+  def testNonFullWildcardRejected(self) -> None:
+    """Tests that only full wildcard expectations can be added."""
+    matcher = data_types.FullWildcardMatcher()
+    with self.assertRaises(AssertionError):
+      matcher.Add(
+        data_types.Expectation('foo*', [], 'Failure', SIMPLE_WILDCARD), None
+      )
+
+
+class ExpectationIndexUnittest(unittest.TestCase):
+  def _CreateIndex(
+    self,
+    expectations: List[data_types.BaseExpectation],
+    expectation_files: typing.Optional[List[str]] = None,
+  ) -> data_types.ExpectationIndex:
+    expectation_map = data_types.TestExpectationMap(
+      {
+        'expectation_file': data_types.ExpectationBuilderMap(
+          {e: data_types.BuilderStepMap() for e in expectations}
+        ),
+      }
+    )
+    return data_types.ExpectationIndex(expectation_map, expectation_files)
+
+  def _GetMatches(
+    self, index: data_types.ExpectationIndex, result: data_types.BaseResult
+  ) -> List[data_types.BaseExpectation]:
+    return [
+      expectation
+      for _, expectation, _ in index.IterMatches(result.test, [result])
+    ]
+
+  def testNonWildcard(self) -> None:
+    """Tests that non-wildcard expectations require an exact name match."""
+    e = data_types.Expectation('foo/test', [], 'Failure', NON_WILDCARD)
+    index = self._CreateIndex([e])
+    r = data_types.Result('foo/test', [], 'Pass', 'step', 'build_id')
+    self.assertEqual(self._GetMatches(index, r), [e])
+    r = data_types.Result('foo/test2', [], 'Pass', 'step', 'build_id')
+    self.assertEqual(self._GetMatches(index, r), [])
+
+  def testSimpleWildcard(self) -> None:
+    """Tests that simple wildcard expectations match by prefix."""
+    e1 = data_types.Expectation('*', [], 'Failure', SIMPLE_WILDCARD)
+    e2 = data_types.Expectation('foo/*', [], 'Failure', SIMPLE_WILDCARD)
+    e3 = data_types.Expectation('foo/test*', [], 'Failure', SIMPLE_WILDCARD)
+    e4 = data_types.Expectation('bar/*', [], 'Failure', SIMPLE_WILDCARD)
+    index = self._CreateIndex([e1, e2, e3, e4])
+    r = data_types.Result('foo/test', [], 'Pass', 'step', 'build_id')
+    self.assertEqual(self._GetMatches(index, r), [e1, e2, e3])
+    r = data_types.Result('foo/bar', [], 'Pass', 'step', 'build_id')
+    self.assertEqual(self._GetMatches(index, r), [e1, e2])
+
+  def testFullWildcard(self) -> None:
+    """Tests that full wildcard expectations are matched."""
+    e = data_types.Expectation('foo/*/test', [], 'Failure', FULL_WILDCARD)
+    index = self._CreateIndex([e])
+    r = data_types.Result('foo/bar/test', [], 'Pass', 'step', 'build_id')
+    self.assertEqual(self._GetMatches(index, r), [e])
+    r = data_types.Result('foo/bar/test2', [], 'Pass', 'step', 'build_id')
+    self.assertEqual(self._GetMatches(index, r), [])
+
+  def testTagSubset(self) -> None:
+    """Tests that expectation tags must be a subset of the result tags."""
+    e1 = data_types.Expectation('foo', ['win'], 'Failure', NON_WILDCARD)
+    e2 = data_types.Expectation('foo', ['win', 'amd'], 'Failure', NON_WILDCARD)
+    e3 = data_types.Expectation('foo', ['mac'], 'Failure', NON_WILDCARD)
+    index = self._CreateIndex([e1, e2, e3])
+    r = data_types.Result('foo', ['win', 'nvidia'], 'Pass', 'step', 'id')
+    self.assertEqual(self._GetMatches(index, r), [e1])
+    r = data_types.Result('foo', ['win', 'amd'], 'Pass', 'step', 'id')
+    self.assertEqual(self._GetMatches(index, r), [e1, e2])
+
+  def testExpectationFiles(self) -> None:
+    """Tests that only the requested expectation files are indexed."""
+    e = data_types.Expectation('foo', [], 'Failure', NON_WILDCARD)
+    r = data_types.Result('foo', [], 'Pass', 'step', 'build_id')
+    index = self._CreateIndex([e], ['expectation_file'])
+    self.assertEqual(self._GetMatches(index, r), [e])
+    index = self._CreateIndex([e], ['other_file'])
+    self.assertEqual(self._GetMatches(index, r), [])
+
+  def testCustomAppliesToResult(self) -> None:
+    """Tests that overridden AppliesToResult implementations are used."""
+
+    class CustomExpectation(data_types.BaseExpectation):
+      def AppliesToResult(self, result: data_types.BaseResult) -> bool:
+        return result.step == 'step'
+
+    e = CustomExpectation('foo', ['win'], 'Failure', NON_WILDCARD)
+    index = self._CreateIndex([e])
+    r = data_types.Result('foo', ['mac'], 'Pass', 'step', 'build_id')
+    self.assertEqual(self._GetMatches(index, r), [e])
+    r = data_types.Result('foo', ['win'], 'Pass', 'step2', 'build_id')
+    self.assertEqual(self._GetMatches(index, r), [])
+
+  def testCustomMaybeAppliesToTest(self) -> None:
+    """Tests that overridden MaybeAppliesToTest implementations are used."""
+
+    class CustomExpectation(data_types.BaseExpectation):
+      def MaybeAppliesToTest(self, test_name: str) -> bool:
+        return test_name.lower() == self.test.lower()
+
+      def AppliesToResult(self, result: data_types.BaseResult) -> bool:
+        return self.MaybeAppliesToTest(result.test)
+
+    e = CustomExpectation('Foo', [], 'Failure', NON_WILDCARD)
+    index = self._CreateIndex([e])
+    r = data_types.Result('foo', [], 'Pass', 'step', 'build_id')
+    self.assertEqual(self._GetMatches(index, r), [e])
+    r = data_types.Result('bar', [], 'Pass', 'step', 'build_id')
+    self.assertEqual(self._GetMatches(index, r), [])
+
+  def testCustomComparison(self) -> None:
+    """Tests that overridden test name comparisons are used."""
+
+    class CustomExpectation(data_types.BaseExpectation):
+      def _CompareNonWildcard(self, name: str) -> bool:
+        return name.startswith(self.test)
+
+    e = CustomExpectation('foo', ['win'], 'Failure', NON_WILDCARD)
+    index = self._CreateIndex([e])
+    r = data_types.Result('foo/bar', ['win'], 'Pass', 'step', 'build_id')
+    self.assertEqual(self._GetMatches(index, r), [e])
+    r = data_types.Result('foo/bar', ['mac'], 'Pass', 'step', 'build_id')
+    self.assertEqual(self._GetMatches(index, r), [])
+    r = data_types.Result('bar', ['win'], 'Pass', 'step', 'build_id')
+    self.assertEqual(self._GetMatches(index, r), [])
+
+
 class TestExpectationMapSplitByStalenessUnittest(unittest.TestCase):
   def testEmptyInput(self) -> None:
     """Tests that nothing blows up with empty input."""
@@ -1736,6 +2136,18 @@ class TestExpectationMapSplitByStalenessUnittest(unittest.TestCase):
     self.assertEqual(semi_stale_dict, expected_semi_stale)
     self.assertEqual(active_dict, expected_active)
 
+  def testParallelMatchesSerial(self) -> None:
+    """Tests that splitting in multiple processes gives the same output."""
+    expectation_map = uu.CreateSyntheticExpectationMap(3, 60, 20, 5)
+    serial_maps = expectation_map.SplitByStaleness()
+    parallel_maps = expectation_map.SplitByStaleness(jobs=2)
+    self.assertEqual(parallel_maps, serial_maps)
+    for serial_map, parallel_map in zip(serial_maps, parallel_maps):
+      self.assertEqual(list(parallel_map.keys()), list(serial_map.keys()))
+    # Make sure that the synthetic map actually covers every case.
+    for split_map in serial_maps:
+      self.assertTrue(split_map)
+
 
 class TestExpectationMapFilterOutUnusedExpectationsUnittest(unittest.TestCase):
   def testNoUnused(self) -> None:
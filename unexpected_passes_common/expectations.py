@@ -4,20 +4,36 @@
 """Methods related to test expectations/expectation files."""
 
 import collections
+import contextlib
 import copy
 import datetime
+import difflib
 import functools
+import hashlib
+import json
 import logging
 import os
 import re
 import subprocess
-from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple, Union
+from typing import (
+  Callable,
+  Dict,
+  FrozenSet,
+  Generator,
+  Iterable,
+  List,
+  Optional,
+  Set,
+  Tuple,
+  Union,
+)
 
 # //third_party/catapult/third_party/typ imports.
 from typ import expectations_parser
 
 # //testing imports.
 from unexpected_passes_common import data_types
+from unexpected_passes_common import json_cache
 
 FINDER_DISABLE_COMMENT_BASE = 'finder:disable'
 FINDER_ENABLE_COMMENT_BASE = 'finder:enable'
@@ -118,6 +134,7 @@ ALL_FINDER_COMMENTS = frozenset(
 GIT_BLAME_REGEX = re.compile(
   r'^[\w\s]+\(.+(?P<date>\d\d\d\d-\d\d-\d\d)[^\)]+\)(?P<content>.*)$', re.DOTALL
 )
+BLAME_CACHE_FILENAME = 'expectation_blame_cache.json'
 TAG_GROUP_REGEX = re.compile(r'# tags: \[([^\]]*)\]', re.MULTILINE | re.DOTALL)
 
 # Annotation comment start (with optional leading whitespace) pattern.
@@ -188,8 +205,20 @@ class RemovalType(object):
 
 
 class Expectations(object):
-  def __init__(self):
+  def __init__(self, cache_dir: Optional[str] = None):
+    """
+    Args:
+      cache_dir: An optional directory to store persistent caches in, e.g. the
+          ages of expectation file lines. If not specified, nothing is cached
+          between runs.
+    """
     self._cached_tag_groups = {}
+    self._expectation_file_models = None
+    self._blame_cache = None
+    if cache_dir:
+      self._blame_cache = GitBlameCache(
+        os.path.join(cache_dir, BLAME_CACHE_FILENAME)
+      )
 
   # Overridden by subclasses.
   # pylint: disable=no-self-use
@@ -229,10 +258,7 @@ class Expectations(object):
         if _RawResultsContainUnhandledValue(e):
           continue
 
-        wildcard_type = WildcardTypeFromTypExpectation(e)
-        expectation = data_types.Expectation(
-          e.test, e.tags, e.raw_results, wildcard_type, e.reason
-        )
+        expectation = _ExpectationFromTypExpectation(e)
         if expectation in expectations_for_file:
           # In practice this should never be hit unless the file was somehow
           # modified, as _RemoveDuplicateExpectations() should have removed all
@@ -258,9 +284,11 @@ class Expectations(object):
         # Normalize to '/' as the path separator.
         expectation_file_name = os.path.normpath(ef).replace(os.path.sep, '/')
         content = _GetNonRecentExpectationContent(
-          expectation_file_name, grace_period
+          expectation_file_name, grace_period, self._blame_cache
         )
         AddContentToMap(content, expectation_map, expectation_file_name)
+      if self._blame_cache:
+        self._blame_cache.Save()
     else:
       expectation_file_name = ''
       content = '# results: [ RetryOnFailure ]\n'
@@ -272,6 +300,75 @@ class Expectations(object):
 
   # pylint: enable=no-self-use
 
+  @contextlib.contextmanager
+  def BatchExpectationFileEdits(self) -> Generator[None, None, None]:
+    """Batches expectation file reads and edits made within the context.
+
+    While active, each expectation file is read and parsed at most once and
+    shared between methods such as RemoveExpectationsFromFile() and
+    NarrowSemiStaleExpectationScope(). Modifications are kept in memory and
+    each modified file is written back once when the context exits.
+    """
+    if self._expectation_file_models is not None:
+      yield
+      return
+
+    self._expectation_file_models = {}
+    try:
+      yield
+      for model in self._expectation_file_models.values():
+        model.Write()
+    finally:
+      self._expectation_file_models = None
+
+  def _GetExpectationFileModel(
+    self, expectation_file: str, content: Optional[str] = None
+  ) -> 'ExpectationFileModel':
+    """Gets an ExpectationFileModel for |expectation_file|.
+
+    Args:
+      expectation_file: A filepath pointing to an expectation file.
+      content: An optional string containing the contents of
+          |expectation_file|. If specified, a new model is created from it
+          instead of from the file on disk.
+
+    Returns:
+      An ExpectationFileModel. If edits are currently being batched and
+      |content| is not specified, the same model is returned for every call
+      with the same file.
+    """
+    key = os.path.normpath(expectation_file)
+    if content is None and self._expectation_file_models is not None:
+      model = self._expectation_file_models.get(key)
+      if model:
+        return model
+
+    if content is None:
+      with open(expectation_file, encoding='utf-8') as infile:
+        model_content = infile.read()
+    else:
+      model_content = content
+    model = ExpectationFileModel(
+      expectation_file,
+      model_content,
+      functools.partial(
+        self._ParseExpectationFileLines, expectation_file=expectation_file
+      ),
+      lambda: len(
+        self._GetExpectationFileTagHeader(expectation_file).splitlines(True)
+      ),
+    )
+    if content is None and self._expectation_file_models is not None:
+      self._expectation_file_models[key] = model
+    return model
+
+  def _FinishExpectationFileModelEdits(
+    self, model: 'ExpectationFileModel'
+  ) -> None:
+    """Writes |model| back to disk unless edits are being batched."""
+    if self._expectation_file_models is None:
+      model.Write()
+
   def RemoveExpectationsFromFile(
     self,
     expectations: List[data_types.Expectation],
@@ -295,91 +392,56 @@ class Expectations(object):
       expectations.
     """
 
-    with open(expectation_file, encoding='utf-8') as f:
-      input_contents = f.read()
+    model = self._GetExpectationFileModel(expectation_file)
+    group_to_expectations, expectation_to_group = model.GetExpectationGroups()
+    disable_annotated_expectations = model.GetDisableAnnotatedExpectations()
 
-    group_to_expectations, expectation_to_group = (
-      self._GetExpectationGroupsFromFileContent(
-        expectation_file, input_contents
-      )
-    )
-    disable_annotated_expectations = (
-      self._GetDisableAnnotatedExpectationsFromFile(
-        expectation_file, input_contents
-      )
-    )
-
-    output_contents = ''
+    removable_expectations = set(expectations)
     removed_urls = set()
-    removed_lines = set()
-    num_removed_lines = 0
-    for line_number, line in enumerate(input_contents.splitlines(True)):
-      # Auto-add any comments or empty lines
-      stripped_line = line.strip()
-      if _IsCommentOrBlankLine(stripped_line):
-        output_contents += line
+    lines_to_remove = set()
+    for line_number, current_expectation in model.IterExpectations():
+      # Keep any lines containing expectations that don't match any of the
+      # given expectations to remove.
+      if current_expectation not in removable_expectations:
         continue
 
-      current_expectation = self._CreateExpectationFromExpectationFileLine(
-        line, expectation_file
+      stripped_line = model.GetLine(line_number).strip()
+      # Skip any expectations that match if we're in a disable block or there
+      # is an inline disable comment.
+      disable_block_suffix, disable_block_reason = (
+        disable_annotated_expectations.get(current_expectation, (None, None))
       )
-
-      # Add any lines containing expectations that don't match any of the given
-      # expectations to remove.
-      if any(e for e in expectations if e == current_expectation):
-        # Skip any expectations that match if we're in a disable block or there
-        # is an inline disable comment.
-        disable_block_suffix, disable_block_reason = (
-          disable_annotated_expectations.get(current_expectation, (None, None))
+      if disable_block_suffix and _DisableSuffixIsRelevant(
+        disable_block_suffix, removal_type
+      ):
+        logging.info(
+          'Would have removed expectation %s, but it is inside a disable '
+          'block or has an inline disable with reason %s',
+          stripped_line,
+          disable_block_reason,
+        )
+      elif _ExpectationPartOfNonRemovableGroup(
+        current_expectation,
+        group_to_expectations,
+        expectation_to_group,
+        expectations,
+      ):
+        logging.info(
+          'Would have removed expectation %s, but it is part of group "%s" '
+          'whose members are not all removable.',
+          stripped_line,
+          expectation_to_group[current_expectation],
         )
-        if disable_block_suffix and _DisableSuffixIsRelevant(
-          disable_block_suffix, removal_type
-        ):
-          output_contents += line
-          logging.info(
-            'Would have removed expectation %s, but it is inside a disable '
-            'block or has an inline disable with reason %s',
-            stripped_line,
-            disable_block_reason,
-          )
-        elif _ExpectationPartOfNonRemovableGroup(
-          current_expectation,
-          group_to_expectations,
-          expectation_to_group,
-          expectations,
-        ):
-          output_contents += line
-          logging.info(
-            'Would have removed expectation %s, but it is part of group "%s" '
-            'whose members are not all removable.',
-            stripped_line,
-            expectation_to_group[current_expectation],
-          )
-        else:
-          bug = current_expectation.bug
-          if bug:
-            # It's possible to have multiple whitespace-separated bugs per
-            # expectation, so treat each one separately.
-            removed_urls |= set(bug.split())
-          # Record that we've removed this line. By subtracting the number of
-          # lines we've already removed, we keep the line numbers relative to
-          # the content we're outputting rather than relative to the input
-          # content. This also has the effect of automatically compressing
-          # contiguous blocks of removal into a single line number.
-          removed_lines.add(line_number - num_removed_lines)
-          num_removed_lines += 1
       else:
-        output_contents += line
+        bug = current_expectation.bug
+        if bug:
+          # It's possible to have multiple whitespace-separated bugs per
+          # expectation, so treat each one separately.
+          removed_urls |= set(bug.split())
+        lines_to_remove.add(line_number)
 
-    header_length = len(
-      self._GetExpectationFileTagHeader(expectation_file).splitlines(True)
-    )
-    output_contents = _RemoveStaleComments(
-      output_contents, removed_lines, header_length
-    )
-
-    with open(expectation_file, 'w', newline='', encoding='utf-8') as f:
-      f.write(output_contents)
+    model.RemoveLines(lines_to_remove)
+    self._FinishExpectationFileModelEdits(model)
 
     return removed_urls
 
@@ -389,57 +451,36 @@ class Expectations(object):
     Note that this ignores annotations such as finder:disable since handling
     those properly here would increase complexity and the likelihood of
     getting a duplicate expectation affected by an annotation is very low.
+    Unlike other edits, this is written back immediately even when edits are
+    being batched.
 
     Args:
       expectation_file_path: A string containing a filepath pointing to an
           expectation file.
     """
-    with open(expectation_file_path, encoding='utf-8') as infile:
-      content = infile.read()
-    list_parser = expectations_parser.TaggedTestListParser(content)
+    model = self._GetExpectationFileModel(expectation_file_path)
 
     seen_expectations = set()
     lines_to_remove = set()
-    for e in list_parser.expectations:
-      if _RawResultsContainUnhandledValue(e):
+    for line_number, expectation in model.IterExpectations():
+      if _RawResultsContainUnhandledValue(
+        model.GetTypExpectation(line_number)
+      ):
         continue
-      wildcard_type = WildcardTypeFromTypExpectation(e)
-      expectation = data_types.Expectation(
-        e.test, e.tags, e.raw_results, wildcard_type, e.reason
-      )
       if expectation in seen_expectations:
-        lines_to_remove.add(e.lineno)
+        lines_to_remove.add(line_number)
       else:
         seen_expectations.add(expectation)
 
     if not lines_to_remove:
       return
 
-    trimmed_lines = []
-    for i, line_content in enumerate(content.splitlines(keepends=True)):
-      if i + 1 in lines_to_remove:
-        continue
-      trimmed_lines.append(line_content)
-
-    # Calculate which lines in the new content correspond to where content was
-    # removed. The additional -1 is due to the difference between the 0-based
-    # line numbers used here and the 1-based line numbers provided by the
-    # expectation parser.
-    removed_lines = set()
-    for offset, rl in enumerate(sorted(lines_to_remove)):
-      removed_lines.add(rl - offset - 1)
-
     # While it's unlikely that an entire block consisted of duplicate
-    # expectations, remove any stale comments now just in case.
-    header_length = len(
-      self._GetExpectationFileTagHeader(expectation_file_path).splitlines(True)
-    )
-    output_contents = _RemoveStaleComments(
-      ''.join(trimmed_lines), removed_lines, header_length
-    )
-
-    with open(expectation_file_path, 'w', encoding='utf-8') as outfile:
-      outfile.write(output_contents)
+    # expectations, RemoveLines() also removes any stale comments just in case.
+    model.RemoveLines(lines_to_remove)
+    # The file is always written immediately since the non-recent content is
+    # read from disk via git afterwards.
+    model.Write()
 
   def _GetDisableAnnotatedExpectationsFromFile(
     self, expectation_file: str, content: str
@@ -457,53 +498,8 @@ class Expectations(object):
       type of annotation is applicable, while |disable_reason| is a string
       containing the comment/reason why the disable annotation is present.
     """
-    in_disable_block = False
-    disable_block_reason = ''
-    disable_block_suffix = ''
-    disable_annotated_expectations = {}
-    for line in content.splitlines(True):
-      stripped_line = line.strip()
-      # Look for cases of disable/enable blocks.
-      if _IsCommentOrBlankLine(stripped_line):
-        # Only allow one enable/disable per line.
-        assert len([c for c in ALL_FINDER_COMMENTS if c in line]) <= 1
-        if _LineContainsDisableComment(line):
-          if in_disable_block:
-            raise RuntimeError(
-              'Invalid expectation file %s - contains a disable comment "%s" '
-              'that is in another disable block.'
-              % (expectation_file, stripped_line)
-            )
-          in_disable_block = True
-          disable_block_reason = _GetDisableReasonFromComment(line)
-          disable_block_suffix = _GetFinderCommentSuffix(line)
-        elif _LineContainsEnableComment(line):
-          if not in_disable_block:
-            raise RuntimeError(
-              'Invalid expectation file %s - contains an enable comment "%s" '
-              'that is outside of a disable block.'
-              % (expectation_file, stripped_line)
-            )
-          in_disable_block = False
-        continue
-
-      current_expectation = self._CreateExpectationFromExpectationFileLine(
-        line, expectation_file
-      )
-
-      if in_disable_block:
-        disable_annotated_expectations[current_expectation] = (
-          disable_block_suffix,
-          disable_block_reason,
-        )
-      elif _LineContainsDisableComment(line):
-        disable_block_reason = _GetDisableReasonFromComment(line)
-        disable_block_suffix = _GetFinderCommentSuffix(line)
-        disable_annotated_expectations[current_expectation] = (
-          disable_block_suffix,
-          disable_block_reason,
-        )
-    return disable_annotated_expectations
+    model = self._GetExpectationFileModel(expectation_file, content)
+    return model.GetDisableAnnotatedExpectations()
 
   def _GetExpectationGroupsFromFileContent(
     self, expectation_file: str, content: str
@@ -523,41 +519,8 @@ class Expectations(object):
       is the same, but mapped the other way from data_type.Expectations to group
       names.
     """
-    group_to_expectations = collections.defaultdict(set)
-    expectation_to_group = {}
-    group_name = None
-
-    for line in content.splitlines():
-      stripped_line = line.strip()
-      # Possibly starting/ending a group.
-      if _IsCommentOrBlankLine(stripped_line):
-        if _LineContainsGroupStartComment(stripped_line):
-          # Start of a new group.
-          if group_name:
-            raise RuntimeError(
-              'Invalid expectation file %s - contains a group comment "%s" '
-              'that is inside another group block.'
-              % (expectation_file, stripped_line)
-            )
-          group_name = _GetGroupNameFromCommentLine(stripped_line)
-        elif _LineContainsGroupEndComment(stripped_line):
-          # End of current group.
-          if not group_name:
-            raise RuntimeError(
-              'Invalid expectation file %s - contains a group comment "%s" '
-              'without a group start comment.'
-              % (expectation_file, stripped_line)
-            )
-          group_name = None
-      elif group_name:
-        # Currently in a group.
-        e = self._CreateExpectationFromExpectationFileLine(
-          stripped_line, expectation_file
-        )
-        group_to_expectations[group_name].add(e)
-        expectation_to_group[e] = group_name
-      # If we aren't in a group, do nothing.
-    return group_to_expectations, expectation_to_group
+    model = self._GetExpectationFileModel(expectation_file, content)
+    return model.GetExpectationGroups()
 
   def _CreateExpectationFromExpectationFileLine(
     self, line: str, expectation_file: str
@@ -572,16 +535,8 @@ class Expectations(object):
     Returns:
       A data_types.Expectation containing the same information as |line|.
     """
-    typ_expectation = self._CreateTypExpectationFromExpectationFileLine(
-      line, expectation_file
-    )
-    wildcard_type = WildcardTypeFromTypExpectation(typ_expectation)
-    return data_types.Expectation(
-      typ_expectation.test,
-      typ_expectation.tags,
-      typ_expectation.raw_results,
-      wildcard_type,
-      typ_expectation.reason,
+    return _ExpectationFromTypExpectation(
+      self._CreateTypExpectationFromExpectationFileLine(line, expectation_file)
     )
 
   def _CreateTypExpectationFromExpectationFileLine(
@@ -598,12 +553,31 @@ class Expectations(object):
       An expectations_parser.Expectation containing the same information as
       |line|.
     """
+    return self._ParseExpectationFileLines([line], expectation_file)[0]
+
+  def _ParseExpectationFileLines(
+    self, lines: List[str], expectation_file: str
+  ) -> List[expectations_parser.Expectation]:
+    """Parses multiple expectation lines from |expectation_file| at once.
+
+    Args:
+      lines: A list of strings, each containing a single expectation line from
+          an expectation file.
+      expectation_file: A filepath pointing to an expectation file |lines| came
+          from.
+
+    Returns:
+      A list of expectations_parser.Expectations, one for each element of
+      |lines| in the same order.
+    """
     header = self._GetExpectationFileTagHeader(expectation_file)
     annotations = self._GetExpectationFileAnnotations(expectation_file)
-    single_line_content = header + annotations + line
-    list_parser = expectations_parser.TaggedTestListParser(single_line_content)
-    assert len(list_parser.expectations) == 1
-    return list_parser.expectations[0]
+    content = [header, annotations]
+    for line in lines:
+      content.append(line if line.endswith('\n') else line + '\n')
+    list_parser = expectations_parser.TaggedTestListParser(''.join(content))
+    assert len(list_parser.expectations) == len(lines)
+    return list_parser.expectations
 
   def _GetExpectationFileTagHeader(self, expectation_file: str) -> str:
     """Gets the tag header used for expectation files.
@@ -771,26 +745,26 @@ class Expectations(object):
       A set of strings containing URLs of bugs associated with the modified
       expectations.
     """
+    with self.BatchExpectationFileEdits():
+      return self._NarrowSemiStaleExpectationScope(stale_expectation_map)
+
+  def _NarrowSemiStaleExpectationScope(
+    self, stale_expectation_map: data_types.TestExpectationMap
+  ) -> Set[str]:
+    """Implementation of NarrowSemiStaleExpectationScope().
+
+    Must be called while expectation file edits are being batched.
+    """
     modified_urls = set()
-    cached_disable_annotated_expectations = {}
     for (
       expectation_file,
       e,
       builder_map,
     ) in stale_expectation_map.IterBuilderStepMaps():
+      model = self._GetExpectationFileModel(expectation_file)
       # Check if the current annotation has scope narrowing disabled.
-      if expectation_file not in cached_disable_annotated_expectations:
-        with open(expectation_file, encoding='utf-8') as infile:
-          disable_annotated_expectations = (
-            self._GetDisableAnnotatedExpectationsFromFile(
-              expectation_file, infile.read()
-            )
-          )
-          cached_disable_annotated_expectations[expectation_file] = (
-            disable_annotated_expectations
-          )
       disable_block_suffix, disable_block_reason = (
-        cached_disable_annotated_expectations[expectation_file].get(e, ('', ''))
+        model.GetDisableAnnotatedExpectations().get(e, ('', ''))
       )
       if _DisableSuffixIsRelevant(disable_block_suffix, RemovalType.NARROWING):
         logging.info(
@@ -899,15 +873,18 @@ class Expectations(object):
       }
 
       # Replace the existing expectation with our new ones.
-      with open(expectation_file, encoding='utf-8') as infile:
-        file_contents = infile.read()
-      line, _ = self._GetExpectationLine(e, file_contents, expectation_file)
+      line_number = model.FindExpectation(e)
+      if line_number is None:
+        logging.warning(
+          'Unable to find expectation %s in %s, not narrowing expectation '
+          'scope.',
+          e.AsExpectationFileString(),
+          expectation_file,
+        )
+        continue
       # We grab the original expectation's trailing comment here so that we can
       # preserve it in the new expectations.
-      original_expectation = self._CreateTypExpectationFromExpectationFileLine(
-        line, expectation_file
-      )
-      trailing_comment = original_expectation.trailing_comments
+      trailing_comment = model.GetTypExpectation(line_number).trailing_comments
       modified_urls |= set(e.bug.split())
       expectation_strs = []
       for new_tags in new_tag_sets:
@@ -919,10 +896,9 @@ class Expectations(object):
           )
         )
       expectation_strs.sort()
-      replacement_lines = '\n'.join(expectation_strs)
-      file_contents = file_contents.replace(line, replacement_lines)
-      with open(expectation_file, 'w', newline='', encoding='utf-8') as outfile:
-        outfile.write(file_contents)
+      line = model.GetLine(line_number)
+      line_ending = line[len(line.rstrip('\r\n')) :]
+      model.ReplaceLine(line_number, '\n'.join(expectation_strs) + line_ending)
 
     return modified_urls
 
@@ -955,16 +931,11 @@ class Expectations(object):
     # text file (e.g. tag ordering), and line numbers can change pretty
     # dramatically between the initial parse and now due to stale expectations
     # being removed. So, parse this way in order to improve the user experience.
-    file_lines = file_contents.splitlines()
-    for line_number, line in enumerate(file_lines):
-      if _IsCommentOrBlankLine(line.strip()):
-        continue
-      current_expectation = self._CreateExpectationFromExpectationFileLine(
-        line, expectation_file
-      )
-      if expectation == current_expectation:
-        return line, line_number + 1
-    return None, None
+    model = self._GetExpectationFileModel(expectation_file, file_contents)
+    line_number = model.FindExpectation(expectation)
+    if line_number is None:
+      return None, None
+    return model.GetLine(line_number).rstrip('\r\n'), line_number + 1
 
   def FindOrphanedBugs(self, affected_urls: Iterable[str]) -> Set[str]:
     """Finds cases where expectations for bugs no longer exist.
@@ -982,8 +953,7 @@ class Expectations(object):
     expectation_files = self.GetExpectationFilepaths()
 
     for ef in expectation_files:
-      with open(ef, encoding='utf-8') as infile:
-        contents = infile.read()
+      contents = self._GetExpectationFileModel(ef).GetContent()
       for url in affected_urls:
         if url in seen_bugs:
           continue
@@ -1001,6 +971,302 @@ class Expectations(object):
     raise NotImplementedError()
 
 
+# Placeholder for expectation lines that have not been parsed yet.
+_UNPARSED = object()
+
+
+class ExpectationFileModel:
+  """In-memory model of a single expectation file.
+
+  The expectation lines are parsed together the first time they are needed
+  and the resulting expectations, groups and disable annotations are indexed
+  by line. Edits are applied in memory and only written to disk by Write().
+  """
+
+  def __init__(
+    self,
+    expectation_file: str,
+    content: str,
+    parse_lines_func: Callable[
+      [List[str]], List[expectations_parser.Expectation]
+    ],
+    header_length_func: Callable[[], int],
+  ):
+    """
+    Args:
+      expectation_file: A filepath pointing to the expectation file.
+      content: A string containing the contents of |expectation_file|.
+      parse_lines_func: A function taking a list of expectation lines and
+          returning a list of the corresponding typ
+          expectations_parser.Expectations.
+      header_length_func: A function returning how many lines long the tag
+          header of |expectation_file| is.
+    """
+    self.expectation_file = expectation_file
+    self._parse_lines_func = parse_lines_func
+    self._header_length_func = header_length_func
+    self._lines = []
+    self._typ_expectations = []
+    self._expectations = []
+    self._expectation_line_numbers = None
+    self._expectation_groups = None
+    self._disable_annotated_expectations = None
+    self._modified = False
+    self._SetLines(content.splitlines(True))
+
+  def _SetLines(self, lines: List[str]) -> None:
+    """Replaces the model's lines, reusing already parsed expectations.
+
+    Args:
+      lines: A list of strings containing the new lines of the file. Any lines
+          that were already present and parsed are not parsed again.
+    """
+    parsed_lines = {}
+    for line, typ_expectation, expectation in zip(
+      self._lines, self._typ_expectations, self._expectations
+    ):
+      if expectation is not None:
+        parsed_lines[line] = (typ_expectation, expectation)
+
+    self._lines = lines
+    self._typ_expectations = []
+    self._expectations = []
+    for line in lines:
+      typ_expectation = expectation = None
+      if not _IsCommentOrBlankLine(line.strip()):
+        typ_expectation, expectation = parsed_lines.get(
+          line, (_UNPARSED, None)
+        )
+      self._typ_expectations.append(typ_expectation)
+      self._expectations.append(expectation)
+    self._expectation_line_numbers = None
+    self._expectation_groups = None
+    self._disable_annotated_expectations = None
+
+  def _EnsureParsed(self) -> None:
+    """Parses any expectation lines that have not been parsed yet."""
+    line_numbers = [
+      i for i, e in enumerate(self._typ_expectations) if e is _UNPARSED
+    ]
+    if not line_numbers:
+      return
+    typ_expectations = self._parse_lines_func(
+      [self._lines[i] for i in line_numbers]
+    )
+    for i, typ_expectation in zip(line_numbers, typ_expectations):
+      self._typ_expectations[i] = typ_expectation
+      self._expectations[i] = _ExpectationFromTypExpectation(typ_expectation)
+
+  def GetContent(self) -> str:
+    return ''.join(self._lines)
+
+  def GetLine(self, line_number: int) -> str:
+    """Gets the 0-indexed line |line_number|, including its line ending."""
+    return self._lines[line_number]
+
+  def GetTypExpectation(
+    self, line_number: int
+  ) -> Optional[expectations_parser.Expectation]:
+    """Gets the typ expectation on the 0-indexed line |line_number|."""
+    self._EnsureParsed()
+    return self._typ_expectations[line_number]
+
+  def IterExpectations(
+    self,
+  ) -> Generator[Tuple[int, data_types.Expectation], None, None]:
+    """Iterates over all expectations in the file.
+
+    Yields:
+      A tuple (line_number, expectation). |line_number| is the 0-indexed line
+      |expectation| is on.
+    """
+    self._EnsureParsed()
+    for line_number, expectation in enumerate(self._expectations):
+      if expectation is not None:
+        yield line_number, expectation
+
+  def FindExpectation(
+    self, expectation: data_types.Expectation
+  ) -> Optional[int]:
+    """Finds the first 0-indexed line containing |expectation|, if any."""
+    if self._expectation_line_numbers is None:
+      self._expectation_line_numbers = {}
+      for line_number, e in self.IterExpectations():
+        self._expectation_line_numbers.setdefault(e, line_number)
+    return self._expectation_line_numbers.get(expectation)
+
+  def GetExpectationGroups(
+    self,
+  ) -> Tuple[
+    Dict[str, Set[data_types.Expectation]], Dict[data_types.Expectation, str]
+  ]:
+    """Gets all groups of expectations in the file.
+
+    Returns:
+      A tuple (group_to_expectations, expectation_to_group) in the same format
+      as Expectations._GetExpectationGroupsFromFileContent().
+    """
+    if self._expectation_groups is not None:
+      return self._expectation_groups
+
+    # Validate the group structure before parsing anything so that malformed
+    # files are reported as such.
+    group_members = []
+    group_name = None
+    for line_number, line in enumerate(self._lines):
+      stripped_line = line.strip()
+      # Possibly starting/ending a group.
+      if _IsCommentOrBlankLine(stripped_line):
+        if _LineContainsGroupStartComment(stripped_line):
+          # Start of a new group.
+          if group_name:
+            raise RuntimeError(
+              'Invalid expectation file %s - contains a group comment "%s" '
+              'that is inside another group block.'
+              % (self.expectation_file, stripped_line)
+            )
+          group_name = _GetGroupNameFromCommentLine(stripped_line)
+        elif _LineContainsGroupEndComment(stripped_line):
+          # End of current group.
+          if not group_name:
+            raise RuntimeError(
+              'Invalid expectation file %s - contains a group comment "%s" '
+              'without a group start comment.'
+              % (self.expectation_file, stripped_line)
+            )
+          group_name = None
+      elif group_name:
+        # Currently in a group.
+        group_members.append((line_number, group_name))
+      # If we aren't in a group, do nothing.
+
+    self._EnsureParsed()
+    group_to_expectations = collections.defaultdict(set)
+    expectation_to_group = {}
+    for line_number, name in group_members:
+      e = self._expectations[line_number]
+      group_to_expectations[name].add(e)
+      expectation_to_group[e] = name
+    self._expectation_groups = (group_to_expectations, expectation_to_group)
+    return self._expectation_groups
+
+  def GetDisableAnnotatedExpectations(
+    self,
+  ) -> Dict[data_types.Expectation, Tuple[str, str]]:
+    """Gets all expectations affected by disable annotations.
+
+    Returns:
+      A dict in the same format as
+      Expectations._GetDisableAnnotatedExpectationsFromFile().
+    """
+    if self._disable_annotated_expectations is not None:
+      return self._disable_annotated_expectations
+
+    # Validate the block structure before parsing anything so that malformed
+    # files are reported as such.
+    annotated_lines = []
+    in_disable_block = False
+    disable_block_reason = ''
+    disable_block_suffix = ''
+    for line_number, line in enumerate(self._lines):
+      stripped_line = line.strip()
+      # Look for cases of disable/enable blocks.
+      if _IsCommentOrBlankLine(stripped_line):
+        # Only allow one enable/disable per line.
+        assert len([c for c in ALL_FINDER_COMMENTS if c in line]) <= 1
+        if _LineContainsDisableComment(line):
+          if in_disable_block:
+            raise RuntimeError(
+              'Invalid expectation file %s - contains a disable comment "%s" '
+              'that is in another disable block.'
+              % (self.expectation_file, stripped_line)
+            )
+          in_disable_block = True
+          disable_block_reason = _GetDisableReasonFromComment(line)
+          disable_block_suffix = _GetFinderCommentSuffix(line)
+        elif _LineContainsEnableComment(line):
+          if not in_disable_block:
+            raise RuntimeError(
+              'Invalid expectation file %s - contains an enable comment "%s" '
+              'that is outside of a disable block.'
+              % (self.expectation_file, stripped_line)
+            )
+          in_disable_block = False
+        continue
+
+      if in_disable_block:
+        annotated_lines.append(
+          (line_number, disable_block_suffix, disable_block_reason)
+        )
+      elif _LineContainsDisableComment(line):
+        annotated_lines.append(
+          (
+            line_number,
+            _GetFinderCommentSuffix(line),
+            _GetDisableReasonFromComment(line),
+          )
+        )
+
+    self._EnsureParsed()
+    self._disable_annotated_expectations = {}
+    for line_number, suffix, reason in annotated_lines:
+      self._disable_annotated_expectations[self._expectations[line_number]] = (
+        suffix,
+        reason,
+      )
+    return self._disable_annotated_expectations
+
+  def RemoveLines(self, line_numbers: Set[int]) -> None:
+    """Removes lines from the file along with any comments made stale by it.
+
+    Args:
+      line_numbers: A set of 0-indexed line numbers to remove.
+    """
+    kept_lines = [
+      line
+      for line_number, line in enumerate(self._lines)
+      if line_number not in line_numbers
+    ]
+
+    # Record where lines were removed relative to the remaining content. This
+    # also has the effect of automatically compressing contiguous blocks of
+    # removal into a single line number.
+    removed_lines = set()
+    for offset, line_number in enumerate(sorted(line_numbers)):
+      removed_lines.add(line_number - offset)
+
+    content = _RemoveStaleComments(
+      ''.join(kept_lines), removed_lines, self._header_length_func()
+    )
+    if content == self.GetContent():
+      return
+    self._SetLines(content.splitlines(True))
+    self._modified = True
+
+  def ReplaceLine(self, line_number: int, content: str) -> None:
+    """Replaces a single line with |content|.
+
+    Args:
+      line_number: The 0-indexed line number to replace.
+      content: A string containing the replacement line(s), including the
+          trailing line ending.
+    """
+    self._SetLines(
+      self._lines[:line_number]
+      + content.splitlines(True)
+      + self._lines[line_number + 1 :]
+    )
+    self._modified = True
+
+  def Write(self) -> None:
+    """Writes the file back to disk if it has been modified."""
+    if not self._modified:
+      return
+    with open(self.expectation_file, 'w', newline='', encoding='utf-8') as f:
+      f.write(self.GetContent())
+    self._modified = False
+
+
 def ParseTaggedTestListContent(
   content: str,
 ) -> expectations_parser.TaggedTestListParser:
@@ -1136,6 +1402,16 @@ def _ExpectationPartOfNonRemovableGroup(
   return not group_removable
 
 
+def _ExpectationFromTypExpectation(
+  e: expectations_parser.Expectation,
+) -> data_types.Expectation:
+  """Converts a typ expectation to a data_types.Expectation."""
+  wildcard_type = WildcardTypeFromTypExpectation(e)
+  return data_types.Expectation(
+    e.test, e.tags, e.raw_results, wildcard_type, e.reason
+  )
+
+
 def _RawResultsContainUnhandledValue(
   expectation: expectations_parser.Expectation,
 ) -> bool:
@@ -1155,7 +1431,9 @@ def _RawResultsContainUnhandledValue(
 
 
 def _GetNonRecentExpectationContent(
-  expectation_file_path: str, num_days: datetime.timedelta
+  expectation_file_path: str,
+  num_days: datetime.timedelta,
+  blame_cache: Optional['GitBlameCache'] = None,
 ) -> str:
   """Gets content from |expectation_file_path| older than |num_days| days.
 
@@ -1164,12 +1442,54 @@ def _GetNonRecentExpectationContent(
         expectation file.
     num_days: A datetime.timedelta containing how old an expectation in the
         given expectation file must be to be included.
+    blame_cache: An optional GitBlameCache to retrieve line dates from instead
+        of blaming the entire file.
 
   Returns:
     The contents of the expectation file located at |expectation_file_path|
     as a string with any recent expectations removed.
   """
-  content = ''
+  if blame_cache:
+    blamed_lines = blame_cache.GetBlamedLines(expectation_file_path)
+  else:
+    blamed_lines = _RunGitBlame(expectation_file_path)
+
+  today = datetime.date.today()
+  content = []
+  for date, line_content in blamed_lines:
+    stripped_line_content = line_content.strip()
+    # Auto-add comments and blank space, otherwise only add if the grace
+    # period has expired.
+    if not stripped_line_content or stripped_line_content.startswith('#'):
+      content.append(line_content)
+    else:
+      date_diff = today - datetime.date.fromisoformat(date)
+      if date_diff > num_days:
+        content.append(line_content)
+      else:
+        logging.debug(
+          'Omitting expectation %s because it is too new', line_content.rstrip()
+        )
+  return ''.join(content)
+
+
+def _RunGitBlame(
+  expectation_file_path: str,
+  line_ranges: Optional[List[Tuple[int, int]]] = None,
+) -> List[Tuple[str, str]]:
+  """Runs `git blame` on |expectation_file_path|.
+
+  Args:
+    expectation_file_path: A string containing a filepath pointing to an
+        expectation file.
+    line_ranges: An optional list of inclusive, 1-indexed (start, end) line
+        number tuples to restrict the blame to. If not specified, the entire
+        file is blamed.
+
+  Returns:
+    A list of (date, line_content) tuples, one for each blamed line in file
+    order. |date| is a string in YYYY-MM-DD format.
+  """
   # `git blame` output is normally in the format:
   # revision optional_filename (author date time timezone lineno) line_content
   # The --porcelain option is meant to be more machine readable, but is much
@@ -1179,29 +1499,129 @@ def _GetNonRecentExpectationContent(
   # use the same format as `git annotate`, which is:
   # revision (author date time timezone lineno)line_content
   # (Note the lack of space between the ) and the content).
-  cmd = ['git', 'blame', '-c', expectation_file_path]
+  cmd = ['git', 'blame', '-c']
+  for start, end in line_ranges or []:
+    cmd.extend(['-L', f'{start},{end}'])
+  cmd.append(expectation_file_path)
   with open(os.devnull, 'w', newline='', encoding='utf-8') as devnull:
     blame_output = subprocess.check_output(cmd, stderr=devnull).decode('utf-8')
+  blamed_lines = []
   for line in blame_output.splitlines(True):
     match = GIT_BLAME_REGEX.match(line)
     assert match
-    date = match.groupdict()['date']
-    line_content = match.groupdict()['content']
-    stripped_line_content = line_content.strip()
-    # Auto-add comments and blank space, otherwise only add if the grace
-    # period has expired.
-    if not stripped_line_content or stripped_line_content.startswith('#'):
-      content += line_content
+    blamed_lines.append((match.group('date'), match.group('content')))
+  return blamed_lines
+
+
+def _GetGitBlobSha(content: bytes) -> str:
+  """Computes the git blob SHA for |content| without invoking git.
+
+  Args:
+    content: The raw bytes of a file.
+
+  Returns:
+    The hex SHA-1 that `git hash-object` would report for |content|.
+  """
+  header = f'blob {len(content)}\0'.encode('utf-8')
+  return hashlib.sha1(header + content).hexdigest()
+
+
+class GitBlameCache(json_cache.JsonFileCache):
+  """Persistent, per-file cache of `git blame` line dates.
+
+  Each file's entry is keyed by the blob SHA of the content that was blamed.
+  Unchanged files are served straight from the cache. For changed files, lines
+  that also existed in the cached content keep their cached dates and only the
+  changed hunks are re-blamed.
+  """
+
+  ENTRIES_KEY = 'files'
+
+  def GetBlamedLines(self, expectation_file_path: str) -> List[Tuple[str, str]]:
+    """Gets the blame dates for every line in |expectation_file_path|.
+
+    Args:
+      expectation_file_path: A string containing a filepath pointing to an
+          expectation file.
+
+    Returns:
+      A list of (date, line_content) tuples in the same format as
+      _RunGitBlame().
+    """
+    with open(expectation_file_path, 'rb') as infile:
+      raw_content = infile.read()
+    blob_sha = _GetGitBlobSha(raw_content)
+    key = os.path.abspath(expectation_file_path)
+    entry = self._entries.get(key)
+    if entry and entry['blob'] == blob_sha:
+      return [tuple(l) for l in entry['lines']]
+
+    if entry is None:
+      blamed_lines = _RunGitBlame(expectation_file_path)
     else:
-      date = datetime.date.fromisoformat(date)
-      date_diff = datetime.date.today() - date
-      if date_diff > num_days:
-        content += line_content
+      blamed_lines = self._UpdateBlamedLines(
+        expectation_file_path, raw_content.decode('utf-8'), entry['lines']
+      )
+    self._entries[key] = {
+      'blob': blob_sha,
+      'lines': blamed_lines,
+    }
+    self._modified = True
+    return blamed_lines
+
+  # pylint: disable=no-self-use
+  def _UpdateBlamedLines(
+    self,
+    expectation_file_path: str,
+    content: str,
+    cached_lines: List[Tuple[str, str]],
+  ) -> List[Tuple[str, str]]:
+    """Blames only the lines of |content| that are not in |cached_lines|.
+
+    Args:
+      expectation_file_path: A string containing a filepath pointing to an
+          expectation file.
+      content: The current contents of |expectation_file_path|.
+      cached_lines: The (date, line_content) tuples from the last time the
+          file was blamed.
+
+    Returns:
+      A list of (date, line_content) tuples for |content|.
+    """
+    lines = content.splitlines(True)
+    dates = [None] * len(lines)
+    matcher = difflib.SequenceMatcher(
+      None, [l for _, l in cached_lines], lines, autojunk=False
+    )
+    for tag, i1, _, j1, j2 in matcher.get_opcodes():
+      if tag == 'equal':
+        for offset in range(j2 - j1):
+          dates[j1 + offset] = cached_lines[i1 + offset][0]
+
+    line_ranges = []
+    for index, date in enumerate(dates):
+      if date is not None:
+        continue
+      line_number = index + 1
+      if line_ranges and line_ranges[-1][1] == index:
+        line_ranges[-1][1] = line_number
       else:
-        logging.debug(
-          'Omitting expectation %s because it is too new', line_content.rstrip()
-        )
-  return content
+        line_ranges.append([line_number, line_number])
+
+    if line_ranges:
+      logging.debug(
+        'Re-blaming %d changed hunks in %s',
+        len(line_ranges),
+        expectation_file_path,
+      )
+      reblamed_lines = iter(_RunGitBlame(expectation_file_path, line_ranges))
+      for index, date in enumerate(dates):
+        if date is None:
+          dates[index] = next(reblamed_lines)[0]
+
+    return list(zip(dates, lines))
+
+  # pylint: enable=no-self-use
 
 
 def _RemoveStaleComments(
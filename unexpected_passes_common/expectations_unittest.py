@@ -4,9 +4,11 @@
 # found in the LICENSE file.
 
 import datetime
+import functools
 import os
 import tempfile
 import unittest
+from typing import List, Tuple
 from unittest import mock
 
 # vpython-provided modules.
@@ -156,7 +158,7 @@ class CreateTestExpectationMapUnittest(fake_filesystem_unittest.TestCase):
     self._header_mock = self._header_patcher.start()
     self.addCleanup(self._header_patcher.stop)
 
-    def ContentSideEffect(filepath, _):
+    def ContentSideEffect(filepath, *_):
       return self._expectation_content[filepath]
 
     self._content_mock.side_effect = ContentSideEffect
@@ -336,7 +338,7 @@ class CreateTestExpectationMapUnittest(fake_filesystem_unittest.TestCase):
     with open(filename, 'w', encoding='utf-8') as outfile:
       outfile.write(FAKE_EXPECTATION_FILE_CONTENTS_WITH_DUPLICATE)
 
-    def ContentSideEffect(_, __) -> str:
+    def ContentSideEffect(*_) -> str:
       with open(filename, encoding='utf-8') as infile:
         return infile.read()
 
@@ -380,7 +382,7 @@ class CreateTestExpectationMapUnittest(fake_filesystem_unittest.TestCase):
         FAKE_EXPECTATION_FILE_CONTENTS_WITH_DUPLICATE_FULL_WILDCARD_SUPPORT
       )
 
-    def ContentSideEffect(_, __) -> str:
+    def ContentSideEffect(*_) -> str:
       with open(filename, encoding='utf-8') as infile:
         return infile.read()
 
@@ -580,6 +582,141 @@ crbug.com/1234 [ tag1 ] testname [ Failure ]
     )
 
 
+class GitBlameCacheUnittest(fake_filesystem_unittest.TestCase):
+  def setUp(self) -> None:
+    self.setUpPyfakefs()
+    self._output_patcher = mock.patch(
+      'unexpected_passes_common.expectations.subprocess.check_output'
+    )
+    self._output_mock = self._output_patcher.start()
+    self.addCleanup(self._output_patcher.stop)
+    self.expectation_file = '/expectations.txt'
+    self.cache_file = '/cache/blame.json'
+
+  def _WriteFile(self, lines: List[str]) -> None:
+    with open(self.expectation_file, 'w', encoding='utf-8') as outfile:
+      outfile.write(''.join(lines))
+
+  def _SetBlameOutput(self, dated_lines: List[Tuple[str, str]]) -> None:
+    blame_output = ''
+    for i, (date, line) in enumerate(dated_lines):
+      blame_output += (
+        f'5f03bc04975c04 (Some R. Author {date} 00:00:00 +0000 {i + 1}){line}'
+      )
+    self._output_mock.return_value = blame_output.encode('utf-8')
+
+  def testUnchangedFileNotReblamed(self) -> None:
+    """Tests that an unchanged file is only blamed once."""
+    lines = ['# results: [ Failure ]\n', 'foo [ Failure ]\n']
+    self._WriteFile(lines)
+    self._SetBlameOutput([('2020-01-01', l) for l in lines])
+    cache = expectations.GitBlameCache(self.cache_file)
+    expected_lines = [('2020-01-01', l) for l in lines]
+    self.assertEqual(
+      cache.GetBlamedLines(self.expectation_file), expected_lines
+    )
+    self.assertEqual(
+      cache.GetBlamedLines(self.expectation_file), expected_lines
+    )
+    self._output_mock.assert_called_once()
+
+  def testOnlyChangedHunksReblamed(self) -> None:
+    """Tests that only lines that changed are blamed again."""
+    lines = [
+      '# results: [ Failure ]\n',
+      'foo [ Failure ]\n',
+      'bar [ Failure ]\n',
+      'baz [ Failure ]\n',
+    ]
+    self._WriteFile(lines)
+    self._SetBlameOutput([('2020-01-01', l) for l in lines])
+    cache = expectations.GitBlameCache(self.cache_file)
+    cache.GetBlamedLines(self.expectation_file)
+
+    lines[2] = 'bar [ Failure Skip ]\n'
+    lines.append('qux [ Failure ]\n')
+    self._WriteFile(lines)
+    self._output_mock.reset_mock()
+    self._SetBlameOutput([
+      ('2021-02-02', lines[2]),
+      ('2021-03-03', lines[4]),
+    ])
+    self.assertEqual(
+      cache.GetBlamedLines(self.expectation_file),
+      [
+        ('2020-01-01', lines[0]),
+        ('2020-01-01', lines[1]),
+        ('2021-02-02', lines[2]),
+        ('2020-01-01', lines[3]),
+        ('2021-03-03', lines[4]),
+      ],
+    )
+    self._output_mock.assert_called_once()
+    self.assertEqual(
+      self._output_mock.call_args[0][0],
+      [
+        'git',
+        'blame',
+        '-c',
+        '-L',
+        '3,3',
+        '-L',
+        '5,5',
+        self.expectation_file,
+      ],
+    )
+
+  def testSaveAndLoad(self) -> None:
+    """Tests that a saved cache is reused by a new instance."""
+    lines = ['# results: [ Failure ]\n', 'foo [ Failure ]\n']
+    self._WriteFile(lines)
+    self._SetBlameOutput([('2020-01-01', l) for l in lines])
+    cache = expectations.GitBlameCache(self.cache_file)
+    cache.GetBlamedLines(self.expectation_file)
+    cache.Save()
+    self.assertTrue(os.path.exists(self.cache_file))
+
+    self._output_mock.reset_mock()
+    cache = expectations.GitBlameCache(self.cache_file)
+    self.assertEqual(
+      cache.GetBlamedLines(self.expectation_file),
+      [('2020-01-01', l) for l in lines],
+    )
+    self._output_mock.assert_not_called()
+
+  def testInvalidCacheFileIgnored(self) -> None:
+    """Tests that an unreadable cache file results in an empty cache."""
+    self.fs.create_file(self.cache_file, contents='not json')
+    lines = ['foo [ Failure ]\n']
+    self._WriteFile(lines)
+    self._SetBlameOutput([('2020-01-01', l) for l in lines])
+    cache = expectations.GitBlameCache(self.cache_file)
+    cache.GetBlamedLines(self.expectation_file)
+    self._output_mock.assert_called_once()
+
+  def testNonRecentContentUsesCache(self) -> None:
+    """Tests that _GetNonRecentExpectationContent uses a provided cache."""
+    recent_date = datetime.date.today().isoformat()
+    lines = ['# results: [ Failure ]\n', 'foo [ Failure ]\n', 'bar [ Failure ]']
+    self._WriteFile(lines)
+    self._SetBlameOutput(
+      [
+        ('2020-01-01', lines[0]),
+        ('2020-01-01', lines[1]),
+        (recent_date, lines[2]),
+      ]
+    )
+    cache = expectations.GitBlameCache(self.cache_file)
+    for _ in range(2):
+      self.assertEqual(
+        expectations._GetNonRecentExpectationContent(
+          self.expectation_file, datetime.timedelta(days=1), cache
+        ),
+        '# results: [ Failure ]\nfoo [ Failure ]\n',
+      )
+    self._output_mock.assert_called_once()
+
+
 class RemoveExpectationsFromFileUnittest(fake_filesystem_unittest.TestCase):
   def setUp(self) -> None:
     self.instance = uu.CreateGenericExpectations()
@@ -1883,6 +2020,158 @@ crbug.com/2345 [ win ] bar/test [ Failure ]
     self.assertEqual(group_name, 'group name')
 
 
+class BatchExpectationFileEditsUnittest(fake_filesystem_unittest.TestCase):
+  def setUp(self) -> None:
+    self.setUpPyfakefs()
+    self.instance = uu.CreateGenericExpectations()
+    self.header = self.instance._GetExpectationFileTagHeader(None)
+    self.filename = '/expectations.txt'
+    self.contents = (
+      self.header
+      + """
+crbug.com/1234 [ win ] foo/test [ Failure ]
+crbug.com/2345 [ win ] bar/test [ Failure ]
+[ linux ] bar/test [ RetryOnFailure ]
+"""
+    )
+    with open(self.filename, 'w', encoding='utf-8') as outfile:
+      outfile.write(self.contents)
+
+  def testEditsWrittenOnExit(self) -> None:
+    """Tests that batched edits share one parse and are written on exit."""
+    stale_expectation = data_types.Expectation(
+      'foo/test', ['win'], ['Failure'], NON_WILDCARD, 'crbug.com/1234'
+    )
+    unused_expectation = data_types.Expectation(
+      'bar/test', ['linux'], ['RetryOnFailure'], NON_WILDCARD
+    )
+    with mock.patch.object(
+      self.instance,
+      '_ParseExpectationFileLines',
+      wraps=self.instance._ParseExpectationFileLines,
+    ) as parse_mock:
+      with self.instance.BatchExpectationFileEdits():
+        self.instance.RemoveExpectationsFromFile(
+          [stale_expectation], self.filename, expectations.RemovalType.STALE
+        )
+        self.instance.RemoveExpectationsFromFile(
+          [unused_expectation], self.filename, expectations.RemovalType.UNUSED
+        )
+        with open(self.filename, encoding='utf-8') as infile:
+          self.assertEqual(infile.read(), self.contents)
+      parse_mock.assert_called_once()
+
+    expected_contents = (
+      self.header
+      + """
+crbug.com/2345 [ win ] bar/test [ Failure ]
+"""
+    )
+    with open(self.filename, encoding='utf-8') as infile:
+      self.assertEqual(infile.read(), expected_contents)
+
+  def testEditsDiscardedOnError(self) -> None:
+    """Tests that batched edits are not written if an error occurs."""
+    stale_expectation = data_types.Expectation(
+      'foo/test', ['win'], ['Failure'], NON_WILDCARD, 'crbug.com/1234'
+    )
+    with self.assertRaises(RuntimeError):
+      with self.instance.BatchExpectationFileEdits():
+        self.instance.RemoveExpectationsFromFile(
+          [stale_expectation], self.filename, expectations.RemovalType.STALE
+        )
+        raise RuntimeError()
+    with open(self.filename, encoding='utf-8') as infile:
+      self.assertEqual(infile.read(), self.contents)
+
+
+class ExpectationFileModelUnittest(fake_filesystem_unittest.TestCase):
+  def setUp(self) -> None:
+    self.setUpPyfakefs()
+    self.instance = uu.CreateGenericExpectations()
+    self.header = self.instance._GetExpectationFileTagHeader(None)
+    self.filename = '/expectations.txt'
+    self.fs.create_file(self.filename)
+    self._parse_mock = mock.Mock(
+      wraps=functools.partial(
+        self.instance._ParseExpectationFileLines,
+        expectation_file=self.filename,
+      )
+    )
+
+  def _CreateModel(self, content: str) -> expectations.ExpectationFileModel:
+    return expectations.ExpectationFileModel(
+      self.filename,
+      content,
+      self._parse_mock,
+      lambda: len(self.header.splitlines(True)),
+    )
+
+  def testLinesParsedLazilyAndOnce(self) -> None:
+    """Tests that all expectation lines are parsed together when needed."""
+    model = self._CreateModel(
+      self.header
+      + """\
+# Comment
+[ win ] foo/test [ Failure ]
+[ linux ] foo/test [ Failure ]
+"""
+    )
+    self._parse_mock.assert_not_called()
+    self.assertEqual(
+      [line_number for line_number, _ in model.IterExpectations()], [4, 5]
+    )
+    self.assertEqual(
+      model.FindExpectation(
+        data_types.Expectation('foo/test', ['linux'], ['Failure'], NON_WILDCARD)
+      ),
+      5,
+    )
+    self._parse_mock.assert_called_once()
+    self.assertEqual(
+      self._parse_mock.call_args[0][0],
+      ['[ win ] foo/test [ Failure ]\n', '[ linux ] foo/test [ Failure ]\n'],
+    )
+
+  def testReplaceLineOnlyParsesNewLines(self) -> None:
+    """Tests that replacing a line does not reparse the rest of the file."""
+    model = self._CreateModel(
+      self.header
+      + """\
+[ win ] foo/test [ Failure ]
+[ linux ] foo/test [ Failure ]
+"""
+    )
+    self.assertEqual(len(list(model.IterExpectations())), 2)
+    model.ReplaceLine(4, '[ amd linux ] foo/test [ Failure ]\n')
+    self.assertEqual(
+      model.FindExpectation(
+        data_types.Expectation(
+          'foo/test', ['amd', 'linux'], ['Failure'], NON_WILDCARD
+        )
+      ),
+      4,
+    )
+    self.assertEqual(self._parse_mock.call_count, 2)
+    self.assertEqual(
+      self._parse_mock.call_args[0][0], ['[ amd linux ] foo/test [ Failure ]\n']
+    )
+
+  def testWriteOnlyWhenModified(self) -> None:
+    """Tests that the file is only written if the model was modified."""
+    content = self.header + '[ win ] foo/test [ Failure ]\n'
+    model = self._CreateModel(content)
+    model.RemoveLines(set())
+    model.Write()
+    with open(self.filename, encoding='utf-8') as infile:
+      self.assertEqual(infile.read(), '')
+
+    model.RemoveLines({3})
+    model.Write()
+    with open(self.filename, encoding='utf-8') as infile:
+      self.assertEqual(infile.read(), self.header)
+
+
 class GetDisableAnnotatedExpectationsFromFileUnittest(
   fake_filesystem_unittest.TestCase
 ):
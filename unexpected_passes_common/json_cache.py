@@ -0,0 +1,70 @@
+# Copyright 2025 The Chromium Authors
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Base class for caches which are persisted to a JSON file between runs."""
+
+import json
+import logging
+import os
+import tempfile
+from typing import Dict
+
+
+class JsonFileCache:
+  """Dict-based cache which is loaded from and saved to a JSON file.
+
+  Subclasses store their data in self._entries and set self._modified when it
+  changes. Cache files written with a different VERSION are ignored.
+  """
+
+  VERSION = 1
+  # The key in the JSON file that self._entries is stored under.
+  ENTRIES_KEY = 'entries'
+
+  def __init__(self, cache_file: str):
+    """
+    Args:
+      cache_file: A filepath to a JSON file to load the cache from and save it
+          to. Does not need to exist yet.
+    """
+    self._cache_file = cache_file
+    self._entries: Dict[str, dict] = {}
+    self._modified = False
+    try:
+      with open(cache_file, encoding='utf-8') as infile:
+        cache_contents = json.load(infile)
+      if cache_contents.get('version') == self.VERSION:
+        self._entries = cache_contents[self.ENTRIES_KEY]
+    except (OSError, ValueError, KeyError, AttributeError):
+      logging.debug(
+        'Not using existing %s %s', self.__class__.__name__, cache_file
+      )
+
+  def Save(self) -> None:
+    """Writes the cache to disk if it was modified.
+
+    The cache is written to a uniquely named temporary file first so that
+    concurrent runs sharing the same cache file never see partial contents.
+    """
+    if not self._modified:
+      return
+    cache_dir = os.path.dirname(os.path.abspath(self._cache_file))
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+      'w',
+      encoding='utf-8',
+      dir=cache_dir,
+      prefix=os.path.basename(self._cache_file) + '.',
+      suffix='.tmp',
+      delete=False,
+    ) as outfile:
+      try:
+        json.dump(
+          {'version': self.VERSION, self.ENTRIES_KEY: self._entries}, outfile
+        )
+      except Exception:
+        outfile.close()
+        os.remove(outfile.name)
+        raise
+    os.replace(outfile.name, self._cache_file)
+    self._modified = False
@@ -0,0 +1,96 @@
+#!/usr/bin/env vpython3
+# Copyright 2025 The Chromium Authors
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import json
+import os
+import unittest
+from unittest import mock
+
+# vpython-provided modules.
+# pylint: disable=import-error
+from pyfakefs import fake_filesystem_unittest
+# pylint: enable=import-error
+
+# //testing imports.
+from unexpected_passes_common import json_cache
+
+# Protected access is allowed for unittests.
+# pylint: disable=protected-access
+
+
+class JsonFileCacheUnittest(fake_filesystem_unittest.TestCase):
+  def setUp(self) -> None:
+    self.setUpPyfakefs()
+    self.cache_file = '/cache/cache.json'
+
+  def _CreateModifiedCache(self) -> json_cache.JsonFileCache:
+    cache = json_cache.JsonFileCache(self.cache_file)
+    cache._entries['key'] = {'value': 1}
+    cache._modified = True
+    return cache
+
+  def testRoundTrip(self) -> None:
+    """Tests that saved entries are loaded by later instances."""
+    self._CreateModifiedCache().Save()
+    self.assertEqual(
+      json_cache.JsonFileCache(self.cache_file)._entries, {'key': {'value': 1}}
+    )
+    self.assertEqual(os.listdir('/cache'), ['cache.json'])
+
+  def testUnmodifiedNotSaved(self) -> None:
+    """Tests that nothing is written if the cache was not modified."""
+    json_cache.JsonFileCache(self.cache_file).Save()
+    self.assertFalse(os.path.exists(self.cache_file))
+
+  def testOtherVersionIgnored(self) -> None:
+    """Tests that cache files from other versions are ignored."""
+    self.fs.create_file(
+      self.cache_file,
+      contents=json.dumps(
+        {'version': json_cache.JsonFileCache.VERSION + 1, 'entries': {'a': {}}}
+      ),
+    )
+    self.assertEqual(json_cache.JsonFileCache(self.cache_file)._entries, {})
+
+  def testInvalidFileIgnored(self) -> None:
+    """Tests that unparsable cache files are ignored."""
+    self.fs.create_file(self.cache_file, contents='not json')
+    self.assertEqual(json_cache.JsonFileCache(self.cache_file)._entries, {})
+    self.fs.remove(self.cache_file)
+    self.fs.create_file(self.cache_file, contents='[]')
+    self.assertEqual(json_cache.JsonFileCache(self.cache_file)._entries, {})
+
+  def testUniqueTempFiles(self) -> None:
+    """Tests that concurrent saves do not share a temporary file."""
+    temp_files = []
+    original_replace = os.replace
+
+    def CaptureReplace(src: str, dst: str) -> None:
+      temp_files.append(src)
+      # Simulate another run saving while this one is between writing its
+      # temporary file and moving it into place.
+      if len(temp_files) == 1:
+        self._CreateModifiedCache().Save()
+      with open(src, encoding='utf-8') as infile:
+        json.load(infile)
+      original_replace(src, dst)
+
+    with mock.patch.object(os, 'replace', side_effect=CaptureReplace):
+      self._CreateModifiedCache().Save()
+    self.assertEqual(len(temp_files), 2)
+    self.assertNotEqual(temp_files[0], temp_files[1])
+    self.assertEqual(os.listdir('/cache'), ['cache.json'])
+
+  def testFailedSaveRemovesTempFile(self) -> None:
+    """Tests that the temporary file is removed if writing fails."""
+    cache = self._CreateModifiedCache()
+    cache._entries['key'] = object()
+    with self.assertRaises(TypeError):
+      cache.Save()
+    self.assertEqual(os.listdir('/cache'), [])
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)
@@ -3,15 +3,37 @@
 # found in the LICENSE file.
 """Methods related to querying the ResultDB BigQuery tables."""
 
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
 import logging
+import os
+import queue
+import threading
 import time
-from typing import Collection, Dict, Generator, Iterable, List, Optional, Tuple
+from typing import (
+  Any,
+  Callable,
+  Collection,
+  Dict,
+  Generator,
+  Iterable,
+  List,
+  Optional,
+  Set,
+  Tuple,
+  Union,
+)
 
 # vpython-provided modules.
 # pylint: disable=import-error
 from google.cloud import bigquery
 from google.cloud import bigquery_storage
 import pandas
+import pyarrow
+from pyarrow import parquet
 # pylint: enable=import-error
 
 # //third_party/catapult/third_party/typ imports.
@@ -22,6 +44,7 @@ from typ import json_results
 from unexpected_passes_common import constants
 from unexpected_passes_common import data_types
 from unexpected_passes_common import expectations
+from unexpected_passes_common import registry
 
 DEFAULT_NUM_SAMPLES = 100
 
@@ -41,7 +64,13 @@ PARTITIONED_SUBMITTED_BUILDS_TEMPLATE = """\
       AND start_time > TIMESTAMP_SUB(CURRENT_TIMESTAMP(),
                                      INTERVAL 30 DAY)"""
 
+QUERY_CACHE_DIRNAME = 'query_results'
+# The number of rows to convert to a record batch at a time when caching rows.
+QUERY_CACHE_ROWS_PER_BATCH = 10000
+
 QueryResult = pandas.Series
+# Batches accepted by QueryResultCache writers.
+CacheableBatchType = Union[pyarrow.RecordBatch, List[QueryResult]]
 
 
 class BigQueryQuerier:
@@ -53,6 +82,10 @@ class BigQueryQuerier:
     project: str,
     num_samples: int,
     keep_unmatched_results: bool,
+    columnar_ingestion: bool = False,
+    jobs: int = 1,
+    cache_dir: Optional[str] = None,
+    query_cache_max_age_hours: float = 0,
   ):
     """
     Args:
@@ -64,13 +97,32 @@ class BigQueryQuerier:
           from.
       keep_unmatched_results: Whether to store and return unmatched results
           for debugging purposes.
+      columnar_ingestion: Whether to read query results as Arrow record
+          batches instead of converting every row to a pandas.Series.
+      jobs: The number of processes to use for matching results against
+          expectations. If greater than 1, results are fetched and matched
+          concurrently.
+      cache_dir: An optional directory to store persistent caches in, e.g. the
+          value of the --cache-dir argument.
+      query_cache_max_age_hours: How old, in hours, results cached in
+          |cache_dir| by a previous run can be and still be used instead of
+          running the same query again. 0 disables the query cache.
     """
     self._suite = suite
     self._project = project
     self._num_samples = num_samples or DEFAULT_NUM_SAMPLES
     self._keep_unmatched_results = keep_unmatched_results
+    self._columnar_ingestion = columnar_ingestion
+    self._jobs = jobs
+    self._query_cache = None
+    if cache_dir and query_cache_max_age_hours > 0:
+      self._query_cache = QueryResultCache(
+        os.path.join(cache_dir, QUERY_CACHE_DIRNAME),
+        query_cache_max_age_hours * 60 * 60,
+      )
 
     assert self._num_samples > 0
+    assert self._jobs > 0
 
   def FillExpectationMapForBuilders(
     self,
@@ -115,56 +167,205 @@ class BigQueryQuerier:
     for b in builders:
       internal_statuses.add(b.is_internal_builder)
 
+    if self._jobs > 1:
+      all_unmatched_results = self._FillExpectationMapInParallel(
+        expectation_map, builders, builder_type, internal_statuses
+      )
+    else:
+      matched_builders = set()
+      all_unmatched_results = {}
+      for internal in internal_statuses:
+        for (
+          builder_name,
+          results,
+          expectation_files,
+        ) in self.GetBuilderGroupedQueryResults(builder_type, internal):
+          prefixed_builder_name = self._GetPrefixedBuilderName(
+            builders, matched_builders, builder_name, internal
+          )
+          if prefixed_builder_name is None:
+            continue
+          unmatched_results = _AddResultsToMap(
+            expectation_map, prefixed_builder_name, results, expectation_files
+          )
+          self._StoreUnmatchedResults(
+            all_unmatched_results, prefixed_builder_name, unmatched_results
+          )
+
+    logging.debug('Filling expectation map took %f', time.time() - start_time)
+    return all_unmatched_results
+
+  def _FillExpectationMapInParallel(
+    self,
+    expectation_map: data_types.TestExpectationMap,
+    builders: Collection[data_types.BuilderEntry],
+    builder_type: str,
+    internal_statuses: Iterable[bool],
+  ) -> Dict[str, data_types.ResultListType]:
+    """Parallel implementation of FillExpectationMapForBuilders().
+
+    One thread per internal status streams builder results from BigQuery into
+    a bounded queue while a process pool matches each builder's results against
+    the expectations. Every worker fills a partial map for a single builder,
+    which is then merged into |expectation_map|. Fetching and matching overlap,
+    and the number of builders held in memory at once is bounded by the queue
+    depth and the number of jobs.
+
+    Args:
+      expectation_map: A data_types.TestExpectationMap. Will be modified
+          in-place.
+      builders: An iterable of data_types.BuilderEntry containing the builders
+          to query.
+      builder_type: The type of all of |builders|.
+      internal_statuses: The internal statuses of |builders|.
+
+    Returns:
+      The unmatched results in the same format as
+      FillExpectationMapForBuilders().
+    """
+    result_queue = queue.Queue(maxsize=self._jobs)
+
+    def FetchResults(internal: bool) -> None:
+      try:
+        for (
+          builder_name,
+          results,
+          expectation_files,
+        ) in self.GetBuilderGroupedQueryResults(builder_type, internal):
+          result_queue.put((internal, builder_name, results, expectation_files))
+      except Exception as e:  # pylint: disable=broad-except
+        result_queue.put(e)
+      finally:
+        result_queue.put(None)
+
+    # Daemon threads so that a failure while consuming doesn't leave the
+    # process hanging on producers blocked on a full queue.
+    fetch_threads = [
+      threading.Thread(target=FetchResults, args=(internal,), daemon=True)
+      for internal in internal_statuses
+    ]
+    for t in fetch_threads:
+      t.start()
+
     matched_builders = set()
     all_unmatched_results = {}
-    for internal in internal_statuses:
-      for (
-        builder_name,
-        results,
-        expectation_files,
-      ) in self.GetBuilderGroupedQueryResults(builder_type, internal):
-        matching_builder = None
-        for b in builders:
-          if b.name == builder_name and b.is_internal_builder == internal:
-            matching_builder = b
-            break
-
-        if not matching_builder:
-          logging.warning(
-            'Did not find a matching builder for name %s and '
-            'internal status %s. This is normal if the builder '
-            'is no longer running tests (e.g. it was '
-            'experimental).',
-            builder_name,
-            internal,
-          )
-          continue
+    pending = collections.deque()
 
-        if matching_builder in matched_builders:
-          raise RuntimeError(
-            f'Got query result batches matched to builder '
-            f'{matching_builder} twice - this is indicative of a malformed '
-            f'query returning results that are not sorted by builder'
-          )
-        matched_builders.add(matching_builder)
+    def MergeOldestPending() -> None:
+      prefixed_builder_name, future = pending.popleft()
+      partial_map, unmatched_results = future.result()
+      expectation_map.Merge(partial_map)
+      self._StoreUnmatchedResults(
+        all_unmatched_results, prefixed_builder_name, unmatched_results
+      )
 
-        prefixed_builder_name = '%s/%s:%s' % (
-          matching_builder.project,
-          matching_builder.builder_type,
-          matching_builder.name,
+    with concurrent.futures.ProcessPoolExecutor(
+      max_workers=self._jobs,
+      initializer=_InitializeMatchingWorker,
+      initargs=(
+        _CopyWithoutStats(expectation_map),
+        data_types.GetImplementations(),
+      ),
+    ) as pool:
+      remaining_fetchers = len(fetch_threads)
+      while remaining_fetchers:
+        item = result_queue.get()
+        if item is None:
+          remaining_fetchers -= 1
+          continue
+        if isinstance(item, Exception):
+          raise item
+        internal, builder_name, results, expectation_files = item
+        prefixed_builder_name = self._GetPrefixedBuilderName(
+          builders, matched_builders, builder_name, internal
         )
-        unmatched_results = expectation_map.AddResultList(
-          prefixed_builder_name, results, expectation_files
+        if prefixed_builder_name is None:
+          continue
+        pending.append(
+          (
+            prefixed_builder_name,
+            pool.submit(
+              _AddResultsInWorker,
+              prefixed_builder_name,
+              results,
+              expectation_files,
+            ),
+          )
         )
-        if self._keep_unmatched_results:
-          if unmatched_results:
-            all_unmatched_results[prefixed_builder_name] = unmatched_results
-        else:
-          logging.info('Dropping %d unmatched results', len(unmatched_results))
+        while len(pending) >= self._jobs:
+          MergeOldestPending()
+      while pending:
+        MergeOldestPending()
 
-    logging.debug('Filling expectation map took %f', time.time() - start_time)
     return all_unmatched_results
 
+  # pylint: disable=no-self-use
+  def _GetPrefixedBuilderName(
+    self,
+    builders: Collection[data_types.BuilderEntry],
+    matched_builders: Set[data_types.BuilderEntry],
+    builder_name: str,
+    internal: bool,
+  ) -> Optional[str]:
+    """Gets the name to store results for a queried builder under.
+
+    Args:
+      builders: An iterable of data_types.BuilderEntry containing the builders
+          being queried.
+      matched_builders: A set of data_types.BuilderEntry that have already been
+          matched. Will be modified in-place.
+      builder_name: The name of the builder returned by the query.
+      internal: Whether the query was for internal builders.
+
+    Returns:
+      The builder name prefixed with its project and builder type, or None if
+      the builder is not one of |builders|.
+    """
+    matching_builder = None
+    for b in builders:
+      if b.name == builder_name and b.is_internal_builder == internal:
+        matching_builder = b
+        break
+
+    if not matching_builder:
+      logging.warning(
+        'Did not find a matching builder for name %s and '
+        'internal status %s. This is normal if the builder '
+        'is no longer running tests (e.g. it was '
+        'experimental).',
+        builder_name,
+        internal,
+      )
+      return None
+
+    if matching_builder in matched_builders:
+      raise RuntimeError(
+        f'Got query result batches matched to builder '
+        f'{matching_builder} twice - this is indicative of a malformed '
+        f'query returning results that are not sorted by builder'
+      )
+    matched_builders.add(matching_builder)
+
+    return '%s/%s:%s' % (
+      matching_builder.project,
+      matching_builder.builder_type,
+      matching_builder.name,
+    )
+
+  # pylint: enable=no-self-use
+
+  def _StoreUnmatchedResults(
+    self,
+    all_unmatched_results: Dict[str, data_types.ResultListType],
+    prefixed_builder_name: str,
+    unmatched_results: data_types.ResultListType,
+  ) -> None:
+    if self._keep_unmatched_results:
+      if unmatched_results:
+        all_unmatched_results[prefixed_builder_name] = unmatched_results
+    else:
+      logging.info('Dropping %d unmatched results', len(unmatched_results))
+
   def GetBuilderGroupedQueryResults(
     self, builder_type: str, is_internal: bool
   ) -> Generator[
@@ -179,7 +380,8 @@ class BigQueryQuerier:
     Yields:
       A tuple (builder_name, results). |builder_name| is a string specifying the
       builder that |results| came from. |results| is a data_types.ResultListType
-      containing all the results for |builder_name|.
+      containing all the results for |builder_name|, or a
+      data_types.ResultTable when using columnar ingestion.
     """
     if builder_type == constants.BuilderTypes.CI:
       if is_internal:
@@ -194,9 +396,41 @@ class BigQueryQuerier:
     else:
       raise RuntimeError(f'Unknown builder type {builder_type}')
 
+    if self._columnar_ingestion:
+      grouped_results = self._GetColumnarGroupedResultsForQuery(query)
+    else:
+      grouped_results = self._GetRowGroupedResultsForQuery(query)
+
+    got_results = False
+    for builder_name, results, expectation_files in grouped_results:
+      got_results = True
+      yield builder_name, results, expectation_files
+
+    if not got_results:
+      logging.warning(
+        'Did not get any results for builder type %s and internal status %s. '
+        'Depending on where tests are run and how frequently trybots are '
+        'used for submission, this may be benign.',
+        builder_type,
+        is_internal,
+      )
+
+  def _GetRowGroupedResultsForQuery(
+    self, query: str
+  ) -> Generator[
+    Tuple[str, data_types.ResultListType, Optional[List[str]]], None, None
+  ]:
+    """Generates results for |query| grouped by builder name one row at a time.
+
+    Args:
+      query: A string containing the BigQuery query to run.
+
+    Yields:
+      Tuples in the same format as GetBuilderGroupedQueryResults().
+    """
     current_builder = None
     rows_for_builder = []
-    for row in self._GetSeriesForQuery(query):
+    for row in self._GetCachedSeriesForQuery(query):
       if current_builder is None:
         current_builder = row.builder_name
       if row.builder_name != current_builder:
@@ -209,15 +443,6 @@ class BigQueryQuerier:
         current_builder = row.builder_name
       rows_for_builder.append(row)
 
-    if current_builder is None:
-      logging.warning(
-        'Did not get any results for builder type %s and internal status %s. '
-        'Depending on where tests are run and how frequently trybots are '
-        'used for submission, this may be benign.',
-        builder_type,
-        is_internal,
-      )
-
     if current_builder is not None and rows_for_builder:
       results_for_builder, expectation_files = self._ProcessRowsForBuilder(
         rows_for_builder
@@ -225,6 +450,104 @@ class BigQueryQuerier:
       assert not rows_for_builder
       yield current_builder, results_for_builder, expectation_files
 
+  def _GetColumnarGroupedResultsForQuery(
+    self, query: str
+  ) -> Generator[
+    Tuple[str, data_types.ResultListType, Optional[List[str]]], None, None
+  ]:
+    """Generates results for |query| grouped by builder name using Arrow data.
+
+    Rows are expected to be sorted by builder, so each record batch is split
+    into zero-copy slices at the points where the builder name changes instead
+    of being converted row by row.
+
+    Args:
+      query: A string containing the BigQuery query to run.
+
+    Yields:
+      Tuples in the same format as GetBuilderGroupedQueryResults().
+    """
+    current_builder = None
+    batches_for_builder = []
+    for batch in self._GetCachedRecordBatchesForQuery(query):
+      builder_names = batch.column(
+        batch.schema.get_field_index('builder_name')
+      ).to_pylist()
+      for builder_name, start, end in _GetRuns(builder_names):
+        if current_builder is not None and builder_name != current_builder:
+          results_for_builder, expectation_files = (
+            self._ProcessRecordBatchesForBuilder(batches_for_builder)
+          )
+          yield current_builder, results_for_builder, expectation_files
+          batches_for_builder = []
+        current_builder = builder_name
+        batches_for_builder.append(batch.slice(start, end - start))
+
+    if batches_for_builder:
+      results_for_builder, expectation_files = (
+        self._ProcessRecordBatchesForBuilder(batches_for_builder)
+      )
+      yield current_builder, results_for_builder, expectation_files
+
+  def _GetCachedSeriesForQuery(
+    self, query: str
+  ) -> Generator[pandas.Series, None, None]:
+    """Generates results for |query|, using the query cache if possible.
+
+    Args:
+      query: A string containing the BigQuery query to run.
+
+    Yields:
+      A pandas.Series object for each row, in the same format as
+      _GetSeriesForQuery().
+    """
+    if not self._query_cache:
+      yield from self._GetSeriesForQuery(query)
+      return
+
+    cached_batches = self._query_cache.GetRecordBatches(query)
+    if cached_batches is not None:
+      for batch in cached_batches:
+        for _, row in batch.to_pandas().iterrows():
+          yield row
+      return
+
+    with self._query_cache.OpenWriter(query) as write_batch:
+      rows = []
+      for row in self._GetSeriesForQuery(query):
+        rows.append(row)
+        if len(rows) >= QUERY_CACHE_ROWS_PER_BATCH:
+          write_batch(rows)
+          rows = []
+        yield row
+      if rows:
+        write_batch(rows)
+
+  def _GetCachedRecordBatchesForQuery(
+    self, query: str
+  ) -> Generator[pyarrow.RecordBatch, None, None]:
+    """Generates record batches for |query|, using the query cache if possible.
+
+    Args:
+      query: A string containing the BigQuery query to run.
+
+    Yields:
+      A pyarrow.RecordBatch, in the same format as _GetRecordBatchesForQuery().
+    """
+    if not self._query_cache:
+      yield from self._GetRecordBatchesForQuery(query)
+      return
+
+    cached_batches = self._query_cache.GetRecordBatches(query)
+    if cached_batches is not None:
+      yield from cached_batches
+      return
+
+    with self._query_cache.OpenWriter(query) as write_batch:
+      for batch in self._GetRecordBatchesForQuery(query):
+        write_batch(batch)
+        yield batch
+
   def _GetSeriesForQuery(
     self, query: str
   ) -> Generator[pandas.Series, None, None]:
@@ -253,6 +576,27 @@ class BigQueryQuerier:
       for _, row in df.iterrows():
         yield row
 
+  def _GetRecordBatchesForQuery(
+    self, query: str
+  ) -> Generator[pyarrow.RecordBatch, None, None]:
+    """Generates Arrow record batches for |query|.
+
+    Args:
+      query: A string containing the BigQuery query to run.
+
+    Yields:
+      A pyarrow.RecordBatch for each page of results returned by the query.
+    """
+    client = bigquery.Client(
+      project=self._project,
+      default_query_job_config=bigquery.QueryJobConfig(use_legacy_sql=False),
+    )
+    job = client.query(query)
+    row_iterator = job.result()
+    yield from row_iterator.to_arrow_iterable(
+      bqstorage_client=bigquery_storage.BigQueryReadClient()
+    )
+
   def _GetPublicCiQuery(self) -> str:
     """Returns the BigQuery query for public CI builder results."""
     raise NotImplementedError()
@@ -291,18 +635,9 @@ class BigQueryQuerier:
       step_name = r.step_name
       if step_name not in results_for_each_step:
         results_for_each_step[step_name] = r
-
-    expectation_files = set()
-    for r in results_for_each_step.values():
-      # None is a special value indicating "use all expectation files", so
-      # handle that.
-      ef = self._GetRelevantExpectationFilesForQueryResult(r)
-      if ef is None:
-        expectation_files = None
-        break
-      expectation_files |= set(ef)
-    if expectation_files is not None:
-      expectation_files = list(expectation_files)
+    expectation_files = self._GetExpectationFilesForStepResults(
+      results_for_each_step.values()
+    )
 
     # The query result list is potentially very large, so reduce the list as we
     # iterate over it instead of using a standard for/in so that we don't
@@ -316,6 +651,127 @@ class BigQueryQuerier:
 
     return results, expectation_files
 
+  def _ProcessRecordBatchesForBuilder(
+    self, batches: List[pyarrow.RecordBatch]
+  ) -> Tuple[
+    Union[data_types.ResultTable, data_types.ResultListType],
+    Optional[List[str]],
+  ]:
+    """Processes Arrow record batches into results for a single builder.
+
+    Columnar equivalent of _ProcessRowsForBuilder(). Columns are converted
+    to registry IDs once per batch, with repeated values such as build IDs,
+    statuses and tags only converted once each, and stored in a
+    data_types.ResultTable. Row objects are only created when they are needed
+    for subclass hooks.
+
+    Args:
+      batches: A list of pyarrow.RecordBatch containing the rows for a single
+          builder.
+
+    Returns:
+      A tuple (results, expectation_files). |results| is a
+      data_types.ResultTable, or a list of data_types.Result objects if results
+      need to be converted by a subclass. |expectation_files| is in the same
+      format as for _ProcessRowsForBuilder().
+    """
+    # Avoid creating a row object per result unless a subclass actually wants
+    # to skip some of them.
+    should_skip = (
+      getattr(self._ShouldSkipOverResult, '__func__', None)
+      is not BigQueryQuerier._ShouldSkipOverResult
+    )
+    # Result implementations that store additional data or results converted
+    # by a subclass may need more than a ResultTable can hold, so create the
+    # objects one by one in that case.
+    use_table = (
+      data_types.Result.__init__ is data_types.BaseResult.__init__
+      and type(self)._ConvertBigQueryRowToResultObject
+      is BigQueryQuerier._ConvertBigQueryRowToResultObject
+    )
+    results_for_each_step = {}
+    table = data_types.ResultTable()
+    results = []
+    caches = collections.defaultdict(dict)
+    for batch in batches:
+      columns = batch.to_pydict()
+      for i, step_name in enumerate(columns['step_name']):
+        if step_name not in results_for_each_step:
+          results_for_each_step[step_name] = _GetColumnarRow(columns, i)
+
+      rows = range(batch.num_rows)
+      if should_skip:
+        rows = [
+          i
+          for i in rows
+          if not self._ShouldSkipOverResult(_GetColumnarRow(columns, i))
+        ]
+      if not use_table:
+        for i in rows:
+          results.append(
+            self._ConvertBigQueryRowToResultObject(_GetColumnarRow(columns, i))
+          )
+        continue
+
+      id_columns = [
+        _ConvertColumn(
+          columns['test_name'], registry.RegisterTestName, caches['test']
+        ),
+        _ConvertColumn(
+          columns['typ_tags'],
+          lambda t: registry.RegisterTagSet(
+            frozenset(expectations.GetInstance().FilterToKnownTags(t))
+          ),
+          caches['tags'],
+          key=tuple,
+        ),
+        _ConvertColumn(
+          columns['status'],
+          lambda s: registry.RegisterActualResult(
+            _ConvertActualResultToExpectationFileFormat(s)
+          ),
+          caches['status'],
+        ),
+        _ConvertColumn(
+          columns['step_name'], registry.RegisterStep, caches['step']
+        ),
+        _ConvertColumn(
+          columns['id'],
+          lambda b: registry.RegisterBuildId(_StripPrefixFromBuildId(b)),
+          caches['build_id'],
+        ),
+      ]
+      if should_skip:
+        id_columns = [[c[i] for i in rows] for c in id_columns]
+      table.Extend(*id_columns)
+
+    expectation_files = self._GetExpectationFilesForStepResults(
+      results_for_each_step.values()
+    )
+    return (table if use_table else results), expectation_files
+
+  def _GetExpectationFilesForStepResults(
+    self, step_results: Iterable[QueryResult]
+  ) -> Optional[List[str]]:
+    """Gets the expectation files that are used by the given results.
+
+    Args:
+      step_results: An iterable of query results, one per unique step.
+
+    Returns:
+      A list of expectation file names, or None if all expectation files should
+      be considered.
+    """
+    expectation_files = set()
+    for r in step_results:
+      # None is a special value indicating "use all expectation files", so
+      # handle that.
+      ef = self._GetRelevantExpectationFilesForQueryResult(r)
+      if ef is None:
+        return None
+      expectation_files |= set(ef)
+    return list(expectation_files)
+
   @staticmethod
   def _ConvertBigQueryRowToResultObject(row: QueryResult) -> data_types.Result:
     """Converts a single BigQuery result row to a data_types.Result.
@@ -366,6 +822,261 @@ class BigQueryQuerier:
   # pylint: enable=no-self-use
 
 
+class QueryResultCache:
+  """Persistent cache of BigQuery results stored as Parquet files.
+
+  Results are stored per query and reused by later runs until they are older
+  than the maximum age. This allows the script to be re-run, e.g. with
+  different settings, without repeating the same expensive queries.
+  """
+
+  def __init__(self, cache_dir: str, max_age_seconds: float):
+    """
+    Args:
+      cache_dir: A path to the directory to store cached results in. Does not
+          need to exist yet.
+      max_age_seconds: How old cached results can be and still be used.
+    """
+    self._cache_dir = cache_dir
+    self._max_age_seconds = max_age_seconds
+
+  def _GetCacheFile(self, query: str) -> str:
+    query_hash = hashlib.sha256(query.encode('utf-8')).hexdigest()
+    return os.path.join(self._cache_dir, query_hash + '.parquet')
+
+  def _IsExpired(self, cache_file: str) -> bool:
+    return time.time() - os.path.getmtime(cache_file) > self._max_age_seconds
+
+  def GetRecordBatches(
+    self, query: str
+  ) -> Optional[Generator[pyarrow.RecordBatch, None, None]]:
+    """Gets the cached results for |query|.
+
+    Args:
+      query: A string containing a BigQuery query.
+
+    Returns:
+      None if there are no unexpired results for |query|. Otherwise, a
+      generator of pyarrow.RecordBatch containing the cached results.
+    """
+    cache_file = self._GetCacheFile(query)
+    try:
+      if self._IsExpired(cache_file):
+        return None
+      parquet_file = parquet.ParquetFile(cache_file)
+    except (OSError, pyarrow.ArrowException):
+      return None
+    logging.info('Using cached query results from %s', cache_file)
+    return parquet_file.iter_batches()
+
+  @contextlib.contextmanager
+  def OpenWriter(
+    self, query: str
+  ) -> Generator[Callable[[CacheableBatchType], None], None, None]:
+    """Opens a writer to cache results for |query|.
+
+    The cached results are only stored if the context exits normally, so
+    partially read results are never reused. Caching is best-effort: if a
+    batch cannot be converted or written, e.g. because its schema is not
+    compatible with earlier batches, nothing is cached for |query| and later
+    batches are ignored.
+
+    Args:
+      query: A string containing a BigQuery query.
+
+    Yields:
+      A function taking either a pyarrow.RecordBatch or a list of
+      pandas.Series rows to add to the cached results.
+    """
+    os.makedirs(self._cache_dir, exist_ok=True)
+    cache_file = self._GetCacheFile(query)
+    temp_file = cache_file + '.tmp'
+    writer = None
+    failed = False
+
+    def CloseWriter(keep: bool) -> None:
+      nonlocal writer
+      if writer is None:
+        return
+      writer.close()
+      writer = None
+      if keep:
+        os.replace(temp_file, cache_file)
+      else:
+        os.remove(temp_file)
+
+    def WriteBatch(batch: CacheableBatchType) -> None:
+      nonlocal writer, failed
+      if failed:
+        return
+      try:
+        if not isinstance(batch, pyarrow.RecordBatch):
+          batch = _ConvertSeriesToRecordBatch(batch)
+        if writer is None:
+          writer = parquet.ParquetWriter(temp_file, batch.schema)
+        elif not batch.schema.equals(writer.schema):
+          batch = batch.cast(writer.schema)
+        writer.write_batch(batch)
+      except pyarrow.ArrowException:
+        logging.warning(
+          'Not caching results for query in %s', cache_file, exc_info=True
+        )
+        failed = True
+        CloseWriter(False)
+
+    try:
+      yield WriteBatch
+    except BaseException:
+      CloseWriter(False)
+      raise
+    CloseWriter(True)
+    self._RemoveExpiredFiles()
+
+  def _RemoveExpiredFiles(self) -> None:
+    for f in os.listdir(self._cache_dir):
+      if not f.endswith('.parquet'):
+        continue
+      cache_file = os.path.join(self._cache_dir, f)
+      # Writers for other queries may be pruning concurrently, so the file
+      # can disappear at any point.
+      try:
+        if self._IsExpired(cache_file):
+          os.remove(cache_file)
+      except FileNotFoundError:
+        pass
+
+
+def _ConvertSeriesToRecordBatch(
+  rows: List[pandas.Series],
+) -> pyarrow.RecordBatch:
+  return pyarrow.RecordBatch.from_pandas(
+    pandas.DataFrame(rows), preserve_index=False
+  )
+
+
+def _AddResultsToMap(
+  expectation_map: data_types.TestExpectationMap,
+  prefixed_builder_name: str,
+  results: Union[data_types.ResultTable, data_types.ResultListType],
+  expectation_files: Optional[List[str]],
+) -> data_types.ResultListType:
+  """Adds |results| to |expectation_map|, returning any unmatched results."""
+  if isinstance(results, data_types.ResultTable):
+    return expectation_map.AddResultTable(
+      prefixed_builder_name, results, expectation_files
+    )
+  return expectation_map.AddResultList(
+    prefixed_builder_name, results, expectation_files
+  )
+
+
+def _CopyWithoutStats(
+  expectation_map: data_types.TestExpectationMap,
+) -> data_types.TestExpectationMap:
+  """Copies the expectations in |expectation_map| without any results."""
+  return data_types.TestExpectationMap(
+    {
+      expectation_file: data_types.ExpectationBuilderMap(
+        {e: data_types.BuilderStepMap() for e in expectation_builder_map}
+      )
+      for expectation_file, expectation_builder_map in expectation_map.items()
+    }
+  )
+
+
+# The expectations that worker processes match results against. Set by
+# _InitializeMatchingWorker().
+_worker_expectation_map = None
+
+
+def _InitializeMatchingWorker(
+  expectation_map: data_types.TestExpectationMap, implementations: tuple
+) -> None:
+  global _worker_expectation_map  # pylint: disable=global-statement
+  # Custom implementations are not carried over to spawned processes.
+  data_types.SetImplementations(implementations)
+  _worker_expectation_map = expectation_map
+
+
+def _AddResultsInWorker(
+  prefixed_builder_name: str,
+  results: Union[data_types.ResultTable, data_types.ResultListType],
+  expectation_files: Optional[List[str]],
+) -> Tuple[data_types.TestExpectationMap, data_types.ResultListType]:
+  """Matches a single builder's results in a worker process.
+
+  Returns:
+    A tuple (partial_map, unmatched_results). |partial_map| is a
+    data_types.TestExpectationMap containing only the expectations that
+    matched at least one result. |unmatched_results| is the list of results
+    that did not match any expectation.
+  """
+  partial_map = _CopyWithoutStats(_worker_expectation_map)
+  unmatched_results = _AddResultsToMap(
+    partial_map, prefixed_builder_name, results, expectation_files
+  )
+  # Only send back what was actually filled in.
+  for expectation_builder_map in partial_map.values():
+    for e in [e for e, b in expectation_builder_map.items() if not b]:
+      del expectation_builder_map[e]
+  for expectation_file in [ef for ef, m in partial_map.items() if not m]:
+    del partial_map[expectation_file]
+  return partial_map, unmatched_results
+
+
+def _GetRuns(values: List[Any]) -> Generator[Tuple[Any, int, int], None, None]:
+  """Generates (value, start, end) tuples for runs of equal values."""
+  start = 0
+  for i in range(1, len(values)):
+    if values[i] != values[start]:
+      yield values[start], start, i
+      start = i
+  if values:
+    yield values[start], start, len(values)
+
+
+def _ConvertColumn(
+  values: List[Any],
+  converter: Callable[[Any], Any],
+  cache: dict,
+  key: Callable[[Any], Any] = lambda v: v,
+) -> List[Any]:
+  """Converts every value in a column, converting repeated values only once.
+
+  Args:
+    values: A list containing the column's values.
+    converter: The function to convert each value with.
+    cache: A dict mapping keys to converted values. Shared between calls so
+        that values repeated across batches are also only converted once.
+    key: A function to get a hashable key for a value.
+
+  Returns:
+    A list containing the converted values.
+  """
+  converted = []
+  for v in values:
+    k = key(v)
+    c = cache.get(k, cache)
+    if c is cache:
+      c = converter(v)
+      cache[k] = c
+    converted.append(c)
+  return converted
+
+
+@functools.lru_cache(maxsize=None)
+def _GetColumnarQueryResultType(column_names: Tuple[str, ...]) -> type:
+  # Subclass hooks access columns as attributes, which a namedtuple supports
+  # with much less overhead than a pandas.Series.
+  return collections.namedtuple('ColumnarQueryResult', column_names)
+
+
+def _GetColumnarRow(columns: Dict[str, List[Any]], index: int) -> tuple:
+  """Gets a single row from |columns| with columns accessible as attributes."""
+  row_type = _GetColumnarQueryResultType(tuple(columns))
+  return row_type._make(values[index] for values in columns.values())
+
+
 def _StripPrefixFromBuildId(build_id: str) -> str:
   # Build IDs provided by ResultDB are prefixed with "build-"
   split_id = build_id.split('-')
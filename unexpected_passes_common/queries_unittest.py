@@ -3,10 +3,16 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import os
+import tempfile
+import time
 from typing import Iterable, Optional
 import unittest
 from unittest import mock
 
+# vpython-provided modules.
+import pandas  # pylint: disable=import-error
+
 # //testing imports.
 from unexpected_passes_common import builders
 from unexpected_passes_common import constants
@@ -34,6 +40,23 @@ class HelperMethodUnittest(unittest.TestCase):
       queries._ConvertActualResultToExpectationFileFormat('ABORT'), 'Timeout'
     )
 
+  def testGetRuns(self) -> None:
+    self.assertEqual(list(queries._GetRuns([])), [])
+    self.assertEqual(
+      list(queries._GetRuns(['a', 'a', 'b', 'a'])),
+      [('a', 0, 2), ('b', 2, 3), ('a', 3, 4)],
+    )
+
+  def testConvertColumn(self) -> None:
+    converter = mock.Mock(side_effect=lambda v: v.upper())
+    cache = {}
+    self.assertEqual(
+      queries._ConvertColumn(['a', 'b', 'a'], converter, cache),
+      ['A', 'B', 'A'],
+    )
+    self.assertEqual(queries._ConvertColumn(['b'], converter, cache), ['B'])
+    self.assertEqual(converter.call_count, 2)
+
 
 class BigQueryQuerierInitUnittest(unittest.TestCase):
   def testInvalidNumSamples(self):
@@ -224,6 +247,343 @@ class GetBuilderGroupedQueryResultsUnittest(unittest.TestCase):
     self.assertEqual(results, expected_results)
 
 
+class ColumnarIngestionUnittest(unittest.TestCase):
+  def setUp(self):
+    expectations.ClearInstance()
+    uu.RegisterGenericExpectationsImplementation()
+    self._querier = uu.CreateGenericQuerier(columnar_ingestion=True)
+    self._querier.query_results = [
+      uu.FakeQueryResult(
+        builder_name='builder_a',
+        id_='build-a1',
+        test_id='test_a',
+        status='PASS',
+        typ_tags=['linux', 'unknown_tag'],
+        step_name='step_a1',
+      ),
+      uu.FakeQueryResult(
+        builder_name='builder_a',
+        id_='build-a1',
+        test_id='test_b',
+        status='FAIL',
+        typ_tags=['linux', 'unknown_tag'],
+        step_name='step_a2',
+      ),
+      uu.FakeQueryResult(
+        builder_name='builder_a',
+        id_='build-a2',
+        test_id='test_a',
+        status='ABORT',
+        typ_tags=['linux'],
+        step_name='step_a1',
+      ),
+      uu.FakeQueryResult(
+        builder_name='builder_b',
+        id_='build-b',
+        test_id='test_b',
+        status='FAIL',
+        typ_tags=['win'],
+        step_name='step_b',
+      ),
+    ]
+
+  def _GetGroupedResults(self) -> list:
+    grouped_results = []
+    with mock.patch.object(self._querier, '_GetPublicCiQuery', return_value=''):
+      for (
+        builder_name,
+        results,
+        expectation_files,
+      ) in self._querier.GetBuilderGroupedQueryResults(
+        constants.BuilderTypes.CI, False
+      ):
+        if self._querier._columnar_ingestion:
+          self.assertIsInstance(results, data_types.ResultTable)
+        grouped_results.append((builder_name, list(results), expectation_files))
+    return grouped_results
+
+  def testGroupedAcrossBatches(self):
+    """Tests that builders spanning multiple record batches are grouped."""
+    expected_results = [
+      (
+        'builder_a',
+        [
+          data_types.BaseResult('test_a', ('linux',), 'Pass', 'step_a1', 'a1'),
+          data_types.BaseResult(
+            'test_b', ('linux',), 'Failure', 'step_a2', 'a1'
+          ),
+          data_types.BaseResult(
+            'test_a', ('linux',), 'Timeout', 'step_a1', 'a2'
+          ),
+        ],
+        None,
+      ),
+      (
+        'builder_b',
+        [data_types.BaseResult('test_b', ('win',), 'Failure', 'step_b', 'b')],
+        None,
+      ),
+    ]
+    for batch_size in (1, 2, 4):
+      self._querier.batch_size = batch_size
+      self.assertEqual(self._GetGroupedResults(), expected_results)
+
+  def testMatchesRowIngestion(self):
+    """Tests that columnar ingestion matches row-based ingestion."""
+    columnar_results = self._GetGroupedResults()
+    self._querier._columnar_ingestion = False
+    row_results = self._GetGroupedResults()
+    self.assertEqual(len(columnar_results), len(row_results))
+    for columnar, row in zip(columnar_results, row_results):
+      self.assertEqual(columnar[0], row[0])
+      self.assertCountEqual(columnar[1], row[1])
+      self.assertEqual(columnar[2], row[2])
+
+  def testExpectationFiles(self):
+    """Tests that expectation files are looked up once per step."""
+
+    def SideEffect(row: queries.QueryResult) -> Optional[Iterable[str]]:
+      return ['ef_' + row.step_name]
+
+    with mock.patch.object(
+      self._querier,
+      '_GetRelevantExpectationFilesForQueryResult',
+      side_effect=SideEffect,
+    ) as ef_mock:
+      results = self._GetGroupedResults()
+    self.assertEqual(ef_mock.call_count, 3)
+    self.assertCountEqual(results[0][2], ['ef_step_a1', 'ef_step_a2'])
+    self.assertEqual(results[1][2], ['ef_step_b'])
+
+  def testCustomResultConversion(self):
+    """Tests that subclasses can still convert rows to results."""
+
+    def SideEffect(row: queries.QueryResult) -> data_types.Result:
+      return data_types.Result(row.test_name, [], 'Pass', 'step', 'build')
+
+    with mock.patch.object(
+      uu.SimpleBigQueryQuerier,
+      '_ConvertBigQueryRowToResultObject',
+      side_effect=SideEffect,
+    ):
+      with mock.patch.object(
+        self._querier, '_GetPublicCiQuery', return_value=''
+      ):
+        results = list(
+          self._querier.GetBuilderGroupedQueryResults(
+            constants.BuilderTypes.CI, False
+          )
+        )
+    self.assertEqual(
+      results[1],
+      (
+        'builder_b',
+        [data_types.Result('test_b', [], 'Pass', 'step', 'build')],
+        None,
+      ),
+    )
+
+  def testSkippedResult(self):
+    """Tests that subclasses can still skip results."""
+
+    def SideEffect(row: queries.QueryResult) -> bool:
+      return row.status == 'FAIL'
+
+    with mock.patch.object(
+      self._querier, '_ShouldSkipOverResult', side_effect=SideEffect
+    ):
+      results = self._GetGroupedResults()
+    self.assertEqual(
+      results,
+      [
+        (
+          'builder_a',
+          [
+            data_types.BaseResult(
+              'test_a', ('linux',), 'Pass', 'step_a1', 'a1'
+            ),
+            data_types.BaseResult(
+              'test_a', ('linux',), 'Timeout', 'step_a1', 'a2'
+            ),
+          ],
+          None,
+        ),
+        ('builder_b', [], None),
+      ],
+    )
+
+
+class QueryResultCacheUnittest(unittest.TestCase):
+  def setUp(self):
+    expectations.ClearInstance()
+    uu.RegisterGenericExpectationsImplementation()
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    self._cache_dir = temp_dir.name
+    self._query_results = [
+      uu.FakeQueryResult(
+        builder_name='builder_a',
+        id_='build-a1',
+        test_id='test_a',
+        status='PASS',
+        typ_tags=['linux'],
+        step_name='step_a',
+      ),
+      uu.FakeQueryResult(
+        builder_name='builder_a',
+        id_='build-a2',
+        test_id='test_a',
+        status='FAIL',
+        typ_tags=['linux'],
+        step_name='step_a',
+      ),
+      uu.FakeQueryResult(
+        builder_name='builder_b',
+        id_='build-b',
+        test_id='test_b',
+        status='FAIL',
+        typ_tags=['win'],
+        step_name='step_b',
+      ),
+    ]
+    self._expected_results = [
+      (
+        'builder_a',
+        [
+          data_types.BaseResult('test_a', ('linux',), 'Pass', 'step_a', 'a1'),
+          data_types.BaseResult(
+            'test_a', ('linux',), 'Failure', 'step_a', 'a2'
+          ),
+        ],
+        None,
+      ),
+      (
+        'builder_b',
+        [data_types.BaseResult('test_b', ('win',), 'Failure', 'step_b', 'b')],
+        None,
+      ),
+    ]
+
+  def _CreateQuerier(
+    self, columnar_ingestion: bool
+  ) -> uu.SimpleBigQueryQuerier:
+    querier = uu.CreateGenericQuerier(
+      columnar_ingestion=columnar_ingestion,
+      cache_dir=self._cache_dir,
+      query_cache_max_age_hours=24,
+    )
+    querier.query_results = list(self._query_results)
+    return querier
+
+  def _GetGroupedResults(self, querier: uu.SimpleBigQueryQuerier) -> list:
+    grouped_results = []
+    for builder_name, results, expectation_files in (
+      querier.GetBuilderGroupedQueryResults(constants.BuilderTypes.CI, False)
+    ):
+      grouped_results.append(
+        (
+          builder_name,
+          sorted(results, key=lambda r: r.build_id),
+          expectation_files,
+        )
+      )
+    return grouped_results
+
+  def _GetCacheFiles(self) -> list:
+    cache_dir = os.path.join(self._cache_dir, queries.QUERY_CACHE_DIRNAME)
+    if not os.path.exists(cache_dir):
+      return []
+    return os.listdir(cache_dir)
+
+  def _AssertSortedResultsEqual(self, actual: list) -> None:
+    expected = [
+      (b, sorted(results, key=lambda r: r.build_id), ef)
+      for b, results, ef in self._expected_results
+    ]
+    self.assertEqual(actual, expected)
+
+  def testResultsReused(self) -> None:
+    """Tests that cached results are used instead of running the query."""
+    for columnar_ingestion in (True, False):
+      for querier_columnar_ingestion in (True, False):
+        for f in self._GetCacheFiles():
+          os.remove(
+            os.path.join(self._cache_dir, queries.QUERY_CACHE_DIRNAME, f)
+          )
+        querier = self._CreateQuerier(columnar_ingestion)
+        self._AssertSortedResultsEqual(self._GetGroupedResults(querier))
+        self.assertEqual(len(self._GetCacheFiles()), 1)
+
+        querier = self._CreateQuerier(querier_columnar_ingestion)
+        querier.query_results = []
+        self._AssertSortedResultsEqual(self._GetGroupedResults(querier))
+
+  def testExpiredResultsNotUsed(self) -> None:
+    """Tests that results older than the maximum age are not used."""
+    self._GetGroupedResults(self._CreateQuerier(True))
+    querier = self._CreateQuerier(True)
+    querier.query_results = []
+    with mock.patch.object(
+      queries.time, 'time', return_value=time.time() + 25 * 60 * 60
+    ):
+      self.assertEqual(self._GetGroupedResults(querier), [])
+
+  def testIncompatibleBatchesNotCached(self) -> None:
+    """Tests that batches which cannot be cached are skipped, not fatal."""
+    cache_dir = os.path.join(self._cache_dir, queries.QUERY_CACHE_DIRNAME)
+    cache = queries.QueryResultCache(cache_dir, 60)
+    with cache.OpenWriter('query') as write_batch, self.assertLogs(
+      level='WARNING'
+    ):
+      # The first batch's column has no values, so its type is inferred as
+      # double, which the second batch's strings cannot be cast to.
+      write_batch([pandas.Series({'column': None})])
+      write_batch([pandas.Series({'column': 'z'})])
+      write_batch([pandas.Series({'column': 'y'})])
+    self.assertIsNone(cache.GetRecordBatches('query'))
+    self.assertEqual(self._GetCacheFiles(), [])
+
+  def testConcurrentlyRemovedExpiredFilesIgnored(self) -> None:
+    """Tests that pruning tolerates files removed by another writer."""
+    cache_dir = os.path.join(self._cache_dir, queries.QUERY_CACHE_DIRNAME)
+    os.makedirs(cache_dir)
+    for f in ('removed.parquet', 'expired.parquet'):
+      with open(os.path.join(cache_dir, f), 'w'):
+        pass
+    original_getmtime = os.path.getmtime
+
+    def GetMtime(path: str) -> float:
+      # Simulate another writer pruning the file first.
+      if path.endswith('removed.parquet'):
+        os.remove(path)
+      return original_getmtime(path)
+
+    cache = queries.QueryResultCache(cache_dir, 60)
+    with mock.patch.object(
+      queries.time, 'time', return_value=time.time() + 120
+    ), mock.patch.object(queries.os.path, 'getmtime', side_effect=GetMtime):
+      cache._RemoveExpiredFiles()  # pylint: disable=protected-access
+    self.assertEqual(self._GetCacheFiles(), [])
+
+  def testPartialResultsNotCached(self) -> None:
+    """Tests that results are not cached if they were not fully read."""
+    for columnar_ingestion in (True, False):
+      querier = self._CreateQuerier(columnar_ingestion)
+      results = querier.GetBuilderGroupedQueryResults(
+        constants.BuilderTypes.CI, False
+      )
+      next(results)
+      results.close()
+      self.assertEqual(self._GetCacheFiles(), [])
+
+  def testDisabledByDefault(self) -> None:
+    """Tests that nothing is cached without a maximum age."""
+    querier = uu.CreateGenericQuerier(cache_dir=self._cache_dir)
+    querier.query_results = list(self._query_results)
+    self._GetGroupedResults(querier)
+    self.assertEqual(self._GetCacheFiles(), [])
+
+
 class FillExpectationMapForBuildersUnittest(unittest.TestCase):
   def setUp(self) -> None:
     self._querier = uu.CreateGenericQuerier()
@@ -242,9 +602,11 @@ class FillExpectationMapForBuildersUnittest(unittest.TestCase):
         data_types.TestExpectationMap({}), builders_to_fill
       )
 
-  def _runValidResultsTest(self, keep_unmatched_results: bool) -> None:
+  def _runValidResultsTest(
+    self, keep_unmatched_results: bool, jobs: int = 1
+  ) -> None:
     self._querier = uu.CreateGenericQuerier(
-      keep_unmatched_results=keep_unmatched_results
+      keep_unmatched_results=keep_unmatched_results, jobs=jobs
     )
 
     public_results = [
@@ -392,6 +754,78 @@ class FillExpectationMapForBuildersUnittest(unittest.TestCase):
     """Tests behavior w/ valid results and not keeping unmatched results."""
     self._runValidResultsTest(False)
 
+  def testValidResultsParallel(self) -> None:
+    """Tests behavior w/ valid results when matching in parallel."""
+    self._runValidResultsTest(True, jobs=2)
+
+  def testParallelFetchError(self) -> None:
+    """Tests that errors while fetching results are surfaced."""
+    self._querier = uu.CreateGenericQuerier(jobs=2)
+    builders_to_fill = [
+      data_types.BuilderEntry('builder', constants.BuilderTypes.CI, False),
+    ]
+    with mock.patch.object(
+      self._querier,
+      'GetBuilderGroupedQueryResults',
+      side_effect=RuntimeError('fetch failed'),
+    ):
+      with self.assertRaisesRegex(RuntimeError, 'fetch failed'):
+        self._querier.FillExpectationMapForBuilders(
+          data_types.TestExpectationMap({}), builders_to_fill
+        )
+
+  def testParallelMatchesSerial(self) -> None:
+    """Tests that parallel matching gives the same results as serial."""
+    rows = []
+    builders_to_fill = []
+    for i in range(5):
+      builder_name = 'builder_%d' % i
+      builders_to_fill.append(
+        data_types.BuilderEntry(builder_name, constants.BuilderTypes.CI, False)
+      )
+      for j in range(4):
+        rows.append(
+          uu.FakeQueryResult(
+            builder_name=builder_name,
+            id_='build-%d' % j,
+            test_id='foo' if j % 2 else 'bar',
+            status='PASS' if j < 2 else 'FAIL',
+            typ_tags=['win'] if i % 2 else ['mac'],
+            step_name='step_name',
+          )
+        )
+
+    def CreateMap() -> data_types.TestExpectationMap:
+      return data_types.TestExpectationMap(
+        {
+          'expectation_file': data_types.ExpectationBuilderMap(
+            {
+              data_types.Expectation(
+                'foo', ['win'], 'Failure', data_types.WildcardType.NON_WILDCARD
+              ): data_types.BuilderStepMap(),
+              data_types.Expectation(
+                'b*', [], 'Failure', data_types.WildcardType.SIMPLE_WILDCARD
+              ): data_types.BuilderStepMap(),
+            }
+          ),
+        }
+      )
+
+    maps = []
+    unmatched = []
+    for jobs in (1, 2):
+      querier = uu.CreateGenericQuerier(keep_unmatched_results=True, jobs=jobs)
+      querier.query_results = rows
+      expectation_map = CreateMap()
+      unmatched.append(
+        querier.FillExpectationMapForBuilders(expectation_map, builders_to_fill)
+      )
+      maps.append(expectation_map)
+    self.assertEqual(maps[0], maps[1])
+    self.assertEqual(unmatched[0].keys(), unmatched[1].keys())
+    for builder_name, results in unmatched[0].items():
+      self.assertCountEqual(results, unmatched[1][builder_name])
+
 
 class ProcessRowsForBuilderUnittest(unittest.TestCase):
   def setUp(self):
@@ -6,9 +6,22 @@
 Since large amount of string-based data is repeated, storing references to
 shared strings results in large memory savings compared to storing the actual
 strings in each object.
+
+Individual typ tags are additionally interned to bit positions so that each
+registered tag set has an integer bitmask. Checking whether one tag set is a
+subset of another is then a single bitwise operation instead of a set
+comparison.
+
+Registration is thread-safe since results can be fetched and converted on
+multiple threads at once.
 """
 
-from typing import Any, FrozenSet
+import threading
+from typing import Any, FrozenSet, Iterable
+
+# Guards all registration. Re-entrant since registering a tag set also
+# registers its individual tags.
+_lock = threading.RLock()
 
 
 class _Registry:
@@ -21,10 +34,15 @@ class _Registry:
     if existing_id is not None:
       return existing_id
 
-    new_id = len(self._values_by_id)
-    self._values_by_id.append(value)
-    self._id_by_values[value] = new_id
-    return new_id
+    with _lock:
+      # Another thread may have registered the value while waiting.
+      existing_id = self._id_by_values.get(value)
+      if existing_id is not None:
+        return existing_id
+      new_id = len(self._values_by_id)
+      self._values_by_id.append(value)
+      self._id_by_values[value] = new_id
+      return new_id
 
   def GetValueForId(self, identifier: int) -> Any:
     return self._values_by_id[identifier]
@@ -32,10 +50,14 @@ class _Registry:
 
 _test_name_registry = _Registry()
 _typ_tag_registry = _Registry()
+_typ_tag_bit_registry = _Registry()
+# Bitmasks for the tag sets in _typ_tag_registry, indexed by tag set ID.
+_typ_tag_masks = []
 _actual_result_registry = _Registry()
 _expected_result_registry = _Registry()
 _bug_registry = _Registry()
 _step_registry = _Registry()
+_build_id_registry = _Registry()
 
 
 def RegisterTestName(test_name: str) -> int:
@@ -47,13 +69,34 @@ def RetrieveTestName(identifier: int) -> str:
 
 
 def RegisterTagSet(tag_set: FrozenSet[str]) -> int:
-  return _typ_tag_registry.Register(tag_set)
+  # The lock is held for both steps so that no other thread can see the new ID
+  # before its mask exists.
+  with _lock:
+    identifier = _typ_tag_registry.Register(tag_set)
+    if identifier == len(_typ_tag_masks):
+      _typ_tag_masks.append(TagsToMask(tag_set))
+    return identifier
 
 
 def RetrieveTagSet(identifier: int) -> FrozenSet[str]:
   return _typ_tag_registry.GetValueForId(identifier)
 
 
+def RetrieveTagMask(identifier: int) -> int:
+  return _typ_tag_masks[identifier]
+
+
+def TagsToMask(tags: Iterable[str]) -> int:
+  mask = 0
+  for tag in tags:
+    mask |= 1 << _typ_tag_bit_registry.Register(tag)
+  return mask
+
+
+def IsTagMaskSubset(subset_mask: int, superset_mask: int) -> bool:
+  return subset_mask & superset_mask == subset_mask
+
+
 def RegisterActualResult(result: str) -> int:
   return _actual_result_registry.Register(result)
 
@@ -84,3 +127,11 @@ def RegisterStep(step: str) -> int:
 
 def RetrieveStep(identifier: int) -> str:
   return _step_registry.GetValueForId(identifier)
+
+
+def RegisterBuildId(build_id: str) -> int:
+  return _build_id_registry.Register(build_id)
+
+
+def RetrieveBuildId(identifier: int) -> str:
+  return _build_id_registry.GetValueForId(identifier)
@@ -0,0 +1,60 @@
+#!/usr/bin/env vpython3
+# Copyright 2025 The Chromium Authors
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import sys
+import threading
+import unittest
+
+# //testing imports.
+from unexpected_passes_common import registry
+
+
+class RegisterTagSetUnittest(unittest.TestCase):
+  def testConcurrentRegistration(self) -> None:
+    """Tests that tag sets registered from several threads stay consistent."""
+    # Switch threads as often as possible to make interleaving likely.
+    old_switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    self.addCleanup(sys.setswitchinterval, old_switch_interval)
+    num_threads = 4
+    num_tag_sets = 20000
+    barrier = threading.Barrier(num_threads)
+    ids_per_thread = [None] * num_threads
+
+    def Register(thread_index: int) -> None:
+      barrier.wait()
+      ids = []
+      for i in range(num_tag_sets):
+        # Threads register overlapping tag sets in different orders.
+        if thread_index % 2:
+          i = num_tag_sets - i - 1
+        tag_set = frozenset(['registry_unittest_%d' % i, 'win'])
+        ids.append((tag_set, registry.RegisterTagSet(tag_set)))
+      ids_per_thread[thread_index] = ids
+
+    threads = [
+      threading.Thread(target=Register, args=(i,)) for i in range(num_threads)
+    ]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+
+    ids_by_tag_set = {}
+    for ids in ids_per_thread:
+      for tag_set, identifier in ids:
+        self.assertEqual(
+          ids_by_tag_set.setdefault(tag_set, identifier), identifier
+        )
+        self.assertEqual(registry.RetrieveTagSet(identifier), tag_set)
+        self.assertEqual(
+          registry.RetrieveTagMask(identifier), registry.TagsToMask(tag_set)
+        )
+    self.assertEqual(len(ids_by_tag_set), num_tag_sets)
+    self.assertEqual(len(set(ids_by_tag_set.values())), num_tag_sets)
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)
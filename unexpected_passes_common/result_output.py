@@ -7,11 +7,22 @@ Also probably a good example of how to *not* write HTML.
 """
 
 import collections
+import json
 import logging
 import re
 import sys
 import tempfile
-from typing import Any, Dict, IO, List, Optional, Set, Union
+from typing import (
+  Any,
+  Dict,
+  Generator,
+  IO,
+  List,
+  Optional,
+  Set,
+  Tuple,
+  Union,
+)
 
 # //testing imports.
 from unexpected_passes_common import data_types
@@ -260,6 +271,16 @@ UnusedExpectation = Dict[str, List[data_types.Expectation]]
 
 RemovedUrlsType = Union[List[str], Set[str]]
 
+# Elements produced by the _Iter*Elements() generators, which describe the
+# output as a tree without building it in memory. _GROUP_START elements have
+# the group's name as their value and are followed by the group's contents and
+# a matching _GROUP_END. _LEAF elements have a string value.
+_GROUP_START = 0
+_GROUP_END = 1
+_LEAF = 2
+OutputElement = Tuple[int, Optional[str]]
+OutputElementGenerator = Generator[OutputElement, None, None]
+
 _BUG_PREFIX_PATTERN = re.compile(
   expectations_parser.TaggedTestListParser.BUG_PREFIX_REGEX
 )
@@ -289,7 +310,8 @@ def OutputResults(
     unused_expectations: A dict from expectation file (str) to list of
         unmatched Expectations that were pulled out of |test_expectation_map|
     output_format: A string denoting the format to output to. Valid values are
-        "print" and "html".
+        "print", "html" and "jsonl". "jsonl" outputs one JSON object per line
+        and is meant for consumption by other tools.
     file_handle: An optional open file-like object to output to. If not
         specified, a suitable default will be used.
   """
@@ -297,34 +319,41 @@ def OutputResults(
   assert isinstance(semi_stale_dict, data_types.TestExpectationMap)
   assert isinstance(active_dict, data_types.TestExpectationMap)
   logging.info('Outputting results in format %s', output_format)
-  stale_str_dict = _ConvertTestExpectationMapToStringDict(stale_dict)
-  semi_stale_str_dict = _ConvertTestExpectationMapToStringDict(semi_stale_dict)
-  active_str_dict = _ConvertTestExpectationMapToStringDict(active_dict)
-  unmatched_results_str_dict = _ConvertUnmatchedResultsToStringDict(
-    unmatched_results
-  )
-  unused_expectations_str_list = _ConvertUnusedExpectationsToStringDict(
-    unused_expectations
-  )
+
+  # Each section is streamed to the output as it is generated rather than
+  # built up as nested dicts first.
+  sections = []
+  if stale_dict:
+    sections.append(
+      (SECTION_STALE, _IterTestExpectationMapElements(stale_dict))
+    )
+  if semi_stale_dict:
+    sections.append(
+      (SECTION_SEMI_STALE, _IterTestExpectationMapElements(semi_stale_dict))
+    )
+  if active_dict:
+    sections.append(
+      (SECTION_ACTIVE, _IterTestExpectationMapElements(active_dict))
+    )
+  # The unused and unmatched sections are preceded by an extra blank line.
+  extra_sections = []
+  if unused_expectations:
+    extra_sections.append(
+      (SECTION_UNUSED, _IterUnusedExpectationsElements(unused_expectations))
+    )
+  if any(unmatched_results.values()):
+    extra_sections.append(
+      (SECTION_UNMATCHED, _IterUnmatchedResultsElements(unmatched_results))
+    )
 
   if output_format == 'print':
     file_handle = file_handle or sys.stdout
-    if stale_dict:
-      file_handle.write(SECTION_STALE + '\n')
-      RecursivePrintToFile(stale_str_dict, 0, file_handle)
-    if semi_stale_dict:
-      file_handle.write(SECTION_SEMI_STALE + '\n')
-      RecursivePrintToFile(semi_stale_str_dict, 0, file_handle)
-    if active_dict:
-      file_handle.write(SECTION_ACTIVE + '\n')
-      RecursivePrintToFile(active_str_dict, 0, file_handle)
-
-    if unused_expectations_str_list:
-      file_handle.write('\n' + SECTION_UNUSED + '\n')
-      RecursivePrintToFile(unused_expectations_str_list, 0, file_handle)
-    if unmatched_results_str_dict:
-      file_handle.write('\n' + SECTION_UNMATCHED + '\n')
-      RecursivePrintToFile(unmatched_results_str_dict, 0, file_handle)
+    for section, elements in sections:
+      file_handle.write(section + '\n')
+      _PrintElementsToFile(elements, file_handle)
+    for section, elements in extra_sections:
+      file_handle.write('\n' + section + '\n')
+      _PrintElementsToFile(elements, file_handle)
 
   elif output_format == 'html':
     should_close_file = False
@@ -335,27 +364,30 @@ def OutputResults(
       )
 
     file_handle.write(HTML_HEADER)
-    if stale_dict:
-      file_handle.write('<h1>' + SECTION_STALE + '</h1>\n')
-      _RecursiveHtmlToFile(stale_str_dict, file_handle)
-    if semi_stale_dict:
-      file_handle.write('<h1>' + SECTION_SEMI_STALE + '</h1>\n')
-      _RecursiveHtmlToFile(semi_stale_str_dict, file_handle)
-    if active_dict:
-      file_handle.write('<h1>' + SECTION_ACTIVE + '</h1>\n')
-      _RecursiveHtmlToFile(active_str_dict, file_handle)
-
-    if unused_expectations_str_list:
-      file_handle.write('\n<h1>' + SECTION_UNUSED + '</h1>\n')
-      _RecursiveHtmlToFile(unused_expectations_str_list, file_handle)
-    if unmatched_results_str_dict:
-      file_handle.write('\n<h1>' + SECTION_UNMATCHED + '</h1>\n')
-      _RecursiveHtmlToFile(unmatched_results_str_dict, file_handle)
+    for section, elements in sections:
+      file_handle.write('<h1>' + section + '</h1>\n')
+      _HtmlElementsToFile(elements, file_handle)
+    for section, elements in extra_sections:
+      file_handle.write('\n<h1>' + section + '</h1>\n')
+      _HtmlElementsToFile(elements, file_handle)
 
     file_handle.write(HTML_FOOTER)
     if should_close_file:
       file_handle.close()
     print('Results available at file://%s' % file_handle.name)
+
+  elif output_format == 'jsonl':
+    file_handle = file_handle or sys.stdout
+    records = [
+      _IterTestExpectationMapRecords('stale', stale_dict),
+      _IterTestExpectationMapRecords('semi_stale', semi_stale_dict),
+      _IterTestExpectationMapRecords('active', active_dict),
+      _IterUnusedExpectationsRecords(unused_expectations),
+      _IterUnmatchedResultsRecords(unmatched_results),
+    ]
+    for record_generator in records:
+      for record in record_generator:
+        file_handle.write(json.dumps(record) + '\n')
   else:
     raise RuntimeError('Unsupported output format %s' % output_format)
 
@@ -385,39 +417,58 @@ def RecursivePrintToFile(
     raise RuntimeError('Given unhandled type %s' % type(element))
 
 
-def _RecursiveHtmlToFile(element: ElementType, file_handle: IO) -> None:
-  """Recursively outputs |element| as HTMl to |file_handle|.
+def _PrintElementsToFile(
+  elements: OutputElementGenerator, file_handle: IO
+) -> None:
+  """Streams |elements| as text to |file_handle|.
+
+  Produces the same output as RecursivePrintToFile() would for the
+  equivalent nested dict.
+
+  Args:
+    elements: A generator of OutputElements.
+    file_handle: An open file-like object to output to.
+  """
+  depth = 0
+  for element_type, value in elements:
+    if element_type == _GROUP_END:
+      depth -= 1
+      continue
+    file_handle.write(('  ' * depth) + str(value) + '\n')
+    if element_type == _GROUP_START:
+      depth += 1
+
+
+def _HtmlElementsToFile(
+  elements: OutputElementGenerator, file_handle: IO
+) -> None:
+  """Streams |elements| as HTML to |file_handle|.
 
-  Iterables will be output as a collapsible section containing any of the
-  iterable's contents.
+  Groups will be output as a collapsible section containing the group's
+  contents.
 
   Any link-like text will be turned into anchor tags.
 
   Args:
-    element: A dict, list, or str/unicode to output.
+    elements: A generator of OutputElements.
     file_handle: An open file-like object to output to.
   """
-  if isinstance(element, str):
-    file_handle.write('<p>%s</p>\n' % _LinkifyString(element))
-  elif isinstance(element, dict):
-    for k, v in element.items():
+  for element_type, value in elements:
+    if element_type == _LEAF:
+      file_handle.write('<p>%s</p>\n' % _LinkifyString(value))
+    elif element_type == _GROUP_START:
       html_class = 'collapsible_group'
       # This allows us to later (in JavaScript) recursively highlight sections
       # that are likely of interest to the user, i.e. whose expectations can be
       # modified.
-      if k and FULL_PASS in k:
+      if value and FULL_PASS in value:
         html_class = 'highlighted_collapsible_group'
       file_handle.write(
-        '<button type="button" class="%s">%s</button>\n' % (html_class, k)
+        '<button type="button" class="%s">%s</button>\n' % (html_class, value)
       )
       file_handle.write('<div class="content">\n')
-      _RecursiveHtmlToFile(v, file_handle)
+    else:
       file_handle.write('</div>\n')
-  elif isinstance(element, list):
-    for i in element:
-      _RecursiveHtmlToFile(i, file_handle)
-  else:
-    raise RuntimeError('Given unhandled type %s' % type(element))
 
 
 def _LinkifyString(s: str) -> str:
@@ -437,156 +488,217 @@ def _LinkifyString(s: str) -> str:
   return s
 
 
-def _ConvertTestExpectationMapToStringDict(
+def _IterTestExpectationMapElements(
   test_expectation_map: data_types.TestExpectationMap,
-) -> ExpectationFileStringDict:
-  """Converts |test_expectation_map| to a dict of strings for reporting.
+) -> OutputElementGenerator:
+  """Generates the output for |test_expectation_map| element by element.
 
   Args:
     test_expectation_map: A data_types.TestExpectationMap.
 
-  Returns:
-    A string dictionary representation of |test_expectation_map| in the
-    following format:
-    {
-      expectation_file: {
-        test_name: {
-          expectation_summary: {
-            builder_name: {
-              'Fully passed in the following': [
-                step1,
-              ],
-              'Partially passed in the following': {
-                step2: [
-                  failure_link,
-                ],
-              },
-              'Never passed in the following': [
-                step3,
-              ],
-            }
-          }
-        }
-      }
-    }
+  Yields:
+    OutputElements grouping the expectations by expectation file, test name,
+    expectation, builder and then pass state.
   """
   assert isinstance(test_expectation_map, data_types.TestExpectationMap)
-  output_dict = {}
-  # This initially looks like a good target for using
-  # data_types.TestExpectationMap's iterators since there are many nested loops.
-  # However, we need to reset state in different loops, and the alternative of
-  # keeping all the state outside the loop and resetting under certain
-  # conditions ends up being less readable than just using nested loops.
   for expectation_file, expectation_map in test_expectation_map.items():
-    output_dict[expectation_file] = {}
+    yield _GROUP_START, expectation_file
 
+    # Output is grouped by test name, so find all the expectations for each
+    # test first. Only references are stored, so this is cheap.
+    expectations_by_test = {}
     for expectation, builder_map in expectation_map.items():
-      test_name = expectation.test
-      expectation_str = _FormatExpectation(expectation)
-      output_dict[expectation_file].setdefault(test_name, {})
-      output_dict[expectation_file][test_name][expectation_str] = {}
-
-      for builder_name, step_map in builder_map.items():
-        output_dict[expectation_file][test_name][expectation_str][
-          builder_name
-        ] = {}
-        fully_passed = []
-        partially_passed = {}
-        never_passed = []
-
-        for step_name, stats in step_map.items():
-          if stats.NeverNeededExpectation(expectation):
-            fully_passed.append(AddStatsToStr(step_name, stats))
-          elif stats.AlwaysNeededExpectation(expectation):
-            never_passed.append(AddStatsToStr(step_name, stats))
-          else:
-            assert step_name not in partially_passed
-            partially_passed[step_name] = stats
-
-        output_builder_map = output_dict[expectation_file][test_name][
-          expectation_str
-        ][builder_name]
-        if fully_passed:
-          output_builder_map[FULL_PASS] = fully_passed
-        if partially_passed:
-          output_builder_map[PARTIAL_PASS] = {}
-          for step_name, stats in partially_passed.items():
-            s = AddStatsToStr(step_name, stats)
-            output_builder_map[PARTIAL_PASS][s] = list(stats.failure_links)
-        if never_passed:
-          output_builder_map[NEVER_PASS] = never_passed
-  return output_dict
-
-
-def _ConvertUnmatchedResultsToStringDict(
+      expectations_by_test.setdefault(expectation.test, {})[
+        _FormatExpectation(expectation)
+      ] = (expectation, builder_map)
+
+    for test_name, expectations in expectations_by_test.items():
+      yield _GROUP_START, test_name
+      for expectation_str, (expectation, builder_map) in expectations.items():
+        yield _GROUP_START, expectation_str
+        for builder_name, step_map in builder_map.items():
+          yield _GROUP_START, builder_name
+          yield from _IterStepMapElements(expectation, step_map)
+          yield _GROUP_END, None
+        yield _GROUP_END, None
+      yield _GROUP_END, None
+
+    yield _GROUP_END, None
+
+
+def _IterStepMapElements(
+  expectation: data_types.Expectation, step_map: data_types.StepBuildStatsMap
+) -> OutputElementGenerator:
+  """Generates the output for a single builder's steps.
+
+  Args:
+    expectation: The data_types.Expectation |step_map| is stored under.
+    step_map: A data_types.StepBuildStatsMap.
+
+  Yields:
+    OutputElements grouping the steps by how often they passed.
+  """
+  fully_passed = []
+  partially_passed = []
+  never_passed = []
+  for step_name, stats in step_map.items():
+    if stats.NeverNeededExpectation(expectation):
+      fully_passed.append(AddStatsToStr(step_name, stats))
+    elif stats.AlwaysNeededExpectation(expectation):
+      never_passed.append(AddStatsToStr(step_name, stats))
+    else:
+      partially_passed.append((step_name, stats))
+
+  if fully_passed:
+    yield _GROUP_START, FULL_PASS
+    for s in fully_passed:
+      yield _LEAF, s
+    yield _GROUP_END, None
+  if partially_passed:
+    yield _GROUP_START, PARTIAL_PASS
+    for step_name, stats in partially_passed:
+      yield _GROUP_START, AddStatsToStr(step_name, stats)
+      for link in stats.failure_links:
+        yield _LEAF, link
+      yield _GROUP_END, None
+    yield _GROUP_END, None
+  if never_passed:
+    yield _GROUP_START, NEVER_PASS
+    for s in never_passed:
+      yield _LEAF, s
+    yield _GROUP_END, None
+
+
+def _IterUnmatchedResultsElements(
   unmatched_results: UnmatchedResultsType,
-) -> TestToBuilderStringDict:
-  """Converts |unmatched_results| to a dict of strings for reporting.
+) -> OutputElementGenerator:
+  """Generates the output for |unmatched_results| element by element.
 
   Args:
     unmatched_results: A dict mapping builder names (string) to lists of
         data_types.Result who did not have a matching expectation.
 
-  Returns:
-    A string dictionary representation of |unmatched_results| in the following
-    format:
-    {
-      test_name: {
-        builder_name: {
-          step_name: [
-            individual_result_string_1,
-            individual_result_string_2,
-            ...
-          ],
-          ...
-        },
-        ...
-      },
-      ...
-    }
+  Yields:
+    OutputElements grouping the results by test name, builder and then
+    step name.
   """
-  output_dict = {}
+  # Output is grouped by test name, so index the results first. Only
+  # references are stored, so this is cheap.
+  results_by_test = {}
   for builder, results in unmatched_results.items():
     for r in results:
-      builder_map = output_dict.setdefault(r.test, {})
-      step_map = builder_map.setdefault(builder, {})
-      result_str = 'Got "%s" on %s with tags [%s]' % (
-        r.actual_result,
-        data_types.BuildLinkFromBuildId(r.build_id),
-        ' '.join(r.tags),
-      )
-      step_map.setdefault(r.step, []).append(result_str)
-  return output_dict
-
-
-def _ConvertUnusedExpectationsToStringDict(
+      results_by_test.setdefault(r.test, {}).setdefault(builder, {}).setdefault(
+        r.step, []
+      ).append(r)
+
+  for test_name, builder_map in results_by_test.items():
+    yield _GROUP_START, test_name
+    for builder, step_map in builder_map.items():
+      yield _GROUP_START, builder
+      for step, results in step_map.items():
+        yield _GROUP_START, step
+        for r in results:
+          yield _LEAF, _FormatUnmatchedResult(r)
+        yield _GROUP_END, None
+      yield _GROUP_END, None
+    yield _GROUP_END, None
+
+
+def _IterUnusedExpectationsElements(
   unused_expectations: UnusedExpectation,
-) -> Dict[str, List[str]]:
-  """Converts |unused_expectations| to a dict of strings for reporting.
+) -> OutputElementGenerator:
+  """Generates the output for |unused_expectations| element by element.
 
   Args:
     unused_expectations: A dict mapping expectation file (str) to lists of
         data_types.Expectation who did not have any matching results.
 
-  Returns:
-    A string dictionary representation of |unused_expectations| in the following
-    format:
-    {
-      expectation_file: [
-        expectation1,
-        expectation2,
-      ],
-    }
-    The expectations are in a format similar to what would be present as a line
-    in an expectation file.
+  Yields:
+    OutputElements grouping the expectations by expectation file.
   """
-  output_dict = {}
   for expectation_file, expectations in unused_expectations.items():
-    expectation_str_list = []
+    yield _GROUP_START, expectation_file
     for e in expectations:
-      expectation_str_list.append(e.AsExpectationFileString())
-    output_dict[expectation_file] = expectation_str_list
-  return output_dict
+      yield _LEAF, e.AsExpectationFileString()
+    yield _GROUP_END, None
+
+
+def _IterTestExpectationMapRecords(
+  section: str, test_expectation_map: data_types.TestExpectationMap
+) -> Generator[Dict[str, Any], None, None]:
+  """Generates JSON-serializable records for |test_expectation_map|.
+
+  Args:
+    section: A string denoting which section the map belongs to, e.g. "stale".
+    test_expectation_map: A data_types.TestExpectationMap.
+
+  Yields:
+    One dict per expectation/builder/step combination.
+  """
+  for expectation_file, expectation, builder_map in (
+    test_expectation_map.IterBuilderStepMaps()
+  ):
+    expectation_str = expectation.AsExpectationFileString()
+    for builder_name, step_name, stats in builder_map.IterBuildStats():
+      if stats.NeverNeededExpectation(expectation):
+        pass_type = 'full'
+      elif stats.AlwaysNeededExpectation(expectation):
+        pass_type = 'never'
+      else:
+        pass_type = 'partial'
+      yield {
+        'section': section,
+        'expectation_file': expectation_file,
+        'test': expectation.test,
+        'expectation': expectation_str,
+        'bug': expectation.bug,
+        'builder': builder_name,
+        'step': step_name,
+        'pass_type': pass_type,
+        'passed_builds': stats.passed_builds,
+        'total_builds': stats.total_builds,
+        'failure_links': sorted(stats.failure_links),
+      }
+
+
+def _IterUnusedExpectationsRecords(
+  unused_expectations: UnusedExpectation,
+) -> Generator[Dict[str, Any], None, None]:
+  """Generates JSON-serializable records for |unused_expectations|."""
+  for expectation_file, expectations in unused_expectations.items():
+    for e in expectations:
+      yield {
+        'section': 'unused',
+        'expectation_file': expectation_file,
+        'test': e.test,
+        'expectation': e.AsExpectationFileString(),
+        'bug': e.bug,
+      }
+
+
+def _IterUnmatchedResultsRecords(
+  unmatched_results: UnmatchedResultsType,
+) -> Generator[Dict[str, Any], None, None]:
+  """Generates JSON-serializable records for |unmatched_results|."""
+  for builder, results in unmatched_results.items():
+    for r in results:
+      yield {
+        'section': 'unmatched',
+        'test': r.test,
+        'builder': builder,
+        'step': r.step,
+        'actual_result': r.actual_result,
+        'build_link': data_types.BuildLinkFromBuildId(r.build_id),
+        'tags': sorted(r.tags),
+      }
+
+
+def _FormatUnmatchedResult(result: data_types.Result) -> str:
+  return 'Got "%s" on %s with tags [%s]' % (
+    result.actual_result,
+    data_types.BuildLinkFromBuildId(result.build_id),
+    ' '.join(result.tags),
+  )
 
 
 def _FormatExpectation(expectation: data_types.Expectation) -> str:
@@ -3,7 +3,9 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import io
 import itertools
+import json
 import tempfile
 from typing import Iterable, Set
 import unittest
@@ -49,10 +51,18 @@ def CreateTextOutputPermutations(text: str, inputs: Iterable[str]) -> Set[str]:
   return permutations
 
 
-class ConvertUnmatchedResultsToStringDictUnittest(unittest.TestCase):
+def _ElementsToText(elements: result_output.OutputElementGenerator) -> str:
+  output = io.StringIO()
+  result_output._PrintElementsToFile(elements, output)
+  return output.getvalue()
+
+
+class IterUnmatchedResultsElementsUnittest(unittest.TestCase):
   def testEmptyResults(self) -> None:
     """Tests that providing empty results is a no-op."""
-    self.assertEqual(result_output._ConvertUnmatchedResultsToStringDict({}), {})
+    self.assertEqual(
+      list(result_output._IterUnmatchedResultsElements({})), []
+    )
 
   def testMinimalData(self) -> None:
     """Tests that everything functions when minimal data is provided."""
@@ -61,17 +71,14 @@ class ConvertUnmatchedResultsToStringDictUnittest(unittest.TestCase):
         data_types.Result('foo', [], 'Failure', 'step', 'build_id'),
       ],
     }
-    expected_output = {
-      'foo': {
-        'builder': {
-          'step': [
-            'Got "Failure" on http://ci.chromium.org/b/build_id with tags []',
-          ],
-        },
-      },
-    }
-    output = result_output._ConvertUnmatchedResultsToStringDict(
-      unmatched_results
+    expected_output = """\
+foo
+  builder
+    step
+      Got "Failure" on http://ci.chromium.org/b/build_id with tags []
+"""
+    output = _ElementsToText(
+      result_output._IterUnmatchedResultsElements(unmatched_results)
     )
     self.assertEqual(output, expected_output)
 
@@ -81,35 +88,44 @@ class ConvertUnmatchedResultsToStringDictUnittest(unittest.TestCase):
       'builder': [
         data_types.Result(
           'foo', ['win', 'intel'], 'Failure', 'step_name', 'build_id'
-        )
+        ),
+        data_types.Result('bar', ['linux'], 'Failure', None, 'build_id2'),
+      ],
+      'other_builder': [
+        data_types.Result('foo', ['mac'], 'Crash', 'step_name', 'build_id3'),
       ],
     }
     # TODO(crbug.com/40177248): Hard-code the tag string once only Python 3 is
     # supported.
-    expected_output = {
-      'foo': {
-        'builder': {
-          'step_name': [
-            'Got "Failure" on http://ci.chromium.org/b/build_id with '
-            'tags [%s]' % ' '.join(set(['win', 'intel'])),
-          ]
-        }
-      }
-    }
-    output = result_output._ConvertUnmatchedResultsToStringDict(
-      unmatched_results
+    expected_output = """\
+foo
+  builder
+    step_name
+      Got "Failure" on http://ci.chromium.org/b/build_id with tags [%s]
+  other_builder
+    step_name
+      Got "Crash" on http://ci.chromium.org/b/build_id3 with tags [mac]
+bar
+  builder
+    None
+      Got "Failure" on http://ci.chromium.org/b/build_id2 with tags [linux]
+""" % ' '.join(set(['win', 'intel']))
+    output = _ElementsToText(
+      result_output._IterUnmatchedResultsElements(unmatched_results)
     )
     self.assertEqual(output, expected_output)
 
 
-class ConvertTestExpectationMapToStringDictUnittest(unittest.TestCase):
+class IterTestExpectationMapElementsUnittest(unittest.TestCase):
   def testEmptyMap(self) -> None:
     """Tests that providing an empty map is a no-op."""
     self.assertEqual(
-      result_output._ConvertTestExpectationMapToStringDict(
-        data_types.TestExpectationMap()
+      list(
+        result_output._IterTestExpectationMapElements(
+          data_types.TestExpectationMap()
+        )
       ),
-      {},
+      [],
     )
 
   def testSemiStaleMap(self) -> None:
@@ -160,56 +176,41 @@ class ConvertTestExpectationMapToStringDictUnittest(unittest.TestCase):
     # Set ordering does not appear to be stable between test runs, as we can
     # get either order of tags. So, generate them now instead of hard coding
     # them.
-    linux_tags = ' '.join(set(['linux', 'intel']))
     win_tags = ' '.join(set(['win', 'intel']))
+    linux_tags = ' '.join(set(['linux', 'intel']))
     mac_tags = ' '.join(set(['mac', 'intel']))
-    expected_output = {
-      'expectation_file': {
-        'foo/test': {
-          '"RetryOnFailure" expectation on "%s"' % linux_tags: {
-            'builder': {
-              'Fully passed in the following': [
-                'all_pass (2/2 passed)',
-              ],
-            },
-          },
-          '"RetryOnFailure" expectation on "%s"' % win_tags: {
-            'builder': {
-              'Fully passed in the following': [
-                'all_pass (2/2 passed)',
-              ],
-              'Partially passed in the following': {
-                'some_pass (1/2 passed)': [
-                  data_types.BuildLinkFromBuildId('build_id0'),
-                ],
-              },
-              'Never passed in the following': [
-                'all_fail (0/2 passed)',
-              ],
-            },
-          },
-          '"RetryOnFailure" expectation on "%s"' % mac_tags: {
-            'builder': {
-              'Never passed in the following': [
-                'all_fail (0/2 passed)',
-              ],
-            },
-          },
-        },
-      },
-    }
-
-    str_dict = result_output._ConvertTestExpectationMapToStringDict(
-      expectation_map
+    expected_output = """\
+expectation_file
+  foo/test
+    "RetryOnFailure" expectation on "%s"
+      builder
+        Fully passed in the following
+          all_pass (2/2 passed)
+        Partially passed in the following
+          some_pass (1/2 passed)
+            http://ci.chromium.org/b/build_id0
+        Never passed in the following
+          all_fail (0/2 passed)
+    "RetryOnFailure" expectation on "%s"
+      builder
+        Fully passed in the following
+          all_pass (2/2 passed)
+    "RetryOnFailure" expectation on "%s"
+      builder
+        Never passed in the following
+          all_fail (0/2 passed)
+""" % (win_tags, linux_tags, mac_tags)
+    output = _ElementsToText(
+      result_output._IterTestExpectationMapElements(expectation_map)
     )
-    self.assertEqual(str_dict, expected_output)
+    self.assertEqual(output, expected_output)
 
 
-class ConvertUnusedExpectationsToStringDictUnittest(unittest.TestCase):
+class IterUnusedExpectationsElementsUnittest(unittest.TestCase):
   def testEmptyDict(self) -> None:
     """Tests that nothing blows up when given an empty dict."""
     self.assertEqual(
-      result_output._ConvertUnusedExpectationsToStringDict({}), {}
+      list(result_output._IterUnusedExpectationsElements({})), []
     )
 
   def testBasic(self) -> None:
@@ -227,24 +228,17 @@ class ConvertUnusedExpectationsToStringDictUnittest(unittest.TestCase):
         ),
       ],
     }
-    # Set ordering does not appear to be stable between test runs, as we can
-    # get either order of tags. So, generate them now instead of hard coding
-    # them.
-    tags = ' '.join(['nvidia', 'win'])
-    results = ' '.join(['Failure', 'Timeout'])
-    expected_output = {
-      'foo_file': [
-        '[ %s ] foo/test [ %s ]' % (tags, results),
-      ],
-      'bar_file': [
-        '[ win ] bar/test [ Failure ]',
-        '[ win ] bar/test2 [ RetryOnFailure ]',
-      ],
-    }
-    self.assertEqual(
-      result_output._ConvertUnusedExpectationsToStringDict(unused),
-      expected_output,
+    expected_output = """\
+foo_file
+  [ nvidia win ] foo/test [ Failure Timeout ]
+bar_file
+  [ win ] bar/test [ Failure ]
+  [ win ] bar/test2 [ RetryOnFailure ]
+"""
+    output = _ElementsToText(
+      result_output._IterUnusedExpectationsElements(unused)
     )
+    self.assertEqual(output, expected_output)
 
 
 class HtmlToFileUnittest(fake_filesystem_unittest.TestCase):
@@ -268,50 +262,58 @@ class HtmlToFileUnittest(fake_filesystem_unittest.TestCase):
       'link to <a href="http://a">http://a</a>, click it',
     )
 
-  def testRecursiveHtmlToFileExpectationMap(self) -> None:
-    """Tests _RecursiveHtmlToFile() with an expectation map as input."""
-    expectation_map = {
-      'foo': {
-        '"RetryOnFailure" expectation on "win intel"': {
-          'builder': {
-            'Fully passed in the following': [
-              'all_pass (2/2)',
-            ],
-            'Never passed in the following': [
-              'all_fail (0/2)',
-            ],
-            'Partially passed in the following': {
-              'some_pass (1/2)': [
-                data_types.BuildLinkFromBuildId('build_id0'),
-              ],
-            },
-          },
-        },
-      },
-    }
-    result_output._RecursiveHtmlToFile(expectation_map, self._file_handle)
+  def testHtmlElementsToFileExpectationMap(self) -> None:
+    """Tests _HtmlElementsToFile() with an expectation map as input."""
+    expectation_map = data_types.TestExpectationMap(
+      {
+        'foo': data_types.ExpectationBuilderMap(
+          {
+            data_types.Expectation(
+              'foo/test', ['win'], ['RetryOnFailure'], NON_WILDCARD
+            ): data_types.BuilderStepMap(
+              {
+                'builder': data_types.StepBuildStatsMap(
+                  {
+                    'all_pass': uu.CreateStatsWithPassFails(2, 0),
+                    'all_fail': uu.CreateStatsWithPassFails(0, 2),
+                    'some_pass': uu.CreateStatsWithPassFails(1, 1),
+                  }
+                ),
+              }
+            ),
+          }
+        ),
+      }
+    )
+    result_output._HtmlElementsToFile(
+      result_output._IterTestExpectationMapElements(expectation_map),
+      self._file_handle,
+    )
     self._file_handle.close()
     # pylint: disable=line-too-long
     expected_output = """\
 <button type="button" class="collapsible_group">foo</button>
 <div class="content">
-  <button type="button" class="collapsible_group">"RetryOnFailure" expectation on "win intel"</button>
+  <button type="button" class="collapsible_group">foo/test</button>
   <div class="content">
-    <button type="button" class="collapsible_group">builder</button>
+    <button type="button" class="collapsible_group">"RetryOnFailure" expectation on "win"</button>
     <div class="content">
-      <button type="button" class="highlighted_collapsible_group">Fully passed in the following</button>
+      <button type="button" class="collapsible_group">builder</button>
       <div class="content">
-        <p>all_pass (2/2)</p>
-      </div>
-      <button type="button" class="collapsible_group">Never passed in the following</button>
-      <div class="content">
-        <p>all_fail (0/2)</p>
-      </div>
-      <button type="button" class="collapsible_group">Partially passed in the following</button>
-      <div class="content">
-        <button type="button" class="collapsible_group">some_pass (1/2)</button>
+        <button type="button" class="highlighted_collapsible_group">Fully passed in the following</button>
+        <div class="content">
+          <p>all_pass (2/2 passed)</p>
+        </div>
+        <button type="button" class="collapsible_group">Partially passed in the following</button>
+        <div class="content">
+          <button type="button" class="collapsible_group">some_pass (1/2 passed)</button>
+          <div class="content">
+            <p><a href="http://ci.chromium.org/b/build_id0">http://ci.chromium.org/b/build_id0</a></p>
+          </div>
+        </div>
+        <button type="button" class="collapsible_group">Never passed in the following</button>
         <div class="content">
-          <p><a href="http://ci.chromium.org/b/build_id0">http://ci.chromium.org/b/build_id0</a></p>
+          <p>all_fail (0/2 passed)</p>
         </div>
       </div>
     </div>
@@ -323,55 +325,40 @@ class HtmlToFileUnittest(fake_filesystem_unittest.TestCase):
     with open(self._filepath) as f:
       self.assertEqual(f.read(), expected_output)
 
-  def testRecursiveHtmlToFileUnmatchedResults(self) -> None:
-    """Tests _RecursiveHtmlToFile() with unmatched results as input."""
+  def testHtmlElementsToFileUnmatchedResults(self) -> None:
+    """Tests _HtmlElementsToFile() with unmatched results as input."""
     unmatched_results = {
-      'foo': {
-        'builder': {
-          None: [
-            'Expected "" on http://ci.chromium.org/b/build_id, got '
-            '"Failure" with tags []',
-          ],
-          'step_name': [
-            'Expected "Failure RetryOnFailure" on '
-            'http://ci.chromium.org/b/build_id, got '
-            '"Failure" with tags [win intel]',
-          ],
-        },
-      },
+      'builder': [
+        data_types.Result('foo', [], 'Failure', None, 'build_id'),
+        data_types.Result('foo', ['win'], 'Failure', 'step_name', 'build_id'),
+      ],
     }
-    result_output._RecursiveHtmlToFile(unmatched_results, self._file_handle)
+    result_output._HtmlElementsToFile(
+      result_output._IterUnmatchedResultsElements(unmatched_results),
+      self._file_handle,
+    )
     self._file_handle.close()
     # pylint: disable=line-too-long
-    # Order is not guaranteed, so create permutations.
-    expected_template = """\
+    expected_output = """\
 <button type="button" class="collapsible_group">foo</button>
 <div class="content">
   <button type="button" class="collapsible_group">builder</button>
   <div class="content">
-    %s
-  </div>
-</div>
-"""
-    values = [
-      """\
     <button type="button" class="collapsible_group">None</button>
     <div class="content">
-      <p>Expected "" on <a href="http://ci.chromium.org/b/build_id">http://ci.chromium.org/b/build_id</a>, got "Failure" with tags []</p>
+      <p>Got "Failure" on <a href="http://ci.chromium.org/b/build_id">http://ci.chromium.org/b/build_id</a> with tags []</p>
     </div>
-""",
-      """\
     <button type="button" class="collapsible_group">step_name</button>
     <div class="content">
-      <p>Expected "Failure RetryOnFailure" on <a href="http://ci.chromium.org/b/build_id">http://ci.chromium.org/b/build_id</a>, got "Failure" with tags [win intel]</p>
+      <p>Got "Failure" on <a href="http://ci.chromium.org/b/build_id">http://ci.chromium.org/b/build_id</a> with tags [win]</p>
     </div>
-""",
-    ]
-    expected_output = CreateTextOutputPermutations(expected_template, values)
+  </div>
+</div>
+"""
     # pylint: enable=line-too-long
-    expected_output = [_Dedent(e) for e in expected_output]
+    expected_output = _Dedent(expected_output)
     with open(self._filepath) as f:
-      self.assertIn(f.read(), expected_output)
+      self.assertEqual(f.read(), expected_output)
 
 
 class PrintToFileUnittest(fake_filesystem_unittest.TestCase):
@@ -596,6 +583,223 @@ class OutputResultsUnittest(fake_filesystem_unittest.TestCase):
     )
 
 
+class StreamedOutputUnittest(unittest.TestCase):
+  def setUp(self) -> None:
+    # yapf: disable
+    self._expectation_map = data_types.TestExpectationMap({
+        'foo':
+        data_types.ExpectationBuilderMap({
+            data_types.Expectation(
+                'foo', ['win', 'intel'], 'RetryOnFailure', NON_WILDCARD):
+            data_types.BuilderStepMap({
+                'stale':
+                data_types.StepBuildStatsMap({
+                    'all_pass':
+                    uu.CreateStatsWithPassFails(2, 0),
+                }),
+            }),
+            data_types.Expectation('foo', ['linux'], 'Failure', NON_WILDCARD):
+            data_types.BuilderStepMap({
+                'semi_stale':
+                data_types.StepBuildStatsMap({
+                    'all_pass':
+                    uu.CreateStatsWithPassFails(2, 0),
+                    'some_pass':
+                    uu.CreateStatsWithPassFails(1, 1),
+                    'none_pass':
+                    uu.CreateStatsWithPassFails(0, 2),
+                }),
+            }),
+            data_types.Expectation('bar', ['mac'], 'Failure', NON_WILDCARD):
+            data_types.BuilderStepMap({
+                'active':
+                data_types.StepBuildStatsMap({
+                    'none_pass':
+                    uu.CreateStatsWithPassFails(0, 2),
+                }),
+            }),
+        }),
+    })
+    # yapf: enable
+    self._unmatched_results = {
+      'builder': [
+        data_types.Result(
+          'foo', ['win', 'intel'], 'Failure', 'step_name', 'build_id'
+        ),
+        data_types.Result('bar', ['linux'], 'Failure', 'step_name', 'id2'),
+      ],
+      'other_builder': [
+        data_types.Result('foo', ['mac'], 'Crash', 'step_name', 'id3'),
+      ],
+    }
+    self._unused_expectations = {
+      'foo_file': [
+        data_types.Expectation(
+          'foo', ['linux'], 'RetryOnFailure', NON_WILDCARD
+        ),
+      ],
+    }
+
+  def testPrint(self) -> None:
+    """Tests that text output is streamed section by section."""
+    stale, semi_stale, active = self._expectation_map.SplitByStaleness()
+    output = io.StringIO()
+    result_output.OutputResults(
+      stale,
+      semi_stale,
+      active,
+      self._unmatched_results,
+      self._unused_expectations,
+      'print',
+      output,
+    )
+    # TODO(crbug.com/40177248): Hard-code the tag string once only Python 3 is
+    # supported.
+    win_tags = ' '.join(set(['win', 'intel']))
+    expected_output = """\
+%s
+foo
+  foo
+    "RetryOnFailure" expectation on "%s"
+      stale
+        Fully passed in the following
+          all_pass (2/2 passed)
+%s
+foo
+  foo
+    "Failure" expectation on "linux"
+      semi_stale
+        Fully passed in the following
+          all_pass (2/2 passed)
+        Partially passed in the following
+          some_pass (1/2 passed)
+            http://ci.chromium.org/b/build_id0
+        Never passed in the following
+          none_pass (0/2 passed)
+%s
+foo
+  bar
+    "Failure" expectation on "mac"
+      active
+        Never passed in the following
+          none_pass (0/2 passed)
+
+%s
+foo_file
+  [ linux ] foo [ RetryOnFailure ]
+
+%s
+foo
+  builder
+    step_name
+      Got "Failure" on http://ci.chromium.org/b/build_id with tags [%s]
+  other_builder
+    step_name
+      Got "Crash" on http://ci.chromium.org/b/id3 with tags [mac]
+bar
+  builder
+    step_name
+      Got "Failure" on http://ci.chromium.org/b/id2 with tags [linux]
+""" % (
+      result_output.SECTION_STALE,
+      win_tags,
+      result_output.SECTION_SEMI_STALE,
+      result_output.SECTION_ACTIVE,
+      result_output.SECTION_UNUSED,
+      result_output.SECTION_UNMATCHED,
+      win_tags,
+    )
+    self.assertEqual(output.getvalue(), expected_output)
+
+  def testHtml(self) -> None:
+    """Tests that HTML output is streamed section by section."""
+    with tempfile.NamedTemporaryFile(mode='w+') as output:
+      result_output.OutputResults(
+        data_types.TestExpectationMap(),
+        data_types.TestExpectationMap(),
+        data_types.TestExpectationMap(),
+        {},
+        self._unused_expectations,
+        'html',
+        output,
+      )
+      output.seek(0)
+      actual_output = output.read()
+    expected_output = _Dedent("""\
+<h1>%s</h1>
+<button type="button" class="collapsible_group">foo_file</button>
+<div class="content">
+  <p>[ linux ] foo [ RetryOnFailure ]</p>
+</div>
+""") % result_output.SECTION_UNUSED
+    self.assertEqual(
+      actual_output,
+      result_output.HTML_HEADER + '\n' + expected_output
+      + result_output.HTML_FOOTER,
+    )
+
+  def testJsonLines(self) -> None:
+    """Tests that JSON lines output contains one record per line."""
+    stale, semi_stale, active = self._expectation_map.SplitByStaleness()
+    output = io.StringIO()
+    result_output.OutputResults(
+      stale,
+      semi_stale,
+      active,
+      self._unmatched_results,
+      self._unused_expectations,
+      'jsonl',
+      output,
+    )
+    records = [json.loads(l) for l in output.getvalue().splitlines()]
+
+    def _Pick(r: dict) -> tuple:
+      return (r['section'], r.get('builder'), r.get('step'), r.get('pass_type'))
+
+    self.assertEqual(
+      [_Pick(r) for r in records],
+      [
+        ('stale', 'stale', 'all_pass', 'full'),
+        ('semi_stale', 'semi_stale', 'all_pass', 'full'),
+        ('semi_stale', 'semi_stale', 'some_pass', 'partial'),
+        ('semi_stale', 'semi_stale', 'none_pass', 'never'),
+        ('active', 'active', 'none_pass', 'never'),
+        ('unused', None, None, None),
+        ('unmatched', 'builder', 'step_name', None),
+        ('unmatched', 'builder', 'step_name', None),
+        ('unmatched', 'other_builder', 'step_name', None),
+      ],
+    )
+    self.assertEqual(
+      records[0],
+      {
+        'section': 'stale',
+        'expectation_file': 'foo',
+        'test': 'foo',
+        'expectation': '[ intel win ] foo [ RetryOnFailure ]',
+        'bug': '',
+        'builder': 'stale',
+        'step': 'all_pass',
+        'pass_type': 'full',
+        'passed_builds': 2,
+        'total_builds': 2,
+        'failure_links': [],
+      },
+    )
+    self.assertEqual(
+      records[-1],
+      {
+        'section': 'unmatched',
+        'test': 'foo',
+        'builder': 'other_builder',
+        'step': 'step_name',
+        'actual_result': 'Crash',
+        'build_link': 'http://ci.chromium.org/b/id3',
+        'tags': ['mac'],
+      },
+    )
+
+
 class OutputAffectedUrlsUnittest(fake_filesystem_unittest.TestCase):
   def setUp(self) -> None:
     self.setUpPyfakefs()
@@ -3,10 +3,14 @@
 # found in the LICENSE file.
 """Helper methods for unittests."""
 
+import random
 from typing import Generator, Iterable, List, Optional, Set, Tuple, Type
 
 # vpython-provided modules.
-import pandas  # pylint: disable=import-error
+# pylint: disable=import-error
+import pandas
+import pyarrow
+# pylint: enable=import-error
 
 # //testing imports.
 from unexpected_passes_common import builders
@@ -24,6 +28,61 @@ def CreateStatsWithPassFails(passes: int, fails: int) -> data_types.BuildStats:
   return stats
 
 
+def CreateSyntheticExpectationMap(
+  num_expectation_files: int,
+  num_expectations: int,
+  num_builders: int,
+  builders_per_expectation: int = 10,
+  seed: int = 0,
+) -> data_types.TestExpectationMap:
+  """Creates a large, filled TestExpectationMap for tests and benchmarks.
+
+  Args:
+    num_expectation_files: The number of expectation files to spread the
+        expectations across.
+    num_expectations: The total number of expectations to create.
+    num_builders: The number of distinct builders to draw from.
+    builders_per_expectation: How many builders each expectation has stats
+        for.
+    seed: The seed used to randomly pick builders and pass/fail counts.
+
+  Returns:
+    A data_types.TestExpectationMap containing a roughly even mix of stale,
+    semi-stale and active expectations.
+  """
+  rng = random.Random(seed)
+  builder_names = ['builder%d' % i for i in range(num_builders)]
+  expectation_map = data_types.TestExpectationMap()
+  for i in range(num_expectations):
+    expectation_file = 'expectations%d.txt' % (i % num_expectation_files)
+    expectation = data_types.Expectation(
+      'test%d' % i,
+      ['tag%d' % (i % 7)],
+      'Failure',
+      data_types.WildcardType.NON_WILDCARD,
+    )
+    # Pick the overall state first so that all states are well represented
+    # regardless of how many builders each expectation has.
+    state = rng.choice(['stale', 'semi_stale', 'active'])
+    builder_map = data_types.BuilderStepMap()
+    for builder_name in rng.sample(
+      builder_names, min(builders_per_expectation, num_builders)
+    ):
+      if state == 'stale':
+        passes, fails = rng.randint(1, 10), 0
+      elif state == 'active':
+        passes, fails = rng.choice([0, 5]), rng.randint(1, 5)
+      else:
+        passes, fails = rng.randint(1, 10), rng.choice([0, 0, 1, 5])
+      builder_map[builder_name] = data_types.StepBuildStatsMap(
+        {'step': CreateStatsWithPassFails(passes, fails)}
+      )
+    expectation_map.setdefault(
+      expectation_file, data_types.ExpectationBuilderMap()
+    )[expectation] = builder_map
+  return expectation_map
+
+
 # id_ is used instead of id since id is a python built-in.
 def FakeQueryResult(
   builder_name: str,
@@ -46,15 +105,33 @@ def FakeQueryResult(
   )
 
 
+def FakeRecordBatch(rows: List[pandas.Series]) -> pyarrow.RecordBatch:
+  """Creates an Arrow record batch equivalent to |rows|.
+
+  Args:
+    rows: A list of rows created by FakeQueryResult().
+  """
+  return pyarrow.RecordBatch.from_pylist([r.to_dict() for r in rows])
+
+
 class SimpleBigQueryQuerier(queries_module.BigQueryQuerier):
   def __init__(self, *args, **kwargs):
     super().__init__(*args, **kwargs)
     self.query_results = []
+    # The number of rows to put in each record batch when using columnar
+    # ingestion.
+    self.batch_size = 2
 
   def _GetSeriesForQuery(self, _) -> Generator[pandas.Series, None, None]:
     for r in self.query_results:
       yield r
 
+  def _GetRecordBatchesForQuery(
+    self, _
+  ) -> Generator[pyarrow.RecordBatch, None, None]:
+    for i in range(0, len(self.query_results), self.batch_size):
+      yield FakeRecordBatch(self.query_results[i : i + self.batch_size])
+
   def _GetRelevantExpectationFilesForQueryResult(self, _) -> None:
     return None
 
@@ -77,12 +154,25 @@ def CreateGenericQuerier(
   num_samples: Optional[int] = None,
   keep_unmatched_results: bool = False,
   cls: Optional[Type[queries_module.BigQueryQuerier]] = None,
+  columnar_ingestion: bool = False,
+  jobs: int = 1,
+  cache_dir: Optional[str] = None,
+  query_cache_max_age_hours: float = 0,
 ) -> queries_module.BigQueryQuerier:
   suite = suite or 'pixel'
   project = project or 'project'
   num_samples = num_samples or 5
   cls = cls or SimpleBigQueryQuerier
-  return cls(suite, project, num_samples, keep_unmatched_results)
+  return cls(
+    suite,
+    project,
+    num_samples,
+    keep_unmatched_results,
+    columnar_ingestion=columnar_ingestion,
+    jobs=jobs,
+    cache_dir=cache_dir,
+    query_cache_max_age_hours=query_cache_max_age_hours,
+  )
 
 
 def GetArgsForMockCall(
@@ -107,9 +197,12 @@ def GetArgsForMockCall(
 class GenericBuilders(builders.Builders):
   # pylint: disable=useless-super-delegation
   def __init__(
-    self, suite: Optional[str] = None, include_internal_builders: bool = False
+    self,
+    suite: Optional[str] = None,
+    include_internal_builders: bool = False,
+    cache_dir: Optional[str] = None,
   ):
-    super().__init__(suite, include_internal_builders)
+    super().__init__(suite, include_internal_builders, cache_dir)
 
   # pylint: enable=useless-super-delegation
 